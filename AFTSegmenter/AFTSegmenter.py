@@ -11,11 +11,13 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 import os
+import time
+import tempfile
 import unittest
-import sys
 import platform
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
+from LesionSpotlightLib import CLIUtils
 import logging
 
 #
@@ -53,6 +55,7 @@ class AFTSegmenterWidget(ScriptedLoadableModuleWidget):
   """
 
   def setup(self):
+    from LesionSpotlightLib import LesionSurfaces
     # ScriptedLoadableModuleWidget.setup(self)
     #
     # Instantiate and connect widgets ...
@@ -126,13 +129,71 @@ class AFTSegmenterWidget(ScriptedLoadableModuleWidget):
       "Output a global lesion mask.")
     parametersInputFormLayout.addRow("Lesion Label ", self.outputSelector)
 
+    #
+    # output lesion statistics table selector
+    #
+    self.lesionStatisticsSelector = slicer.qMRMLNodeComboBox()
+    self.lesionStatisticsSelector.nodeTypes = ["vtkMRMLTableNode"]
+    self.lesionStatisticsSelector.selectNodeUponCreation = True
+    self.lesionStatisticsSelector.addEnabled = True
+    self.lesionStatisticsSelector.renameEnabled = True
+    self.lesionStatisticsSelector.removeEnabled = True
+    self.lesionStatisticsSelector.noneEnabled = True
+    self.lesionStatisticsSelector.showHidden = False
+    self.lesionStatisticsSelector.showChildNodeTypes = False
+    self.lesionStatisticsSelector.setMRMLScene(slicer.mrmlScene)
+    self.lesionStatisticsSelector.setToolTip(
+      "Optional table with the voxel count, volume, centroid, bounding box and mean T2-FLAIR intensity of each lesion.")
+    parametersInputFormLayout.addRow("Lesion Statistics ", self.lesionStatisticsSelector)
+
+    #
+    # output lesion segmentation selector
+    #
+    self.outputSegmentationSelector = slicer.qMRMLNodeComboBox()
+    self.outputSegmentationSelector.nodeTypes = ["vtkMRMLSegmentationNode"]
+    self.outputSegmentationSelector.selectNodeUponCreation = True
+    self.outputSegmentationSelector.addEnabled = True
+    self.outputSegmentationSelector.renameEnabled = True
+    self.outputSegmentationSelector.removeEnabled = True
+    self.outputSegmentationSelector.noneEnabled = True
+    self.outputSegmentationSelector.showHidden = False
+    self.outputSegmentationSelector.showChildNodeTypes = False
+    self.outputSegmentationSelector.setMRMLScene(slicer.mrmlScene)
+    self.outputSegmentationSelector.setToolTip(
+      "Optional segmentation with the lesions of the lesion label. Its 3D surfaces are only built when it is shown in 3D.")
+    parametersInputFormLayout.addRow("Lesion Segmentation ", self.outputSegmentationSelector)
+
+    #
+    # One segment per lesion?
+    #
+    self.setPerLesionSegmentsWidget = ctk.ctkCheckBox()
+    self.setPerLesionSegmentsWidget.setChecked(True)
+    self.setPerLesionSegmentsWidget.setToolTip(
+      "Writes each connected lesion to its own segment. If not, all the lesions are written to a single segment.")
+    parametersInputFormLayout.addRow("One segment per lesion?",
+                                     self.setPerLesionSegmentsWidget)
+
+    #
+    # Minimum 3D lesion volume
+    #
+    self.setMinimumDisplayVolumeWidget = qt.QDoubleSpinBox()
+    self.setMinimumDisplayVolumeWidget.setDecimals(1)
+    self.setMinimumDisplayVolumeWidget.setMinimum(0)
+    self.setMinimumDisplayVolumeWidget.setMaximum(1000)
+    self.setMinimumDisplayVolumeWidget.setValue(LesionSurfaces.MINIMUM_DISPLAY_VOLUME)
+    self.setMinimumDisplayVolumeWidget.setSuffix(" mm3")
+    self.setMinimumDisplayVolumeWidget.setToolTip("Lesions smaller than this volume are not shown in 3D, which keeps the 3D view "
+                                                  "responsive on brains with many small lesions.")
+    parametersInputFormLayout.addRow("Minimum 3D Lesion Volume ", self.setMinimumDisplayVolumeWidget)
+
     #
     # Is brain extracted?
     #
     self.setIsBETWidget = ctk.ctkCheckBox()
     self.setIsBETWidget.setChecked(False)
     self.setIsBETWidget.setToolTip(
-      "Is the input data (T1 and T2-FLAIR) already brain extracted?")
+      "Is the input data (T1 and T2-FLAIR) already brain extracted? If not, the processing is restricted to the brain mask "
+      "given by the MNI152 brain tissues registered to the T1.")
     parametersInputFormLayout.addRow("Is brain extracted?",
                                      self.setIsBETWidget)
 
@@ -176,7 +237,8 @@ class AFTSegmenterWidget(ScriptedLoadableModuleWidget):
     self.setGammaWidget.singleStep = 0.1
     self.setGammaWidget.value = 2.0
     self.setGammaWidget.setToolTip(
-      "Define the outlier detection based on units of standard deviation in the T2-FLAIR gray matter voxel intensity distribution.")
+      "Define the outlier detection based on units of standard deviation in the T2-FLAIR gray matter voxel intensity distribution. "
+      "After a full resolution run, changing it updates the output lesion map without running the segmentation again.")
     parametersSegmentationFormLayout.addRow("Gamma ", self.setGammaWidget)
 
     #
@@ -203,6 +265,17 @@ class AFTSegmenterWidget(ScriptedLoadableModuleWidget):
       "Set the minimum lesion size adopted as a true lesion in the final lesion map. Units given in number of voxels.")
     parametersSegmentationFormLayout.addRow("Minimum Lesion Size ", self.setMinimumLesionWidget)
 
+    #
+    # Lesion Connectivity
+    #
+    self.setConnectivityWidget = ctk.ctkComboBox()
+    self.setConnectivityWidget.addItem("6")
+    self.setConnectivityWidget.addItem("18")
+    self.setConnectivityWidget.addItem("26")
+    self.setConnectivityWidget.setToolTip(
+      "Neighbourhood used to group voxels into the same lesion: 6 (faces), 18 (faces and edges) or 26 (faces, edges and corners).")
+    parametersSegmentationFormLayout.addRow("Lesion Connectivity ", self.setConnectivityWidget)
+
     #
     # Gray Matter Label
     #
@@ -226,8 +299,66 @@ class AFTSegmenterWidget(ScriptedLoadableModuleWidget):
     parametersSegmentationFormLayout.addRow("White Matter Label Value ", self.setWMLabelWidget)
 
 
+    #
+    # Execution Parameters Area
+    #
+    parametersExecutionCollapsibleButton = ctk.ctkCollapsibleButton()
+    parametersExecutionCollapsibleButton.text = "Execution Parameters"
+    parametersExecutionCollapsibleButton.collapsed = True
+    self.layout.addWidget(parametersExecutionCollapsibleButton)
+
+    # Layout within the dummy collapsible button
+    parametersExecutionFormLayout = qt.QFormLayout(parametersExecutionCollapsibleButton)
+
+    #
+    # Number Of Threads Area
+    #
+    self.setNumberOfThreadsWidget = qt.QSpinBox()
+    self.setNumberOfThreadsWidget.setMinimum(0)
+    self.setNumberOfThreadsWidget.setMaximum(256)
+    self.setNumberOfThreadsWidget.setValue(0)
+    self.setNumberOfThreadsWidget.setSpecialValueText("All cores")
+    self.setNumberOfThreadsWidget.setToolTip("Maximum number of threads used by each processing step (bias field correction, "
+                                             "filtering, registration and resampling). Lower it to run several segmentations on the same computer.")
+    parametersExecutionFormLayout.addRow("Number Of Threads ", self.setNumberOfThreadsWidget)
+
+    #
+    # Preprocessing Profile Area
+    #
+    self.setPreprocessingProfileWidget = ctk.ctkComboBox()
+    self.setPreprocessingProfileWidget.addItem("accurate")
+    self.setPreprocessingProfileWidget.addItem("balanced")
+    self.setPreprocessingProfileWidget.addItem("fast")
+    self.setPreprocessingProfileWidget.setToolTip("Bias field correction and noise attenuation settings. accurate keeps the default settings, "
+                                                  "balanced and fast trade a small lesion map difference for a shorter preprocessing.")
+    parametersExecutionFormLayout.addRow("Preprocessing Profile ", self.setPreprocessingProfileWidget)
+
+    #
+    # Preview Spacing Area
+    #
+    self.setPreviewSpacingWidget = qt.QDoubleSpinBox()
+    self.setPreviewSpacingWidget.setDecimals(1)
+    self.setPreviewSpacingWidget.setMinimum(0)
+    self.setPreviewSpacingWidget.setMaximum(5)
+    self.setPreviewSpacingWidget.setSingleStep(0.5)
+    self.setPreviewSpacingWidget.setValue(0)
+    self.setPreviewSpacingWidget.setSuffix(" mm")
+    self.setPreviewSpacingWidget.setSpecialValueText("Full resolution")
+    self.setPreviewSpacingWidget.setToolTip("Runs a quick preview on the inputs resampled to this spacing (e.g. 2 or 3 mm) and shows the result "
+                                            "on the input grid. Useful to explore the parameters before a full resolution run.")
+    parametersExecutionFormLayout.addRow("Preview Spacing ", self.setPreviewSpacingWidget)
+
+    self.logic = AFTSegmenterLogic()
+    self.gammaTimer = qt.QTimer()
+    self.gammaTimer.setSingleShot(True)
+    self.gammaTimer.setInterval(300)
+
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.setGammaWidget.connect("valueChanged(double)", self.onGammaChanged)
+    self.setMinimumLesionWidget.connect("valueChanged(int)", self.onGammaChanged)
+    self.setConnectivityWidget.connect("currentIndexChanged(int)", self.onGammaChanged)
+    self.gammaTimer.connect("timeout()", self.onGammaTimeout)
     self.inputT1Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.inputFLAIRSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.outputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
@@ -239,13 +370,26 @@ class AFTSegmenterWidget(ScriptedLoadableModuleWidget):
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.gammaTimer.stop()
+    self.logic.clearGammaLevelCache()
 
   def onSelect(self):
     self.applyButton.enabled = self.inputT1Selector.currentNode() and self.outputSelector.currentNode() and self.inputFLAIRSelector.currentNode()
 
+  def onGammaChanged(self, value=None):
+    if self.logic.hasGammaLevelCache(self.outputSelector.currentNode()):
+      self.gammaTimer.start()
+
+  def onGammaTimeout(self):
+    if self.logic.hasGammaLevelCache(self.outputSelector.currentNode()):
+      self.logic.updateGamma(self.setGammaWidget.value, self.setMinimumLesionWidget.value,
+                             int(self.setConnectivityWidget.currentText))
+      self.exportSegmentation()
+
   def onApplyButton(self):
-    logic = AFTSegmenterLogic()
+    from LesionSpotlightLib import QualityGates
+    self.gammaTimer.stop()
+    self.logic.clearGammaLevelCache()
     # enableScreenshotsFlag = self.enableScreenshotsFlagCheckBox.checked
     # imageThreshold = self.imageThresholdSliderWidget.value
     isBET=self.setIsBETWidget.isChecked()
@@ -255,8 +399,34 @@ class AFTSegmenterWidget(ScriptedLoadableModuleWidget):
     minLesionSize=self.setMinimumLesionWidget.value
     GMLabel=self.setGMLabelWidget.value
     WMLabel=self.setWMLabelWidget.value
-    logic.run(self.inputT1Selector.currentNode(), self.inputFLAIRSelector.currentNode(), self.outputSelector.currentNode(), isBET,
-              absError,gamma,WMMath,minLesionSize,GMLabel,WMLabel)
+    connectivity=int(self.setConnectivityWidget.currentText)
+    numberOfThreads=self.setNumberOfThreadsWidget.value
+    preprocessingProfile=self.setPreprocessingProfileWidget.currentText
+    previewSpacing=self.setPreviewSpacingWidget.value
+    # The gamma level map lets the gamma slider update the lesion map of full resolution runs
+    gammaLevelMapVolume = None
+    if not previewSpacing:
+      gammaLevelMapVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "AFTSegmenterGammaLevelMap")
+    try:
+      result = self.logic.run(self.inputT1Selector.currentNode(), self.inputFLAIRSelector.currentNode(), self.outputSelector.currentNode(), isBET,
+                              absError,gamma,WMMath,minLesionSize,GMLabel,WMLabel,connectivity,self.lesionStatisticsSelector.currentNode(),
+                              numberOfThreads, preprocessingProfile, previewSpacing, gammaLevelMapVolume=gammaLevelMapVolume)
+      if result and gammaLevelMapVolume:
+        self.logic.cacheGammaLevelMap(self.outputSelector.currentNode(), gammaLevelMapVolume)
+      if result:
+        self.exportSegmentation()
+    except QualityGates.QualityGateError as e:
+      slicer.util.errorDisplay("Segmentation aborted: %s" % e)
+    finally:
+      if gammaLevelMapVolume:
+        slicer.mrmlScene.RemoveNode(gammaLevelMapVolume)
+
+  def exportSegmentation(self):
+    from LesionSpotlightLib import LesionSurfaces
+    if self.outputSegmentationSelector.currentNode():
+      LesionSurfaces.exportLesions(self.outputSelector.currentNode(), self.outputSegmentationSelector.currentNode(),
+                                   self.setPerLesionSegmentsWidget.isChecked(), int(self.setConnectivityWidget.currentText),
+                                   self.setMinimumDisplayVolumeWidget.value)
 
 #
 # AFTSegmenterLogic
@@ -272,6 +442,13 @@ class AFTSegmenterLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  # Atlases of the segmentation, recorded in the cohort summary
+  SUMMARY_ATLASES = ("MNI152_T1_1mm_brain.nii.gz", "MNI152_T1_1mm_brain_tissues.nii.gz")
+
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    self.gammaLevelCache = None
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -299,10 +476,69 @@ class AFTSegmenterLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
-  def run(self, inputT1Volume, inputFLAIRVolume, outputVolume, isBET, absError, gamma, WMMath, minLesionSize, GMlabel, WMLabel):
+  def lesionStatisticsFile(self):
+    """New temporary file for the lesion statistics of a run, so that concurrent runs do not share
+    it. readLesionStatistics removes it.
+    """
+    handle, statisticsFile = tempfile.mkstemp(suffix=".csv", prefix="AFTSegmenterLesionStatistics", dir=slicer.app.temporaryPath)
+    os.close(handle)
+    return statisticsFile
+
+  def readLesionStatistics(self, statisticsFile, lesionStatisticsTable):
+    """Reads the lesion statistics table written by the automatic FLAIR threshold and removes its file
     """
-    Run the actual algorithm
+    try:
+      storageNode = slicer.vtkMRMLTableStorageNode()
+      storageNode.SetFileName(statisticsFile)
+      storageNode.ReadData(lesionStatisticsTable)
+    finally:
+      os.remove(statisticsFile)
+
+  def registerFLAIRToT1(self, inputT1Volume, inputFLAIRVolume, numberOfThreads=0):
+    """Rigid FLAIR to T1 transform, in a new linear transform node
     """
+    registrationFLAIR2T1Transform = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", "regFLAIR2T1_linear")
+    regParams = {}
+    regParams["fixedVolume"] = inputT1Volume.GetID()
+    regParams["movingVolume"] = inputFLAIRVolume.GetID()
+    regParams["samplingPercentage"] = 0.02
+    regParams["linearTransform"] = registrationFLAIR2T1Transform.GetID()
+    regParams["initializeTransformMode"] = "useMomentsAlign"
+    regParams["useRigid"] = True
+    regParams["interpolationMode"] = "Linear"
+
+    CLIUtils.runCLI(slicer.modules.brainsfit, regParams, numberOfThreads)
+    return registrationFLAIR2T1Transform
+
+  def resample(self, inputVolume, outputVolume, referenceVolume, transform, isLabel, numberOfThreads=0):
+    """Resamples inputVolume on the grid of referenceVolume with transform: nearest neighbour
+    with the label pixel type for label maps, linear otherwise
+    """
+    params = {}
+    params["inputVolume"] = inputVolume.GetID()
+    params["referenceVolume"] = referenceVolume.GetID()
+    params["outputVolume"] = outputVolume.GetID()
+    params["warpTransform"] = transform.GetID()
+    params["interpolationMode"] = "NearestNeighbor" if isLabel else "Linear"
+    if isLabel:
+      params["pixelType"] = "uchar"
+
+    CLIUtils.runCLI(slicer.modules.brainsresample, params, numberOfThreads)
+
+  def run(self, inputT1Volume, inputFLAIRVolume, outputVolume, isBET, absError, gamma, WMMath, minLesionSize, GMlabel, WMLabel,
+          connectivity=6, lesionStatisticsTable=None, numberOfThreads=0, preprocessingProfile="accurate",
+          previewSpacing=0, brainMaskLabel=None, alignedFLAIR=False, gammaLevelMapVolume=None):
+    """
+    Run the actual algorithm. A previewSpacing (mm) runs it on inputs resampled to that spacing
+    and resamples the lesion map back to the T1 grid. When the inputs are not skull stripped
+    (isBET off), it runs on the brain region given by the atlas registered to the T1, and
+    brainMaskLabel is the mask of that region used by the bias field correction. alignedFLAIR
+    tells that the FLAIR is already registered and resampled to the T1 grid. gammaLevelMapVolume
+    receives the gamma level map of the lesion map (not computed by preview runs), see
+    cacheGammaLevelMap(). Inputs or registrations failing the quality gates raise
+    QualityGates.QualityGateError.
+    """
+    from LesionSpotlightLib import BrainMask, Preprocessing, Preview, QualityGates
 
     if not self.isValidInputOutputData(inputT1Volume, outputVolume):
       slicer.util.errorDisplay('Input T1 volume is the same as output volume. Choose a different output volume.')
@@ -312,6 +548,59 @@ class AFTSegmenterLogic(ScriptedLoadableModuleLogic):
       slicer.util.errorDisplay('Input FLAIR volume is the same as output volume. Choose a different output volume.')
       return False
 
+    QualityGates.checkInput(inputT1Volume, QualityGates.T1)
+    QualityGates.checkInput(inputFLAIRVolume, QualityGates.FLAIR)
+
+    if previewSpacing:
+      slicer.util.showStatusMessage("Preview: resampling the inputs to %g mm..." % previewSpacing)
+      previewT1Volume = Preview.previewVolume(inputT1Volume, previewSpacing, numberOfThreads)
+      previewFLAIRVolume = Preview.previewVolume(inputFLAIRVolume, previewSpacing, numberOfThreads)
+      previewLabel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+      try:
+        result = self.run(previewT1Volume, previewFLAIRVolume, previewLabel, isBET, absError, gamma, WMMath,
+                          Preview.previewMinimumSize(minLesionSize, inputT1Volume, previewT1Volume), GMlabel, WMLabel,
+                          connectivity, lesionStatisticsTable, numberOfThreads, preprocessingProfile)
+        Preview.restoreResolution(previewLabel, inputT1Volume, outputVolume, True, numberOfThreads)
+      finally:
+        slicer.mrmlScene.RemoveNode(previewLabel)
+        slicer.mrmlScene.RemoveNode(previewFLAIRVolume)
+        slicer.mrmlScene.RemoveNode(previewT1Volume)
+      return result
+
+    if not isBET:
+      slicer.util.showStatusMessage("Brain masking...")
+      brainMaskLabel = BrainMask.brainMask(inputT1Volume, numberOfThreads=numberOfThreads)
+      alignedFLAIRVolume = brainT1Volume = brainFLAIRVolume = brainMaskCrop = brainLabel = brainGammaLevelMap = None
+      try:
+        # The FLAIR is put on the T1 grid first, so that both are restricted to the same brain region
+        alignedFLAIRVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+        registrationFLAIR2T1Transform = self.registerFLAIRToT1(inputT1Volume, inputFLAIRVolume, numberOfThreads)
+        self.resample(inputFLAIRVolume, alignedFLAIRVolume, inputT1Volume, registrationFLAIR2T1Transform, False, numberOfThreads)
+        slicer.mrmlScene.RemoveNode(registrationFLAIR2T1Transform)
+
+        brainT1Volume = BrainMask.restrictToMask(inputT1Volume, brainMaskLabel)
+        brainFLAIRVolume = BrainMask.restrictToMask(alignedFLAIRVolume, brainMaskLabel)
+        brainMaskCrop = BrainMask.restrictToMask(brainMaskLabel, brainMaskLabel)
+        brainLabel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+        brainGammaLevelMap = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode") if gammaLevelMapVolume else None
+        result = self.run(brainT1Volume, brainFLAIRVolume, brainLabel, True, absError, gamma, WMMath, minLesionSize,
+                          GMlabel, WMLabel, connectivity, lesionStatisticsTable, numberOfThreads, preprocessingProfile,
+                          brainMaskLabel=brainMaskCrop, alignedFLAIR=True, gammaLevelMapVolume=brainGammaLevelMap)
+        Preview.restoreResolution(brainLabel, inputT1Volume, outputVolume, True, numberOfThreads)
+        if brainGammaLevelMap:
+          # Both grids share the voxel centres, so the linear resampling keeps the levels. Out of the
+          # brain no voxel is ever a lesion, it gets a level below every level of the brain
+          Preview.restoreResolution(brainGammaLevelMap, inputT1Volume, gammaLevelMapVolume, False, numberOfThreads)
+          levels = slicer.util.arrayFromVolume(gammaLevelMapVolume)
+          levels[slicer.util.arrayFromVolume(brainMaskLabel) == 0] = slicer.util.arrayFromVolume(brainGammaLevelMap).min() - 1
+          slicer.util.arrayFromVolumeModified(gammaLevelMapVolume)
+      finally:
+        for node in (brainGammaLevelMap, brainLabel, brainMaskCrop, brainFLAIRVolume, brainT1Volume,
+                     alignedFLAIRVolume, brainMaskLabel):
+          if node:
+            slicer.mrmlScene.RemoveNode(node)
+      return result
+
     logging.info('Processing started')
 
     # Creating FLAIR image copy for processing pipeline
@@ -327,21 +616,17 @@ class AFTSegmenterLogic(ScriptedLoadableModuleLogic):
     #                                    T2-FLAIR Bias Field Correction                                             #
     #################################################################################################################
 
-    regParams = {}
-    regParams["inputImageName"] = inputFLAIRVolume.GetID()
-    regParams["outputImageName"] = inputFLAIRVolume_tmp.GetID()
+    regParams = Preprocessing.n4Parameters(inputFLAIRVolume, inputFLAIRVolume_tmp, preprocessingProfile, brainMaskLabel)
 
-    slicer.cli.run(slicer.modules.n4itkbiasfieldcorrection, None, regParams, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.n4itkbiasfieldcorrection, regParams, numberOfThreads)
 
     #################################################################################################################
     #                                    T1 Bias Field Correction                                             #
     #################################################################################################################
 
-    regParams = {}
-    regParams["inputImageName"] = inputT1Volume.GetID()
-    regParams["outputImageName"] = inputT1Volume_tmp.GetID()
+    regParams = Preprocessing.n4Parameters(inputT1Volume, inputT1Volume_tmp, preprocessingProfile, brainMaskLabel)
 
-    slicer.cli.run(slicer.modules.n4itkbiasfieldcorrection, None, regParams, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.n4itkbiasfieldcorrection, regParams, numberOfThreads)
 
 
     # Get the path to LSSegmenter-Data files
@@ -350,42 +635,26 @@ class AFTSegmenterLogic(ScriptedLoadableModuleLogic):
     #################################################################################################################
     #                                        Registration  - MNI to Native space                                    #
     #################################################################################################################
+    # The inputs are skull stripped here, by the user or by the brain masking
     if platform.system() == "Windows":
-      if isBET:
-        (read, MNITemplateNode) = slicer.util.loadVolume(
-          path2files + '\\Resources\\LSSegmenter-Data\\MNI152_T1_1mm_brain.nii.gz',
-          {}, True)
-      else:
-        (read, MNITemplateNode) = slicer.util.loadVolume(
-          path2files + '\\Resources\\LSSegmenter-Data\\MNI152_T1_1mm.nii.gz', {},
-          True)
+      (read, MNITemplateNode) = slicer.util.loadVolume(
+        path2files + '\\Resources\\LSSegmenter-Data\\MNI152_T1_1mm_brain.nii.gz',
+        {}, True)
     else:
-      if isBET:
-        (read, MNITemplateNode) = slicer.util.loadVolume(
-          path2files + '/Resources/LSSegmenter-Data/MNI152_T1_1mm_brain.nii.gz', {},
-          True)
-      else:
-        (read, MNITemplateNode) = slicer.util.loadVolume(
-          path2files + '/Resources/LSSegmenter-Data/MNI152_T1_1mm.nii.gz', {}, True)
+      (read, MNITemplateNode) = slicer.util.loadVolume(
+        path2files + '/Resources/LSSegmenter-Data/MNI152_T1_1mm_brain.nii.gz', {},
+        True)
 
     #
-    # Registering the FLAIR to T1 space.
+    # Registering the FLAIR to T1 space. Only the transforms are computed by BRAINSFit, every
+    # volume is then resampled once on the T1 grid.
     #
-    slicer.util.showStatusMessage("Step 2: FLAIR to T1 space registration...")
-
-    regParams = {}
-    regParams["fixedVolume"] = inputT1Volume.GetID()
-    regParams["movingVolume"] = inputFLAIRVolume_tmp.GetID()
-    regParams["outputVolume"] = inputFLAIRVolume_tmp.GetID()
-    regParams["samplingPercentage"] = 0.02
-    regParams["splineGridSize"] = '8,8,8'
-    regParams["initializeTransformMode"] = "useMomentsAlign"
-    regParams["useRigid"] = True
-    # regParams["useAffine"] = True
-    # regParams["useBSpline"] = True
-    regParams["interpolationMode"] = "Linear"
-
-    slicer.cli.run(slicer.modules.brainsfit, None, regParams, wait_for_completion=True)
+    if not alignedFLAIR:
+      slicer.util.showStatusMessage("Step 2: FLAIR to T1 space registration...")
+      registrationFLAIR2T1Transform = self.registerFLAIRToT1(inputT1Volume, inputFLAIRVolume_tmp, numberOfThreads)
+      self.resample(inputFLAIRVolume_tmp, inputFLAIRVolume_tmp, inputT1Volume_tmp, registrationFLAIR2T1Transform, False,
+                    numberOfThreads)
+      slicer.mrmlScene.RemoveNode(registrationFLAIR2T1Transform)
 
     #
     # Registering the MNI template to native space.
@@ -395,20 +664,18 @@ class AFTSegmenterLogic(ScriptedLoadableModuleLogic):
     slicer.mrmlScene.AddNode(registrationMNI2NativeTransform)
     slicer.util.showStatusMessage("Step 3: MNI152 to native space registration...")
 
+    # Only the affine transform is used, so no BSpline stage is run
     regParams = {}
     regParams["fixedVolume"] = inputT1Volume_tmp.GetID()
     regParams["movingVolume"] = MNITemplateNode.GetID()
-    regParams["outputVolume"] = MNITemplateNode.GetID()
     regParams["samplingPercentage"] = 0.02
-    regParams["splineGridSize"] = '8,8,8'
     regParams["linearTransform"] = registrationMNI2NativeTransform.GetID()
     regParams["initializeTransformMode"] = "useMomentsAlign"
     regParams["useRigid"] = True
     regParams["useAffine"] = True
-    regParams["useBSpline"] = True
     regParams["interpolationMode"] = "Linear"
 
-    slicer.cli.run(slicer.modules.brainsfit, None, regParams, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.brainsfit, regParams, numberOfThreads)
 
     if platform.system() == "Windows":
       (read, MNIBrainTissues) = slicer.util.loadLabelVolume(
@@ -418,15 +685,22 @@ class AFTSegmenterLogic(ScriptedLoadableModuleLogic):
         path2files + '/Resources/LSSegmenter-Data/MNI152_T1_1mm_brain_tissues.nii.gz', {}, True)
 
     slicer.util.showStatusMessage("Step 4: MNI brain template conforming...")
-    params = {}
-    params["inputVolume"] = MNIBrainTissues.GetID()
-    params["referenceVolume"] = inputT1Volume_tmp.GetID()
-    params["outputVolume"] = MNIBrainTissues.GetID()
-    params["transformationFile"] = registrationMNI2NativeTransform.GetID()
-    params["inverseITKTransformation"] = False
-    params["interpolationType"] = "nn"
-
-    slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, params, wait_for_completion=True)
+    self.resample(MNITemplateNode, MNITemplateNode, inputT1Volume_tmp, registrationMNI2NativeTransform, False,
+                  numberOfThreads)
+    self.resample(MNIBrainTissues, MNIBrainTissues, inputT1Volume_tmp, registrationMNI2NativeTransform, True,
+                  numberOfThreads)
+
+    # Registration quality gates: the registered gray and white matter must fall on the foreground
+    # of both volumes, with the white matter brighter than the gray matter on the T1 only
+    temporaryNodes = (MNIBrainTissues, MNITemplateNode, registrationMNI2NativeTransform, inputFLAIRVolume_tmp,
+                      inputT1Volume_tmp)
+    tissues = slicer.util.arrayFromVolume(MNIBrainTissues)
+    wmMask = tissues == WMLabel
+    gmMask = tissues == GMlabel
+    for volume, modality in ((inputT1Volume_tmp, QualityGates.T1), (inputFLAIRVolume_tmp, QualityGates.FLAIR)):
+      QualityGates.checkRegistration(volume, wmMask | gmMask, modality, "gray and white matter atlas",
+                                     nodesToRemove=temporaryNodes)
+      QualityGates.checkContrast(volume, wmMask, gmMask, modality, nodesToRemove=temporaryNodes)
 
     slicer.util.showStatusMessage("Step 5: MS lesion segmentation...")
     cliParams={}
@@ -441,8 +715,16 @@ class AFTSegmenterLogic(ScriptedLoadableModuleLogic):
     cliParams["minimumSize"] = minLesionSize
     cliParams["gmMaskValue"] = GMlabel
     cliParams["wmMaskValue"] = WMLabel
+    cliParams["connectivity"] = connectivity
+    if lesionStatisticsTable:
+      statisticsFile = self.lesionStatisticsFile()
+      cliParams["lesionStatistics"] = statisticsFile
+    if gammaLevelMapVolume:
+      cliParams["gammaLevelMap"] = gammaLevelMapVolume.GetID()
 
-    slicer.cli.run(slicer.modules.automaticflairthreshold, None, cliParams, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.automaticflairthreshold, cliParams, numberOfThreads)
+    if lesionStatisticsTable:
+      self.readLesionStatistics(statisticsFile, lesionStatisticsTable)
 
 
     logging.info('Processing completed')
@@ -456,6 +738,91 @@ class AFTSegmenterLogic(ScriptedLoadableModuleLogic):
 
     return True
 
+  def cacheGammaLevelMap(self, outputVolume, gammaLevelMapVolume):
+    """Keeps the gamma level map of the lesion map outputVolume in memory, so that updateGamma()
+    can segment it again with another gamma, minimum lesion size or connectivity
+    """
+    levels = slicer.util.arrayFromVolume(gammaLevelMapVolume).copy()
+    if levels.shape != slicer.util.arrayFromVolume(outputVolume).shape:
+      self.clearGammaLevelCache()
+      return False
+    self.gammaLevelCache = {"outputVolumeID": outputVolume.GetID(), "levels": levels}
+    return True
+
+  def clearGammaLevelCache(self):
+    self.gammaLevelCache = None
+
+  def hasGammaLevelCache(self, outputVolume):
+    return (self.gammaLevelCache is not None and outputVolume is not None
+            and self.gammaLevelCache["outputVolumeID"] == outputVolume.GetID()
+            and slicer.mrmlScene.GetNodeByID(outputVolume.GetID()) is not None)
+
+  def updateGamma(self, gamma, minLesionSize, connectivity=6):
+    """Segments the cached gamma level map again, without running the pipeline. The white matter
+    match is the one of the run that made the map.
+    """
+    from LesionSpotlightLib import Engine
+    outputVolume = slicer.mrmlScene.GetNodeByID(self.gammaLevelCache["outputVolumeID"])
+    lesions = Engine.gammaLevelLesions(self.gammaLevelCache["levels"], gamma, minLesionSize, connectivity)
+    slicer.util.updateVolumeFromArray(outputVolume, lesions)
+    return True
+
+  def processSubject(self, subject, parameters):
+    """Segments one cohort subject from files. parameters holds the inputT1Volume, inputFLAIRVolume
+    and outputVolume paths, optional lesionStatistics and cohortSummary paths and the keyword
+    arguments of run()
+    """
+    from LesionSpotlightLib import CohortSummary
+    parameters = dict(parameters)
+    inputT1Path = parameters.pop("inputT1Volume")
+    inputFLAIRPath = parameters.pop("inputFLAIRVolume")
+    outputPath = parameters.pop("outputVolume")
+    statisticsPath = parameters.pop("lesionStatistics", None)
+    summaryPath = parameters.pop("cohortSummary", None)
+
+    inputT1Volume = slicer.util.loadVolume(inputT1Path)
+    inputFLAIRVolume = slicer.util.loadVolume(inputFLAIRPath)
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", subject + "_lesions")
+    lesionStatisticsTable = None
+    if statisticsPath or summaryPath:
+      lesionStatisticsTable = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", subject + "_lesionStatistics")
+    try:
+      start = time.time()
+      if not self.run(inputT1Volume, inputFLAIRVolume, outputVolume, lesionStatisticsTable=lesionStatisticsTable, **parameters):
+        raise ValueError("Invalid input or output volume for subject %s" % subject)
+      seconds = time.time() - start
+      if not slicer.util.saveNode(outputVolume, outputPath):
+        raise IOError("Could not write %s" % outputPath)
+      outputs = {"outputVolume": outputPath}
+      if statisticsPath:
+        if not slicer.util.saveNode(lesionStatisticsTable, statisticsPath):
+          raise IOError("Could not write %s" % statisticsPath)
+        outputs["lesionStatistics"] = statisticsPath
+      if summaryPath:
+        CohortSummary.appendToSummary(summaryPath, subject, "AFTSegmenter",
+                                      CohortSummary.tableLesionVolumes(lesionStatisticsTable),
+                                      parameters=parameters, atlas=",".join(self.SUMMARY_ATLASES),
+                                      transform="BRAINSFit affine", seconds=seconds)
+        outputs["cohortSummary"] = summaryPath
+    finally:
+      for node in (inputT1Volume, inputFLAIRVolume, outputVolume, lesionStatisticsTable):
+        if node:
+          slicer.mrmlScene.RemoveNode(node)
+    return outputs
+
+  def runJobQueue(self, queuePath, worker=None, memoryBudgetMB=None):
+    """Processes the AFTSegmenter jobs of a cohort job queue until none is left. Several Slicer
+    processes can share the same queue, and a restarted run only processes the unfinished subjects:
+
+      Slicer --no-main-window --python-code "import AFTSegmenter; AFTSegmenter.AFTSegmenterLogic().runJobQueue('cohort.sqlite'); exit()"
+
+    With memoryBudgetMB, the workers of the machine (given the same budget) only start a subject
+    while the peak memory estimates of the running ones leave room for it.
+    """
+    from LesionSpotlightLib.JobQueue import JobQueue
+    with JobQueue(queuePath) as queue:
+      return queue.runWorker({"AFTSegmenter": self.processSubject}, worker, memoryBudgetMB=memoryBudgetMB)
+
 
 class AFTSegmenterTest(ScriptedLoadableModuleTest):
   """
@@ -21,22 +21,33 @@
 #include "itkAbsImageFilter.h"
 #include "itkRescaleIntensityImageFilter.h"
 
+#include "itkBinaryDilateImageFilter.h"
+#include "itkBinaryBallStructuringElement.h"
+#include "itkImageRegionConstIterator.h"
+#include "itkMersenneTwisterRandomVariateGenerator.h"
+#include "itkConstNeighborhoodIterator.h"
+#include <algorithm>
+#include <vector>
+
 //Gray matter segmentation
 #include "itkThresholdImageFilter.h"
-#include "itkConnectedComponentImageFilter.h"
-#include "itkRelabelComponentImageFilter.h"
 #include "itkBinaryThresholdImageFilter.h"
+#include "itkWhiteMatterMatchImageFilter.h"
+#include "itkLesionSizeFilterImageFilter.h"
 
 //T2-FLAIR outlier detection
 #include "itkMaskImageFilter.h"
 #include "itkImageToHistogramFilter.h"
 #include "itkImageRegionIterator.h"
 #include "itkRescaleIntensityImageFilter.h"
-#include "itkNeighborhoodIterator.h"
 #include "itkImageRegionIterator.h"
 
+#include "itkFilterProfiler.h"
+#include "itkThreadBudget.h"
+#include "itkMultiThreaderBase.h"
 #include "itkPluginUtilities.h"
 #include "cmath"
+#include <fstream>
 
 #include "AutomaticFLAIRThresholdCLP.h"
 
@@ -50,6 +61,165 @@ using namespace std;
 namespace
 {
 
+//Maps a value through the piecewise linear function given by the source and reference quantiles,
+//extrapolating with the slope of the first and last segments
+double MatchIntensity(double value, const std::vector<double> & source, const std::vector<double> & reference)
+{
+    unsigned int last = source.size()-1;
+    unsigned int s = std::upper_bound(source.begin(), source.end(), value) - source.begin();
+    s = (s < 1) ? 1 : ((s > last) ? last : s);
+    double width = source[s]-source[s-1];
+    if (width <= 0.0) {
+        return reference[s];
+    }
+    return reference[s-1]+(value-source[s-1])*(reference[s]-reference[s-1])/width;
+}
+
+//Gray matter quality control restricted to the gray matter: the template histogram is matched to
+//the T1 one with the voxels of the dilated gray matter only (a random fraction sampling of them),
+//and the absolute residual is evaluated inside the gray matter. Returns the mask of the gray matter
+//voxels whose residual, relative to the largest one, lies in [0.005, absErrorThreshold].
+template <class TInputImage, class TMaskImage>
+typename TMaskImage::Pointer GrayMatterQualityControl(const TInputImage * t1, const TInputImage * mni,
+                                                      const TMaskImage * gmMask, const TMaskImage * histogramMask,
+                                                      unsigned int numberOfMatchPoints, double sampling,
+                                                      double absErrorThreshold)
+{
+    typedef itk::ImageRegionConstIterator<TInputImage>     InputIteratorType;
+    typedef itk::ImageRegionConstIterator<TMaskImage>      MaskIteratorType;
+    typedef itk::Statistics::MersenneTwisterRandomVariateGenerator  RandomType;
+    typename RandomType::Pointer random = RandomType::New();
+    random->SetSeed(2016);
+
+    //Both histograms from the same gray matter voxels
+    std::vector<double> t1Samples, mniSamples;
+    InputIteratorType t1It(t1, t1->GetBufferedRegion());
+    InputIteratorType mniIt(mni, mni->GetBufferedRegion());
+    MaskIteratorType maskIt(histogramMask, histogramMask->GetBufferedRegion());
+    for (; !maskIt.IsAtEnd(); ++maskIt, ++t1It, ++mniIt) {
+        if (maskIt.Get()!=0 && (sampling >= 1.0 || random->GetVariateWithClosedRange() < sampling)) {
+            t1Samples.push_back(static_cast<double>(t1It.Get()));
+            mniSamples.push_back(static_cast<double>(mniIt.Get()));
+        }
+    }
+
+    typename TMaskImage::Pointer qualityMask = TMaskImage::New();
+    qualityMask->CopyInformation(gmMask);
+    qualityMask->SetRegions(gmMask->GetBufferedRegion());
+    qualityMask->Allocate();
+    qualityMask->FillBuffer(0);
+    if (t1Samples.size() < 2) {
+        return qualityMask;
+    }
+    std::sort(t1Samples.begin(), t1Samples.end());
+    std::sort(mniSamples.begin(), mniSamples.end());
+
+    //Quantiles at the match points, the minimum and the maximum included
+    unsigned int points = std::min<unsigned int>(numberOfMatchPoints+2, t1Samples.size());
+    std::vector<double> sourceQuantiles(points), referenceQuantiles(points);
+    for (unsigned int q = 0; q < points; ++q) {
+        double position = static_cast<double>(q)/(points-1);
+        sourceQuantiles[q] = mniSamples[static_cast<size_t>(position*(mniSamples.size()-1)+0.5)];
+        referenceQuantiles[q] = t1Samples[static_cast<size_t>(position*(t1Samples.size()-1)+0.5)];
+    }
+
+    //Absolute residual inside the gray matter
+    typedef itk::Image<float, TInputImage::ImageDimension>    ErrorImageType;
+    typename ErrorImageType::Pointer error = ErrorImageType::New();
+    error->SetRegions(gmMask->GetBufferedRegion());
+    error->Allocate();
+    error->FillBuffer(0.0f);
+    itk::ImageRegionIterator<ErrorImageType> errorIt(error, error->GetBufferedRegion());
+    MaskIteratorType gmIt(gmMask, gmMask->GetBufferedRegion());
+    double maximumError = 0.0;
+    for (t1It.GoToBegin(), mniIt.GoToBegin(); !gmIt.IsAtEnd(); ++gmIt, ++t1It, ++mniIt, ++errorIt) {
+        if (gmIt.Get()!=0) {
+            double value = std::fabs(MatchIntensity(mniIt.Get(), sourceQuantiles, referenceQuantiles)-t1It.Get());
+            errorIt.Set(static_cast<float>(value));
+            maximumError = std::max(maximumError, value);
+        }
+    }
+    if (maximumError <= 0.0) {
+        return qualityMask;
+    }
+
+    itk::ImageRegionIterator<TMaskImage> qualityIt(qualityMask, qualityMask->GetBufferedRegion());
+    for (errorIt.GoToBegin(); !errorIt.IsAtEnd(); ++errorIt, ++qualityIt) {
+        double relativeError = errorIt.Get()/maximumError;
+        if (relativeError >= 0.005 && relativeError <= absErrorThreshold) {
+            qualityIt.Set(1);
+        }
+    }
+    return qualityMask;
+}
+
+//Gamma level of each voxel: the largest gamma for which it is kept by the threshold (mu + gamma*sigma)
+//and the white matter match. A voxel passes the match when at least k of its neighbours are white
+//matter lesion voxels, so its level is the minimum of its own score (I-mu)/sigma and the k-th largest
+//score of its white matter neighbours. Voxels that never pass are set to the lowest score.
+template <class TInputImage, class TMaskImage>
+typename itk::Image<float, TInputImage::ImageDimension>::Pointer GammaLevelMap(const TInputImage * flair,
+                                                                              const TMaskImage * wmMask,
+                                                                              double mu, double sigma,
+                                                                              double wmMatch,
+                                                                              unsigned int neighborhoodRadius)
+{
+    typedef itk::Image<float, TInputImage::ImageDimension>    LevelImageType;
+    typename LevelImageType::Pointer levels = LevelImageType::New();
+    levels->CopyInformation(flair);
+    levels->SetRegions(flair->GetBufferedRegion());
+    levels->Allocate();
+
+    //Same neighbourhood and zero flux boundary as the WhiteMatterMatchImageFilter
+    typedef itk::ConstNeighborhoodIterator<TInputImage>    InputNeighborhoodType;
+    typedef itk::ConstNeighborhoodIterator<TMaskImage>     MaskNeighborhoodType;
+    typename InputNeighborhoodType::RadiusType radius;
+    radius.Fill(neighborhoodRadius);
+    InputNeighborhoodType flairIt(radius, flair, flair->GetBufferedRegion());
+    MaskNeighborhoodType wmIt(radius, wmMask, flair->GetBufferedRegion());
+    itk::ImageRegionIterator<LevelImageType> levelIt(levels, levels->GetBufferedRegion());
+
+    const unsigned int neighborhoodSize = flairIt.Size();
+    unsigned int k = 0;
+    while (k < neighborhoodSize && (float)k/(float)neighborhoodSize < wmMatch) {
+        k++;
+    }
+    if (sigma <= 0.0) {
+        sigma = 1.0;
+    }
+
+    const float unreachable = itk::NumericTraits<float>::max();
+    float lowest = unreachable;
+    std::vector<float> scores(neighborhoodSize);
+    for (; !levelIt.IsAtEnd(); ++flairIt, ++wmIt, ++levelIt) {
+        float score = static_cast<float>((flairIt.GetCenterPixel()-mu)/sigma);
+        lowest = std::min(lowest, score);
+        unsigned int n = 0;
+        for (unsigned int idx = 0; idx < neighborhoodSize; ++idx) {
+            if (wmIt.GetPixel(idx)!=0) {
+                scores[n++] = static_cast<float>((flairIt.GetPixel(idx)-mu)/sigma);
+            }
+        }
+        if (n < k) {
+            levelIt.Set(unreachable);
+        }else if (k == 0) {
+            levelIt.Set(score);
+        }else{
+            std::nth_element(scores.begin(), scores.begin()+(n-k), scores.begin()+n);
+            levelIt.Set(std::min(score, scores[n-k]));
+        }
+    }
+    //Voxels that no gamma segments get a level below every reachable score, so that no threshold
+    //of the map at a reachable gamma selects them
+    const float belowLowest = lowest - 1.0f;
+    for (levelIt.GoToBegin(); !levelIt.IsAtEnd(); ++levelIt) {
+        if (levelIt.Get() == unreachable) {
+            levelIt.Set(belowLowest);
+        }
+    }
+    return levels;
+}
+
 template <class T>
 int DoIt( int argc, char * argv[], T )
 {
@@ -76,6 +246,13 @@ int DoIt( int argc, char * argv[], T )
     readerT2FLAIR->SetFileName( inputT2FLAIRVolume.c_str() );
     readerMNI->SetFileName( inputMNIVolume.c_str() );
     readerBrainLabels->SetFileName( brainLabels.c_str() );
+
+    //Wall time and buffer size of each step, written to profileOutput
+    itk::FilterProfiler profiler;
+    profiler.Observe(readerT1, "readerT1");
+    profiler.Observe(readerT2FLAIR, "readerT2FLAIR");
+    profiler.Observe(readerMNI, "readerMNI");
+    profiler.Observe(readerBrainLabels, "readerBrainLabels");
     readerT1->Update();
     readerT2FLAIR->Update();
     readerMNI->Update();
@@ -90,39 +267,73 @@ int DoIt( int argc, char * argv[], T )
     //
     //Gray matter quality control
     //
-    typedef itk::HistogramMatchingImageFilter<InputImageType, InputImageType>       HistogramMatchingFilterType;
-    typename HistogramMatchingFilterType::Pointer histogramMatch = HistogramMatchingFilterType::New();
-    histogramMatch->SetInput(readerMNI->GetOutput());
-    histogramMatch->SetReferenceImage(readerT1->GetOutput());
-    histogramMatch->SetNumberOfMatchPoints(10000);
-
-    typedef itk::SubtractImageFilter<InputImageType>                                SubtractFilterType;
-    typename SubtractFilterType::Pointer residual = SubtractFilterType::New();
-    residual->SetInput1(histogramMatch->GetOutput());
-    residual->SetInput2(readerT1->GetOutput());
-
-    typedef itk::AbsImageFilter<InputImageType, InputImageType>                     AbsoluteFilterType;
-    typename AbsoluteFilterType::Pointer absError = AbsoluteFilterType::New();
-    absError->SetInput(residual->GetOutput());
-
-    typedef itk::MaskImageFilter<InputImageType, MaskImageType>                     MaskInputFilterType;
-    typename MaskInputFilterType::Pointer gmError = MaskInputFilterType::New();
-    gmError->SetInput(absError->GetOutput());
-    gmError->SetMaskImage(gmMask->GetOutput());
-
-    //Absolute Error of Gray Matter alignment
-    typedef itk::RescaleIntensityImageFilter<InputImageType>                        RescalerFilterType;
-    typename RescalerFilterType::Pointer gmAbsErrorProbability = RescalerFilterType::New();
-    gmAbsErrorProbability->SetInput(gmError->GetOutput());
-    gmAbsErrorProbability->SetOutputMaximum(1.0);
-    gmAbsErrorProbability->SetOutputMinimum(0.0);
-
-    typedef itk::BinaryThresholdImageFilter<InputImageType, MaskImageType>          BinaryThresholdFilterType;
-    typename BinaryThresholdFilterType::Pointer gmAbsErrorMask = BinaryThresholdFilterType::New();
-    gmAbsErrorMask->SetInput(gmAbsErrorProbability->GetOutput());
-    gmAbsErrorMask->SetInsideValue(1);
-    gmAbsErrorMask->SetUpperThreshold(absErrorThreshold);
-    gmAbsErrorMask->SetLowerThreshold(0.005);
+    typename MaskImageType::Pointer gmQualityMask;
+    if (wholeImageMatching) {
+        typedef itk::HistogramMatchingImageFilter<InputImageType, InputImageType>       HistogramMatchingFilterType;
+        typename HistogramMatchingFilterType::Pointer histogramMatch = HistogramMatchingFilterType::New();
+        histogramMatch->SetInput(readerMNI->GetOutput());
+        histogramMatch->SetReferenceImage(readerT1->GetOutput());
+        histogramMatch->SetNumberOfMatchPoints(10000);
+        profiler.Observe(histogramMatch, "histogramMatch");
+
+        typedef itk::SubtractImageFilter<InputImageType>                                SubtractFilterType;
+        typename SubtractFilterType::Pointer residual = SubtractFilterType::New();
+        residual->SetInput1(histogramMatch->GetOutput());
+        residual->SetInput2(readerT1->GetOutput());
+        residual->InPlaceOn();
+
+        typedef itk::AbsImageFilter<InputImageType, InputImageType>                     AbsoluteFilterType;
+        typename AbsoluteFilterType::Pointer absError = AbsoluteFilterType::New();
+        absError->SetInput(residual->GetOutput());
+        absError->InPlaceOn();
+
+        typedef itk::MaskImageFilter<InputImageType, MaskImageType>                     MaskInputFilterType;
+        typename MaskInputFilterType::Pointer gmError = MaskInputFilterType::New();
+        gmError->SetInput(absError->GetOutput());
+        gmError->SetMaskImage(gmMask->GetOutput());
+        gmError->InPlaceOn();
+
+        //Absolute Error of Gray Matter alignment
+        typedef itk::RescaleIntensityImageFilter<InputImageType>                        RescalerFilterType;
+        typename RescalerFilterType::Pointer gmAbsErrorProbability = RescalerFilterType::New();
+        gmAbsErrorProbability->SetInput(gmError->GetOutput());
+        gmAbsErrorProbability->SetOutputMaximum(1.0);
+        gmAbsErrorProbability->SetOutputMinimum(0.0);
+        gmAbsErrorProbability->InPlaceOn();
+
+        typedef itk::BinaryThresholdImageFilter<InputImageType, MaskImageType>          BinaryThresholdFilterType;
+        typename BinaryThresholdFilterType::Pointer gmAbsErrorMask = BinaryThresholdFilterType::New();
+        gmAbsErrorMask->SetInput(gmAbsErrorProbability->GetOutput());
+        gmAbsErrorMask->SetInsideValue(1);
+        gmAbsErrorMask->SetUpperThreshold(absErrorThreshold);
+        gmAbsErrorMask->SetLowerThreshold(0.005);
+        gmAbsErrorMask->Update();
+        gmQualityMask = gmAbsErrorMask->GetOutput();
+        gmQualityMask->DisconnectPipeline();
+    }else{
+        //Histograms from the dilated gray matter, residual inside the gray matter only
+        typedef itk::BinaryBallStructuringElement<MaskLabelPixelType, 3>                 StructuringElementType;
+        typedef itk::BinaryDilateImageFilter<MaskImageType, MaskImageType, StructuringElementType>   DilateFilterType;
+        StructuringElementType structuringElement;
+        structuringElement.SetRadius(gmDilationRadius);
+        structuringElement.CreateStructuringElement();
+        typename DilateFilterType::Pointer gmDilated = DilateFilterType::New();
+        gmDilated->SetInput(gmMask->GetOutput());
+        gmDilated->SetKernel(structuringElement);
+        gmDilated->SetDilateValue(GMlabel);
+        profiler.Observe(gmDilated, "gmDilation");
+        gmDilated->Update();
+
+        profiler.Begin("histogramMatch");
+        gmQualityMask = GrayMatterQualityControl<InputImageType, MaskImageType>(readerT1->GetOutput(), readerMNI->GetOutput(),
+                                                                                gmMask->GetOutput(), gmDilated->GetOutput(),
+                                                                                10000, qcSampling, absErrorThreshold);
+        profiler.End("histogramMatch");
+    }
+    //The T1, MNI and gray matter volumes are only used by the quality control
+    readerT1->GetOutput()->ReleaseData();
+    readerMNI->GetOutput()->ReleaseData();
+    gmMask->GetOutput()->ReleaseData();
 
     //
     //Calculate the T2-FLAIR gray matter voxel intensity distribution
@@ -130,11 +341,13 @@ int DoIt( int argc, char * argv[], T )
     typedef itk::MaskImageFilter<InputImageType,MaskImageType>   MaskingImage;
     typename MaskingImage::Pointer gmFLAIR = MaskingImage::New();
     gmFLAIR->SetInput(readerT2FLAIR->GetOutput());
-    gmFLAIR->SetMaskImage(gmAbsErrorMask->GetOutput());
+    gmFLAIR->SetMaskImage(gmQualityMask);
+    profiler.Observe(gmFLAIR, "gmFLAIR");
     gmFLAIR->Update();
 
     //Get T2-FLAIR gray matter distribution parameters
     //Calculating mean mu and standard deviation sigma
+    profiler.Begin("gmStatistics");
     double mu=0.0,sigma=0.0;
     int N=1;
     typedef itk::ImageRegionIterator<InputImageType>    RegionIterator;
@@ -160,6 +373,9 @@ int DoIt( int argc, char * argv[], T )
         }
     }
     sigma=sqrt(sigma/(N-1));
+    profiler.End("gmStatistics");
+    gmFLAIR->GetOutput()->ReleaseData();
+    gmQualityMask->ReleaseData();
 
     cout<<"Gray matter voxel intensity distribution: G(mu="<<mu<<",sigma="<<sigma<<")"<<endl;
 
@@ -173,7 +389,7 @@ int DoIt( int argc, char * argv[], T )
     flairLesions->SetInput(readerT2FLAIR->GetOutput());
     flairLesions->SetLowerThreshold(lesionThr);
     flairLesions->SetInsideValue(1);
-    flairLesions->Update();
+    flairLesions->ReleaseDataFlagOn();
 
     //Apply global lesion constraints
     //1: Lesion are mostly close to white matter tissue.
@@ -181,73 +397,75 @@ int DoIt( int argc, char * argv[], T )
     wmMask->SetInput(readerBrainLabels->GetOutput());
     wmMask->ThresholdOutside(WMlabel, WMlabel);
     wmMask->SetOutsideValue(0);
-    wmMask->Update();
-
-    MaskImageType::Pointer finalLesionMap = MaskImageType::New();
-    finalLesionMap->CopyInformation(readerT2FLAIR->GetOutput());
-    finalLesionMap->SetRegions(readerT2FLAIR->GetOutput()->GetBufferedRegion());
-    finalLesionMap->Allocate();
-    finalLesionMap->FillBuffer(0);
-    typedef itk::NeighborhoodIterator<MaskImageType>                        NeighborhoodIterator;
-    typedef itk::ImageRegionIterator<MaskImageType>                         MaskRegionIterator;
-    NeighborhoodIterator::RadiusType radius = {1,1,1};
-    NeighborhoodIterator        lesionMaskIt(radius,flairLesions->GetOutput(),flairLesions->GetOutput()->GetBufferedRegion());
-    NeighborhoodIterator        wmMaskIt(radius,wmMask->GetOutput(),wmMask->GetOutput()->GetBufferedRegion());
-    MaskRegionIterator          finalLesionIt(finalLesionMap,wmMask->GetOutput()->GetBufferedRegion());
-
-    int match=0;
-    lesionMaskIt.GoToBegin();
-    wmMaskIt.GoToBegin();
-    finalLesionIt.GoToBegin();
-    while (!lesionMaskIt.IsAtEnd()) {
-        if (lesionMaskIt.GetCenterPixel()!=static_cast<MaskLabelPixelType>(0)) {
-            match=0;
-            for (int idx = 0; idx < 27; ++idx) {
-                if (lesionMaskIt.GetPixel(idx)*wmMaskIt.GetPixel(idx)!=static_cast<MaskLabelPixelType>(0)) {
-                    match++;
-                }
-            }
-            if ((float)match/(float)27 >= wmMatch) {
-                finalLesionIt.Set(1);
-            }else{
-                finalLesionIt.Set(0);
-            }
-            ++lesionMaskIt;
-            ++wmMaskIt;
-            ++finalLesionIt;
-        }else{
-            ++lesionMaskIt;
-            ++wmMaskIt;
-            ++finalLesionIt;
-        }
-    }
+    //The gray matter mask is done, the brain labels have no other consumer
+    wmMask->InPlaceOn();
+
+    typedef itk::WhiteMatterMatchImageFilter<MaskImageType>                      WhiteMatterMatchType;
+    typename WhiteMatterMatchType::Pointer finalLesionMap = WhiteMatterMatchType::New();
+    finalLesionMap->SetInput(flairLesions->GetOutput());
+    finalLesionMap->SetWhiteMatterMask(wmMask->GetOutput());
+    finalLesionMap->SetWhiteMatterMatch(wmMatch);
+    finalLesionMap->SetInsideValue(1);
+    finalLesionMap->ReleaseDataFlagOn();
+    profiler.Observe(finalLesionMap, "whiteMatterMatch");
 
     //2: Apply a minimum lesion size
-    typedef unsigned int ConnectedVoxelType;
-    typedef itk::Image<ConnectedVoxelType, 3>   ConnectedVoxelImageType;
-    typedef itk::ConnectedComponentImageFilter<MaskImageType, ConnectedVoxelImageType> ConnectedLabelType;
-    typename ConnectedLabelType::Pointer connLesionLabel = ConnectedLabelType::New();
-    connLesionLabel->SetInput(finalLesionMap);
-    connLesionLabel->Update();
-
-    typedef itk::RelabelComponentImageFilter<ConnectedVoxelImageType, MaskImageType>      RelabelerType;
-    typename RelabelerType::Pointer relabelLesionLabel = RelabelerType::New();
-    relabelLesionLabel->SetInput(connLesionLabel->GetOutput());
-    relabelLesionLabel->SetSortByObjectSize(true);
-    relabelLesionLabel->SetMinimumObjectSize(minimumSize);
-    relabelLesionLabel->Update();
-
-    typedef itk::BinaryThresholdImageFilter<MaskImageType,MaskImageType>                BinaryLabelMap;
-    typename BinaryLabelMap::Pointer hyperintenseLesions = BinaryLabelMap::New();
-    hyperintenseLesions->SetInput(relabelLesionLabel->GetOutput());
-    hyperintenseLesions->SetLowerThreshold(1);
+    typedef itk::LesionSizeFilterImageFilter<MaskImageType, InputImageType>      LesionSizeFilterType;
+    typename LesionSizeFilterType::Pointer hyperintenseLesions = LesionSizeFilterType::New();
+    hyperintenseLesions->SetInput(finalLesionMap->GetOutput());
+    hyperintenseLesions->SetIntensityImage(readerT2FLAIR->GetOutput());
+    hyperintenseLesions->SetMinimumSize(minimumSize);
+    hyperintenseLesions->SetConnectivity(connectivity);
     hyperintenseLesions->SetInsideValue(1);
+    profiler.Observe(hyperintenseLesions, "lesionSizeFilter");
+    hyperintenseLesions->Update();
+
+    if (!lesionStatistics.empty()) {
+        std::ofstream statisticsFile(lesionStatistics.c_str());
+        hyperintenseLesions->WriteLesionStatistics(statisticsFile);
+    }
+
+    //Optional gamma level map, thresholding it at any gamma gives the white matter matched lesions
+    if (!gammaLevelMap.empty()) {
+        profiler.Begin("gammaLevelMap");
+        typedef itk::Image<float, 3>                      LevelImageType;
+        LevelImageType::Pointer levels = GammaLevelMap<InputImageType, MaskImageType>(readerT2FLAIR->GetOutput(),
+                                                                                               wmMask->GetOutput(),
+                                                                                               mu, sigma, wmMatch,
+                                                                                               finalLesionMap->GetRadius());
+        profiler.End("gammaLevelMap");
+
+        typedef itk::ImageFileWriter<LevelImageType>      LevelWriterType;
+        LevelWriterType::Pointer levelWriter = LevelWriterType::New();
+        levelWriter->SetFileName( gammaLevelMap.c_str() );
+        levelWriter->SetInput( levels );
+        levelWriter->SetUseCompression(1);
+        profiler.Observe(levelWriter, "gammaLevelWriter");
+        levelWriter->Update();
+    }
+
+    //Only the lesion mask is left to write
+    readerT2FLAIR->GetOutput()->ReleaseData();
+    wmMask->GetOutput()->ReleaseData();
 
     typename WriterType::Pointer writer = WriterType::New();
     writer->SetFileName( outputLesionMap.c_str() );
     writer->SetInput( hyperintenseLesions->GetOutput() );
     writer->SetUseCompression(1);
+    profiler.Observe(writer, "writer");
     writer->Update();
+
+    if (!returnParameterFile.empty()) {
+        std::ofstream returnFile(returnParameterFile.c_str());
+        returnFile<<"gmMean = "<<mu<<std::endl;
+        returnFile<<"gmStd = "<<sigma<<std::endl;
+        returnFile<<"lesionThreshold = "<<lesionThr<<std::endl;
+        returnFile<<"numberOfLesions = "<<hyperintenseLesions->GetNumberOfLesions()<<std::endl;
+    }
+    if (!profileOutput.empty()) {
+        std::ofstream profileFile(profileOutput.c_str());
+        profiler.Write(profileFile);
+    }
     return EXIT_SUCCESS;
 
 }
@@ -258,6 +476,10 @@ int main( int argc, char * argv[] )
 {
     PARSE_ARGS;
 
+    //Thread budget given by the caller, 0 keeps the ITK default (every core). The former
+    //default is restored on return, since an in-process CLI shares it with Slicer
+    itk::ThreadBudget threadBudget(numberOfThreads);
+
     itk::ImageIOBase::IOPixelType     pixelType;
     itk::ImageIOBase::IOComponentType componentType;
 
@@ -0,0 +1,125 @@
+#include "CLIBenchmark.h"
+
+#ifdef WIN32
+# define MODULE_IMPORT __declspec(dllimport)
+#else
+# define MODULE_IMPORT
+#endif
+
+extern "C" MODULE_IMPORT int ModuleEntryPoint(int, char* []);
+
+namespace
+{
+
+//Runs the module on the synthetic volumes with the given options and reads gmMean and gmStd from its return parameters
+bool RunQualityControl(const std::string & prefix, const std::string & name, const std::vector<std::string> & options,
+                       double & gmMean, double & gmStd)
+{
+  std::vector<std::string> strings;
+  strings.push_back("AutomaticFLAIRThreshold");
+  strings.push_back(prefix+"t1.nrrd");
+  strings.push_back(prefix+"flair.nrrd");
+  strings.push_back(prefix+"mni.nrrd");
+  strings.push_back(prefix+"labels.nrrd");
+  strings.push_back(prefix+name+"_output.nrrd");
+  strings.push_back("--returnparameterfile");
+  strings.push_back(prefix+name+"_parameters.txt");
+  strings.insert(strings.end(), options.begin(), options.end());
+  std::vector<char *> argv;
+  for (unsigned int a = 0; a < strings.size(); ++a)
+    {
+    argv.push_back(const_cast<char *>(strings[a].c_str()));
+    }
+  argv.push_back(nullptr);
+  if (ModuleEntryPoint(static_cast<int>(strings.size()), &argv[0]) != EXIT_SUCCESS)
+    {
+    std::cerr<<"AutomaticFLAIRThreshold failed with the "<<name<<" quality control"<<std::endl;
+    return false;
+    }
+
+  std::ifstream parameters((prefix+name+"_parameters.txt").c_str());
+  std::string line;
+  bool hasMean = false, hasStd = false;
+  while (std::getline(parameters, line))
+    {
+    std::string::size_type equal = line.find(" = ");
+    if (equal == std::string::npos)
+      {
+      continue;
+      }
+    std::string key = line.substr(0, equal);
+    double value = std::atof(line.c_str()+equal+3);
+    if (key == "gmMean")
+      {
+      gmMean = value;
+      hasMean = true;
+      }
+    else if (key == "gmStd")
+      {
+      gmStd = value;
+      hasStd = true;
+      }
+    }
+  std::cout<<name<<": gmMean "<<gmMean<<", gmStd "<<gmStd<<std::endl;
+  return hasMean && hasStd;
+}
+
+bool WithinTolerance(const std::string & name, const char * statistic, double value, double reference, double tolerance)
+{
+  if (std::fabs(value-reference) > tolerance*std::fabs(reference))
+    {
+    std::cerr<<statistic<<" of the "<<name<<" quality control is "<<value<<", the whole image matching gives "
+             <<reference<<" (tolerance "<<100.0*tolerance<<"%)"<<std::endl;
+    return false;
+    }
+  return true;
+}
+
+} // end of anonymous namespace
+
+//The gray matter statistics of the gray matter restricted quality control, with every voxel and subsampled,
+//against the whole image histogram matching of the former versions of the module.
+//Arguments: size temporaryDirectory tolerance
+int AutomaticFLAIRThresholdQualityControlTest(int argc, char* argv[])
+{
+  if (argc < 4)
+    {
+    std::cerr<<"Usage: "<<argv[0]<<" size temporaryDirectory tolerance"<<std::endl;
+    return EXIT_FAILURE;
+    }
+  unsigned int size = static_cast<unsigned int>(std::atoi(argv[1]));
+  std::string directory = argv[2];
+  double tolerance = std::atof(argv[3]);
+
+  std::ostringstream prefix;
+  prefix<<directory<<"/AutomaticFLAIRThresholdQualityControl"<<size<<"_";
+  CLIBenchmark::WriteSyntheticVolumes(prefix.str(), size);
+
+  double referenceMean = 0.0, referenceStd = 0.0;
+  if (!RunQualityControl(prefix.str(), "wholeImage", std::vector<std::string>(1, "--wholeImageMatching"),
+                         referenceMean, referenceStd))
+    {
+    return EXIT_FAILURE;
+    }
+
+  std::vector<std::string> sampled;
+  sampled.push_back("--qcSampling");
+  sampled.push_back("0.25");
+  const std::vector<std::string> modes[2] = {std::vector<std::string>(), sampled};
+  const char * names[2] = {"grayMatter", "grayMatterSampled"};
+  int result = EXIT_SUCCESS;
+  for (unsigned int m = 0; m < 2; ++m)
+    {
+    double gmMean = 0.0, gmStd = 0.0;
+    if (!RunQualityControl(prefix.str(), names[m], modes[m], gmMean, gmStd))
+      {
+      return EXIT_FAILURE;
+      }
+    if (!WithinTolerance(names[m], "gmMean", gmMean, referenceMean, tolerance) ||
+        !WithinTolerance(names[m], "gmStd", gmStd, referenceStd, tolerance))
+      {
+      result = EXIT_FAILURE;
+      }
+    }
+  return result;
+}
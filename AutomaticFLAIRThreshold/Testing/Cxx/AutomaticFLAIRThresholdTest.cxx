@@ -18,8 +18,12 @@
 #endif
 
 extern "C" MODULE_IMPORT int ModuleEntryPoint(int, char* []);
+int AutomaticFLAIRThresholdBenchmark(int, char* []);
+int AutomaticFLAIRThresholdQualityControlTest(int, char* []);
 
 void RegisterTests()
 {
   StringToTestFunctionMap["ModuleEntryPoint"] = ModuleEntryPoint;
+  StringToTestFunctionMap["AutomaticFLAIRThresholdBenchmark"] = AutomaticFLAIRThresholdBenchmark;
+  StringToTestFunctionMap["AutomaticFLAIRThresholdQualityControlTest"] = AutomaticFLAIRThresholdQualityControlTest;
 }
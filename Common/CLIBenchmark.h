@@ -0,0 +1,308 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef __CLIBenchmark_h
+#define __CLIBenchmark_h
+#include "itkFilterProfiler.h"
+#include "itkImage.h"
+#include "itkImageFileWriter.h"
+#include "itkImageRegionIteratorWithIndex.h"
+#include "itkMersenneTwisterRandomVariateGenerator.h"
+#include "itkTimeProbe.h"
+
+#include <cmath>
+#include <cstdlib>
+#include <fstream>
+#include <iostream>
+#include <sstream>
+#include <string>
+#include <vector>
+
+/** Performance regression tests of the CLIs.
+ *
+ * WriteSyntheticVolumes writes a synthetic brain of size^3 voxels (T1, FLAIR,
+ * an MNI-like template, tissue labels, masks and a lesion probability map) and
+ * RunBenchmark runs a CLI entry point once on it. The throughput (voxels per
+ * second) and the peak resident memory (MB) of the test process are appended
+ * to the results CSV and compared with the row of the same size in the
+ * reference CSV:
+ *
+ *   size,voxelsPerSecond,peakMemoryMB
+ *
+ * The test fails when the throughput drops below (1-tolerance) times the
+ * reference or the peak memory grows above (1+tolerance) times the reference.
+ * Sizes without a reference row report their values and return
+ * SkipReturnCode, the SKIP_RETURN_CODE of the benchmark tests, so CTest shows
+ * them as skipped rather than passed. The peak memory includes the synthetic
+ * volumes generation, which keeps one volume at a time.
+ */
+namespace CLIBenchmark
+{
+
+typedef int (*EntryPointType)(int, char * []);
+
+/** Return code of a benchmark without a reference to compare with. */
+const int SkipReturnCode = 77;
+
+typedef itk::Image<float, 3>            ImageType;
+typedef itk::Image<unsigned char, 3>    LabelImageType;
+
+/** Tissue labels of the synthetic brain, as in the LesionSpotlight atlases. */
+const unsigned char CSFLabel = 1;
+const unsigned char GMLabel = 2;
+const unsigned char WMLabel = 3;
+
+inline double PeakMemoryMB()
+{
+    return itk::FilterProfiler::PeakMemoryMB();
+}
+
+/** Synthetic brain description, evaluated voxel by voxel. */
+class SyntheticBrain
+{
+public:
+    SyntheticBrain(unsigned int size) : m_Size(size)
+    {
+        //Lesions are spheres spread in the white matter, always at the same place
+        itk::Statistics::MersenneTwisterRandomVariateGenerator::Pointer random =
+                itk::Statistics::MersenneTwisterRandomVariateGenerator::New();
+        random->SetSeed(2016);
+        for (unsigned int l = 0; l < 12; ++l) {
+            double angle = random->GetUniformVariate(0.0, 6.283185307179586);
+            double radius = random->GetUniformVariate(0.2, 0.55);
+            m_Lesions.push_back(radius*std::cos(angle));
+            m_Lesions.push_back(radius*std::sin(angle));
+            m_Lesions.push_back(random->GetUniformVariate(-0.4, 0.4));
+        }
+    }
+
+    /** Tissue label of a voxel, 0 outside the brain. */
+    unsigned char Label(const ImageType::IndexType & index) const
+    {
+        double r = this->Radius(index);
+        if (r > 1.0) {
+            return 0;
+        }
+        if (r > 0.9) {
+            return CSFLabel;
+        }
+        if (r > 0.7) {
+            return GMLabel;
+        }
+        return WMLabel;
+    }
+
+    bool IsLesion(const ImageType::IndexType & index) const
+    {
+        double x, y, z;
+        this->Coordinates(index, x, y, z);
+        for (unsigned int l = 0; l < m_Lesions.size(); l+=3) {
+            double dx=x-m_Lesions[l], dy=y-m_Lesions[l+1], dz=z-m_Lesions[l+2];
+            if (dx*dx+dy*dy+dz*dz < 0.01) {
+                return true;
+            }
+        }
+        return false;
+    }
+
+private:
+    void Coordinates(const ImageType::IndexType & index, double & x, double & y, double & z) const
+    {
+        double center = 0.5*(m_Size-1), scale = 0.45*m_Size;
+        x = (index[0]-center)/scale;
+        y = (index[1]-center)/scale;
+        z = 1.2*(index[2]-center)/scale;
+    }
+
+    double Radius(const ImageType::IndexType & index) const
+    {
+        double x, y, z;
+        this->Coordinates(index, x, y, z);
+        return std::sqrt(x*x+y*y+z*z);
+    }
+
+    unsigned int m_Size;
+    std::vector<double> m_Lesions;
+};
+
+template <class TImage>
+typename TImage::Pointer NewVolume(unsigned int size)
+{
+    typename TImage::SizeType imageSize;
+    imageSize.Fill(size);
+    typename TImage::RegionType region;
+    region.SetSize(imageSize);
+    typename TImage::Pointer image = TImage::New();
+    image->SetRegions(region);
+    image->Allocate();
+    return image;
+}
+
+template <class TImage>
+void WriteVolume(TImage * image, const std::string & fileName)
+{
+    typedef itk::ImageFileWriter<TImage>    WriterType;
+    typename WriterType::Pointer writer = WriterType::New();
+    writer->SetFileName(fileName.c_str());
+    writer->SetInput(image);
+    writer->Update();
+}
+
+/** Intensity volume from the mean of each tissue (background, CSF, GM, WM, lesion) with Gaussian noise. */
+inline void WriteIntensityVolume(const SyntheticBrain & brain, unsigned int size, const double means[5], double noise,
+                                 int seed, const std::string & fileName)
+{
+    itk::Statistics::MersenneTwisterRandomVariateGenerator::Pointer random =
+            itk::Statistics::MersenneTwisterRandomVariateGenerator::New();
+    random->SetSeed(seed);
+    ImageType::Pointer image = NewVolume<ImageType>(size);
+    itk::ImageRegionIteratorWithIndex<ImageType> it(image, image->GetBufferedRegion());
+    for (it.GoToBegin(); !it.IsAtEnd(); ++it) {
+        unsigned char label = brain.Label(it.GetIndex());
+        if (label==0) {
+            it.Set(0.0);
+            continue;
+        }
+        double value = (label==WMLabel && means[4] >= 0.0 && brain.IsLesion(it.GetIndex())) ? means[4] : means[label];
+        value+=noise*random->GetNormalVariate();
+        it.Set(static_cast<float>(value > 1.0 ? value : 1.0));
+    }
+    WriteVolume<ImageType>(image, fileName);
+}
+
+/** Writes the t1, flair, mni (no lesions), labels, brainMask, wmMask and lesionProbability .nrrd files,
+ * each file name starting with prefix. */
+inline void WriteSyntheticVolumes(const std::string & prefix, unsigned int size)
+{
+    SyntheticBrain brain(size);
+    const double t1Means[5] = {0.0, 40.0, 80.0, 120.0, 70.0};
+    const double flairMeans[5] = {0.0, 30.0, 110.0, 90.0, 190.0};
+    const double mniMeans[5] = {0.0, 40.0, 80.0, 120.0, -1.0};
+    WriteIntensityVolume(brain, size, t1Means, 5.0, 1, prefix+"t1.nrrd");
+    WriteIntensityVolume(brain, size, flairMeans, 5.0, 2, prefix+"flair.nrrd");
+    WriteIntensityVolume(brain, size, mniMeans, 2.0, 3, prefix+"mni.nrrd");
+
+    LabelImageType::Pointer labels = NewVolume<LabelImageType>(size);
+    LabelImageType::Pointer brainMask = NewVolume<LabelImageType>(size);
+    LabelImageType::Pointer wmMask = NewVolume<LabelImageType>(size);
+    ImageType::Pointer probability = NewVolume<ImageType>(size);
+    itk::ImageRegionIteratorWithIndex<LabelImageType> it(labels, labels->GetBufferedRegion());
+    for (it.GoToBegin(); !it.IsAtEnd(); ++it) {
+        const LabelImageType::IndexType & index = it.GetIndex();
+        unsigned char label = brain.Label(index);
+        it.Set(label);
+        brainMask->SetPixel(index, label!=0);
+        wmMask->SetPixel(index, label==WMLabel);
+        probability->SetPixel(index, (label==WMLabel && brain.IsLesion(index)) ? 0.9f : (label!=0 ? 0.005f : 0.0f));
+    }
+    WriteVolume<LabelImageType>(labels, prefix+"labels.nrrd");
+    WriteVolume<LabelImageType>(brainMask, prefix+"brainMask.nrrd");
+    WriteVolume<LabelImageType>(wmMask, prefix+"wmMask.nrrd");
+    WriteVolume<ImageType>(probability, prefix+"lesionProbability.nrrd");
+}
+
+/** Reads the voxelsPerSecond and peakMemoryMB of size from a reference CSV. Returns false when there is no such row. */
+inline bool ReadReference(const std::string & fileName, unsigned int size, double & voxelsPerSecond, double & peakMemoryMB)
+{
+    std::ifstream reference(fileName.c_str());
+    std::string line;
+    while (std::getline(reference, line)) {
+        if (line.empty() || line[0]=='#' || line.compare(0, 4, "size")==0) {
+            continue;
+        }
+        std::istringstream row(line);
+        std::string field;
+        std::vector<double> values;
+        while (std::getline(row, field, ',')) {
+            values.push_back(std::atof(field.c_str()));
+        }
+        if (values.size() >= 3 && static_cast<unsigned int>(values[0])==size) {
+            voxelsPerSecond=values[1];
+            peakMemoryMB=values[2];
+            return true;
+        }
+    }
+    return false;
+}
+
+/** Runs entryPoint with arguments (without the program name) and checks it against the reference. */
+inline int RunBenchmark(const std::string & name, EntryPointType entryPoint, const std::vector<std::string> & arguments,
+                        unsigned int size, const std::string & referenceFile, double tolerance, const std::string & resultsFile)
+{
+    std::vector<std::string> strings(1, name);
+    strings.insert(strings.end(), arguments.begin(), arguments.end());
+    std::vector<char *> argv;
+    for (unsigned int a = 0; a < strings.size(); ++a) {
+        argv.push_back(const_cast<char *>(strings[a].c_str()));
+    }
+    argv.push_back(nullptr);
+
+    itk::TimeProbe probe;
+    probe.Start();
+    int status = entryPoint(static_cast<int>(strings.size()), &argv[0]);
+    probe.Stop();
+    if (status!=EXIT_SUCCESS) {
+        std::cerr<<name<<" failed on the "<<size<<"^3 synthetic volumes"<<std::endl;
+        return EXIT_FAILURE;
+    }
+
+    double voxels = static_cast<double>(size)*size*size;
+    double voxelsPerSecond = voxels/probe.GetTotal();
+    double peakMemoryMB = PeakMemoryMB();
+    std::cout<<name<<" "<<size<<"^3: "<<probe.GetTotal()<<" s, "<<voxelsPerSecond<<" voxels/s, peak memory "
+             <<peakMemoryMB<<" MB"<<std::endl;
+
+    bool newResults = !std::ifstream(resultsFile.c_str()).good();
+    std::ofstream results(resultsFile.c_str(), std::ios::app);
+    if (newResults) {
+        results<<"size,voxelsPerSecond,peakMemoryMB"<<std::endl;
+    }
+    results<<size<<","<<voxelsPerSecond<<","<<peakMemoryMB<<std::endl;
+
+    double referenceVoxelsPerSecond, referencePeakMemoryMB;
+    if (!ReadReference(referenceFile, size, referenceVoxelsPerSecond, referencePeakMemoryMB)) {
+        std::cout<<"No reference for size "<<size<<" in "<<referenceFile<<", the benchmark is skipped"<<std::endl;
+        return SkipReturnCode;
+    }
+    int result = EXIT_SUCCESS;
+    if (voxelsPerSecond < (1.0-tolerance)*referenceVoxelsPerSecond) {
+        std::cerr<<"Throughput regression: "<<voxelsPerSecond<<" voxels/s, reference "<<referenceVoxelsPerSecond<<std::endl;
+        result = EXIT_FAILURE;
+    }
+    if (peakMemoryMB > (1.0+tolerance)*referencePeakMemoryMB) {
+        std::cerr<<"Peak memory regression: "<<peakMemoryMB<<" MB, reference "<<referencePeakMemoryMB<<std::endl;
+        result = EXIT_FAILURE;
+    }
+    return result;
+}
+
+/** Parses the common benchmark arguments: size temporaryDirectory referenceCSV tolerance */
+inline bool ParseArguments(int argc, char * argv[], unsigned int & size, std::string & directory,
+                           std::string & referenceFile, double & tolerance)
+{
+    if (argc < 5) {
+        std::cerr<<"Usage: "<<argv[0]<<" size temporaryDirectory referenceCSV tolerance"<<std::endl;
+        return false;
+    }
+    size = static_cast<unsigned int>(std::atoi(argv[1]));
+    directory = argv[2];
+    referenceFile = argv[3];
+    tolerance = std::atof(argv[4]);
+    return size > 0;
+}
+
+} // end namespace CLIBenchmark
+
+#endif
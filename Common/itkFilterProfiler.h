@@ -0,0 +1,208 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef __itkFilterProfiler_h
+#define __itkFilterProfiler_h
+#include "itkCommand.h"
+#include "itkProcessObject.h"
+#include "itkImageBase.h"
+#include "itkRealTimeClock.h"
+
+#include <ostream>
+#include <string>
+#include <vector>
+
+#if defined(_WIN32)
+#ifndef NOMINMAX
+#define NOMINMAX
+#endif
+#include <windows.h>
+#include <psapi.h>
+#else
+#include <sys/resource.h>
+#endif
+
+namespace itk
+{
+
+/** \class FilterProfiler
+ *
+ * Records the wall time and the largest output buffer (in voxels) of the
+ * observed filters through their StartEvent and EndEvent. A filter that runs
+ * several times, e.g. once per tile, accumulates its calls and its time.
+ * Steps that are not a single filter can be timed with Begin and End. The
+ * peak resident memory of the process is sampled at the end of every step,
+ * so the step where it grows is the one holding the largest buffers.
+ *
+ * The table is written as CSV: step,calls,seconds,bufferedVoxels,peakMemoryMB
+ */
+class FilterProfiler
+{
+public:
+    FilterProfiler()
+    {
+        m_Clock = RealTimeClock::New();
+    }
+
+    /** Observe the StartEvent and EndEvent of a filter. */
+    void Observe(ProcessObject * filter, const std::string & name)
+    {
+        const unsigned int step = this->AddStep(name);
+        ProfileCommand::Pointer start = ProfileCommand::New();
+        start->SetStep(this, step, true);
+        filter->AddObserver(StartEvent(), start);
+        ProfileCommand::Pointer end = ProfileCommand::New();
+        end->SetStep(this, step, false);
+        filter->AddObserver(EndEvent(), end);
+    }
+
+    /** Time a step that is not a single filter. */
+    void Begin(const std::string & name)
+    {
+        this->Start(this->FindStep(name));
+    }
+
+    void End(const std::string & name)
+    {
+        this->Stop(this->FindStep(name), nullptr);
+    }
+
+    void Write(std::ostream & os) const
+    {
+        os<<"step,calls,seconds,bufferedVoxels,peakMemoryMB"<<std::endl;
+        for (unsigned int s = 0; s < m_Steps.size(); ++s) {
+            os<<m_Steps[s].Name<<","<<m_Steps[s].Calls<<","<<m_Steps[s].Seconds<<","<<m_Steps[s].BufferedVoxels<<","
+              <<m_Steps[s].PeakMemoryMB<<std::endl;
+        }
+    }
+
+    /** Peak resident memory (MB) of the process so far. */
+    static double PeakMemoryMB()
+    {
+#if defined(_WIN32)
+        PROCESS_MEMORY_COUNTERS counters;
+        if (GetProcessMemoryInfo(GetCurrentProcess(), &counters, sizeof(counters))) {
+            return counters.PeakWorkingSetSize/1048576.0;
+        }
+        return 0.0;
+#else
+        struct rusage usage;
+        getrusage(RUSAGE_SELF, &usage);
+#if defined(__APPLE__)
+        return usage.ru_maxrss/1048576.0;
+#else
+        return usage.ru_maxrss/1024.0;
+#endif
+#endif
+    }
+
+private:
+    struct Step {
+        std::string Name;
+        unsigned int Calls;
+        double Seconds;
+        double StartTime;
+        SizeValueType BufferedVoxels;
+        double PeakMemoryMB;
+    };
+
+    class ProfileCommand: public Command
+    {
+    public:
+        typedef ProfileCommand         Self;
+        typedef Command                Superclass;
+        typedef SmartPointer< Self >   Pointer;
+        itkNewMacro(Self)
+
+        void SetStep(FilterProfiler * profiler, unsigned int step, bool start)
+        {
+            m_Profiler=profiler;
+            m_Step=step;
+            m_IsStart=start;
+        }
+
+        void Execute(Object * caller, const EventObject & event)
+        {
+            this->Execute(const_cast<const Object *>(caller), event);
+        }
+
+        void Execute(const Object * caller, const EventObject &)
+        {
+            if (m_IsStart) {
+                m_Profiler->Start(m_Step);
+            }else{
+                m_Profiler->Stop(m_Step, dynamic_cast<const ProcessObject *>(caller));
+            }
+        }
+    protected:
+        ProfileCommand() : m_Profiler(nullptr), m_Step(0), m_IsStart(true) {}
+    private:
+        FilterProfiler * m_Profiler;
+        unsigned int m_Step;
+        bool m_IsStart;
+    };
+
+    unsigned int AddStep(const std::string & name)
+    {
+        Step step;
+        step.Name=name;
+        step.Calls=0;
+        step.Seconds=0.0;
+        step.StartTime=0.0;
+        step.BufferedVoxels=0;
+        step.PeakMemoryMB=0.0;
+        m_Steps.push_back(step);
+        return m_Steps.size()-1;
+    }
+
+    unsigned int FindStep(const std::string & name)
+    {
+        for (unsigned int s = 0; s < m_Steps.size(); ++s) {
+            if (m_Steps[s].Name==name) {
+                return s;
+            }
+        }
+        return this->AddStep(name);
+    }
+
+    void Start(unsigned int step)
+    {
+        m_Steps[step].StartTime=m_Clock->GetTimeInSeconds();
+    }
+
+    void Stop(unsigned int step, const ProcessObject * filter)
+    {
+        m_Steps[step].Calls++;
+        m_Steps[step].Seconds+=m_Clock->GetTimeInSeconds()-m_Steps[step].StartTime;
+        m_Steps[step].PeakMemoryMB=PeakMemoryMB();
+        if (!filter) {
+            return;
+        }
+        //Largest image buffer among the filter outputs
+        for (unsigned int o = 0; o < filter->GetNumberOfIndexedOutputs(); ++o) {
+            const ImageBase<3> * image = dynamic_cast<const ImageBase<3> *>(filter->GetOutput(o));
+            if (image && image->GetBufferedRegion().GetNumberOfPixels() > m_Steps[step].BufferedVoxels) {
+                m_Steps[step].BufferedVoxels=image->GetBufferedRegion().GetNumberOfPixels();
+            }
+        }
+    }
+
+    RealTimeClock::Pointer m_Clock;
+    std::vector<Step> m_Steps;
+};
+
+} // end namespace itk
+
+#endif
@@ -0,0 +1,167 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef __itkLesionSizeFilterImageFilter_h
+#define __itkLesionSizeFilterImageFilter_h
+#include "itkImageToImageFilter.h"
+#include "itkImage.h"
+#include "itkNumericTraits.h"
+
+#include <ostream>
+#include <vector>
+
+namespace itk
+{
+
+/** \class LesionSizeFilterImageFilter
+ *
+ * Labels the connected lesions of a binary lesion mask, removes the lesions
+ * smaller than MinimumSize and keeps a statistics table for the remaining
+ * ones (voxel count, volume in mm3, physical centroid, index bounding box and
+ * the mean value of an optional intensity image).
+ *
+ * Labelling is done with a union-find pass split in slabs along the slowest
+ * dimension, so the lesions are never sorted and the volume is not relabelled
+ * between the size filtering and the statistics. The connectivity can be set
+ * to 6 (faces), 18 (faces and edges) or 26 (faces, edges and corners).
+ *
+ * The output is a binary mask where the kept lesions are set to InsideValue.
+ * The intensity image can be requested in NumberOfStreamDivisions slabs
+ * during the statistics pass, so it never has to be fully in memory.
+ */
+template< typename TMaskImage, typename TIntensityImage = TMaskImage >
+class ITK_EXPORT LesionSizeFilterImageFilter:
+        public ImageToImageFilter< TMaskImage, TMaskImage >
+{
+public:
+    /** Extract dimension from the mask image. */
+    itkStaticConstMacro(ImageDimension, unsigned int,
+                        TMaskImage::ImageDimension);
+
+    /** Convenient typedefs for simplifying declarations. */
+    typedef TMaskImage       MaskImageType;
+    typedef TIntensityImage  IntensityImageType;
+
+    /** Standard class typedefs. */
+    typedef LesionSizeFilterImageFilter                      Self;
+    typedef ImageToImageFilter< TMaskImage, TMaskImage >     Superclass;
+    typedef SmartPointer< Self >                             Pointer;
+    typedef SmartPointer< const Self >                       ConstPointer;
+
+    /** Method for creation through the object factory. */
+    itkNewMacro(Self)
+
+    /** Run-time type information (and related methods). */
+    itkTypeMacro(LesionSizeFilterImageFilter, ImageToImageFilter)
+
+    typedef typename MaskImageType::PixelType          MaskPixelType;
+    typedef typename IntensityImageType::PixelType     IntensityPixelType;
+    typedef typename MaskImageType::IndexType          IndexType;
+    typedef typename MaskImageType::PointType          PointType;
+    typedef typename MaskImageType::RegionType         RegionType;
+    typedef typename MaskImageType::SizeType           SizeType;
+
+    /** Provisional lesion labels are stored as 32 bits linear indexes. */
+    typedef unsigned int                               LabelType;
+
+    /** Statistics of one kept lesion. */
+    struct LesionStatistics {
+        SizeValueType VoxelCount;
+        double        Volume;
+        PointType     Centroid;
+        IndexType     BoundingBoxMinimum;
+        IndexType     BoundingBoxMaximum;
+        double        MeanIntensity;
+    };
+    typedef std::vector< LesionStatistics >            LesionStatisticsContainer;
+
+    /** Set the (optional) intensity image used for the mean lesion intensity. */
+    itkSetInputMacro(IntensityImage, IntensityImageType)
+    itkGetInputMacro(IntensityImage, IntensityImageType)
+
+    /** Set the minimum lesion size, in number of voxels. */
+    itkSetMacro(MinimumSize, SizeValueType)
+
+    /** Set the neighbourhood connectivity (6, 18 or 26). */
+    itkSetMacro(Connectivity, unsigned int)
+
+    /** Set the value given to the kept lesions. */
+    itkSetMacro(InsideValue, MaskPixelType)
+
+    /** Set the number of slabs in which the intensity image is requested. */
+    itkSetMacro(NumberOfStreamDivisions, unsigned int)
+
+    itkGetMacro(MinimumSize, SizeValueType)
+    itkGetMacro(Connectivity, unsigned int)
+    itkGetMacro(InsideValue, MaskPixelType)
+    itkGetMacro(NumberOfStreamDivisions, unsigned int)
+
+    /** Statistics of the kept lesions, in raster order of their first voxel. */
+    const LesionStatisticsContainer & GetLesionStatistics() const
+    {
+        return m_LesionStatistics;
+    }
+
+    SizeValueType GetNumberOfLesions() const
+    {
+        return static_cast<SizeValueType>(m_LesionStatistics.size());
+    }
+
+    /** Write the lesion statistics as a CSV table (one row per kept lesion). */
+    void WriteLesionStatistics(std::ostream & os) const;
+
+#ifdef ITK_USE_CONCEPT_CHECKING
+    // Begin concept checking
+    itkConceptMacro( ThreeDimensionCheck,
+                     ( Concept::SameDimension< ImageDimension, 3 > ) );
+    itkConceptMacro( IntensityHasNumericTraitsCheck,
+                     ( Concept::HasNumericTraits< IntensityPixelType > ) );
+#endif
+
+protected:
+    LesionSizeFilterImageFilter();
+    virtual ~LesionSizeFilterImageFilter() {}
+    SizeValueType m_MinimumSize;
+    unsigned int m_Connectivity;
+    MaskPixelType m_InsideValue;
+    unsigned int m_NumberOfStreamDivisions;
+    LesionStatisticsContainer m_LesionStatistics;
+
+    void GenerateInputRequestedRegion();
+    void EnlargeOutputRequestedRegion(DataObject * output);
+    void GenerateData();
+    void PrintSelf(std::ostream & os, Indent indent) const;
+private:
+    LesionSizeFilterImageFilter(const Self &); //purposely not implemented
+    void operator=(const Self &);  //purposely not implemented
+
+    typedef typename MaskImageType::OffsetType      OffsetType;
+    typedef std::vector< OffsetType >               NeighborOffsetsType;
+
+    void labelSlab(const MaskPixelType * mask, const SizeType & size, SizeValueType firstSlice,
+                   SizeValueType lastSlice, const NeighborOffsetsType & neighbors, std::vector<LabelType> & parent) const;
+    RegionType intensitySlab(const RegionType & region, unsigned int division) const;
+    const IntensityPixelType * updateIntensitySlab(const RegionType & slab, SizeValueType & bufferOffset);
+    static LabelType findRoot(std::vector<LabelType> & parent, LabelType label);
+    static void mergeLabels(std::vector<LabelType> & parent, LabelType a, LabelType b);
+};
+
+} // end namespace itk
+
+#ifndef ITK_MANUAL_INSTANTIATION
+#include "itkLesionSizeFilterImageFilter.hxx"
+#endif
+
+#endif
@@ -0,0 +1,396 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef __itkLesionSizeFilterImageFilter_hxx
+#define __itkLesionSizeFilterImageFilter_hxx
+#include "itkLesionSizeFilterImageFilter.h"
+
+#include <itkContinuousIndex.h>
+#include <itkMultiThreaderBase.h>
+
+#include <algorithm>
+#include <limits>
+
+namespace itk
+{
+template< typename TMaskImage, typename TIntensityImage >
+LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >
+::LesionSizeFilterImageFilter()
+{
+    this->m_MinimumSize=1;
+    this->m_Connectivity=6;
+    this->m_InsideValue=NumericTraits<MaskPixelType>::OneValue();
+    this->m_NumberOfStreamDivisions=1;
+}
+
+template< typename TMaskImage, typename TIntensityImage >
+void
+LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >
+::GenerateInputRequestedRegion()
+{
+    Superclass::GenerateInputRequestedRegion();
+
+    //Lesions may span the whole volume, so the entire mask is needed.
+    //The intensity image is only needed slab by slab in the statistics pass.
+    MaskImageType * input = const_cast<MaskImageType *>(this->GetInput());
+    if (input) {
+        input->SetRequestedRegionToLargestPossibleRegion();
+    }
+    IntensityImageType * intensity = const_cast<IntensityImageType *>(this->GetIntensityImage());
+    if (intensity) {
+        intensity->SetRequestedRegion(this->intensitySlab(intensity->GetLargestPossibleRegion(), 0));
+    }
+}
+
+template< typename TMaskImage, typename TIntensityImage >
+void
+LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >
+::EnlargeOutputRequestedRegion(DataObject * output)
+{
+    Superclass::EnlargeOutputRequestedRegion(output);
+    output->SetRequestedRegionToLargestPossibleRegion();
+}
+
+template< typename TMaskImage, typename TIntensityImage >
+void
+LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >
+::GenerateData()
+{
+    if (m_Connectivity!=6 && m_Connectivity!=18 && m_Connectivity!=26) {
+        itkExceptionMacro(<<"Connectivity must be 6, 18 or 26 (given "<<m_Connectivity<<").");
+    }
+
+    const MaskImageType * input = this->GetInput();
+    const IntensityImageType * intensity = this->GetIntensityImage();
+    MaskImageType * output = this->GetOutput();
+
+    const RegionType region = input->GetBufferedRegion();
+    if (intensity && intensity->GetLargestPossibleRegion()!=region) {
+        itkExceptionMacro(<<"The intensity image must have the same region as the lesion mask.");
+    }
+    output->SetBufferedRegion(output->GetRequestedRegion());
+    output->Allocate();
+
+    const SizeType size = region.GetSize();
+    const SizeValueType numberOfPixels = region.GetNumberOfPixels();
+    if (numberOfPixels >= static_cast<SizeValueType>(std::numeric_limits<LabelType>::max())) {
+        itkExceptionMacro(<<"The lesion mask has too many voxels ("<<numberOfPixels<<") for 32 bits lesion labels.");
+    }
+    const SizeValueType sliceSize = size[0]*size[1];
+
+    //Backward neighbours (already visited in raster order) for the chosen connectivity.
+    //The number of non-zero components gives the face (1), edge (2) and corner (3) neighbours.
+    NeighborOffsetsType neighbors;
+    const unsigned int maximumNonZero = (m_Connectivity==6)?1:((m_Connectivity==18)?2:3);
+    for (int dz = -1; dz <= 0; ++dz) {
+        for (int dy = -1; dy <= 1; ++dy) {
+            for (int dx = -1; dx <= 1; ++dx) {
+                if (dz==0 && (dy>0 || (dy==0 && dx>=0))) {
+                    continue;
+                }
+                const unsigned int nonZero = (dx!=0) + (dy!=0) + (dz!=0);
+                if (nonZero <= maximumNonZero) {
+                    OffsetType offset;
+                    offset[0]=dx;
+                    offset[1]=dy;
+                    offset[2]=dz;
+                    neighbors.push_back(offset);
+                }
+            }
+        }
+    }
+
+    const MaskPixelType * mask = input->GetBufferPointer();
+    std::vector<LabelType> parent(numberOfPixels);
+
+    //1: Provisional labelling, one slab of slices per work unit.
+    SizeValueType numberOfSlabs = std::min<SizeValueType>(this->GetNumberOfWorkUnits(), size[2]);
+    numberOfSlabs = std::max<SizeValueType>(numberOfSlabs, 1);
+    std::vector<SizeValueType> slabStart(numberOfSlabs+1);
+    for (SizeValueType s = 0; s <= numberOfSlabs; ++s) {
+        slabStart[s] = (size[2]*s)/numberOfSlabs;
+    }
+
+    this->GetMultiThreader()->ParallelizeArray(0, numberOfSlabs, [&](SizeValueType s) {
+        this->labelSlab(mask, size, slabStart[s], slabStart[s+1], neighbors, parent);
+    }, nullptr);
+
+    //2: Merge the lesions crossing the slab borders.
+    for (SizeValueType s = 1; s < numberOfSlabs; ++s) {
+        const SizeValueType z = slabStart[s];
+        for (SizeValueType y = 0; y < size[1]; ++y) {
+            for (SizeValueType x = 0; x < size[0]; ++x) {
+                const SizeValueType i = x + y*size[0] + z*sliceSize;
+                if (mask[i]==NumericTraits<MaskPixelType>::ZeroValue()) {
+                    continue;
+                }
+                for (typename NeighborOffsetsType::const_iterator it = neighbors.begin(); it != neighbors.end(); ++it) {
+                    if ((*it)[2]==0) {
+                        continue;
+                    }
+                    const OffsetValueType nx = static_cast<OffsetValueType>(x)+(*it)[0];
+                    const OffsetValueType ny = static_cast<OffsetValueType>(y)+(*it)[1];
+                    if (nx<0 || ny<0 || nx>=static_cast<OffsetValueType>(size[0]) || ny>=static_cast<OffsetValueType>(size[1])) {
+                        continue;
+                    }
+                    const SizeValueType j = nx + ny*size[0] + (z-1)*sliceSize;
+                    if (mask[j]!=NumericTraits<MaskPixelType>::ZeroValue()) {
+                        mergeLabels(parent, static_cast<LabelType>(i), static_cast<LabelType>(j));
+                    }
+                }
+            }
+        }
+    }
+
+    //3: Resolve the final lesion labels and accumulate the statistics in the same pass.
+    //Every parent points to a lower linear index, so the labels are resolved in raster order.
+    struct Accumulator {
+        SizeValueType count;
+        double sumIntensity;
+        double sumIndex[3];
+        IndexValueType minimum[3];
+        IndexValueType maximum[3];
+    };
+    std::vector<Accumulator> accumulators(1);
+    const IndexType start = region.GetIndex();
+    LabelType numberOfLabels = 0;
+    SizeValueType i = 0;
+    const IntensityPixelType * intensityBuffer = nullptr;
+    SizeValueType intensityOffset = 0;
+    unsigned int division = 0;
+    SizeValueType divisionEnd = 0;
+    for (SizeValueType z = 0; z < size[2]; ++z) {
+        if (intensity && z==divisionEnd) {
+            const RegionType slab = this->intensitySlab(region, division);
+            intensityBuffer = this->updateIntensitySlab(slab, intensityOffset);
+            divisionEnd = slab.GetIndex(2)-start[2]+slab.GetSize(2);
+            division++;
+        }
+        for (SizeValueType y = 0; y < size[1]; ++y) {
+            for (SizeValueType x = 0; x < size[0]; ++x, ++i) {
+                if (mask[i]==NumericTraits<MaskPixelType>::ZeroValue()) {
+                    continue;
+                }
+                const IndexValueType idx[3] = {start[0]+static_cast<IndexValueType>(x),
+                                               start[1]+static_cast<IndexValueType>(y),
+                                               start[2]+static_cast<IndexValueType>(z)};
+                const LabelType ancestor = parent[i];
+                LabelType label;
+                if (ancestor==static_cast<LabelType>(i)) {
+                    label = ++numberOfLabels;
+                    Accumulator newLesion;
+                    newLesion.count = 0;
+                    newLesion.sumIntensity = 0.0;
+                    for (unsigned int d = 0; d < 3; ++d) {
+                        newLesion.sumIndex[d] = 0.0;
+                        newLesion.minimum[d] = idx[d];
+                        newLesion.maximum[d] = idx[d];
+                    }
+                    accumulators.push_back(newLesion);
+                }else{
+                    label = parent[ancestor];
+                }
+                parent[i] = label;
+
+                Accumulator & lesion = accumulators[label];
+                lesion.count++;
+                if (intensityBuffer) {
+                    lesion.sumIntensity += static_cast<double>(intensityBuffer[i-intensityOffset]);
+                }
+                for (unsigned int d = 0; d < 3; ++d) {
+                    lesion.sumIndex[d] += static_cast<double>(idx[d]);
+                    lesion.minimum[d] = std::min(lesion.minimum[d], idx[d]);
+                    lesion.maximum[d] = std::max(lesion.maximum[d], idx[d]);
+                }
+            }
+        }
+    }
+
+    //4: Size filtering, without sorting the lesions.
+    const typename MaskImageType::SpacingType spacing = input->GetSpacing();
+    const double voxelVolume = spacing[0]*spacing[1]*spacing[2];
+    std::vector<bool> keep(numberOfLabels+1, false);
+    m_LesionStatistics.clear();
+    for (LabelType label = 1; label <= numberOfLabels; ++label) {
+        const Accumulator & lesion = accumulators[label];
+        if (lesion.count < m_MinimumSize) {
+            continue;
+        }
+        keep[label] = true;
+
+        LesionStatistics statistics;
+        statistics.VoxelCount = lesion.count;
+        statistics.Volume = static_cast<double>(lesion.count)*voxelVolume;
+        ContinuousIndex<double, 3> centroidIndex;
+        for (unsigned int d = 0; d < 3; ++d) {
+            centroidIndex[d] = lesion.sumIndex[d]/static_cast<double>(lesion.count);
+            statistics.BoundingBoxMinimum[d] = lesion.minimum[d];
+            statistics.BoundingBoxMaximum[d] = lesion.maximum[d];
+        }
+        input->TransformContinuousIndexToPhysicalPoint(centroidIndex, statistics.Centroid);
+        statistics.MeanIntensity = intensity ? lesion.sumIntensity/static_cast<double>(lesion.count) : 0.0;
+        m_LesionStatistics.push_back(statistics);
+    }
+
+    //5: Write the kept lesions.
+    MaskPixelType * outputBuffer = output->GetBufferPointer();
+    const MaskPixelType insideValue = m_InsideValue;
+    this->GetMultiThreader()->ParallelizeArray(0, numberOfSlabs, [&](SizeValueType s) {
+        const SizeValueType first = slabStart[s]*sliceSize;
+        const SizeValueType last = slabStart[s+1]*sliceSize;
+        for (SizeValueType v = first; v < last; ++v) {
+            if (mask[v]!=NumericTraits<MaskPixelType>::ZeroValue() && keep[parent[v]]) {
+                outputBuffer[v] = insideValue;
+            }else{
+                outputBuffer[v] = NumericTraits<MaskPixelType>::ZeroValue();
+            }
+        }
+    }, nullptr);
+}
+
+template< typename TMaskImage, typename TIntensityImage >
+void
+LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >
+::labelSlab(const MaskPixelType * mask, const SizeType & size, SizeValueType firstSlice,
+            SizeValueType lastSlice, const NeighborOffsetsType & neighbors, std::vector<LabelType> & parent) const
+{
+    //Only neighbours inside the slab are visited, so every thread writes its own part of the parent table.
+    const SizeValueType sliceSize = size[0]*size[1];
+    for (SizeValueType z = firstSlice; z < lastSlice; ++z) {
+        for (SizeValueType y = 0; y < size[1]; ++y) {
+            for (SizeValueType x = 0; x < size[0]; ++x) {
+                const SizeValueType i = x + y*size[0] + z*sliceSize;
+                if (mask[i]==NumericTraits<MaskPixelType>::ZeroValue()) {
+                    continue;
+                }
+                parent[i] = static_cast<LabelType>(i);
+                for (typename NeighborOffsetsType::const_iterator it = neighbors.begin(); it != neighbors.end(); ++it) {
+                    const OffsetValueType nx = static_cast<OffsetValueType>(x)+(*it)[0];
+                    const OffsetValueType ny = static_cast<OffsetValueType>(y)+(*it)[1];
+                    const OffsetValueType nz = static_cast<OffsetValueType>(z)+(*it)[2];
+                    if (nz<static_cast<OffsetValueType>(firstSlice) || nx<0 || ny<0
+                            || nx>=static_cast<OffsetValueType>(size[0]) || ny>=static_cast<OffsetValueType>(size[1])) {
+                        continue;
+                    }
+                    const SizeValueType j = nx + ny*size[0] + nz*sliceSize;
+                    if (mask[j]!=NumericTraits<MaskPixelType>::ZeroValue()) {
+                        mergeLabels(parent, static_cast<LabelType>(i), static_cast<LabelType>(j));
+                    }
+                }
+            }
+        }
+    }
+}
+
+template< typename TMaskImage, typename TIntensityImage >
+typename LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >::RegionType
+LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >
+::intensitySlab(const RegionType & region, unsigned int division) const
+{
+    const SizeValueType numberOfSlices = region.GetSize(2);
+    SizeValueType numberOfDivisions = std::min<SizeValueType>(m_NumberOfStreamDivisions, numberOfSlices);
+    numberOfDivisions = std::max<SizeValueType>(numberOfDivisions, 1);
+    const SizeValueType firstSlice = (numberOfSlices*division)/numberOfDivisions;
+    const SizeValueType lastSlice = (numberOfSlices*(division+1))/numberOfDivisions;
+
+    RegionType slab = region;
+    slab.SetIndex(2, region.GetIndex(2)+static_cast<IndexValueType>(firstSlice));
+    slab.SetSize(2, lastSlice-firstSlice);
+    return slab;
+}
+
+template< typename TMaskImage, typename TIntensityImage >
+const typename LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >::IntensityPixelType *
+LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >
+::updateIntensitySlab(const RegionType & slab, SizeValueType & bufferOffset)
+{
+    //Pull the slab through the upstream pipeline, as the streaming filters do. The upstream
+    //output may be shared with the mask pipeline, so even the first slab is requested again.
+    IntensityImageType * intensity = const_cast<IntensityImageType *>(this->GetIntensityImage());
+    intensity->SetRequestedRegion(slab);
+    intensity->PropagateRequestedRegion();
+    intensity->UpdateOutputData();
+
+    //The buffer may be larger than the slab, but it must hold whole slices.
+    const RegionType buffered = intensity->GetBufferedRegion();
+    if (!buffered.IsInside(slab) || buffered.GetSize(0)!=slab.GetSize(0) || buffered.GetSize(1)!=slab.GetSize(1)) {
+        itkExceptionMacro(<<"The intensity image slab "<<slab<<" is not buffered as whole slices.");
+    }
+    const SizeValueType sliceSize = slab.GetSize(0)*slab.GetSize(1);
+    const RegionType region = intensity->GetLargestPossibleRegion();
+    bufferOffset = static_cast<SizeValueType>(buffered.GetIndex(2)-region.GetIndex(2))*sliceSize;
+    return intensity->GetBufferPointer();
+}
+
+template< typename TMaskImage, typename TIntensityImage >
+typename LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >::LabelType
+LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >
+::findRoot(std::vector<LabelType> & parent, LabelType label)
+{
+    //Path halving: the parents only get lower, so the root is the first voxel of the lesion.
+    while (parent[label]!=label) {
+        parent[label] = parent[parent[label]];
+        label = parent[label];
+    }
+    return label;
+}
+
+template< typename TMaskImage, typename TIntensityImage >
+void
+LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >
+::mergeLabels(std::vector<LabelType> & parent, LabelType a, LabelType b)
+{
+    const LabelType rootA = findRoot(parent, a);
+    const LabelType rootB = findRoot(parent, b);
+    if (rootA < rootB) {
+        parent[rootB] = rootA;
+    }else if (rootB < rootA) {
+        parent[rootA] = rootB;
+    }
+}
+
+template< typename TMaskImage, typename TIntensityImage >
+void
+LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >
+::WriteLesionStatistics(std::ostream & os) const
+{
+    os<<"label,voxelCount,volume_mm3,centroid_x,centroid_y,centroid_z,"
+      <<"bbox_min_i,bbox_min_j,bbox_min_k,bbox_max_i,bbox_max_j,bbox_max_k,meanIntensity"<<std::endl;
+    for (SizeValueType l = 0; l < m_LesionStatistics.size(); ++l) {
+        const LesionStatistics & lesion = m_LesionStatistics[l];
+        os<<(l+1)<<","<<lesion.VoxelCount<<","<<lesion.Volume<<","
+          <<lesion.Centroid[0]<<","<<lesion.Centroid[1]<<","<<lesion.Centroid[2]<<","
+          <<lesion.BoundingBoxMinimum[0]<<","<<lesion.BoundingBoxMinimum[1]<<","<<lesion.BoundingBoxMinimum[2]<<","
+          <<lesion.BoundingBoxMaximum[0]<<","<<lesion.BoundingBoxMaximum[1]<<","<<lesion.BoundingBoxMaximum[2]<<","
+          <<lesion.MeanIntensity<<std::endl;
+    }
+}
+
+template< typename TMaskImage, typename TIntensityImage >
+void
+LesionSizeFilterImageFilter< TMaskImage, TIntensityImage >
+::PrintSelf(std::ostream & os, Indent indent) const
+{
+    Superclass::PrintSelf(os, indent);
+    os << indent << "MinimumSize: " << m_MinimumSize << std::endl;
+    os << indent << "Connectivity: " << m_Connectivity << std::endl;
+    os << indent << "InsideValue: " << static_cast<typename NumericTraits<MaskPixelType>::PrintType>(m_InsideValue) << std::endl;
+    os << indent << "NumberOfStreamDivisions: " << m_NumberOfStreamDivisions << std::endl;
+    os << indent << "NumberOfLesions: " << m_LesionStatistics.size() << std::endl;
+}
+
+} // end namespace itk
+
+#endif
@@ -0,0 +1,55 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef __itkThreadBudget_h
+#define __itkThreadBudget_h
+#include "itkMultiThreaderBase.h"
+
+namespace itk
+{
+
+/** \class ThreadBudget
+ *
+ * Sets the global default number of threads for its lifetime and restores
+ * the former default when it is destroyed. A CLI loaded in the Slicer process
+ * shares the ITK globals of the application, so its thread budget must not
+ * outlive its run. 0 keeps the current default.
+ */
+class ThreadBudget
+{
+public:
+    explicit ThreadBudget(int numberOfThreads)
+    {
+        m_PreviousNumberOfThreads = MultiThreaderBase::GetGlobalDefaultNumberOfThreads();
+        if (numberOfThreads > 0) {
+            MultiThreaderBase::SetGlobalDefaultNumberOfThreads(numberOfThreads);
+        }
+    }
+
+    ~ThreadBudget()
+    {
+        MultiThreaderBase::SetGlobalDefaultNumberOfThreads(m_PreviousNumberOfThreads);
+    }
+
+private:
+    ThreadBudget(const ThreadBudget &) = delete;
+    void operator=(const ThreadBudget &) = delete;
+
+    ThreadIdType m_PreviousNumberOfThreads;
+};
+
+} // end namespace itk
+
+#endif
@@ -0,0 +1,96 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef __itkWhiteMatterMatchImageFilter_h
+#define __itkWhiteMatterMatchImageFilter_h
+#include "itkImageToImageFilter.h"
+#include "itkImage.h"
+#include "itkNumericTraits.h"
+
+namespace itk
+{
+
+/** \class WhiteMatterMatchImageFilter
+ *
+ * Keeps the lesion voxels whose neighbourhood is mostly made of lesion voxels
+ * lying in the white matter, i.e. the fraction of neighbours that are both in
+ * the lesion mask and in the white matter mask is at least WhiteMatterMatch.
+ *
+ * The input requested region is padded by the neighbourhood radius, so the
+ * filter can be streamed in tiles with the same result as a whole volume run.
+ */
+template< typename TMaskImage >
+class ITK_EXPORT WhiteMatterMatchImageFilter:
+        public ImageToImageFilter< TMaskImage, TMaskImage >
+{
+public:
+    /** Convenient typedefs for simplifying declarations. */
+    typedef TMaskImage  MaskImageType;
+
+    /** Standard class typedefs. */
+    typedef WhiteMatterMatchImageFilter                      Self;
+    typedef ImageToImageFilter< TMaskImage, TMaskImage >     Superclass;
+    typedef SmartPointer< Self >                             Pointer;
+    typedef SmartPointer< const Self >                       ConstPointer;
+
+    /** Method for creation through the object factory. */
+    itkNewMacro(Self)
+
+    /** Run-time type information (and related methods). */
+    itkTypeMacro(WhiteMatterMatchImageFilter, ImageToImageFilter)
+
+    typedef typename MaskImageType::PixelType          MaskPixelType;
+    typedef typename MaskImageType::RegionType         RegionType;
+    typedef typename Superclass::OutputImageRegionType OutputImageRegionType;
+
+    /** Set the white matter mask (any non-zero value is white matter). */
+    itkSetInputMacro(WhiteMatterMask, MaskImageType)
+    itkGetInputMacro(WhiteMatterMask, MaskImageType)
+
+    /** Set the minimum fraction of white matter lesion neighbours (0 < w <= 1). */
+    itkSetMacro(WhiteMatterMatch, float)
+
+    /** Set the neighbourhood radius. */
+    itkSetMacro(Radius, SizeValueType)
+
+    /** Set the value given to the kept lesion voxels. */
+    itkSetMacro(InsideValue, MaskPixelType)
+
+    itkGetMacro(WhiteMatterMatch, float)
+    itkGetMacro(Radius, SizeValueType)
+    itkGetMacro(InsideValue, MaskPixelType)
+
+protected:
+    WhiteMatterMatchImageFilter();
+    virtual ~WhiteMatterMatchImageFilter() {}
+    float m_WhiteMatterMatch;
+    SizeValueType m_Radius;
+    MaskPixelType m_InsideValue;
+
+    void GenerateInputRequestedRegion();
+    void DynamicThreadedGenerateData(const OutputImageRegionType & outputRegionForThread);
+    void PrintSelf(std::ostream & os, Indent indent) const;
+private:
+    WhiteMatterMatchImageFilter(const Self &); //purposely not implemented
+    void operator=(const Self &);  //purposely not implemented
+};
+
+} // end namespace itk
+
+#ifndef ITK_MANUAL_INSTANTIATION
+#include "itkWhiteMatterMatchImageFilter.hxx"
+#endif
+
+#endif
@@ -0,0 +1,119 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef __itkWhiteMatterMatchImageFilter_hxx
+#define __itkWhiteMatterMatchImageFilter_hxx
+#include "itkWhiteMatterMatchImageFilter.h"
+
+#include <itkConstNeighborhoodIterator.h>
+#include <itkImageRegionIterator.h>
+
+namespace itk
+{
+template< typename TMaskImage >
+WhiteMatterMatchImageFilter< TMaskImage >
+::WhiteMatterMatchImageFilter()
+{
+    this->m_WhiteMatterMatch=0.6;
+    this->m_Radius=1;
+    this->m_InsideValue=NumericTraits<MaskPixelType>::OneValue();
+    this->DynamicMultiThreadingOn();
+}
+
+template< typename TMaskImage >
+void
+WhiteMatterMatchImageFilter< TMaskImage >
+::GenerateInputRequestedRegion()
+{
+    Superclass::GenerateInputRequestedRegion();
+
+    //Pad the requested region by the neighbourhood radius (tile halo).
+    MaskImageType * inputs[2] = {const_cast<MaskImageType *>(this->GetInput()),
+                                 const_cast<MaskImageType *>(this->GetWhiteMatterMask())};
+    for (unsigned int i = 0; i < 2; ++i) {
+        if (!inputs[i]) {
+            continue;
+        }
+        RegionType requestedRegion = inputs[i]->GetRequestedRegion();
+        requestedRegion.PadByRadius(m_Radius);
+        if (requestedRegion.Crop(inputs[i]->GetLargestPossibleRegion())) {
+            inputs[i]->SetRequestedRegion(requestedRegion);
+        }else{
+            inputs[i]->SetRequestedRegion(requestedRegion);
+            InvalidRequestedRegionError e(__FILE__, __LINE__);
+            e.SetLocation(ITK_LOCATION);
+            e.SetDescription("Requested region is (at least partially) outside the largest possible region.");
+            e.SetDataObject(inputs[i]);
+            throw e;
+        }
+    }
+}
+
+template< typename TMaskImage >
+void
+WhiteMatterMatchImageFilter< TMaskImage >
+::DynamicThreadedGenerateData(const OutputImageRegionType & outputRegionForThread)
+{
+    const MaskImageType * lesionMask = this->GetInput();
+    const MaskImageType * wmMask = this->GetWhiteMatterMask();
+    MaskImageType * output = this->GetOutput();
+
+    typedef ConstNeighborhoodIterator<MaskImageType>    NeighborhoodIterator;
+    typedef ImageRegionIterator<MaskImageType>          MaskRegionIterator;
+    typename NeighborhoodIterator::RadiusType radius;
+    radius.Fill(m_Radius);
+    NeighborhoodIterator        lesionMaskIt(radius, lesionMask, outputRegionForThread);
+    NeighborhoodIterator        wmMaskIt(radius, wmMask, outputRegionForThread);
+    MaskRegionIterator          finalLesionIt(output, outputRegionForThread);
+
+    const unsigned int neighborhoodSize = lesionMaskIt.Size();
+    unsigned int match=0;
+    while (!finalLesionIt.IsAtEnd()) {
+        if (lesionMaskIt.GetCenterPixel()!=NumericTraits<MaskPixelType>::ZeroValue()) {
+            match=0;
+            for (unsigned int idx = 0; idx < neighborhoodSize; ++idx) {
+                if (lesionMaskIt.GetPixel(idx)!=NumericTraits<MaskPixelType>::ZeroValue()
+                        && wmMaskIt.GetPixel(idx)!=NumericTraits<MaskPixelType>::ZeroValue()) {
+                    match++;
+                }
+            }
+            if ((float)match/(float)neighborhoodSize >= m_WhiteMatterMatch) {
+                finalLesionIt.Set(m_InsideValue);
+            }else{
+                finalLesionIt.Set(NumericTraits<MaskPixelType>::ZeroValue());
+            }
+        }else{
+            finalLesionIt.Set(NumericTraits<MaskPixelType>::ZeroValue());
+        }
+        ++lesionMaskIt;
+        ++wmMaskIt;
+        ++finalLesionIt;
+    }
+}
+
+template< typename TMaskImage >
+void
+WhiteMatterMatchImageFilter< TMaskImage >
+::PrintSelf(std::ostream & os, Indent indent) const
+{
+    Superclass::PrintSelf(os, indent);
+    os << indent << "WhiteMatterMatch: " << m_WhiteMatterMatch << std::endl;
+    os << indent << "Radius: " << m_Radius << std::endl;
+    os << indent << "InsideValue: " << static_cast<typename NumericTraits<MaskPixelType>::PrintType>(m_InsideValue) << std::endl;
+}
+
+} // end namespace itk
+
+#endif
@@ -11,16 +11,12 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 import os
-import sys
 import platform
 import unittest
-from ctypes.util import find_library
-
-from os.path import expanduser
 
 import vtk, qt, ctk, slicer
-from numpy.core.numeric import outer
 from slicer.ScriptedLoadableModule import *
+from LesionSpotlightLib import CLIUtils
 import logging
 
 #
@@ -108,7 +104,8 @@ class LSContrastEnhancerWidget(ScriptedLoadableModuleWidget):
     self.setIsBETWidget = ctk.ctkCheckBox()
     self.setIsBETWidget.setChecked(False)
     self.setIsBETWidget.setToolTip(
-      "Is the input data already brain extracted? This is information is useful when choosing the brain template that will be adjusted to the native space.")
+      "Is the input data already brain extracted? If not, only the brain region given by the MNI152 brain tissues registered "
+      "to the input is processed, and the remaining voxels are kept as they are.")
     parametersInputFormLayout.addRow("Is brain extracted?",
                                             self.setIsBETWidget)
 
@@ -279,8 +276,66 @@ class LSContrastEnhancerWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = False
     parametersInputFormLayout.addRow(self.applyButton)
 
+    #
+    # Execution Parameters Area
+    #
+    parametersExecutionCollapsibleButton = ctk.ctkCollapsibleButton()
+    parametersExecutionCollapsibleButton.text = "Execution Parameters"
+    parametersExecutionCollapsibleButton.collapsed = True
+    self.layout.addWidget(parametersExecutionCollapsibleButton)
+
+    # Layout within the dummy collapsible button
+    parametersExecutionFormLayout = qt.QFormLayout(parametersExecutionCollapsibleButton)
+
+    #
+    # Number Of Threads Area
+    #
+    self.setNumberOfThreadsWidget = qt.QSpinBox()
+    self.setNumberOfThreadsWidget.setMinimum(0)
+    self.setNumberOfThreadsWidget.setMaximum(256)
+    self.setNumberOfThreadsWidget.setValue(0)
+    self.setNumberOfThreadsWidget.setSpecialValueText("All cores")
+    self.setNumberOfThreadsWidget.setToolTip("Maximum number of threads used by each processing step (bias field correction, "
+                                             "filtering, registration and resampling). Lower it to run several segmentations on the same computer.")
+    parametersExecutionFormLayout.addRow("Number Of Threads ", self.setNumberOfThreadsWidget)
+
+    #
+    # Preprocessing Profile Area
+    #
+    self.setPreprocessingProfileWidget = ctk.ctkComboBox()
+    self.setPreprocessingProfileWidget.addItem("accurate")
+    self.setPreprocessingProfileWidget.addItem("balanced")
+    self.setPreprocessingProfileWidget.addItem("fast")
+    self.setPreprocessingProfileWidget.setToolTip("Bias field correction and noise attenuation settings. accurate keeps the default settings, "
+                                                  "balanced and fast trade a small lesion map difference for a shorter preprocessing.")
+    parametersExecutionFormLayout.addRow("Preprocessing Profile ", self.setPreprocessingProfileWidget)
+
+    #
+    # Preview Spacing Area
+    #
+    self.setPreviewSpacingWidget = qt.QDoubleSpinBox()
+    self.setPreviewSpacingWidget.setDecimals(1)
+    self.setPreviewSpacingWidget.setMinimum(0)
+    self.setPreviewSpacingWidget.setMaximum(5)
+    self.setPreviewSpacingWidget.setSingleStep(0.5)
+    self.setPreviewSpacingWidget.setValue(0)
+    self.setPreviewSpacingWidget.setSuffix(" mm")
+    self.setPreviewSpacingWidget.setSpecialValueText("Full resolution")
+    self.setPreviewSpacingWidget.setToolTip("Runs a quick preview on the inputs resampled to this spacing (e.g. 2 or 3 mm) and shows the result "
+                                            "on the input grid. Useful to explore the parameters before a full resolution run.")
+    parametersExecutionFormLayout.addRow("Preview Spacing ", self.setPreviewSpacingWidget)
+
+    # Weighting preview: the shown slices are updated at once, the whole volume when the slider rests
+    self.logic = LSContrastEnhancerLogic()
+    self.weightingTimer = qt.QTimer()
+    self.weightingTimer.setSingleShot(True)
+    self.weightingTimer.setInterval(300)
+
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.setWeightedEnhancementWidget.connect("valueChanged(double)", self.onWeightingChanged)
+    self.setKeepGaussianSignalWidget.connect("toggled(bool)", self.onWeightingChanged)
+    self.weightingTimer.connect("timeout()", self.onWeightingTimeout)
     self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.outputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
 
@@ -291,28 +346,48 @@ class LSContrastEnhancerWidget(ScriptedLoadableModuleWidget):
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.weightingTimer.stop()
+    self.logic.clearWeightingCache()
 
   def onSelect(self):
     self.applyButton.enabled = self.inputSelector.currentNode() and self.outputSelector.currentNode()
 
+  def onWeightingChanged(self, value=None):
+    if not self.logic.hasWeightingCache(self.inputSelector.currentNode(), self.outputSelector.currentNode()):
+      return
+    self.logic.updateWeighting(self.setWeightedEnhancementWidget.value, self.setKeepGaussianSignalWidget.isChecked(),
+                               self.logic.visibleSlices(self.outputSelector.currentNode()))
+    self.weightingTimer.start()
+
+  def onWeightingTimeout(self):
+    if self.logic.hasWeightingCache(self.inputSelector.currentNode(), self.outputSelector.currentNode()):
+      self.logic.updateWeighting(self.setWeightedEnhancementWidget.value, self.setKeepGaussianSignalWidget.isChecked())
+
   def onApplyButton(self):
-    logic = LSContrastEnhancerLogic()
-    logic.run( self.inputSelector.currentNode()
-              , self.outputSelector.currentNode()
-              , self.setIsBETWidget.isChecked()
-              , self.setPercSamplingQWidget.value
-              , self.setInitiationRegistrationBooleanWidget.currentText
-              , self.setInterpolationMethodBooleanWidget.currentText
-              , self.setNumberOfBinsWidget.value
-              , self.setFlipObjectWidget.isChecked()
-              , self.setWeightedEnhancementWidget.value
-              , self.setKeepGaussianSignalWidget.isChecked()
-              , self.setThresholdLFMethodBooleanWidget.currentText
-              , self.setFilteringCondutanceWidget.value
-              , self.setFilteringNumberOfIterationWidget.value
-              , self.setFilteringQWidget.value
-              )
+    from LesionSpotlightLib import QualityGates
+    self.weightingTimer.stop()
+    try:
+      self.logic.run( self.inputSelector.currentNode()
+                , self.outputSelector.currentNode()
+                , self.setIsBETWidget.isChecked()
+                , self.setPercSamplingQWidget.value
+                , self.setInitiationRegistrationBooleanWidget.currentText
+                , self.setInterpolationMethodBooleanWidget.currentText
+                , self.setNumberOfBinsWidget.value
+                , self.setFlipObjectWidget.isChecked()
+                , self.setWeightedEnhancementWidget.value
+                , self.setKeepGaussianSignalWidget.isChecked()
+                , self.setThresholdLFMethodBooleanWidget.currentText
+                , self.setFilteringCondutanceWidget.value
+                , self.setFilteringNumberOfIterationWidget.value
+                , self.setFilteringQWidget.value
+                , numberOfThreads=self.setNumberOfThreadsWidget.value
+                , preprocessingProfile=self.setPreprocessingProfileWidget.currentText
+                , keepContrastMap=True
+                , previewSpacing=self.setPreviewSpacingWidget.value
+                )
+    except QualityGates.QualityGateError as e:
+      slicer.util.errorDisplay("Enhancement aborted: %s" % e)
 
 #
 # LSContrastEnhancerLogic
@@ -328,6 +403,10 @@ class LSContrastEnhancerLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    self.weightingCache = None
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -357,16 +436,74 @@ class LSContrastEnhancerLogic(ScriptedLoadableModuleLogic):
 
   def run(self, inputVolume, outputVolume, isBET, sampling, initiation, interpolation,
               numberOfBins, flipObject, weightingValue, keepGaussianSignal, thresholdMethod, conductance, nIter,
-              qValue):
+              qValue, numberOfTiles=1, numberOfThreads=0, preprocessingProfile="accurate",
+              keepContrastMap=False, previewSpacing=0, brainMaskLabel=None, contrastMapVolume=None):
 
     """
-    Run the actual algorithm
+    Run the actual algorithm. With keepContrastMap, the contrast map is kept in memory so that
+    updateWeighting() can change the weighting afterwards, and contrastMapVolume receives the
+    contrast map on the input grid. A previewSpacing (mm) runs it on the
+    input resampled to that spacing and resamples the enhanced volume back to the input grid.
+    When the input is not skull stripped (isBET off), only the brain region given by the registered
+    atlas is enhanced, and brainMaskLabel is the mask of that region used by the bias field correction.
+    An input or a registration failing the quality gates raises QualityGates.QualityGateError.
     """
+    from LesionSpotlightLib import BrainMask, Preprocessing, Preview, QualityGates
 
     if not self.isValidInputOutputData(inputVolume, outputVolume):
       slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
       return False
 
+    QualityGates.checkInput(inputVolume, QualityGates.FLAIR)
+
+    if previewSpacing:
+      slicer.util.showStatusMessage("Preview: resampling the input to %g mm..." % previewSpacing)
+      previewInputVolume = Preview.previewVolume(inputVolume, previewSpacing, numberOfThreads)
+      previewOutputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+      previewContrastMap = None
+      if keepContrastMap or contrastMapVolume:
+        previewContrastMap = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+      try:
+        result = self.run(previewInputVolume, previewOutputVolume, isBET, sampling, initiation, interpolation,
+                          numberOfBins, flipObject, weightingValue, keepGaussianSignal, thresholdMethod, conductance,
+                          nIter, qValue, numberOfTiles, numberOfThreads, preprocessingProfile,
+                          contrastMapVolume=previewContrastMap)
+        Preview.restoreResolution(previewOutputVolume, inputVolume, outputVolume, False, numberOfThreads)
+        if result and previewContrastMap:
+          self.restoreContrastMap(previewContrastMap, inputVolume, outputVolume, keepContrastMap, contrastMapVolume,
+                                  numberOfThreads)
+      finally:
+        for node in (previewContrastMap, previewOutputVolume, previewInputVolume):
+          if node:
+            slicer.mrmlScene.RemoveNode(node)
+      return result
+
+    if not isBET:
+      slicer.util.showStatusMessage("Brain masking...")
+      brainMaskLabel = BrainMask.brainMask(inputVolume, False, sampling, initiation, numberOfThreads=numberOfThreads)
+      brainInputVolume = BrainMask.restrictToMask(inputVolume, brainMaskLabel)
+      brainMaskCrop = BrainMask.restrictToMask(brainMaskLabel, brainMaskLabel)
+      brainOutputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+      brainContrastMap = None
+      if keepContrastMap or contrastMapVolume:
+        brainContrastMap = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+      try:
+        result = self.run(brainInputVolume, brainOutputVolume, True, sampling, initiation, interpolation,
+                          numberOfBins, flipObject, weightingValue, keepGaussianSignal, thresholdMethod, conductance,
+                          nIter, qValue, numberOfTiles, numberOfThreads, preprocessingProfile,
+                          brainMaskLabel=brainMaskCrop, contrastMapVolume=brainContrastMap)
+        Preview.restoreResolution(brainOutputVolume, inputVolume, outputVolume, False, numberOfThreads)
+        # Out of the brain the input is kept as it is
+        BrainMask.fillOutsideMask(outputVolume, inputVolume, brainMaskLabel)
+        if result and brainContrastMap:
+          self.restoreContrastMap(brainContrastMap, inputVolume, outputVolume, keepContrastMap, contrastMapVolume,
+                                  numberOfThreads, brainMaskLabel)
+      finally:
+        for node in (brainContrastMap, brainOutputVolume, brainMaskCrop, brainInputVolume, brainMaskLabel):
+          if node:
+            slicer.mrmlScene.RemoveNode(node)
+      return result
+
     logging.info('Processing started')
     slicer.util.showStatusMessage("Processing started")
 
@@ -379,44 +516,33 @@ class LSContrastEnhancerLogic(ScriptedLoadableModuleLogic):
     #################################################################################################################
     slicer.util.showStatusMessage("Step 1: Bias field correction...")
 
-    regParams = {}
-    regParams["inputImageName"] = inputVolume.GetID()
-    regParams["outputImageName"] = outputVolume.GetID()
+    regParams = Preprocessing.n4Parameters(inputVolume, outputVolume, preprocessingProfile, brainMaskLabel)
 
-    slicer.cli.run(slicer.modules.n4itkbiasfieldcorrection, None, regParams, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.n4itkbiasfieldcorrection, regParams, numberOfThreads)
 
     #################################################################################################################
     #                                              Noise Attenuation                                                #
     #################################################################################################################
     slicer.util.showStatusMessage("Step 2: Decreasing image noise level...")
 
-    regParams = {}
-    regParams["inputVolume"] = outputVolume.GetID()
-    regParams["outputVolume"] = outputVolume.GetID()
+    regParams = Preprocessing.aadParameters(outputVolume, outputVolume, nIter, preprocessingProfile)
     regParams["conductance"] = conductance
-    regParams["iterations"] = nIter
     regParams["q"] = qValue
 
-    slicer.cli.run(slicer.modules.aadimagefilter, None, regParams, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.aadimagefilter, regParams, numberOfThreads)
 
     # Get the path to LSSegmenter-Data files
     path2files = os.path.dirname(slicer.modules.lssegmenter.path)
     #################################################################################################################
     #                                        Registration  - MNI to Native space                                    #
     #################################################################################################################
+    # The input is skull stripped here, by the user or by the brain masking
     if platform.system() == "Windows":
-      if isBET:
-        (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '\\Resources\\LSSegmenter-Data\\MNI152_T1_1mm_brain.nii.gz',
-                                                         {}, True)
-      else:
-        (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '\\Resources\\LSSegmenter-Data\\MNI152_T1_1mm.nii.gz', {},
-                                                         True)
+      (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '\\Resources\\LSSegmenter-Data\\MNI152_T1_1mm_brain.nii.gz',
+                                                       {}, True)
     else:
-      if isBET:
-        (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '/Resources/LSSegmenter-Data/MNI152_T1_1mm_brain.nii.gz', {},
-                                                         True)
-      else:
-        (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '/Resources/LSSegmenter-Data/MNI152_T1_1mm.nii.gz', {}, True)
+      (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '/Resources/LSSegmenter-Data/MNI152_T1_1mm_brain.nii.gz', {},
+                                                       True)
 
     #
     # Registering the MNI template to native space.
@@ -437,7 +563,7 @@ class LSContrastEnhancerLogic(ScriptedLoadableModuleLogic):
     regParams["useAffine"] = True
     regParams["interpolationMode"] = interpolation
 
-    slicer.cli.run(slicer.modules.brainsfit, None, regParams, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.brainsfit, regParams, numberOfThreads)
 
     if platform.system() == "Windows":
       (read, MNIWM_thin_Label) = slicer.util.loadLabelVolume(path2files + '\\Resources\\LSSegmenter-Data\\MNI152_T1_1mm_WhiteMatter_thinner.nii.gz', {}, True)
@@ -455,14 +581,23 @@ class LSContrastEnhancerLogic(ScriptedLoadableModuleLogic):
     params["interpolationMode"] = "NearestNeighbor"
     params["pixelType"] = "binary"
 
-    slicer.cli.run(slicer.modules.brainsresample, None, params, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.brainsresample, params, numberOfThreads)
+
+    # Registration quality gates, the contrast one only holds for hyperintense lesions on a T2-FLAIR
+    temporaryNodes = (registrationMNI2NativeTransform, MNITemplateNode, MNIWM_thin_Label, brainWM_thin_Label)
+    brainWMArray = slicer.util.arrayFromVolume(brainWM_thin_Label)
+    QualityGates.checkRegistration(outputVolume, brainWMArray, QualityGates.FLAIR, nodesToRemove=temporaryNodes)
+    if not flipObject:
+      QualityGates.checkContrast(outputVolume, brainWMArray, None, QualityGates.FLAIR, nodesToRemove=temporaryNodes)
 
     #################################################################################################################
     #                                            Lesion segmentation                                                #
     #################################################################################################################
     slicer.util.showStatusMessage("Step 4: Enhancing hyperintenses lesions...")
-    lesionUpdate = slicer.vtkMRMLScalarVolumeNode()
-    slicer.mrmlScene.AddNode(lesionUpdate)
+    lesionUpdate = contrastMapVolume
+    if lesionUpdate is None:
+      lesionUpdate = slicer.vtkMRMLScalarVolumeNode()
+      slicer.mrmlScene.AddNode(lesionUpdate)
 
     # Enhancing lesion contrast...
     regParams = {}
@@ -472,8 +607,12 @@ class LSContrastEnhancerLogic(ScriptedLoadableModuleLogic):
     regParams["numberOfBins"] = numberOfBins
     regParams["flipObject"] = flipObject
     regParams["thrType"] = thresholdMethod
+    regParams["numberOfTiles"] = numberOfTiles
 
-    slicer.cli.run(slicer.modules.logisticcontrastenhancement, None, regParams, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.logisticcontrastenhancement, regParams, numberOfThreads)
+    self.clearWeightingCache()
+    if keepContrastMap:
+      self.cacheWeightingMaps(inputVolume, outputVolume, lesionUpdate)
 
     # Increasing FLAIR lesions contrast...
     regParams = {}
@@ -482,8 +621,9 @@ class LSContrastEnhancerLogic(ScriptedLoadableModuleLogic):
     regParams["outputVolume"] = outputVolume.GetID()
     regParams["weight"] = weightingValue
     regParams["maintainGaussianity"] = keepGaussianSignal
+    regParams["numberOfTiles"] = numberOfTiles
 
-    slicer.cli.run(slicer.modules.weightedenhancementimagefilter, None, regParams, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.weightedenhancementimagefilter, regParams, numberOfThreads)
 
 
     # Removing unnecessary nodes
@@ -491,13 +631,129 @@ class LSContrastEnhancerLogic(ScriptedLoadableModuleLogic):
     slicer.mrmlScene.RemoveNode(MNITemplateNode)
     slicer.mrmlScene.RemoveNode(MNIWM_thin_Label)
     slicer.mrmlScene.RemoveNode(brainWM_thin_Label)
-    slicer.mrmlScene.RemoveNode(lesionUpdate)
+    if lesionUpdate is not contrastMapVolume:
+      slicer.mrmlScene.RemoveNode(lesionUpdate)
 
     slicer.util.showStatusMessage("Processing completed")
     logging.info('Processing completed')
 
     return True
 
+  def cacheWeightingMaps(self, inputVolume, outputVolume, contrastMapNode):
+    """Keeps the weight independent part of the weighted enhancement of inputVolume into outputVolume
+    """
+    from LesionSpotlightLib import Engine
+    # Same baseline settings as the weightedenhancementimagefilter call in run()
+    maps = Engine.weightingMaps(slicer.util.arrayFromVolume(contrastMapNode))
+    self.weightingCache = {"inputVolumeID": inputVolume.GetID(), "outputVolumeID": outputVolume.GetID(), "maps": maps}
+
+  def restoreContrastMap(self, contrastMapNode, inputVolume, outputVolume, keepContrastMap, contrastMapVolume=None,
+                         numberOfThreads=0, brainMaskLabel=None):
+    """Resamples the contrast map of a run on another grid (preview or brain region) onto the grid of
+    inputVolume, into contrastMapVolume and, with keepContrastMap, into the weighting cache of
+    inputVolume and outputVolume. Out of brainMaskLabel the contrast map is zero, so the weighting
+    keeps the input there.
+    """
+    from LesionSpotlightLib import Preview
+    fullContrastMap = contrastMapVolume or slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    try:
+      Preview.restoreResolution(contrastMapNode, inputVolume, fullContrastMap, False, numberOfThreads)
+      if brainMaskLabel:
+        contrastMap = slicer.util.arrayFromVolume(fullContrastMap)
+        contrastMap[slicer.util.arrayFromVolume(brainMaskLabel) == 0] = 0
+        slicer.util.arrayFromVolumeModified(fullContrastMap)
+      if keepContrastMap:
+        self.cacheWeightingMaps(inputVolume, outputVolume, fullContrastMap)
+    finally:
+      if fullContrastMap is not contrastMapVolume:
+        slicer.mrmlScene.RemoveNode(fullContrastMap)
+
+  def clearWeightingCache(self):
+    self.weightingCache = None
+
+  def hasWeightingCache(self, inputVolume, outputVolume):
+    return (self.weightingCache is not None and inputVolume is not None and outputVolume is not None
+            and self.weightingCache["inputVolumeID"] == inputVolume.GetID()
+            and self.weightingCache["outputVolumeID"] == outputVolume.GetID()
+            and slicer.mrmlScene.GetNodeByID(inputVolume.GetID()) is not None
+            and slicer.mrmlScene.GetNodeByID(outputVolume.GetID()) is not None)
+
+  def updateWeighting(self, weightingValue, keepGaussianSignal, sliceIndices=None):
+    """Recomputes the output volume from the cached contrast map, without running the pipeline again.
+    sliceIndices restricts the update to a list of (array axis, index) slices, the whole volume
+    is updated otherwise.
+    """
+    from LesionSpotlightLib import Engine
+    inputArray = slicer.util.arrayFromVolume(slicer.mrmlScene.GetNodeByID(self.weightingCache["inputVolumeID"]))
+    outputVolume = slicer.mrmlScene.GetNodeByID(self.weightingCache["outputVolumeID"])
+    outputArray = slicer.util.arrayFromVolume(outputVolume)
+    if inputArray.shape != outputArray.shape:
+      self.clearWeightingCache()
+      return False
+    if sliceIndices is None:
+      regions = [Ellipsis]
+    else:
+      regions = [tuple([slice(None)] * axis + [index]) for axis, index in sliceIndices]
+    for region in regions:
+      maps = [weightingMap[region] for weightingMap in self.weightingCache["maps"]]
+      outputArray[region] = inputArray[region] * Engine.weightingBoost(maps, weightingValue, keepGaussianSignal)
+    slicer.util.arrayFromVolumeModified(outputVolume)
+    return True
+
+  def visibleSlices(self, volumeNode):
+    """(array axis, index) of the volume slices closest to the slices shown in the slice viewers
+    """
+    layoutManager = slicer.app.layoutManager()
+    if not layoutManager or not volumeNode:
+      return []
+    rasToIJK = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(rasToIJK)
+    dimensions = volumeNode.GetImageData().GetDimensions()
+    sliceIndices = []
+    for sliceViewName in layoutManager.sliceViewNames():
+      sliceToRAS = layoutManager.sliceWidget(sliceViewName).mrmlSliceNode().GetSliceToRAS()
+      center = rasToIJK.MultiplyPoint([sliceToRAS.GetElement(i, 3) for i in range(3)] + [1.0])
+      normal = rasToIJK.MultiplyPoint([sliceToRAS.GetElement(i, 2) for i in range(3)] + [0.0])
+      # The array is indexed [k, j, i]
+      axis = max(range(3), key=lambda d: abs(normal[d]))
+      index = int(round(center[axis]))
+      if 0 <= index < dimensions[axis] and (2 - axis, index) not in sliceIndices:
+        sliceIndices.append((2 - axis, index))
+    return sliceIndices
+
+  def processSubject(self, subject, parameters):
+    """Enhances one cohort subject from files. parameters holds the inputVolume and outputVolume
+    paths and the keyword arguments of run()
+    """
+    parameters = dict(parameters)
+    inputPath = parameters.pop("inputVolume")
+    outputPath = parameters.pop("outputVolume")
+
+    inputVolume = slicer.util.loadVolume(inputPath)
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", subject + "_enhanced")
+    try:
+      if not self.run(inputVolume, outputVolume, **parameters):
+        raise ValueError("Invalid input or output volume for subject %s" % subject)
+      if not slicer.util.saveNode(outputVolume, outputPath):
+        raise IOError("Could not write %s" % outputPath)
+    finally:
+      slicer.mrmlScene.RemoveNode(inputVolume)
+      slicer.mrmlScene.RemoveNode(outputVolume)
+    return {"outputVolume": outputPath}
+
+  def runJobQueue(self, queuePath, worker=None, memoryBudgetMB=None):
+    """Processes the LSContrastEnhancer jobs of a cohort job queue until none is left. Several Slicer
+    processes can share the same queue, and a restarted run only processes the unfinished subjects:
+
+      Slicer --no-main-window --python-code "import LSContrastEnhancer; LSContrastEnhancer.LSContrastEnhancerLogic().runJobQueue('cohort.sqlite'); exit()"
+
+    With memoryBudgetMB, the workers of the machine (given the same budget) only start a subject
+    while the peak memory estimates of the running ones leave room for it.
+    """
+    from LesionSpotlightLib.JobQueue import JobQueue
+    with JobQueue(queuePath) as queue:
+      return queue.runWorker({"LSContrastEnhancer": self.processSubject}, worker, memoryBudgetMB=memoryBudgetMB)
+
 
 class LSContrastEnhancerTest(ScriptedLoadableModuleTest):
   """
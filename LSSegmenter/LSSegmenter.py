@@ -11,16 +11,14 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 import os
-import sys
+import time
+import tempfile
 import platform
 import unittest
-from ctypes.util import find_library
-
-from os.path import expanduser
 
 import vtk, qt, ctk, slicer
-from SimpleITK._SimpleITK import sitkComposite
 from slicer.ScriptedLoadableModule import *
+from LesionSpotlightLib import CLIUtils
 import logging
 
 #
@@ -57,6 +55,7 @@ class LSSegmenterWidget(ScriptedLoadableModuleWidget):
   """
 
   def setup(self):
+    from LesionSpotlightLib import LesionSurfaces
      # ScriptedLoadableModuleWidget.setup(self)
     # Instantiate and connect widgets ...
 
@@ -102,13 +101,71 @@ class LSSegmenterWidget(ScriptedLoadableModuleWidget):
       "Output a global lesion mask.")
     parametersInputFormLayout.addRow("Lesion Label ", self.outputSelector)
 
+    #
+    # output lesion statistics table selector
+    #
+    self.lesionStatisticsSelector = slicer.qMRMLNodeComboBox()
+    self.lesionStatisticsSelector.nodeTypes = ["vtkMRMLTableNode"]
+    self.lesionStatisticsSelector.selectNodeUponCreation = True
+    self.lesionStatisticsSelector.addEnabled = True
+    self.lesionStatisticsSelector.renameEnabled = True
+    self.lesionStatisticsSelector.removeEnabled = True
+    self.lesionStatisticsSelector.noneEnabled = True
+    self.lesionStatisticsSelector.showHidden = False
+    self.lesionStatisticsSelector.showChildNodeTypes = False
+    self.lesionStatisticsSelector.setMRMLScene(slicer.mrmlScene)
+    self.lesionStatisticsSelector.setToolTip(
+      "Optional table with the voxel count, volume, centroid, bounding box and mean lesion probability of each lesion.")
+    parametersInputFormLayout.addRow("Lesion Statistics ", self.lesionStatisticsSelector)
+
+    #
+    # output lesion segmentation selector
+    #
+    self.outputSegmentationSelector = slicer.qMRMLNodeComboBox()
+    self.outputSegmentationSelector.nodeTypes = ["vtkMRMLSegmentationNode"]
+    self.outputSegmentationSelector.selectNodeUponCreation = True
+    self.outputSegmentationSelector.addEnabled = True
+    self.outputSegmentationSelector.renameEnabled = True
+    self.outputSegmentationSelector.removeEnabled = True
+    self.outputSegmentationSelector.noneEnabled = True
+    self.outputSegmentationSelector.showHidden = False
+    self.outputSegmentationSelector.showChildNodeTypes = False
+    self.outputSegmentationSelector.setMRMLScene(slicer.mrmlScene)
+    self.outputSegmentationSelector.setToolTip(
+      "Optional segmentation with the lesions of the lesion label. Its 3D surfaces are only built when it is shown in 3D.")
+    parametersInputFormLayout.addRow("Lesion Segmentation ", self.outputSegmentationSelector)
+
+    #
+    # One segment per lesion?
+    #
+    self.setPerLesionSegmentsWidget = ctk.ctkCheckBox()
+    self.setPerLesionSegmentsWidget.setChecked(True)
+    self.setPerLesionSegmentsWidget.setToolTip(
+      "Writes each connected lesion to its own segment. If not, all the lesions are written to a single segment.")
+    parametersInputFormLayout.addRow("One segment per lesion?",
+                                     self.setPerLesionSegmentsWidget)
+
+    #
+    # Minimum 3D lesion volume
+    #
+    self.setMinimumDisplayVolumeWidget = qt.QDoubleSpinBox()
+    self.setMinimumDisplayVolumeWidget.setDecimals(1)
+    self.setMinimumDisplayVolumeWidget.setMinimum(0)
+    self.setMinimumDisplayVolumeWidget.setMaximum(1000)
+    self.setMinimumDisplayVolumeWidget.setValue(LesionSurfaces.MINIMUM_DISPLAY_VOLUME)
+    self.setMinimumDisplayVolumeWidget.setSuffix(" mm3")
+    self.setMinimumDisplayVolumeWidget.setToolTip("Lesions smaller than this volume are not shown in 3D, which keeps the 3D view "
+                                                  "responsive on brains with many small lesions.")
+    parametersInputFormLayout.addRow("Minimum 3D Lesion Volume ", self.setMinimumDisplayVolumeWidget)
+
     #
     # Is brain extracted?
     #
     self.setIsBETWidget = ctk.ctkCheckBox()
     self.setIsBETWidget.setChecked(False)
     self.setIsBETWidget.setToolTip(
-      "Is the input data (T1 and T2-FLAIR) already brain extracted?")
+      "Is the input data (T1 and T2-FLAIR) already brain extracted? If not, the processing is restricted to the brain mask "
+      "given by the MNI152 brain tissues registered to the input.")
     parametersInputFormLayout.addRow("Is brain extracted?",
                                       self.setIsBETWidget)
 
@@ -118,7 +175,8 @@ class LSSegmenterWidget(ScriptedLoadableModuleWidget):
     self.setMNISpaceWidget = ctk.ctkCheckBox()
     self.setMNISpaceWidget.setChecked(False)
     self.setMNISpaceWidget.setToolTip(
-      "Is the input data already registered to MNI152 space?")
+      "Is the input data already registered to MNI152 space? Inputs on the MNI152 template grid are also detected "
+      "automatically.")
     parametersInputFormLayout.addRow("MNI152 space?",
                                      self.setMNISpaceWidget)
 
@@ -175,6 +233,17 @@ class LSSegmenterWidget(ScriptedLoadableModuleWidget):
     self.setMinimumLesionWidget.setToolTip("Set the minimum lesion size adopted as a true lesion in the final lesion map. Units given in number of voxels.")
     parametersSegmentationFormLayout.addRow("Minimum Lesion Size ", self.setMinimumLesionWidget)
 
+    #
+    # Lesion Connectivity
+    #
+    self.setConnectivityWidget = ctk.ctkComboBox()
+    self.setConnectivityWidget.addItem("6")
+    self.setConnectivityWidget.addItem("18")
+    self.setConnectivityWidget.addItem("26")
+    self.setConnectivityWidget.setToolTip("Neighbourhood used to group voxels into the same lesion: 6 (faces), 18 (faces and edges) "
+                                          "or 26 (faces, edges and corners).")
+    parametersSegmentationFormLayout.addRow("Lesion Connectivity ", self.setConnectivityWidget)
+
     #
     # Lesions Map Iterative Updates
     #
@@ -254,6 +323,55 @@ class LSSegmenterWidget(ScriptedLoadableModuleWidget):
       "Choose the interpolation method used to register the standard space to input image space. Options: Linear, NearestNeighbor, B-Spline")
     parametersRegistrationFormLayout.addRow("Interpolation ", self.setInterpolationMethodBooleanWidget)
 
+    #
+    # Execution Parameters Area
+    #
+    parametersExecutionCollapsibleButton = ctk.ctkCollapsibleButton()
+    parametersExecutionCollapsibleButton.text = "Execution Parameters"
+    parametersExecutionCollapsibleButton.collapsed = True
+    self.layout.addWidget(parametersExecutionCollapsibleButton)
+
+    # Layout within the dummy collapsible button
+    parametersExecutionFormLayout = qt.QFormLayout(parametersExecutionCollapsibleButton)
+
+    #
+    # Number Of Threads Area
+    #
+    self.setNumberOfThreadsWidget = qt.QSpinBox()
+    self.setNumberOfThreadsWidget.setMinimum(0)
+    self.setNumberOfThreadsWidget.setMaximum(256)
+    self.setNumberOfThreadsWidget.setValue(0)
+    self.setNumberOfThreadsWidget.setSpecialValueText("All cores")
+    self.setNumberOfThreadsWidget.setToolTip("Maximum number of threads used by each processing step (bias field correction, "
+                                             "filtering, registration and resampling). Lower it to run several segmentations on the same computer.")
+    parametersExecutionFormLayout.addRow("Number Of Threads ", self.setNumberOfThreadsWidget)
+
+    #
+    # Preprocessing Profile Area
+    #
+    self.setPreprocessingProfileWidget = ctk.ctkComboBox()
+    self.setPreprocessingProfileWidget.addItem("accurate")
+    self.setPreprocessingProfileWidget.addItem("balanced")
+    self.setPreprocessingProfileWidget.addItem("fast")
+    self.setPreprocessingProfileWidget.setToolTip("Bias field correction and noise attenuation settings. accurate keeps the default settings, "
+                                                  "balanced and fast trade a small lesion map difference for a shorter preprocessing.")
+    parametersExecutionFormLayout.addRow("Preprocessing Profile ", self.setPreprocessingProfileWidget)
+
+    #
+    # Preview Spacing Area
+    #
+    self.setPreviewSpacingWidget = qt.QDoubleSpinBox()
+    self.setPreviewSpacingWidget.setDecimals(1)
+    self.setPreviewSpacingWidget.setMinimum(0)
+    self.setPreviewSpacingWidget.setMaximum(5)
+    self.setPreviewSpacingWidget.setSingleStep(0.5)
+    self.setPreviewSpacingWidget.setValue(0)
+    self.setPreviewSpacingWidget.setSuffix(" mm")
+    self.setPreviewSpacingWidget.setSpecialValueText("Full resolution")
+    self.setPreviewSpacingWidget.setToolTip("Runs a quick preview on the inputs resampled to this spacing (e.g. 2 or 3 mm) and shows the result "
+                                            "on the input grid. Useful to explore the parameters before a full resolution run.")
+    parametersExecutionFormLayout.addRow("Preview Spacing ", self.setPreviewSpacingWidget)
+
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
     self.inputFLAIRSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
@@ -272,21 +390,39 @@ class LSSegmenterWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = self.inputFLAIRSelector.currentNode() and self.outputSelector.currentNode()
 
   def onApplyButton(self):
+    from LesionSpotlightLib import QualityGates
     logic = LSSegmenterLogic()
-    logic.run(self.inputFLAIRSelector.currentNode()
-              ,self.outputSelector.currentNode()
-              ,self.setIsBETWidget.isChecked()
-              ,self.setMNISpaceWidget.isChecked()
-              ,self.setPercSamplingQWidget.value
-              ,self.setInitiationRegistrationBooleanWidget.currentText
-              ,self.setInterpolationMethodBooleanWidget.currentText
-              ,self.setWMMatchWidget.value
-              ,self.setMinimumLesionWidget.value
-              ,self.setLesionMapUpdatesWidget.value
-              ,self.setThresholdLFMethodBooleanWidget.currentText
-              ,self.setNumberOfBinsWidget.value
-              ,self.setLesionThresholdWidget.value
-              )
+    try:
+      result = logic.run(self.inputFLAIRSelector.currentNode()
+                        ,self.outputSelector.currentNode()
+                        ,self.setIsBETWidget.isChecked()
+                        ,self.setMNISpaceWidget.isChecked()
+                        ,self.setPercSamplingQWidget.value
+                        ,self.setInitiationRegistrationBooleanWidget.currentText
+                        ,self.setInterpolationMethodBooleanWidget.currentText
+                        ,self.setWMMatchWidget.value
+                        ,self.setMinimumLesionWidget.value
+                        ,self.setLesionMapUpdatesWidget.value
+                        ,self.setThresholdLFMethodBooleanWidget.currentText
+                        ,self.setNumberOfBinsWidget.value
+                        ,self.setLesionThresholdWidget.value
+                        ,int(self.setConnectivityWidget.currentText)
+                        ,self.lesionStatisticsSelector.currentNode()
+                        ,numberOfThreads=self.setNumberOfThreadsWidget.value
+                        ,preprocessingProfile=self.setPreprocessingProfileWidget.currentText
+                        ,previewSpacing=self.setPreviewSpacingWidget.value
+                        )
+      if result:
+        self.exportSegmentation()
+    except QualityGates.QualityGateError as e:
+      slicer.util.errorDisplay("Segmentation aborted: %s" % e)
+
+  def exportSegmentation(self):
+    from LesionSpotlightLib import LesionSurfaces
+    if self.outputSegmentationSelector.currentNode():
+      LesionSurfaces.exportLesions(self.outputSelector.currentNode(), self.outputSegmentationSelector.currentNode(),
+                                   self.setPerLesionSegmentsWidget.isChecked(), int(self.setConnectivityWidget.currentText),
+                                   self.setMinimumDisplayVolumeWidget.value)
 
 
 #
@@ -303,6 +439,14 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  # Atlases of the segmentation, recorded in the cohort summary
+  SUMMARY_ATLASES = ("MNI152_T1_1mm_brain.nii.gz", "MNI152_T1_WhiteMatter.nii.gz", "MNI152_T1_1mm_WhiteMatter_thinner.nii.gz")
+
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    # MNI152 space decision of the last run, given or detected
+    self.isMNISpace = False
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -330,16 +474,91 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
+  def lesionStatisticsFile(self):
+    """New temporary file for the lesion statistics of a run, so that concurrent runs do not share
+    it. readLesionStatistics removes it.
+    """
+    handle, statisticsFile = tempfile.mkstemp(suffix=".csv", prefix="LSSegmenterLesionStatistics", dir=slicer.app.temporaryPath)
+    os.close(handle)
+    return statisticsFile
+
+  def readLesionStatistics(self, statisticsFile, lesionStatisticsTable):
+    """Reads the lesion statistics table written by the lesion map refinement and removes its file
+    """
+    try:
+      storageNode = slicer.vtkMRMLTableStorageNode()
+      storageNode.SetFileName(statisticsFile)
+      storageNode.ReadData(lesionStatisticsTable)
+    finally:
+      os.remove(statisticsFile)
+
   def run(self, inputFLAIRVolume, outputLabel, isBET, isMNISpace, sampling, initiation, interpolation,
-          wmMatch, minimumSize, lUpdate, thrMethod, numBins, lThr):
+          wmMatch, minimumSize, lUpdate, thrMethod, numBins, lThr, connectivity=6, lesionStatisticsTable=None,
+          numberOfTiles=1, numberOfThreads=0, preprocessingProfile="accurate", previewSpacing=0,
+          brainMaskLabel=None, detectMNISpace=True):
     """
-    Run the actual algorithm
+    Run the actual algorithm. A previewSpacing (mm) runs it on inputs resampled to that spacing
+    and resamples the lesion map back to the input grid; the preview registers the atlases even for
+    an input in the MNI152 space. When the input is not skull stripped (isBET off), it runs on the
+    brain region given by the registered atlas, and brainMaskLabel is the mask of that region used
+    by the bias field correction. With detectMNISpace, an input found on the MNI152 template grid
+    is processed as isMNISpace, see MNISpace. An input or a registration failing the quality gates
+    raises QualityGates.QualityGateError.
     """
+    from LesionSpotlightLib import BrainMask, MNISpace, Preprocessing, Preview, QualityGates
 
     if not self.isValidInputOutputData(inputFLAIRVolume, outputLabel):
       slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
       return False
 
+    QualityGates.checkInput(inputFLAIRVolume, QualityGates.FLAIR)
+
+    if previewSpacing:
+      slicer.util.showStatusMessage("Preview: resampling the input to %g mm..." % previewSpacing)
+      previewFLAIRVolume = Preview.previewVolume(inputFLAIRVolume, previewSpacing, numberOfThreads)
+      previewLabel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+      try:
+        # The 1 mm MNI152 atlases are not on the preview grid, so the preview registers them as
+        # for any other input
+        result = self.run(previewFLAIRVolume, previewLabel, isBET, False, sampling, initiation, interpolation,
+                          wmMatch, Preview.previewMinimumSize(minimumSize, inputFLAIRVolume, previewFLAIRVolume), lUpdate,
+                          thrMethod, numBins, lThr, connectivity, lesionStatisticsTable, numberOfTiles, numberOfThreads,
+                          preprocessingProfile, detectMNISpace=False)
+        Preview.restoreResolution(previewLabel, inputFLAIRVolume, outputLabel, True, numberOfThreads)
+      finally:
+        slicer.mrmlScene.RemoveNode(previewLabel)
+        slicer.mrmlScene.RemoveNode(previewFLAIRVolume)
+      return result
+
+    if not isMNISpace and detectMNISpace:
+      isMNISpace, reason = MNISpace.isMNISpaceVolume(inputFLAIRVolume)
+      if isMNISpace:
+        logging.info("%s is in the MNI152 space (%s), registration and atlas resampling skipped"
+                     % (inputFLAIRVolume.GetName(), reason))
+        slicer.util.showStatusMessage("Input in the MNI152 space, registration skipped")
+      else:
+        logging.info("%s is not in the MNI152 space (%s)" % (inputFLAIRVolume.GetName(), reason))
+    self.isMNISpace = isMNISpace
+
+    if not isBET:
+      slicer.util.showStatusMessage("Brain masking...")
+      brainMaskLabel = BrainMask.brainMask(inputFLAIRVolume, isMNISpace, sampling, initiation,
+                                           numberOfThreads=numberOfThreads)
+      # Masks in the MNI space are used on the input grid, so the input is not cropped
+      brainFLAIRVolume = BrainMask.restrictToMask(inputFLAIRVolume, brainMaskLabel, not isMNISpace)
+      brainMaskCrop = BrainMask.restrictToMask(brainMaskLabel, brainMaskLabel, not isMNISpace)
+      brainLabel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+      try:
+        result = self.run(brainFLAIRVolume, brainLabel, True, isMNISpace, sampling, initiation, interpolation, wmMatch,
+                          minimumSize, lUpdate, thrMethod, numBins, lThr, connectivity, lesionStatisticsTable,
+                          numberOfTiles, numberOfThreads, preprocessingProfile, brainMaskLabel=brainMaskCrop,
+                          detectMNISpace=False)
+        Preview.restoreResolution(brainLabel, inputFLAIRVolume, outputLabel, True, numberOfThreads)
+      finally:
+        for node in (brainLabel, brainMaskCrop, brainFLAIRVolume, brainMaskLabel):
+          slicer.mrmlScene.RemoveNode(node)
+      return result
+
     logging.info('Processing started')
     slicer.util.showStatusMessage("Processing started")
 
@@ -357,27 +576,22 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
     #################################################################################################################
     slicer.util.showStatusMessage("Step 1: Bias field correction...")
 
-    regParams = {}
-    regParams["inputImageName"] = inputFLAIRVolume.GetID()
-    regParams["outputImageName"] = inputFLAIRVolume_tmp.GetID()
+    regParams = Preprocessing.n4Parameters(inputFLAIRVolume, inputFLAIRVolume_tmp, preprocessingProfile, brainMaskLabel)
 
-    slicer.cli.run(slicer.modules.n4itkbiasfieldcorrection, None, regParams, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.n4itkbiasfieldcorrection, regParams, numberOfThreads)
 
     #################################################################################################################
     #                                       T2-FLAIR Noise Attenuation                                              #
     #################################################################################################################
     slicer.util.showStatusMessage("Step 2: Decreasing image noise level...")
 
-    regParams = {}
-    regParams["inputVolume"] = inputFLAIRVolume_tmp.GetID()
-    regParams["outputVolume"] = inputFLAIRVolume_tmp.GetID()
+    regParams = Preprocessing.aadParameters(inputFLAIRVolume_tmp, inputFLAIRVolume_tmp, 5, preprocessingProfile)
     regParams["conductance"] = 10.0
     regParams["useAutoConductance"] = True
     regParams["optFunction"] = "Canny"
-    regParams["iterations"] = 5
     regParams["q"] = 1.25
 
-    slicer.cli.run(slicer.modules.aadimagefilter, None, regParams, wait_for_completion=True)
+    CLIUtils.runCLI(slicer.modules.aadimagefilter, regParams, numberOfThreads)
 
     # Get the path to LSSegmenter-Data files
     path2files = os.path.dirname(slicer.modules.lssegmenter.path)
@@ -385,19 +599,13 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
       #################################################################################################################
       #                                        Registration  - MNI to Native space                                    #
       #################################################################################################################
+      # The input is skull stripped here, by the user or by the brain masking
       if platform.system() == "Windows":
-        if isBET:
-          (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '\\Resources\\LSSegmenter-Data\\MNI152_T1_1mm_brain.nii.gz',
-                                                           {}, True)
-        else:
-          (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '\\Resources\\LSSegmenter-Data\\MNI152_T1_1mm.nii.gz', {},
-                                                           True)
+        (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '\\Resources\\LSSegmenter-Data\\MNI152_T1_1mm_brain.nii.gz',
+                                                         {}, True)
       else:
-        if isBET:
-          (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '/Resources/LSSegmenter-Data/MNI152_T1_1mm_brain.nii.gz', {},
-                                                           True)
-        else:
-          (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '/Resources/LSSegmenter-Data/MNI152_T1_1mm.nii.gz', {}, True)
+        (read, MNITemplateNode) = slicer.util.loadVolume(path2files + '/Resources/LSSegmenter-Data/MNI152_T1_1mm_brain.nii.gz', {},
+                                                         True)
 
       #
       # Registering the MNI template to native space.
@@ -418,7 +626,7 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
       regParams["useAffine"] = True
       regParams["interpolationMode"] = interpolation
 
-      slicer.cli.run(slicer.modules.brainsfit, None, regParams, wait_for_completion=True)
+      CLIUtils.runCLI(slicer.modules.brainsfit, regParams, numberOfThreads)
 
       if platform.system() == "Windows":
         (read, MNIWM_thin_Label) = slicer.util.loadLabelVolume(path2files + '\\Resources\\LSSegmenter-Data\\MNI152_T1_1mm_WhiteMatter_thinner.nii.gz', {}, True)
@@ -438,7 +646,7 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
       params["interpolationMode"] = "NearestNeighbor"
       params["pixelType"] = "binary"
 
-      slicer.cli.run(slicer.modules.brainsresample, None, params, wait_for_completion=True)
+      CLIUtils.runCLI(slicer.modules.brainsresample, params, numberOfThreads)
 
       brainWMLabel = slicer.vtkMRMLLabelMapVolumeNode()
       slicer.mrmlScene.AddNode(brainWMLabel)
@@ -451,7 +659,15 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
       params["interpolationMode"] = "Linear"
       params["pixelType"] = "binary"
 
-      slicer.cli.run(slicer.modules.brainsresample, None, params, wait_for_completion=True)
+      CLIUtils.runCLI(slicer.modules.brainsresample, params, numberOfThreads)
+
+      # Registration quality gates
+      temporaryNodes = (registrationMNI2NativeTransform, MNITemplateNode, MNIWM_thin_Label, MNIWMLabel,
+                        inputFLAIRVolume_tmp, brainWMLabel, brainWM_thin_Label)
+      QualityGates.checkRegistration(inputFLAIRVolume_tmp, slicer.util.arrayFromVolume(brainWMLabel),
+                                     QualityGates.FLAIR, nodesToRemove=temporaryNodes)
+      QualityGates.checkContrast(inputFLAIRVolume_tmp, slicer.util.arrayFromVolume(brainWM_thin_Label), None,
+                                 QualityGates.FLAIR, nodesToRemove=temporaryNodes)
 
       #################################################################################################################
       #                                            Lesion segmentation                                                #
@@ -469,8 +685,9 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
         regParams["numberOfBins"] = numBins
         regParams["flipObject"] = False
         regParams["thrType"] = thrMethod
+        regParams["numberOfTiles"] = numberOfTiles
 
-        slicer.cli.run(slicer.modules.logisticcontrastenhancement, None, regParams, wait_for_completion=True)
+        CLIUtils.runCLI(slicer.modules.logisticcontrastenhancement, regParams, numberOfThreads)
 
         # Increasing FLAIR lesions contrast...
         regParams = {}
@@ -480,8 +697,9 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
         regParams["outputVolume"] = inputFLAIRVolume_tmp.GetID()
         regParams["weight"] = 0
         regParams["lesionThr"] = lThr
+        regParams["numberOfTiles"] = numberOfTiles
 
-        slicer.cli.run(slicer.modules.weightedenhancementimagefilter, None, regParams, wait_for_completion=True)
+        CLIUtils.runCLI(slicer.modules.weightedenhancementimagefilter, regParams, numberOfThreads)
 
       #
       # Lesion Map Refinement
@@ -493,8 +711,15 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
       params["lesionThr"] = lThr
       params["wmMatch"] = wmMatch
       params["minimumSize"] = minimumSize
+      params["connectivity"] = connectivity
+      params["numberOfTiles"] = numberOfTiles
+      if lesionStatisticsTable:
+        statisticsFile = self.lesionStatisticsFile()
+        params["lesionStatistics"] = statisticsFile
 
-      slicer.cli.run(slicer.modules.lesionmaprefinement, None, params, wait_for_completion=True)
+      CLIUtils.runCLI(slicer.modules.lesionmaprefinement, params, numberOfThreads)
+      if lesionStatisticsTable:
+        self.readLesionStatistics(statisticsFile, lesionStatisticsTable)
 
       # Removing unnecessary nodes
       slicer.mrmlScene.RemoveNode(registrationMNI2NativeTransform)
@@ -522,6 +747,15 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
         (read, MNIWM_thin_Label) = slicer.util.loadLabelVolume(path2files + '/Resources/LSSegmenter-Data/MNI152_T1_1mm_WhiteMatter_thinner.nii.gz', {}, True)
         (read, MNIWMLabel) = slicer.util.loadLabelVolume(path2files + '/Resources/LSSegmenter-Data/MNI152_T1_WhiteMatter.nii.gz', {}, True)
 
+      # The atlas is used on the input grid, the gates only apply when their grids agree
+      MNIWMArray = slicer.util.arrayFromVolume(MNIWMLabel)
+      if MNIWMArray.shape == slicer.util.arrayFromVolume(inputFLAIRVolume_tmp).shape:
+        temporaryNodes = (MNIWM_thin_Label, MNIWMLabel, inputFLAIRVolume_tmp)
+        QualityGates.checkRegistration(inputFLAIRVolume_tmp, MNIWMArray, QualityGates.FLAIR,
+                                       nodesToRemove=temporaryNodes)
+        QualityGates.checkContrast(inputFLAIRVolume_tmp, slicer.util.arrayFromVolume(MNIWM_thin_Label), None,
+                                   QualityGates.FLAIR, nodesToRemove=temporaryNodes)
+
       lesionUpdate = slicer.vtkMRMLScalarVolumeNode()
       slicer.mrmlScene.AddNode(lesionUpdate)
       lUpdate = int(lUpdate)
@@ -534,8 +768,9 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
         regParams["numberOfBins"] = numBins
         regParams["flipObject"] = False
         regParams["thrType"] = thrMethod
+        regParams["numberOfTiles"] = numberOfTiles
 
-        slicer.cli.run(slicer.modules.logisticcontrastenhancement, None, regParams, wait_for_completion=True)
+        CLIUtils.runCLI(slicer.modules.logisticcontrastenhancement, regParams, numberOfThreads)
 
         # Increasing FLAIR lesions contrast...
         regParams = {}
@@ -544,8 +779,9 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
         regParams["outputVolume"] = inputFLAIRVolume_tmp.GetID()
         regParams["weight"] = 0
         regParams["maintainGaussianity"] = False
+        regParams["numberOfTiles"] = numberOfTiles
 
-        slicer.cli.run(slicer.modules.weightedenhancementimagefilter, None, regParams, wait_for_completion=True)
+        CLIUtils.runCLI(slicer.modules.weightedenhancementimagefilter, regParams, numberOfThreads)
 
       #
       # Lesion Map Refinement
@@ -557,8 +793,15 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
       params["lesionThr"] = lThr
       params["wmMatch"] = wmMatch
       params["minimumSize"] = minimumSize
+      params["connectivity"] = connectivity
+      params["numberOfTiles"] = numberOfTiles
+      if lesionStatisticsTable:
+        statisticsFile = self.lesionStatisticsFile()
+        params["lesionStatistics"] = statisticsFile
 
-      slicer.cli.run(slicer.modules.lesionmaprefinement, None, params, wait_for_completion=True)
+      CLIUtils.runCLI(slicer.modules.lesionmaprefinement, params, numberOfThreads)
+      if lesionStatisticsTable:
+        self.readLesionStatistics(statisticsFile, lesionStatisticsTable)
 
       # Removing unnecessary nodes
       slicer.mrmlScene.RemoveNode(lesionUpdate)
@@ -568,6 +811,61 @@ class LSSegmenterLogic(ScriptedLoadableModuleLogic):
 
       return True
 
+  def processSubject(self, subject, parameters):
+    """Segments one cohort subject from files. parameters holds the inputFLAIRVolume and
+    outputLabel paths, optional lesionStatistics and cohortSummary paths and the keyword
+    arguments of run()
+    """
+    from LesionSpotlightLib import CohortSummary
+    parameters = dict(parameters)
+    inputPath = parameters.pop("inputFLAIRVolume")
+    outputPath = parameters.pop("outputLabel")
+    statisticsPath = parameters.pop("lesionStatistics", None)
+    summaryPath = parameters.pop("cohortSummary", None)
+
+    inputFLAIRVolume = slicer.util.loadVolume(inputPath)
+    outputLabel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", subject + "_lesions")
+    lesionStatisticsTable = None
+    if statisticsPath or summaryPath:
+      lesionStatisticsTable = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", subject + "_lesionStatistics")
+    try:
+      start = time.time()
+      if not self.run(inputFLAIRVolume, outputLabel, lesionStatisticsTable=lesionStatisticsTable, **parameters):
+        raise ValueError("Invalid input or output volume for subject %s" % subject)
+      seconds = time.time() - start
+      if not slicer.util.saveNode(outputLabel, outputPath):
+        raise IOError("Could not write %s" % outputPath)
+      outputs = {"outputLabel": outputPath}
+      if statisticsPath:
+        if not slicer.util.saveNode(lesionStatisticsTable, statisticsPath):
+          raise IOError("Could not write %s" % statisticsPath)
+        outputs["lesionStatistics"] = statisticsPath
+      if summaryPath:
+        CohortSummary.appendToSummary(summaryPath, subject, "LSSegmenter",
+                                      CohortSummary.tableLesionVolumes(lesionStatisticsTable),
+                                      parameters=parameters, atlas=",".join(self.SUMMARY_ATLASES),
+                                      transform="identity" if self.isMNISpace else "BRAINSFit affine",
+                                      seconds=seconds)
+        outputs["cohortSummary"] = summaryPath
+    finally:
+      for node in (inputFLAIRVolume, outputLabel, lesionStatisticsTable):
+        if node:
+          slicer.mrmlScene.RemoveNode(node)
+    return outputs
+
+  def runJobQueue(self, queuePath, worker=None, memoryBudgetMB=None):
+    """Processes the LSSegmenter jobs of a cohort job queue until none is left. Several Slicer
+    processes can share the same queue, and a restarted run only processes the unfinished subjects:
+
+      Slicer --no-main-window --python-code "import LSSegmenter; LSSegmenter.LSSegmenterLogic().runJobQueue('cohort.sqlite'); exit()"
+
+    With memoryBudgetMB, the workers of the machine (given the same budget) only start a subject
+    while the peak memory estimates of the running ones leave room for it.
+    """
+    from LesionSpotlightLib.JobQueue import JobQueue
+    with JobQueue(queuePath) as queue:
+      return queue.runWorker({"LSSegmenter": self.processSubject}, worker, memoryBudgetMB=memoryBudgetMB)
+
 
 
 
@@ -0,0 +1,135 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Brain masking of the inputs that are not skull stripped.
+
+The MNI152 brain template is registered to the input with an affine BRAINSFit
+and the brain tissues atlas is mapped back with the resulting transform. The
+voxels of any tissue, dilated by a safety margin, make the native space brain
+mask. restrictToMask() then zeroes the voxels out of the mask and crops the
+volume to the mask bounding box, so the bias field correction, the noise
+attenuation and the later steps only work on the brain region.
+"""
+import os
+import logging
+
+from LesionSpotlightLib import CLIUtils
+
+BRAIN_TEMPLATE = "MNI152_T1_1mm_brain.nii.gz"
+BRAIN_TISSUES = "MNI152_T1_1mm_brain_tissues.nii.gz"
+
+# Safety margin (mm) added around the registered atlas brain
+DILATION_RADIUS = 4.0
+
+def atlasPath(fileName):
+  """Path of a file of the LSSegmenter-Data folder
+  """
+  import slicer
+  return os.path.join(os.path.dirname(slicer.modules.lssegmenter.path), "Resources", "LSSegmenter-Data", fileName)
+
+def dilate(mask, spacing, radius):
+  """Binary dilation of a KJI mask array by a ball of radius mm (voxel radii rounded per axis)
+  """
+  from LesionSpotlightLib import Engine
+  sitk = Engine.simpleITK()
+  radii = [max(0, int(round(radius / s))) for s in spacing]
+  if not any(radii):
+    return mask
+  image = sitk.GetImageFromArray(mask.astype("uint8"))
+  image.SetSpacing(tuple(float(s) for s in spacing))
+  return sitk.GetArrayFromImage(sitk.BinaryDilate(image, radii, sitk.sitkBall)) != 0
+
+def brainMask(volumeNode, isMNISpace=False, sampling=0.02, initiation="useMomentsAlign",
+              dilationRadius=DILATION_RADIUS, numberOfThreads=0):
+  """Brain mask label map on the grid of volumeNode. The atlas is registered to the volume unless
+  it is already in the MNI152 space.
+  """
+  import slicer
+  tissuesNode = slicer.util.loadLabelVolume(atlasPath(BRAIN_TISSUES))
+  maskNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", volumeNode.GetName() + "_brainMask")
+  templateNode = None
+  transformNode = None
+  try:
+    params = {}
+    if not isMNISpace:
+      templateNode = slicer.util.loadVolume(atlasPath(BRAIN_TEMPLATE))
+      transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", "regMNI2Native_brainMask")
+      regParams = {}
+      regParams["fixedVolume"] = volumeNode.GetID()
+      regParams["movingVolume"] = templateNode.GetID()
+      regParams["samplingPercentage"] = sampling
+      regParams["linearTransform"] = transformNode.GetID()
+      regParams["initializeTransformMode"] = initiation
+      regParams["useRigid"] = True
+      regParams["useAffine"] = True
+      regParams["interpolationMode"] = "Linear"
+
+      CLIUtils.runCLI(slicer.modules.brainsfit, regParams, numberOfThreads)
+      params["warpTransform"] = transformNode.GetID()
+
+    params["inputVolume"] = tissuesNode.GetID()
+    params["referenceVolume"] = volumeNode.GetID()
+    params["outputVolume"] = maskNode.GetID()
+    params["interpolationMode"] = "NearestNeighbor"
+    params["pixelType"] = "uchar"
+
+    CLIUtils.runCLI(slicer.modules.brainsresample, params, numberOfThreads)
+  except Exception:
+    slicer.mrmlScene.RemoveNode(maskNode)
+    raise
+  finally:
+    for node in (tissuesNode, templateNode, transformNode):
+      if node:
+        slicer.mrmlScene.RemoveNode(node)
+
+  mask = dilate(slicer.util.arrayFromVolume(maskNode) != 0, volumeNode.GetSpacing(), dilationRadius)
+  slicer.util.updateVolumeFromArray(maskNode, mask.astype("uint8"))
+  logging.info("Brain mask of %s: %d voxels" % (volumeNode.GetName(), int(mask.sum())))
+  return maskNode
+
+def restrictToMask(volumeNode, maskNode, crop=True):
+  """New volume node with the voxels of volumeNode out of the mask set to zero, cropped to the
+  bounding box of the mask unless crop is False. Both volumes must share the same grid.
+  """
+  import numpy as np
+  import vtk
+  import slicer
+  array = slicer.util.arrayFromVolume(volumeNode)
+  mask = slicer.util.arrayFromVolume(maskNode) != 0
+  if not mask.any():
+    raise ValueError("the brain mask of %s is empty" % volumeNode.GetName())
+  lower = [0, 0, 0]
+  upper = list(mask.shape)
+  if crop:
+    indices = np.nonzero(mask)
+    lower = [int(index.min()) for index in indices]
+    upper = [int(index.max()) + 1 for index in indices]
+  region = tuple(slice(l, u) for l, u in zip(lower, upper))
+  restricted = np.where(mask[region], array[region], 0).astype(array.dtype)
+
+  ijkToRAS = vtk.vtkMatrix4x4()
+  volumeNode.GetIJKToRASMatrix(ijkToRAS)
+  origin = ijkToRAS.MultiplyPoint((lower[2], lower[1], lower[0], 1.0))
+  restrictedNode = slicer.mrmlScene.AddNewNodeByClass(volumeNode.GetClassName(), volumeNode.GetName() + "_brain")
+  restrictedNode.SetIJKToRASMatrix(ijkToRAS)
+  restrictedNode.SetOrigin(origin[:3])
+  slicer.util.updateVolumeFromArray(restrictedNode, restricted)
+  return restrictedNode
+
+def fillOutsideMask(volumeNode, referenceVolume, maskNode):
+  """Copies the voxels of referenceVolume out of the mask into volumeNode (same grid)
+  """
+  import slicer
+  array = slicer.util.arrayFromVolume(volumeNode)
+  outside = slicer.util.arrayFromVolume(maskNode) == 0
+  array[outside] = slicer.util.arrayFromVolume(referenceVolume)[outside].astype(array.dtype)
+  slicer.util.arrayFromVolumeModified(volumeNode)
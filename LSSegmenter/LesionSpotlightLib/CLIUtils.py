@@ -0,0 +1,59 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+import os
+import contextlib
+
+#
+# Thread budget for the CLI modules
+#
+
+# CLI modules exposing a numberOfThreads parameter. The other ones (N4, AAD and
+# the resamplers without it) read the ITK environment variable when they start.
+# ITK reads it once per process, so it only limits the CLIs run out of process:
+# a CLI loaded in the Slicer process keeps the thread count of the application.
+# The CLIs of this extension set their numberOfThreads parameter as the global
+# default for their run and restore the former one on return.
+CLI_MODULES_WITH_THREADS_PARAMETER = ("brainsfit", "brainsresample",
+                                      "logisticcontrastenhancement", "weightedenhancementimagefilter",
+                                      "lesionmaprefinement", "automaticflairthreshold")
+
+ITK_THREADS_ENVIRONMENT_VARIABLE = "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+
+@contextlib.contextmanager
+def threadBudget(numberOfThreads):
+  """Limits the ITK threads of the processes started in this context (0 keeps every core).
+  It has no effect on the CLIs loaded in the Slicer process.
+  """
+  if numberOfThreads is None or numberOfThreads < 1:
+    yield
+    return
+  previousValue = os.environ.get(ITK_THREADS_ENVIRONMENT_VARIABLE)
+  os.environ[ITK_THREADS_ENVIRONMENT_VARIABLE] = str(int(numberOfThreads))
+  try:
+    yield
+  finally:
+    if previousValue is None:
+      del os.environ[ITK_THREADS_ENVIRONMENT_VARIABLE]
+    else:
+      os.environ[ITK_THREADS_ENVIRONMENT_VARIABLE] = previousValue
+
+def runCLI(module, parameters, numberOfThreads=0):
+  """Runs a CLI module until completion within the given thread budget (0 keeps every core).
+  The budget is passed as the numberOfThreads parameter when the module has one, and
+  through the ITK environment variable otherwise, which only out-of-process CLIs read.
+  """
+  import slicer
+  if numberOfThreads and numberOfThreads > 0 and module.name.lower() in CLI_MODULES_WITH_THREADS_PARAMETER:
+    parameters["numberOfThreads"] = int(numberOfThreads)
+  with threadBudget(numberOfThreads):
+    return slicer.cli.run(module, None, parameters, wait_for_completion=True)
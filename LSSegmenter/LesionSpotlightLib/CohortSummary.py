@@ -0,0 +1,251 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Cohort summary of the lesion maps, stored in a SQLite file.
+
+Every segmentation of a subject appends one record: lesion count, total lesion
+volume, lesion size histogram, parameters, atlas and transform identifiers and
+timings. The summary figures are plain typed columns (one per histogram bin),
+so the study spreadsheet and the cohort statistics are read from the summary
+without loading any lesion map. A subject segmented again by the same method
+replaces its record. Like the job queue, several workers can share the file.
+
+The LSSegmenter and AFTSegmenter job handlers (and the Engine ones) append
+to the summary given by the cohortSummary parameter of their jobs.
+
+From the command line:
+
+  python -m LesionSpotlightLib.CohortSummary summary cohort_summary.sqlite
+  python -m LesionSpotlightLib.CohortSummary export cohort_summary.sqlite study.csv
+"""
+import os
+import sys
+import json
+import time
+import math
+import sqlite3
+
+# Lower edges (mm3) of the lesion size histogram bins, the last bin is open
+SIZE_BIN_EDGES = (0.0, 10.0, 50.0, 100.0, 500.0, 1000.0, 5000.0)
+
+def sizeBinColumn(index):
+  """Column name of a lesion size histogram bin, e.g. lesions10to50mm3
+  """
+  if index + 1 < len(SIZE_BIN_EDGES):
+    return "lesions%gto%gmm3" % (SIZE_BIN_EDGES[index], SIZE_BIN_EDGES[index + 1])
+  return "lesionsOver%gmm3" % SIZE_BIN_EDGES[index]
+
+SIZE_BIN_COLUMNS = tuple(sizeBinColumn(index) for index in range(len(SIZE_BIN_EDGES)))
+
+NUMERIC_COLUMNS = ("lesionCount", "totalVolume_mm3", "meanVolume_mm3", "maximumVolume_mm3", "seconds") + SIZE_BIN_COLUMNS
+
+COLUMNS = ("subject", "method", "created") + NUMERIC_COLUMNS + ("atlas", "transform", "parameters", "timings")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS summaries (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  subject TEXT NOT NULL,
+  method TEXT NOT NULL,
+  created REAL,
+  lesionCount INTEGER NOT NULL,
+  totalVolume_mm3 REAL NOT NULL,
+  meanVolume_mm3 REAL NOT NULL,
+  maximumVolume_mm3 REAL NOT NULL,
+  seconds REAL,
+  %s,
+  atlas TEXT,
+  transform TEXT,
+  parameters TEXT,
+  timings TEXT,
+  UNIQUE (subject, method)
+);
+CREATE INDEX IF NOT EXISTS summariesMethod ON summaries (method, subject);
+""" % ",\n  ".join("%s INTEGER NOT NULL DEFAULT 0" % column for column in SIZE_BIN_COLUMNS)
+
+def sizeHistogram(lesionVolumes):
+  """Number of lesions of each SIZE_BIN_EDGES bin
+  """
+  histogram = [0] * len(SIZE_BIN_EDGES)
+  for volume in lesionVolumes:
+    index = len(SIZE_BIN_EDGES) - 1
+    while index > 0 and volume < SIZE_BIN_EDGES[index]:
+      index -= 1
+    histogram[index] += 1
+  return histogram
+
+def lesionRecord(subject, method, lesionVolumes, parameters=None, atlas=None, transform=None, seconds=None,
+                 timings=None):
+  """Summary record of one lesion map from the volumes (mm3) of its lesions
+  """
+  lesionVolumes = [float(volume) for volume in lesionVolumes]
+  record = {"subject": subject, "method": method, "created": time.time(),
+            "lesionCount": len(lesionVolumes),
+            "totalVolume_mm3": sum(lesionVolumes),
+            "meanVolume_mm3": sum(lesionVolumes) / len(lesionVolumes) if lesionVolumes else 0.0,
+            "maximumVolume_mm3": max(lesionVolumes) if lesionVolumes else 0.0,
+            "seconds": seconds, "atlas": atlas, "transform": transform,
+            "parameters": json.dumps(parameters or {}, sort_keys=True),
+            "timings": json.dumps(timings or {}, sort_keys=True)}
+  record.update(zip(SIZE_BIN_COLUMNS, sizeHistogram(lesionVolumes)))
+  return record
+
+def tableLesionVolumes(lesionStatisticsTable):
+  """Lesion volumes (mm3) of a lesion statistics table node
+  """
+  column = lesionStatisticsTable.GetColumnIndex("volume_mm3")
+  if column < 0:
+    return []
+  return [float(lesionStatisticsTable.GetCellText(row, column))
+          for row in range(lesionStatisticsTable.GetTable().GetNumberOfRows())]
+
+def appendToSummary(path, subject, method, lesionVolumes, **kwargs):
+  """Opens the summary file, adds the record of a lesion map and closes it, see lesionRecord()
+  """
+  with CohortSummary(path) as summary:
+    summary.appendLesions(subject, method, lesionVolumes, **kwargs)
+
+class CohortSummary(object):
+  """Cohort summary stored in a SQLite file
+  """
+
+  def __init__(self, path, timeout=60.0):
+    self.path = path
+    self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    self.connection.row_factory = sqlite3.Row
+    self.connection.executescript(SCHEMA)
+
+  def close(self):
+    self.connection.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def append(self, record):
+    """Adds a record made by lesionRecord(), replacing the former one of its subject and method
+    """
+    columns = [column for column in COLUMNS if column in record]
+    self.connection.execute("INSERT OR REPLACE INTO summaries (%s) VALUES (%s)"
+                            % (", ".join(columns), ", ".join("?" * len(columns))),
+                            [record[column] for column in columns])
+
+  def appendLesions(self, subject, method, lesionVolumes, **kwargs):
+    """Adds the record of a lesion map given the volumes (mm3) of its lesions, see lesionRecord()
+    """
+    self.append(lesionRecord(subject, method, lesionVolumes, **kwargs))
+
+  def _where(self, method=None, subjects=None):
+    clauses = []
+    arguments = []
+    if method:
+      clauses.append("method = ?")
+      arguments.append(method)
+    if subjects is not None:
+      subjects = list(subjects)
+      clauses.append("subject IN (%s)" % ",".join("?" * len(subjects)))
+      arguments += subjects
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", arguments
+
+  def records(self, method=None, subjects=None):
+    """Records as dictionaries, parameters and timings decoded, sorted by method and subject
+    """
+    where, arguments = self._where(method, subjects)
+    records = []
+    for row in self.connection.execute("SELECT %s FROM summaries%s ORDER BY method, subject"
+                                       % (", ".join(COLUMNS), where), arguments):
+      record = dict(zip(COLUMNS, row))
+      record["parameters"] = json.loads(record["parameters"]) if record["parameters"] else {}
+      record["timings"] = json.loads(record["timings"]) if record["timings"] else {}
+      records.append(record)
+    return records
+
+  def column(self, name, method=None, subjects=None):
+    """Values of one numeric column, sorted by method and subject
+    """
+    if name not in NUMERIC_COLUMNS:
+      raise ValueError("%s is not a numeric summary column" % name)
+    where, arguments = self._where(method, subjects)
+    return [row[0] for row in self.connection.execute("SELECT %s FROM summaries%s ORDER BY method, subject"
+                                                      % (name, where), arguments)]
+
+  def aggregate(self, columns=NUMERIC_COLUMNS, method=None, subjects=None):
+    """Count, mean, standard deviation, minimum and maximum of numeric columns, one dictionary per column
+    """
+    for name in columns:
+      if name not in NUMERIC_COLUMNS:
+        raise ValueError("%s is not a numeric summary column" % name)
+    where, arguments = self._where(method, subjects)
+    selections = ", ".join("COUNT(%s), AVG(%s), AVG(%s * %s), MIN(%s), MAX(%s)" % ((name,) * 6) for name in columns)
+    row = self.connection.execute("SELECT %s FROM summaries%s" % (selections, where), arguments).fetchone()
+    statistics = {}
+    for index, name in enumerate(columns):
+      count, mean, meanSquare, minimum, maximum = row[5 * index:5 * index + 5]
+      std = None
+      if count > 1:
+        std = math.sqrt(max(0.0, (meanSquare - mean * mean) * count / (count - 1)))
+      statistics[name] = {"count": count, "mean": mean, "std": std, "minimum": minimum, "maximum": maximum}
+    return statistics
+
+  def methods(self):
+    return [row[0] for row in self.connection.execute("SELECT DISTINCT method FROM summaries ORDER BY method")]
+
+  def exportCSV(self, path, method=None):
+    """Writes the records as the study spreadsheet, one row per subject and method
+    """
+    import csv
+    with open(path, "w") as csvFile:
+      writer = csv.writer(csvFile, lineterminator="\n")
+      writer.writerow(COLUMNS)
+      for record in self.records(method):
+        record["parameters"] = json.dumps(record["parameters"], sort_keys=True)
+        record["timings"] = json.dumps(record["timings"], sort_keys=True)
+        writer.writerow([record[column] for column in COLUMNS])
+
+  def printSummary(self, stream=None):
+    stream = stream or sys.stdout
+    for method in self.methods():
+      statistics = self.aggregate(("lesionCount", "totalVolume_mm3", "seconds"), method)
+      stream.write("%s: %d subjects\n" % (method, statistics["lesionCount"]["count"]))
+      for name in ("lesionCount", "totalVolume_mm3", "seconds"):
+        column = statistics[name]
+        if not column["count"]:
+          continue
+        stream.write("  %s: mean %.1f, std %.1f, min %.1f, max %.1f\n"
+                     % (name, column["mean"], column["std"] or 0.0, column["minimum"], column["maximum"]))
+      histogram = self.aggregate(SIZE_BIN_COLUMNS, method)
+      stream.write("  lesions per subject by size: %s\n"
+                   % ", ".join("%s %.1f" % (name, histogram[name]["mean"]) for name in SIZE_BIN_COLUMNS))
+
+def main(argv):
+  import argparse
+  parser = argparse.ArgumentParser(prog="python -m LesionSpotlightLib.CohortSummary",
+                                   description="Lesion Spotlight cohort summary")
+  parser.add_argument("command", choices=["summary", "export"])
+  parser.add_argument("summary", help="SQLite cohort summary file")
+  parser.add_argument("output", nargs="?", help="export: CSV file")
+  parser.add_argument("--method", default=None, help="only the records of this method (LSSegmenter or AFTSegmenter)")
+  args = parser.parse_args(argv)
+  if not os.path.exists(args.summary):
+    parser.error("summary file not found: %s" % args.summary)
+  with CohortSummary(args.summary) as summary:
+    if args.command == "summary":
+      summary.printSummary()
+    elif args.command == "export":
+      if not args.output:
+        parser.error("export needs an output CSV file")
+      summary.exportCSV(args.output, args.method)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,841 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Slicer-free implementation of the LSSegmenter and AFTSegmenter algorithms.
+
+Every step works on SimpleITK images and follows the CLI of the same name:
+logistic contrast enhancement, weighted enhancement, white matter match,
+lesion size filtering, lesion map refinement and the automatic FLAIR
+threshold. SimpleITK is loaded by simpleITK() on first use and NumPy by the
+functions, so the engine runs in a stock Slicer, which has no SciPy.
+
+The pipelines take the volumes already preprocessed (bias field corrected
+and, for LSSegmenter, filtered by the anisotropic anomalous diffusion) and
+either the white matter masks / brain tissues in the subject space or the
+MNI152 to subject transform computed by BRAINSFit.
+
+From the command line:
+
+  python -m LesionSpotlightLib.Engine ls --flair flair.nii.gz --transform mni2flair.tfm --output lesions.nii.gz
+  python -m LesionSpotlightLib.Engine aft --t1 t1.nii.gz --flair flair.nii.gz --mniTransform mni2t1.tfm
+         --flairTransform flair2t1.tfm --output lesions.nii.gz
+
+With the job queue, processLSSubject and processAFTSubject are the handlers of
+the LS_STAGE and AFT_STAGE jobs. Their parameters are the keyword arguments
+of the engine functions, not those of the Slicer logics, so the engine jobs
+have their own stage names and memory model coefficients:
+
+  JobQueue(path).runWorker({Engine.LS_STAGE: Engine.processLSSubject})
+
+or, with the steps of several subjects overlapping in a stage pipeline:
+
+  python -m LesionSpotlightLib.Engine cohort cohort.sqlite --workers enhancement=3
+"""
+import os
+import sys
+import math
+import time
+import logging
+
+THRESHOLD_FILTERS = {
+  "MaximumEntropy": "MaximumEntropyThresholdImageFilter",
+  "Otsu": "OtsuThresholdImageFilter",
+  "Renyi": "RenyiEntropyThresholdImageFilter",
+  "Moments": "MomentsThresholdImageFilter",
+  "Yen": "YenThresholdImageFilter",
+  "IsoData": "IsoDataThresholdImageFilter",
+  "Intermodes": "IntermodesThresholdImageFilter",
+}
+
+# Largest number of bins of the outlier clipping histogram, as the MaskedIntensityHistogramCalculator
+CLIPPING_HISTOGRAM_BINS = 1 << 16
+
+# Fractions of the masked voxels below and above the outlier clipping cut points
+CLIPPING_FRACTIONS = (0.01, 0.99)
+
+LESION_STATISTICS_COLUMNS = ("label", "voxelCount", "volume_mm3", "centroid_x", "centroid_y", "centroid_z",
+                             "bbox_min_i", "bbox_min_j", "bbox_min_k", "bbox_max_i", "bbox_max_j", "bbox_max_k",
+                             "meanIntensity")
+
+# Job queue stages of processLSSubject() and processAFTSubject()
+LS_STAGE = "LSEngine"
+AFT_STAGE = "AFTEngine"
+
+# Edge neighbours that the 18-connectivity adds to the face ones, one of each opposite pair (KJI)
+EDGE_OFFSETS = ((0, 1, 1), (0, 1, -1), (1, 0, 1), (1, 0, -1), (1, 1, 0), (1, -1, 0))
+
+_sitk = None
+
+def simpleITK():
+  """The SimpleITK module, imported on the first call
+  """
+  global _sitk
+  if _sitk is None:
+    import SimpleITK
+    _sitk = SimpleITK
+  return _sitk
+
+def atlasPath(fileName):
+  """Path of a file of the LSSegmenter-Data folder
+  """
+  return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "Resources", "LSSegmenter-Data", fileName)
+
+def readImage(path):
+  sitk = simpleITK()
+  return sitk.ReadImage(path)
+
+def writeImage(image, path):
+  sitk = simpleITK()
+  sitk.WriteImage(image, path, True)
+
+def _toImage(array, reference):
+  sitk = simpleITK()
+  image = sitk.GetImageFromArray(array)
+  image.CopyInformation(reference)
+  return image
+
+def _outputType(array):
+  """Pixel type kept by the CLIs: the input type when it holds real values, float otherwise
+  """
+  import numpy as np
+  return array.dtype if np.issubdtype(array.dtype, np.floating) else np.float32
+
+def _rescale(array, outputMinimum, outputMaximum):
+  """Intensity windowing of the whole array range, as in the CLIs
+  """
+  import numpy as np
+  minimum = float(array.min())
+  maximum = float(array.max())
+  if not maximum > minimum:
+    maximum = minimum + 1.0
+  return (np.asarray(array, dtype=np.float64) - minimum) * ((outputMaximum - outputMinimum) / (maximum - minimum)) + outputMinimum
+
+def sameGrid(image, reference):
+  """True when both images have the same size, origin, spacing and direction
+  """
+  return (image.GetSize() == reference.GetSize()
+          and all(abs(a - b) < 1e-4 for a, b in zip(image.GetOrigin(), reference.GetOrigin()))
+          and all(abs(a - b) < 1e-6 for a, b in zip(image.GetSpacing(), reference.GetSpacing()))
+          and all(abs(a - b) < 1e-6 for a, b in zip(image.GetDirection(), reference.GetDirection())))
+
+def resampleToReference(image, reference, transform=None, interpolation="Linear", binary=False):
+  """Resamples image on the reference grid, like BRAINSResample. transform maps the reference
+  space to the image space (the BRAINSFit transform with the reference as fixed volume).
+  binary gives a 0/1 unsigned char image.
+  """
+  sitk = simpleITK()
+  interpolators = {"Linear": sitk.sitkLinear, "NearestNeighbor": sitk.sitkNearestNeighbor,
+                   "BSpline": sitk.sitkBSpline}
+  if transform is None:
+    transform = sitk.Transform()
+  pixelType = sitk.sitkFloat32 if binary else image.GetPixelID()
+  resampled = sitk.Resample(image, reference, transform, interpolators[interpolation], 0.0, pixelType)
+  if binary:
+    resampled = sitk.Cast(resampled > 0.5, sitk.sitkUInt8)
+  return resampled
+
+def biasFieldCorrection(image, mask=None, shrinkFactor=4, numberOfIterations=(50, 40, 30),
+                        convergenceThreshold=0.0001, splineOrder=3):
+  """N4 bias field correction with the defaults of the N4ITKBiasFieldCorrection CLI
+  """
+  sitk = simpleITK()
+  image = sitk.Cast(image, sitk.sitkFloat32)
+  if mask is None:
+    mask = sitk.OtsuThreshold(image, 0, 1, 200)
+  shrunkImage = sitk.Shrink(image, [shrinkFactor] * image.GetDimension())
+  shrunkMask = sitk.Shrink(mask, [shrinkFactor] * image.GetDimension())
+  corrector = sitk.N4BiasFieldCorrectionImageFilter()
+  corrector.SetMaximumNumberOfIterations(list(numberOfIterations))
+  corrector.SetConvergenceThreshold(convergenceThreshold)
+  corrector.SetSplineOrder(splineOrder)
+  corrector.Execute(shrunkImage, shrunkMask)
+  logBiasField = corrector.GetLogBiasFieldAsImage(image)
+  return image / sitk.Exp(logBiasField)
+
+#
+# Lesion enhancement
+#
+
+def maskedHistogramBins(values, fractions, maximumNumberOfBins=CLIPPING_HISTOGRAM_BINS):
+  """Histogram bin of each of the masked values and the bin of each CDF fraction, as the
+  MaskedIntensityHistogramCalculator of the CLI: one bin per value when the values are integers
+  whose range fits maximumNumberOfBins, maximumNumberOfBins equal width bins of the range otherwise
+  """
+  import numpy as np
+  minimum = float(values.min())
+  maximum = float(values.max())
+  if np.issubdtype(values.dtype, np.integer) and maximum - minimum + 1 <= maximumNumberOfBins:
+    numberOfBins = int(maximum - minimum + 1)
+    binWidth = 1.0
+  else:
+    numberOfBins = max(1, int(maximumNumberOfBins))
+    binWidth = (maximum - minimum) / numberOfBins
+  scale = 1.0 / binWidth if binWidth > 0 else 0.0
+  bins = np.minimum(((values.astype(np.float64) - minimum) * scale).astype(np.int64), numberOfBins - 1)
+  cumulative = np.cumsum(np.bincount(bins, minlength=numberOfBins))
+  #First bin whose cumulative count is nonzero and reaches the fraction of the values
+  percentileBins = [min(int(np.searchsorted(cumulative, max(fraction * values.size, 1), side="left")), numberOfBins - 1)
+                    for fraction in fractions]
+  return bins, percentileBins
+
+def logisticContrastEnhancement(image, mask, numberOfBins=128, thresholdMethod="MaximumEntropy",
+                                flipObject=False, tolerance=1):
+  """Lesion contrast map of the LogisticContrastEnhancement CLI. The (alpha,beta) parameters
+  are estimated inside the mask, after the masked voxels below the 1% and above the 99% of
+  their histogram (binned as in the CLI) are cut off, and the sigmoid is applied on the whole
+  image. The threshold is computed on the clipped voxel values, where the CLI uses the values
+  of their clipping bins; both agree for integer inputs.
+  """
+  import numpy as np
+  sitk = simpleITK()
+  if thresholdMethod not in THRESHOLD_FILTERS:
+    raise ValueError("unknown threshold method %s, choose one of %s" % (thresholdMethod, ", ".join(sorted(THRESHOLD_FILTERS))))
+  if not 0 < tolerance < 100:
+    raise ValueError("tolerance is out of bound, it must be 0 < T < 100")
+  array = sitk.GetArrayViewFromImage(image)
+  inMask = sitk.GetArrayViewFromImage(mask) != 0
+  values = array[inMask]
+  if not values.size:
+    raise ValueError("the mask is empty")
+
+  #Removing signal outliers using a similar strategy applied at BET brain extraction algorithm.
+  #The histogram bins follow the masked intensity range, so the cut points hold for any bit depth.
+  bins, (lowBin, highBin) = maskedHistogramBins(values, CLIPPING_FRACTIONS)
+  logging.info("Clipping bins: %d - %d" % (lowBin, highBin))
+  cleaned = np.zeros(array.shape, dtype=np.float32)
+  cleaned[inMask] = np.where((bins >= lowBin) & (bins <= highBin), values, 0)
+
+  calculator = getattr(sitk, THRESHOLD_FILTERS[thresholdMethod])()
+  calculator.SetNumberOfHistogramBins(int(numberOfBins))
+  calculator.Execute(_toImage(cleaned, image))
+  thr = float(calculator.GetThreshold())
+
+  if flipObject:
+    beta = thr / 2.0
+  else:
+    beta = ((float(cleaned.max()) - thr) / 2.0) + thr
+  alpha = (beta - thr) / math.log((100.0 - tolerance) / float(tolerance))
+  logging.info("Beta: %g - Alpha: %g" % (beta, alpha))
+
+  contrastMap = 1.0 / (1.0 + np.exp(-(np.asarray(array, dtype=np.float64) - beta) / alpha))
+  return _toImage(contrastMap.astype(_outputType(array)), image)
+
+def weightingMaps(contrastMap, regionMask=None, lesionThr=0.85):
+  """Part of the weighted enhancement that does not depend on the weight, from NumPy arrays:
+  the contrast map and the final contrast map (above the baseline of the region) rescaled to [0,1].
+  """
+  import numpy as np
+  rescaledContrastMap = _rescale(contrastMap, 0.0, 1.0)
+  #Split background and lesion regions
+  background = np.where(rescaledContrastMap < lesionThr, rescaledContrastMap, 0.0)
+  if regionMask is not None:
+    background = np.where(regionMask != 0, background, 0.0)
+  #Calculating baseline contrast
+  regionVoxels = background[background != 0]
+  baselineValue = float(regionVoxels.mean()) if regionVoxels.size else 0.0
+  logging.info("Region mean contrast: %g" % baselineValue)
+
+  finalContrastMap = np.maximum(rescaledContrastMap - baselineValue, 0.0)
+  return rescaledContrastMap.astype(np.float32), _rescale(finalContrastMap, 0.0, 1.0).astype(np.float32)
+
+def weightingBoost(maps, weight=0.0, maintainGaussianity=False):
+  """Voxelwise factor applied on the input image, from the weightingMaps() arrays (or slices of them)
+  """
+  rescaledContrastMap, rescaledFinalContrastMap = maps
+  if maintainGaussianity:
+    #Lesion probabilities are realocated to 1 < l < 2 + 2 * weight
+    return rescaledContrastMap * (1.0 + (2.0 * weight)) + 1.0
+  return rescaledFinalContrastMap * (weight + 1.0) + 1.0
+
+def weightedEnhancement(image, contrastMap, regionMask=None, weight=0.0, lesionThr=0.85, maintainGaussianity=False):
+  """Input image weighted by its lesion contrast map, as the WeightedEnhancementImageFilter CLI.
+  The whole volume is the baseline region when no regionMask is given.
+  """
+  sitk = simpleITK()
+  array = sitk.GetArrayViewFromImage(image)
+  maps = weightingMaps(sitk.GetArrayViewFromImage(contrastMap),
+                       None if regionMask is None else sitk.GetArrayViewFromImage(regionMask), lesionThr)
+  boost = weightingBoost(maps, weight, maintainGaussianity)
+
+  boostedVoxels = array != 0
+  if not maintainGaussianity:
+    boostedVoxels &= maps[1] > 0
+  meanBoost = (float(boost[boostedVoxels].mean()) - 1.0) if boostedVoxels.any() else -1.0
+  logging.info("Mean image contrast enhancement estimated in %g%% in comparison with the original image." % (meanBoost * 100.0))
+  return _toImage((array * boost).astype(array.dtype), image)
+
+#
+# Lesion refinement
+#
+
+def whiteMatterMatch(lesionMask, whiteMatterMask, wmMatch=0.6, radius=1):
+  """Keeps the lesion voxels whose neighbourhood has at least a wmMatch fraction of voxels
+  in both the lesion and the white matter masks (WhiteMatterMatchImageFilter).
+  """
+  import numpy as np
+  sitk = simpleITK()
+  lesions = sitk.GetArrayViewFromImage(lesionMask) != 0
+  both = (lesions & (sitk.GetArrayViewFromImage(whiteMatterMask) != 0)).astype(np.uint16)
+  #The image border is replicated, as the zero flux boundary of the ITK neighbourhood iterators
+  padded = np.pad(both, radius, mode="edge")
+  match = np.zeros(both.shape, dtype=np.uint16)
+  width = 2 * radius + 1
+  for k in range(width):
+    for j in range(width):
+      for i in range(width):
+        match += padded[k:k + both.shape[0], j:j + both.shape[1], i:i + both.shape[2]]
+  keep = lesions & (match.astype(np.float32) / np.float32(width ** 3) >= np.float32(wmMatch))
+  return _toImage(keep.astype(np.uint8), lesionMask)
+
+def _mergeEdgeNeighbours(labels):
+  """18-connected labels from the 6-connected labels array of ConnectedComponent: the lesions
+  touching by an edge are merged, and the labels stay consecutive in the order of their first voxel.
+  """
+  import numpy as np
+  parent = np.arange(int(labels.max()) + 1 if labels.size else 1)
+
+  def root(label):
+    while parent[label] != label:
+      parent[label] = parent[parent[label]]
+      label = parent[label]
+    return label
+
+  for offset in EDGE_OFFSETS:
+    source = tuple(slice(max(0, -o), n - max(0, o)) for o, n in zip(offset, labels.shape))
+    target = tuple(slice(max(0, o), n - max(0, -o)) for o, n in zip(offset, labels.shape))
+    first = labels[source]
+    second = labels[target]
+    touching = (first != 0) & (second != 0) & (first != second)
+    if not touching.any():
+      continue
+    for a, b in np.unique(np.stack((first[touching], second[touching]), axis=1), axis=0):
+      a = root(a)
+      b = root(b)
+      if a != b:
+        # The smaller label, the one of the first voxel, is kept
+        parent[max(a, b)] = min(a, b)
+  roots = np.array([root(label) for label in range(len(parent))])
+  consecutive = np.unique(roots, return_inverse=True)[1].reshape(roots.shape)
+  return consecutive[labels].astype(labels.dtype)
+
+def labelLesions(lesionMask, connectivity=6):
+  """Connected lesions of a binary mask, as an array of labels in the order of their first voxel
+  """
+  sitk = simpleITK()
+  if connectivity not in (6, 18, 26):
+    raise ValueError("connectivity must be 6, 18 or 26")
+  binary = sitk.Cast(lesionMask != 0, sitk.sitkUInt8)
+  labels = sitk.GetArrayFromImage(sitk.ConnectedComponent(binary, connectivity == 26))
+  if connectivity == 18:
+    return _mergeEdgeNeighbours(labels)
+  return labels
+
+def lesionSizeFilter(lesionMask, minimumSize=10, connectivity=6, intensity=None, insideValue=1):
+  """Removes the lesions smaller than minimumSize voxels (LesionSizeFilterImageFilter).
+  Returns the lesion mask and the statistics of the kept lesions, in raster order of their
+  first voxel, one dictionary per lesion with the LESION_STATISTICS_COLUMNS keys.
+  """
+  import numpy as np
+  sitk = simpleITK()
+  labels = labelLesions(lesionMask, connectivity)
+  flatLabels = labels.ravel()
+  numberOfLabels = int(flatLabels.max()) if flatLabels.size else 0
+  counts = np.bincount(flatLabels, minlength=numberOfLabels + 1)
+  keep = counts >= minimumSize
+  keep[0] = False
+
+  statistics = []
+  if keep.any():
+    k, j, i = np.nonzero(keep[labels])
+    voxelLabels = labels[k, j, i]
+    sums = [np.bincount(voxelLabels, weights=index, minlength=numberOfLabels + 1) for index in (i, j, k)]
+    minimums = [np.full(numberOfLabels + 1, np.iinfo(np.int64).max, dtype=np.int64) for d in range(3)]
+    maximums = [np.full(numberOfLabels + 1, -1, dtype=np.int64) for d in range(3)]
+    for d, index in enumerate((i, j, k)):
+      np.minimum.at(minimums[d], voxelLabels, index)
+      np.maximum.at(maximums[d], voxelLabels, index)
+    if intensity is not None:
+      intensitySums = np.bincount(voxelLabels, weights=sitk.GetArrayViewFromImage(intensity)[k, j, i],
+                                  minlength=numberOfLabels + 1)
+    values, firstVoxels = np.unique(flatLabels, return_index=True)
+    spacing = lesionMask.GetSpacing()
+    voxelVolume = spacing[0] * spacing[1] * spacing[2]
+    for label in values[np.argsort(firstVoxels)]:
+      if not keep[label]:
+        continue
+      count = int(counts[label])
+      centroid = lesionMask.TransformContinuousIndexToPhysicalPoint([float(sums[d][label]) / count for d in range(3)])
+      lesion = dict(zip(LESION_STATISTICS_COLUMNS[3:6], centroid))
+      lesion.update(zip(LESION_STATISTICS_COLUMNS[6:9], [int(minimums[d][label]) for d in range(3)]))
+      lesion.update(zip(LESION_STATISTICS_COLUMNS[9:12], [int(maximums[d][label]) for d in range(3)]))
+      lesion["label"] = len(statistics) + 1
+      lesion["voxelCount"] = count
+      lesion["volume_mm3"] = count * voxelVolume
+      lesion["meanIntensity"] = float(intensitySums[label]) / count if intensity is not None else 0.0
+      statistics.append(lesion)
+
+  output = np.where(keep[labels], insideValue, 0).astype(np.uint8)
+  return _toImage(output, lesionMask), statistics
+
+def writeLesionStatistics(statistics, path):
+  """Writes the lesion statistics table in the CSV layout of the CLIs
+  """
+  with open(path, "w") as statisticsFile:
+    statisticsFile.write(",".join(LESION_STATISTICS_COLUMNS) + "\n")
+    for lesion in statistics:
+      statisticsFile.write(",".join(("%g" % lesion[column]) if isinstance(lesion[column], float) else str(lesion[column])
+                                    for column in LESION_STATISTICS_COLUMNS) + "\n")
+
+def lesionMapRefinement(lesionProbMap, wmMask, lesionThr=0.95, wmMatch=0.6, minimumSize=10, connectivity=6):
+  """Final lesion map of the LesionMapRefinement CLI. Returns the lesion mask and its statistics.
+  """
+  sitk = simpleITK()
+  lesions = sitk.Cast(lesionProbMap >= lesionThr, sitk.sitkUInt8)
+  lesions = whiteMatterMatch(lesions, wmMask, wmMatch)
+  return lesionSizeFilter(lesions, minimumSize, connectivity, intensity=lesionProbMap)
+
+def _matchIntensity(values, source, reference):
+  """Piecewise linear map of the source quantiles to the reference ones, extrapolated with the
+  slope of the first and last segments
+  """
+  import numpy as np
+  mapped = np.interp(values, source, reference)
+  for end, previous in ((0, 1), (-1, -2)):
+    width = source[end] - source[previous]
+    if width:
+      outside = (values < source[0]) if end == 0 else (values > source[-1])
+      mapped[outside] = reference[end] + (values[outside] - source[end]) * (reference[end] - reference[previous]) / width
+  return mapped
+
+def grayMatterQualityControl(t1, mniTemplate, gmMask, absErrorThreshold=0.1, gmDilationRadius=2, qcSampling=1.0,
+                             numberOfMatchPoints=10000):
+  """Gray matter voxels whose template to T1 residual is reliable. The histograms are matched with the
+  voxels of the dilated gray matter only, or a qcSampling fraction of them, and the residual is
+  evaluated inside the gray matter, as in the CLI.
+  """
+  import numpy as np
+  sitk = simpleITK()
+  gmArray = sitk.GetArrayViewFromImage(gmMask) != 0
+  dilated = _toImage(gmArray.astype(np.uint8), t1)
+  if gmDilationRadius > 0:
+    dilated = sitk.BinaryDilate(dilated, [int(gmDilationRadius)] * 3, sitk.sitkBall)
+  histogramVoxels = sitk.GetArrayViewFromImage(dilated) != 0
+  t1Array = sitk.GetArrayViewFromImage(t1).astype(np.float64)
+  mniArray = sitk.GetArrayViewFromImage(mniTemplate).astype(np.float64)
+  t1Samples = t1Array[histogramVoxels]
+  mniSamples = mniArray[histogramVoxels]
+  if qcSampling < 1.0:
+    keep = np.random.RandomState(2016).random_sample(t1Samples.size) < qcSampling
+    t1Samples, mniSamples = t1Samples[keep], mniSamples[keep]
+  if t1Samples.size < 2:
+    return np.zeros(gmArray.shape, dtype=bool)
+  points = min(numberOfMatchPoints + 2, t1Samples.size)
+  positions = np.round(np.linspace(0.0, 1.0, points) * (t1Samples.size - 1)).astype(np.int64)
+  source = np.sort(mniSamples)[positions]
+  reference = np.sort(t1Samples)[positions]
+
+  absError = np.zeros(gmArray.shape)
+  absError[gmArray] = np.abs(_matchIntensity(mniArray[gmArray], source, reference) - t1Array[gmArray])
+  if absError.max() <= 0:
+    return np.zeros(gmArray.shape, dtype=bool)
+  relativeError = absError / absError.max()
+  return (relativeError >= 0.005) & (relativeError <= absErrorThreshold)
+
+def automaticFLAIRThreshold(t1, flair, mniTemplate, brainLabels, absErrorThreshold=0.1, gamma=2.0, wmMatch=0.6,
+                            minimumSize=10, gmMaskValue=2, wmMaskValue=3, connectivity=6, wholeImageMatching=False,
+                            gmDilationRadius=2, qcSampling=1.0):
+  """Lesion map of the AutomaticFLAIRThreshold CLI, with every image in the T1 space.
+  Returns the lesion mask and its statistics.
+  """
+  import numpy as np
+  sitk = simpleITK()
+  #The CLI reads every volume with the T1 pixel type
+  flair = sitk.Cast(flair, t1.GetPixelID())
+  labels = sitk.GetArrayViewFromImage(brainLabels)
+
+  #Gray matter quality control
+  if wholeImageMatching:
+    histogramMatch = sitk.HistogramMatchingImageFilter()
+    histogramMatch.SetNumberOfMatchPoints(10000)
+    matched = histogramMatch.Execute(sitk.Cast(mniTemplate, t1.GetPixelID()), t1)
+    absError = np.abs(sitk.GetArrayViewFromImage(matched).astype(np.float64) - sitk.GetArrayViewFromImage(t1))
+    gmAbsErrorProbability = _rescale(np.where(labels == gmMaskValue, absError, 0.0), 0.0, 1.0)
+    gmMask = (gmAbsErrorProbability >= 0.005) & (gmAbsErrorProbability <= absErrorThreshold)
+  else:
+    gmMask = grayMatterQualityControl(t1, sitk.Cast(mniTemplate, t1.GetPixelID()),
+                                      _toImage((labels == gmMaskValue).astype(np.uint8), t1), absErrorThreshold,
+                                      gmDilationRadius, qcSampling)
+
+  #Calculate the T2-FLAIR gray matter voxel intensity distribution
+  flairArray = sitk.GetArrayViewFromImage(flair)
+  gmValues = flairArray[gmMask & (flairArray != 0)].astype(np.float64)
+  if not gmValues.size:
+    raise ValueError("no gray matter voxel is left for the T2-FLAIR statistics, raise the absolute error threshold")
+  #Same estimators as the CLI, whose voxel count starts at one
+  mu = gmValues.sum() / (gmValues.size + 1)
+  sigma = math.sqrt(((gmValues - mu) ** 2).sum() / gmValues.size)
+  logging.info("Gray matter voxel intensity distribution: G(mu=%g,sigma=%g)" % (mu, sigma))
+
+  #Lesion label refinement
+  lesionThr = mu + gamma * sigma
+  logging.info("Hyperintense lesions set to values higher than %g" % lesionThr)
+  lesions = _toImage((flairArray >= lesionThr).astype(np.uint8), flair)
+  wmMask = _toImage((labels == wmMaskValue).astype(np.uint8), brainLabels)
+  lesions = whiteMatterMatch(lesions, wmMask, wmMatch)
+  return lesionSizeFilter(lesions, minimumSize, connectivity, intensity=flair)
+
+def gammaLevelLesions(levels, gamma=2.0, minimumSize=10, connectivity=6):
+  """Lesion mask array of a new gamma from the gammaLevelMap array of the AutomaticFLAIRThreshold
+  CLI: the voxels whose level reaches gamma, without the lesions smaller than minimumSize voxels.
+  """
+  import numpy as np
+  sitk = simpleITK()
+  lesions = sitk.GetImageFromArray((levels >= gamma).astype(np.uint8))
+  if connectivity == 18:
+    labels = labelLesions(lesions, connectivity)
+    keep = np.bincount(labels.ravel()) >= minimumSize
+    keep[0] = False
+    return keep[labels].astype(np.uint8)
+  if connectivity != 6 and connectivity != 26:
+    raise ValueError("connectivity must be 6, 18 or 26")
+  labels = sitk.RelabelComponent(sitk.ConnectedComponent(lesions, connectivity == 26), int(minimumSize))
+  return (sitk.GetArrayViewFromImage(labels) != 0).astype(np.uint8)
+
+#
+# Pipelines
+#
+
+def atlasWhiteMatterMasks(reference, transform=None):
+  """MNI152 white matter masks on the reference grid: the thinner mask (nearest neighbour)
+  and the white matter mask (linear), as LSSegmenterLogic resamples them
+  """
+  thinMask = resampleToReference(readImage(atlasPath("MNI152_T1_1mm_WhiteMatter_thinner.nii.gz")), reference,
+                                 transform, "NearestNeighbor", binary=True)
+  wmMask = resampleToReference(readImage(atlasPath("MNI152_T1_WhiteMatter.nii.gz")), reference,
+                               transform, "NearestNeighbor" if transform is None else "Linear", binary=True)
+  return thinMask, wmMask
+
+def brainMask(brainTissues, dilationRadius=4.0):
+  """Mask of the brain tissues dilated by dilationRadius mm, as the brain masking of the logics
+  """
+  sitk = simpleITK()
+  mask = sitk.NotEqual(brainTissues, 0)
+  radius = [max(1, int(round(dilationRadius / s))) for s in mask.GetSpacing()]
+  return sitk.BinaryDilate(mask, radius, sitk.sitkBall)
+
+def lsWhiteMatterMasks(flair, whiteMatterMask=None, whiteMatterThinMask=None, transform=None, isMNISpace=False):
+  """(thinner white matter mask, white matter mask, isMNISpace) of lsSegmenter(). The masks are
+  taken from the MNI152 atlas when they are not given, see lsSegmenter().
+  """
+  if whiteMatterMask is None or whiteMatterThinMask is None:
+    if transform is None and not isMNISpace:
+      from LesionSpotlightLib import MNISpace
+      isMNISpace, reason = MNISpace.isMNISpaceImage(flair)
+      if not isMNISpace:
+        raise ValueError("the white matter masks or the MNI152 to FLAIR transform are needed out of the MNI space "
+                         "(%s)" % reason)
+      logging.info("The FLAIR is in the MNI152 space (%s), the atlas masks are used as they are" % reason)
+    whiteMatterThinMask, whiteMatterMask = atlasWhiteMatterMasks(flair, None if isMNISpace else transform)
+  return whiteMatterThinMask, whiteMatterMask, isMNISpace
+
+def lsLesionSegmentation(flair, whiteMatterThinMask, whiteMatterMask, isMNISpace=False, lesionUpdates=3,
+                         thresholdMethod="MaximumEntropy", numberOfBins=128, lesionThr=0.95, wmMatch=0.6,
+                         minimumSize=50, connectivity=6):
+  """Lesion map updates and refinement of lsSegmenter(), given the masks on the FLAIR grid
+  """
+  enhancedFLAIR = flair
+  contrastMap = None
+  for i in range(int(lesionUpdates)):
+    #Enhancing lesion contrast...
+    contrastMap = logisticContrastEnhancement(enhancedFLAIR, whiteMatterThinMask, numberOfBins, thresholdMethod)
+    #Increasing FLAIR lesions contrast...
+    if isMNISpace:
+      enhancedFLAIR = weightedEnhancement(enhancedFLAIR, contrastMap, weight=0)
+    else:
+      enhancedFLAIR = weightedEnhancement(enhancedFLAIR, contrastMap, whiteMatterThinMask, weight=0, lesionThr=lesionThr)
+  if contrastMap is None:
+    raise ValueError("at least one lesion map update is needed")
+
+  return lesionMapRefinement(contrastMap, whiteMatterMask, lesionThr, wmMatch, minimumSize, connectivity)
+
+def lsSegmenter(flair, whiteMatterMask=None, whiteMatterThinMask=None, transform=None, isMNISpace=False,
+                lesionUpdates=3, thresholdMethod="MaximumEntropy", numberOfBins=128, lesionThr=0.95,
+                wmMatch=0.6, minimumSize=50, connectivity=6):
+  """LSSegmenterLogic lesion segmentation of a preprocessed T2-FLAIR volume.
+
+  The white matter masks are taken from the MNI152 atlas when they are not given, mapped with
+  transform (MNI152 to FLAIR) or, for isMNISpace, only put on the FLAIR grid. Without masks
+  and transform, a FLAIR on the MNI152 template grid is detected as isMNISpace.
+  Returns the lesion mask and its statistics.
+  """
+  whiteMatterThinMask, whiteMatterMask, isMNISpace = lsWhiteMatterMasks(flair, whiteMatterMask, whiteMatterThinMask,
+                                                                         transform, isMNISpace)
+  return lsLesionSegmentation(flair, whiteMatterThinMask, whiteMatterMask, isMNISpace, lesionUpdates,
+                              thresholdMethod, numberOfBins, lesionThr, wmMatch, minimumSize, connectivity)
+
+def aftSegmenter(t1, flair, mniTemplate=None, brainTissues=None, mniTransform=None, flairTransform=None,
+                 isBET=True, absErrorThreshold=0.1, gamma=2.0, wmMatch=0.6, minimumSize=10, gmLabel=2,
+                 wmLabel=3, connectivity=6, wholeImageMatching=False, gmDilationRadius=2, qcSampling=1.0):
+  """AFTSegmenterLogic lesion segmentation of bias field corrected T1 and T2-FLAIR volumes.
+
+  flair is put on the T1 grid with flairTransform (T1 to FLAIR). The MNI152 template and brain
+  tissues are taken from the atlas when they are not given and mapped with mniTransform
+  (MNI152 to T1). Inputs that are not skull stripped (isBET off) are restricted to the brain
+  tissues. Returns the lesion mask and its statistics.
+  """
+  if flairTransform is not None or not sameGrid(flair, t1):
+    flair = resampleToReference(flair, t1, flairTransform, "Linear")
+  if mniTemplate is None:
+    mniTemplate = readImage(atlasPath("MNI152_T1_1mm_brain.nii.gz"))
+  if brainTissues is None:
+    brainTissues = readImage(atlasPath("MNI152_T1_1mm_brain_tissues.nii.gz"))
+  if mniTransform is not None or not sameGrid(mniTemplate, t1):
+    mniTemplate = resampleToReference(mniTemplate, t1, mniTransform, "Linear")
+  if mniTransform is not None or not sameGrid(brainTissues, t1):
+    brainTissues = resampleToReference(brainTissues, t1, mniTransform, "NearestNeighbor")
+  if not isBET:
+    sitk = simpleITK()
+    mask = brainMask(brainTissues)
+    t1 = sitk.Mask(t1, mask)
+    flair = sitk.Mask(flair, mask)
+
+  return automaticFLAIRThreshold(t1, flair, mniTemplate, brainTissues, absErrorThreshold, gamma, wmMatch,
+                                 minimumSize, gmLabel, wmLabel, connectivity, wholeImageMatching, gmDilationRadius,
+                                 qcSampling)
+
+#
+# Job queue handlers
+#
+
+def _readOptional(parameters, key, reader):
+  path = parameters.pop(key, None)
+  return reader(path) if path else None
+
+def _readTransform(path):
+  sitk = simpleITK()
+  return sitk.ReadTransform(path)
+
+def _writeResults(result, outputPath, statisticsPath):
+  lesionMap, statistics = result
+  writeImage(lesionMap, outputPath)
+  outputs = {"outputLabel": outputPath, "numberOfLesions": len(statistics)}
+  if statisticsPath:
+    writeLesionStatistics(statistics, statisticsPath)
+    outputs["lesionStatistics"] = statisticsPath
+  return outputs
+
+def _appendSummary(outputs, summaryPath, subject, method, statistics, parameters, atlas, transform, seconds):
+  """Adds the record of the lesion map to the cohort summary, when a summary path is given
+  """
+  if not summaryPath:
+    return outputs
+  from LesionSpotlightLib import CohortSummary
+  CohortSummary.appendToSummary(summaryPath, subject, method, [lesion["volume_mm3"] for lesion in statistics],
+                                parameters=parameters, atlas=atlas, transform=transform, seconds=seconds)
+  outputs["cohortSummary"] = summaryPath
+  return outputs
+
+def _readLSSubject(job):
+  """First step of processLSSubject(): reads the volumes, masks and transform of a (subject,
+  parameters) job. Returns the state handed to the next steps.
+  """
+  subject, parameters = job
+  parameters = dict(parameters)
+  state = {"subject": subject,
+           "flair": readImage(parameters.pop("inputFLAIRVolume")),
+           "outputPath": parameters.pop("outputLabel"),
+           "statisticsPath": parameters.pop("lesionStatistics", None),
+           "summaryPath": parameters.pop("cohortSummary", None),
+           "biasFieldCorrection": parameters.pop("biasFieldCorrection", False),
+           "atlas": ",".join(parameters.get(key) or default for key, default in
+                             (("whiteMatterMask", "MNI152_T1_WhiteMatter.nii.gz"),
+                              ("whiteMatterThinMask", "MNI152_T1_1mm_WhiteMatter_thinner.nii.gz"))),
+           "transformPath": parameters.get("transform"),
+           "seconds": 0.0}
+  state["whiteMatterMask"] = _readOptional(parameters, "whiteMatterMask", readImage)
+  state["whiteMatterThinMask"] = _readOptional(parameters, "whiteMatterThinMask", readImage)
+  state["transform"] = _readOptional(parameters, "transform", _readTransform)
+  state["isMNISpace"] = parameters.pop("isMNISpace", False)
+  state["parameters"] = parameters
+  return state
+
+def _biasFieldLSSubject(state):
+  """N4 of the FLAIR, for the jobs asking for it (biasFieldCorrection parameter)
+  """
+  if state["biasFieldCorrection"]:
+    start = time.time()
+    state["flair"] = biasFieldCorrection(state["flair"])
+    state["seconds"] += time.time() - start
+  return state
+
+def _atlasLSSubject(state):
+  logging.info("Segmenting %s" % state["subject"])
+  start = time.time()
+  state["whiteMatterThinMask"], state["whiteMatterMask"], state["isMNISpace"] = lsWhiteMatterMasks(
+    state["flair"], state["whiteMatterMask"], state["whiteMatterThinMask"], state["transform"], state["isMNISpace"])
+  state["seconds"] += time.time() - start
+  return state
+
+def _segmentLSSubject(state):
+  start = time.time()
+  state["result"] = lsLesionSegmentation(state["flair"], state["whiteMatterThinMask"], state["whiteMatterMask"],
+                                         state["isMNISpace"], **state["parameters"])
+  state["seconds"] += time.time() - start
+  # Only the lesion map goes on to the writer
+  for key in ("flair", "whiteMatterMask", "whiteMatterThinMask", "transform"):
+    state[key] = None
+  return state
+
+def _writeLSSubject(state):
+  """Last step of processLSSubject(): writes the results and adds them to the cohort summary.
+  Returns the job outputs.
+  """
+  parameters = dict(state["parameters"], isMNISpace=state["isMNISpace"])
+  return _appendSummary(_writeResults(state["result"], state["outputPath"], state["statisticsPath"]),
+                        state["summaryPath"], state["subject"], "LSSegmenter", state["result"][1], parameters,
+                        state["atlas"], state["transformPath"], state["seconds"])
+
+# Steps of processLSSubject() and default workers of their pipeline stages, see lsCohortExecutor()
+LS_COHORT_STAGES = (("read", _readLSSubject, 1), ("biasField", _biasFieldLSSubject, 2),
+                    ("atlas", _atlasLSSubject, 1), ("enhancement", _segmentLSSubject, 2),
+                    ("write", _writeLSSubject, 1))
+
+def processLSSubject(subject, parameters):
+  """Job queue handler of lsSegmenter. parameters holds the inputFLAIRVolume and outputLabel
+  paths, the optional whiteMatterMask, whiteMatterThinMask, transform, lesionStatistics and
+  cohortSummary paths, an optional biasFieldCorrection flag and the keyword arguments of
+  lsSegmenter()
+  """
+  state = (subject, parameters)
+  for name, step, workers in LS_COHORT_STAGES:
+    state = step(state)
+  return state
+
+def lsCohortExecutor(workers=None, queueSize=2):
+  """PipelineExecutor of the processLSSubject() steps, one stage per step. workers maps a stage
+  name to its number of worker threads, see LS_COHORT_STAGES for the defaults. The items are
+  (subject, parameters) jobs.
+  """
+  from LesionSpotlightLib import Pipeline
+  workers = workers or {}
+  unknown = set(workers) - set(name for name, step, default in LS_COHORT_STAGES)
+  if unknown:
+    raise ValueError("unknown stages: %s" % ", ".join(sorted(unknown)))
+  return Pipeline.PipelineExecutor([Pipeline.Stage(name, step, workers.get(name, default), queueSize)
+                                    for name, step, default in LS_COHORT_STAGES])
+
+def processAFTSubject(subject, parameters):
+  """Job queue handler of aftSegmenter. parameters holds the inputT1Volume, inputFLAIRVolume and
+  outputVolume paths, the optional mniTemplate, brainTissues, mniTransform, flairTransform,
+  lesionStatistics and cohortSummary paths and the keyword arguments of aftSegmenter()
+  """
+  parameters = dict(parameters)
+  t1 = readImage(parameters.pop("inputT1Volume"))
+  flair = readImage(parameters.pop("inputFLAIRVolume"))
+  outputPath = parameters.pop("outputVolume")
+  statisticsPath = parameters.pop("lesionStatistics", None)
+  summaryPath = parameters.pop("cohortSummary", None)
+  atlas = ",".join(parameters.get(key) or default for key, default in
+                   (("mniTemplate", "MNI152_T1_1mm_brain.nii.gz"), ("brainTissues", "MNI152_T1_1mm_brain_tissues.nii.gz")))
+  transformPaths = ",".join(parameters.get(key) or "" for key in ("mniTransform", "flairTransform"))
+  mniTemplate = _readOptional(parameters, "mniTemplate", readImage)
+  brainTissues = _readOptional(parameters, "brainTissues", readImage)
+  mniTransform = _readOptional(parameters, "mniTransform", _readTransform)
+  flairTransform = _readOptional(parameters, "flairTransform", _readTransform)
+  logging.info("Segmenting %s" % subject)
+  start = time.time()
+  result = aftSegmenter(t1, flair, mniTemplate, brainTissues, mniTransform, flairTransform, **parameters)
+  seconds = time.time() - start
+  return _appendSummary(_writeResults(result, outputPath, statisticsPath), summaryPath, subject, "AFTSegmenter",
+                        result[1], parameters, atlas, transformPaths, seconds)
+
+def main(argv):
+  import argparse
+  parser = argparse.ArgumentParser(prog="python -m LesionSpotlightLib.Engine",
+                                   description="Lesion Spotlight segmentation without Slicer")
+  subparsers = parser.add_subparsers(dest="command")
+  subparsers.required = True
+  ls = subparsers.add_parser("ls", help="LSSegmenter lesion segmentation")
+  ls.add_argument("--flair", required=True, help="preprocessed T2-FLAIR volume")
+  ls.add_argument("--whiteMatterMask", help="white matter mask on the FLAIR grid")
+  ls.add_argument("--whiteMatterThinMask", help="thinner white matter mask on the FLAIR grid")
+  ls.add_argument("--transform", help="MNI152 to FLAIR transform")
+  ls.add_argument("--isMNISpace", action="store_true")
+  ls.add_argument("--lesionUpdates", type=int, default=3)
+  ls.add_argument("--thresholdMethod", default="MaximumEntropy", choices=sorted(THRESHOLD_FILTERS))
+  ls.add_argument("--numberOfBins", type=int, default=128)
+  ls.add_argument("--lesionThr", type=float, default=0.95)
+  ls.add_argument("--wmMatch", type=float, default=0.6)
+  ls.add_argument("--minimumSize", type=int, default=50)
+  aft = subparsers.add_parser("aft", help="AFTSegmenter lesion segmentation")
+  aft.add_argument("--t1", required=True, help="bias field corrected T1 volume")
+  aft.add_argument("--flair", required=True, help="bias field corrected T2-FLAIR volume")
+  aft.add_argument("--mniTemplate", help="MNI152 template on the T1 grid")
+  aft.add_argument("--brainTissues", help="brain tissue labels on the T1 grid")
+  aft.add_argument("--mniTransform", help="MNI152 to T1 transform")
+  aft.add_argument("--flairTransform", help="T1 to FLAIR transform")
+  aft.add_argument("--absErrorThreshold", type=float, default=0.1)
+  aft.add_argument("--gamma", type=float, default=2.0)
+  aft.add_argument("--wmMatch", type=float, default=0.6)
+  aft.add_argument("--minimumSize", type=int, default=10)
+  aft.add_argument("--gmLabel", type=int, default=2)
+  aft.add_argument("--wmLabel", type=int, default=3)
+  aft.add_argument("--wholeImageMatching", action="store_true",
+                   help="match the whole template histogram to the T1 one, not only the gray matter")
+  aft.add_argument("--gmDilationRadius", type=int, default=2)
+  aft.add_argument("--qcSampling", type=float, default=1.0, help="fraction of the gray matter voxels of the histograms")
+  cohort = subparsers.add_parser("cohort", help="%s jobs of a job queue run by a stage pipelined executor" % LS_STAGE)
+  cohort.add_argument("queue", help="SQLite job queue file")
+  cohort.add_argument("--workers", action="append", default=[], metavar="STAGE=N",
+                      help="worker threads of a stage (%s)"
+                           % ", ".join("%s=%d" % (name, workers) for name, step, workers in LS_COHORT_STAGES))
+  cohort.add_argument("--queueSize", type=int, default=2, help="subjects waiting at most before each stage")
+  cohort.add_argument("--worker", default=None, help="worker name recorded in the job queue")
+  cohort.add_argument("--maximumJobs", type=int, default=None)
+  for subparser in (ls, aft):
+    subparser.add_argument("--connectivity", type=int, default=6, choices=[6, 18, 26])
+    subparser.add_argument("--output", required=True, help="output lesion map")
+    subparser.add_argument("--lesionStatistics", help="lesion statistics CSV file")
+    subparser.add_argument("--cohortSummary", help="cohort summary SQLite file the lesion map record is added to")
+  args = vars(parser.parse_args(argv))
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+  command = args.pop("command")
+  if command == "cohort":
+    from LesionSpotlightLib.JobQueue import JobQueue
+    try:
+      workers = dict((name, int(number)) for name, number in (value.split("=") for value in args["workers"]))
+      executor = lsCohortExecutor(workers, args["queueSize"])
+    except ValueError as e:
+      parser.error("--workers: %s" % e)
+    with JobQueue(args["queue"]) as jobQueue:
+      numberOfJobs = jobQueue.runPipeline(LS_STAGE, executor, args["worker"], maximumJobs=args["maximumJobs"])
+    print("%d %s jobs run" % (numberOfJobs, LS_STAGE))
+    executor.printReport()
+    return 0
+  outputPath = args.pop("output")
+  parameters = dict((key, value) for key, value in args.items() if value is not None)
+  if command == "ls":
+    parameters["inputFLAIRVolume"] = parameters.pop("flair")
+    parameters["outputLabel"] = outputPath
+    outputs = processLSSubject(parameters["inputFLAIRVolume"], parameters)
+  else:
+    parameters["inputT1Volume"] = parameters.pop("t1")
+    parameters["inputFLAIRVolume"] = parameters.pop("flair")
+    parameters["outputVolume"] = outputPath
+    outputs = processAFTSubject(parameters["inputT1Volume"], parameters)
+  print("%d lesions written to %s" % (outputs["numberOfLesions"], outputPath))
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,216 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Evaluation of the lesion maps of a cohort against reference (expert) masks.
+
+Each subject gives a predicted lesion map (e.g. the outputLabel of
+LSSegmenterLogic or AFTSegmenterLogic) and a reference mask; the nonzero
+voxels of both are the lesions. The voxel-wise metrics (Dice, TPR, FPR,
+precision and volumes) come from a single bincount of the voxel codes. The
+lesion-wise metrics come from one connected component labelling of each
+mask: a reference lesion is detected, and a predicted lesion is a true one,
+when they share at least minimumOverlap voxels. lesionTPR is the fraction of
+the reference lesions detected, and lesionFDR (false discovery rate, one minus
+the lesion precision) the fraction of the predicted lesions that are false.
+
+The subjects are read and scored in a stage pipeline (see Pipeline), so the
+reading of a subject overlaps the scoring of the former ones, and the rows
+are written to one CSV table.
+
+From the command line, with a CSV file of subject,predicted,reference paths
+or two folders whose files are matched by name:
+
+  python -m LesionSpotlightLib.Evaluation --pairs cohort.csv --output evaluation.csv
+  python -m LesionSpotlightLib.Evaluation --predicted lesionMaps/ --reference expertMasks/ --output evaluation.csv
+"""
+import os
+import sys
+import csv
+import logging
+
+from LesionSpotlightLib import Engine, Pipeline
+
+VOXEL_COLUMNS = ("dice", "tpr", "fpr", "precision", "predictedVolume_mm3", "referenceVolume_mm3",
+                 "volumeDifference")
+
+LESION_COLUMNS = ("predictedLesions", "referenceLesions", "detectedLesions", "falsePositiveLesions",
+                  "lesionTPR", "lesionFDR", "lesionF1")
+
+COLUMNS = ("subject",) + VOXEL_COLUMNS + LESION_COLUMNS
+
+IMAGE_EXTENSIONS = (".nii.gz", ".nii", ".nrrd", ".nhdr", ".mha", ".mhd")
+
+def _ratio(numerator, denominator):
+  return float(numerator) / denominator if denominator else float("nan")
+
+def voxelMetrics(predicted, reference, voxelVolume=1.0):
+  """Voxel-wise metrics of two boolean arrays of the same shape
+  """
+  import numpy as np
+  codes = predicted.view(np.uint8) << 1
+  codes |= reference.view(np.uint8)
+  trueNegatives, falseNegatives, falsePositives, truePositives = np.bincount(codes.ravel(), minlength=4)
+  predictedVoxels = truePositives + falsePositives
+  referenceVoxels = truePositives + falseNegatives
+  return {"dice": _ratio(2 * truePositives, predictedVoxels + referenceVoxels) if predictedVoxels + referenceVoxels else 1.0,
+          "tpr": _ratio(truePositives, referenceVoxels),
+          "fpr": _ratio(falsePositives, falsePositives + trueNegatives),
+          "precision": _ratio(truePositives, predictedVoxels),
+          "predictedVolume_mm3": float(predictedVoxels) * voxelVolume,
+          "referenceVolume_mm3": float(referenceVoxels) * voxelVolume,
+          "volumeDifference": _ratio(float(predictedVoxels) - referenceVoxels, referenceVoxels)}
+
+def lesionMetrics(predictedLabels, referenceLabels, minimumOverlap=1):
+  """Lesion-wise metrics of two arrays of connected component labels of the same shape. lesionFDR
+  is the false positive lesions over the predicted lesions, there are no true negative lesions.
+  """
+  import numpy as np
+  numberOfPredicted = int(predictedLabels.max()) if predictedLabels.size else 0
+  numberOfReference = int(referenceLabels.max()) if referenceLabels.size else 0
+  overlap = (predictedLabels != 0) & (referenceLabels != 0)
+  detected = int(np.count_nonzero(np.bincount(referenceLabels[overlap], minlength=numberOfReference + 1)[1:]
+                                  >= minimumOverlap))
+  truePredicted = int(np.count_nonzero(np.bincount(predictedLabels[overlap], minlength=numberOfPredicted + 1)[1:]
+                                       >= minimumOverlap))
+  lesionTPR = _ratio(detected, numberOfReference)
+  precision = _ratio(truePredicted, numberOfPredicted)
+  return {"predictedLesions": numberOfPredicted, "referenceLesions": numberOfReference,
+          "detectedLesions": detected, "falsePositiveLesions": numberOfPredicted - truePredicted,
+          "lesionTPR": lesionTPR, "lesionFDR": _ratio(numberOfPredicted - truePredicted, numberOfPredicted),
+          "lesionF1": _ratio(2.0 * lesionTPR * precision, lesionTPR + precision)}
+
+def readPair(pair):
+  """Reads the (predicted path, reference path) of a subject. The predicted map is resampled
+  (nearest neighbour) on the reference grid when the grids differ.
+  """
+  predictedPath, referencePath = pair
+  predicted = Engine.readImage(predictedPath)
+  reference = Engine.readImage(referencePath)
+  if not Engine.sameGrid(predicted, reference):
+    logging.warning("%s is not on the grid of %s, it is resampled" % (predictedPath, referencePath))
+    predicted = Engine.resampleToReference(predicted, reference, interpolation="NearestNeighbor")
+  return predicted, reference
+
+def scorePair(images, connectivity=6, minimumOverlap=1):
+  """Voxel-wise and lesion-wise metrics of (predicted, reference) images on the same grid
+  """
+  predicted, reference = images
+  predictedLabels = Engine.labelLesions(predicted, connectivity)
+  referenceLabels = Engine.labelLesions(reference, connectivity)
+  spacing = reference.GetSpacing()
+  metrics = voxelMetrics(predictedLabels != 0, referenceLabels != 0, spacing[0] * spacing[1] * spacing[2])
+  metrics.update(lesionMetrics(predictedLabels, referenceLabels, minimumOverlap))
+  return metrics
+
+def readPairs(path):
+  """(subject, predicted path, reference path) of a CSV file with subject, predicted and reference
+  columns. Relative paths are taken from the folder of the file.
+  """
+  folder = os.path.dirname(os.path.abspath(path))
+  with open(path) as csvFile:
+    return [(row["subject"], os.path.join(folder, row["predicted"]), os.path.join(folder, row["reference"]))
+            for row in csv.DictReader(csvFile)]
+
+def _subjectName(fileName):
+  for extension in IMAGE_EXTENSIONS:
+    if fileName.lower().endswith(extension):
+      return fileName[:-len(extension)]
+  return None
+
+def matchFolders(predictedFolder, referenceFolder):
+  """(subject, predicted path, reference path) of the images of both folders with the same name
+  """
+  references = dict((_subjectName(name), os.path.join(referenceFolder, name))
+                    for name in os.listdir(referenceFolder) if _subjectName(name))
+  pairs = []
+  for name in sorted(os.listdir(predictedFolder)):
+    subject = _subjectName(name)
+    if subject in references:
+      pairs.append((subject, os.path.join(predictedFolder, name), references[subject]))
+    elif subject:
+      logging.warning("%s has no reference mask" % name)
+  return pairs
+
+def evaluateCohort(pairs, outputCSV=None, connectivity=6, minimumOverlap=1, readers=2, workers=None, stream=None):
+  """Scores the (subject, predicted path, reference path) pairs. readers and workers are the
+  threads of the reading and scoring stages (the number of CPUs by default). Returns the rows,
+  sorted by subject, and writes them to outputCSV when it is given. The failed subjects are
+  logged and left out.
+  """
+  import multiprocessing
+  workers = workers or multiprocessing.cpu_count()
+  executor = Pipeline.PipelineExecutor([
+    Pipeline.Stage("read", readPair, readers),
+    Pipeline.Stage("score", lambda images: scorePair(images, connectivity, minimumOverlap), workers)])
+  rows = []
+
+  def onResult(subject, metrics):
+    metrics["subject"] = subject
+    rows.append(metrics)
+    logging.info("%s: Dice %.3f, lesion TPR %.3f" % (subject, metrics["dice"], metrics["lesionTPR"]))
+
+  def onError(subject, error):
+    logging.error("Evaluation of %s failed: %s" % (subject, error))
+
+  executor.run(((subject, (predictedPath, referencePath)) for subject, predictedPath, referencePath in pairs),
+               onResult, onError)
+  rows.sort(key=lambda row: row["subject"])
+  if outputCSV:
+    writeTable(rows, outputCSV)
+  reportEvaluation(rows, stream)
+  return rows
+
+def writeTable(rows, path):
+  with open(path, "w") as csvFile:
+    csvFile.write(",".join(COLUMNS) + "\n")
+    for row in rows:
+      csvFile.write(",".join(("%g" % row[column]) if isinstance(row[column], float) else str(row[column])
+                             for column in COLUMNS) + "\n")
+
+def reportEvaluation(rows, stream=None):
+  """Writes the mean and standard deviation of each metric over the subjects where it is defined
+  """
+  import numpy as np
+  stream = stream or sys.stdout
+  stream.write("%d subjects\n" % len(rows))
+  for column in VOXEL_COLUMNS + LESION_COLUMNS:
+    values = np.array([row[column] for row in rows], dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if values.size:
+      stream.write("%-20s %10.4f +- %.4f (%d)\n" % (column, values.mean(), values.std(), values.size))
+
+def main(argv):
+  import argparse
+  parser = argparse.ArgumentParser(prog="python -m LesionSpotlightLib.Evaluation",
+                                   description="Lesion maps of a cohort against reference masks")
+  parser.add_argument("--pairs", help="CSV file with subject, predicted and reference columns")
+  parser.add_argument("--predicted", help="folder of the predicted lesion maps")
+  parser.add_argument("--reference", help="folder of the reference masks, matched by file name")
+  parser.add_argument("--output", help="evaluation table CSV file")
+  parser.add_argument("--connectivity", type=int, default=6, choices=[6, 18, 26])
+  parser.add_argument("--minimumOverlap", type=int, default=1, help="voxels shared by a detected lesion")
+  parser.add_argument("--readers", type=int, default=2, help="reading threads")
+  parser.add_argument("--workers", type=int, default=None, help="scoring threads")
+  args = parser.parse_args(argv)
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+  if args.pairs:
+    pairs = readPairs(args.pairs)
+  elif args.predicted and args.reference:
+    pairs = matchFolders(args.predicted, args.reference)
+  else:
+    parser.error("give --pairs or both --predicted and --reference")
+  rows = evaluateCohort(pairs, args.output, args.connectivity, args.minimumOverlap, args.readers, args.workers)
+  return 0 if len(rows) == len(pairs) else 1
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
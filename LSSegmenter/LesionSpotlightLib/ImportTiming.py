@@ -0,0 +1,71 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Measures the import time added by the Lesion Spotlight scripted modules.
+
+The modules must not be loaded yet, so run it in a Slicer that ignores them:
+
+  Slicer --no-main-window --modules-to-ignore LSSegmenter,LSContrastEnhancer,AFTSegmenter
+         --python-code "from LesionSpotlightLib import ImportTiming; ImportTiming.main(); exit()"
+
+Besides the time, the report lists the top level packages that each import
+loaded for the first time, so a heavy dependency pulled at registration
+(SimpleITK, NumPy, SciPy) shows up immediately.
+"""
+import sys
+import time
+import importlib
+
+MODULE_NAMES = ("LSSegmenter", "LSContrastEnhancer", "AFTSegmenter")
+
+HEAVY_PACKAGES = ("SimpleITK", "numpy", "scipy", "sitkUtils")
+
+def loadedPackages():
+  return set(name.split(".")[0] for name in list(sys.modules.keys()))
+
+def measureImportTimes(moduleNames=MODULE_NAMES):
+  """Imports each module and returns a list of (name, seconds, newly loaded packages).
+  The time is None for the modules that were already imported.
+  """
+  results = []
+  for name in moduleNames:
+    if name in sys.modules:
+      results.append((name, None, []))
+      continue
+    before = loadedPackages()
+    start = time.perf_counter()
+    importlib.import_module(name)
+    elapsed = time.perf_counter() - start
+    results.append((name, elapsed, sorted(loadedPackages() - before)))
+  return results
+
+def reportImportTimes(results, stream=None):
+  """Writes the import times and returns the total time, in seconds
+  """
+  stream = stream or sys.stdout
+  total = 0.0
+  for name, elapsed, packages in results:
+    if elapsed is None:
+      stream.write("%s: already imported, not measured\n" % name)
+      continue
+    total += elapsed
+    heavy = [package for package in packages if package in HEAVY_PACKAGES]
+    stream.write("%s: %.1f ms%s\n" % (name, 1000.0 * elapsed,
+                                      (" (loads %s)" % ", ".join(heavy)) if heavy else ""))
+  stream.write("Total import time: %.1f ms\n" % (1000.0 * total))
+  return total
+
+def main(moduleNames=MODULE_NAMES):
+  return reportImportTimes(measureImportTimes(moduleNames))
+
+if __name__ == "__main__":
+  main(sys.argv[1:] or MODULE_NAMES)
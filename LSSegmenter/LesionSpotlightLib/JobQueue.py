@@ -0,0 +1,527 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Resumable job queue for cohort processing, stored in a SQLite file.
+
+Each job is one stage of one subject. The stages of a subject run in order:
+a job is only claimed when every previous stage of its subject is done.
+Workers claim jobs inside an immediate transaction, so several processes can
+share the same file. Running jobs hold a lease, renewed by a heartbeat thread
+while the job runs, and the jobs of a worker that died are claimed again when
+their lease expires.
+
+The queue file may be put on a shared filesystem only if it supports POSIX
+locks (e.g. NFSv4 with locking enabled), since SQLite relies on them.
+
+With a memory budget, the workers of a machine only claim a job while the
+peak memory estimates of the jobs running on that machine plus its own fit the
+budget, the largest job that fits first, and wait when none fits. The
+estimates come from the MemoryModel of the input headers, and the workers
+record the peak memory of the jobs they run so that the model can be
+calibrated on them.
+
+runPipeline() runs the jobs of a stage through a stage pipelined executor
+(see Pipeline), so that the steps of several subjects overlap.
+
+Summary from the command line:
+
+  python -m LesionSpotlightLib.JobQueue summary cohort.sqlite
+  python -m LesionSpotlightLib.JobQueue retry cohort.sqlite
+  python -m LesionSpotlightLib.JobQueue calibrate cohort.sqlite
+"""
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import sqlite3
+import threading
+import traceback
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  subject TEXT NOT NULL,
+  stage TEXT NOT NULL,
+  stageIndex INTEGER NOT NULL DEFAULT 0,
+  status TEXT NOT NULL DEFAULT 'pending',
+  parameters TEXT,
+  outputs TEXT,
+  error TEXT,
+  worker TEXT,
+  host TEXT,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  created REAL,
+  started REAL,
+  finished REAL,
+  leaseExpires REAL,
+  megavoxels REAL,
+  inputMB REAL,
+  memoryMB REAL,
+  peakMemoryMB REAL,
+  UNIQUE (subject, stage)
+);
+CREATE INDEX IF NOT EXISTS jobsStatus ON jobs (status, stageIndex, id);
+"""
+
+# Columns added after the first queue files were made
+ADDED_COLUMNS = (("megavoxels", "REAL"), ("inputMB", "REAL"), ("memoryMB", "REAL"), ("peakMemoryMB", "REAL"),
+                 ("host", "TEXT"))
+
+# Leases are renewed every LEASE_RENEWAL of their duration
+LEASE_RENEWAL = 0.25
+
+def defaultWorkerName():
+  """Host name and process id, unique among the workers sharing a queue
+  """
+  return "%s:%d" % (socket.gethostname(), os.getpid())
+
+class Job(object):
+  """A claimed job
+  """
+
+  def __init__(self, row):
+    self.id = row["id"]
+    self.subject = row["subject"]
+    self.stage = row["stage"]
+    self.stageIndex = row["stageIndex"]
+    self.status = row["status"]
+    self.parameters = json.loads(row["parameters"]) if row["parameters"] else {}
+    self.outputs = json.loads(row["outputs"]) if row["outputs"] else {}
+    self.error = row["error"]
+    self.worker = row["worker"]
+    self.attempts = row["attempts"]
+    self.started = row["started"]
+    self.finished = row["finished"]
+    self.memoryMB = row["memoryMB"]
+    self.peakMemoryMB = row["peakMemoryMB"]
+
+  def __repr__(self):
+    return "Job(%d, %s, %s, %s)" % (self.id, self.subject, self.stage, self.status)
+
+class JobQueue(object):
+  """Job queue stored in a SQLite file
+  """
+
+  def __init__(self, path, timeout=60.0):
+    self.path = path
+    self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    self.connection.row_factory = sqlite3.Row
+    self.connection.executescript(SCHEMA)
+    columns = [row["name"] for row in self.connection.execute("PRAGMA table_info(jobs)")]
+    for column, columnType in ADDED_COLUMNS:
+      if column not in columns:
+        self.connection.execute("ALTER TABLE jobs ADD COLUMN %s %s" % (column, columnType))
+
+  def close(self):
+    self.connection.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _transaction(self):
+    """Takes the write lock before reading, so that two workers never claim the same job
+    """
+    return _ImmediateTransaction(self.connection)
+
+  #
+  # Filling the queue
+  #
+
+  def addJob(self, subject, stage, parameters=None, stageIndex=0):
+    """Adds a job, unless the subject already has this stage (so a cohort can be added again on restart)
+    """
+    with self._transaction() as cursor:
+      cursor.execute("INSERT OR IGNORE INTO jobs (subject, stage, stageIndex, parameters, created) VALUES (?, ?, ?, ?, ?)",
+                     (subject, stage, stageIndex, json.dumps(parameters or {}, sort_keys=True), time.time()))
+      return cursor.rowcount == 1
+
+  def addSubject(self, subject, stages, parameters=None):
+    """Adds the stages of a subject, run in the given order. parameters may be a dict
+    of dicts keyed by stage name, or a single dict shared by every stage.
+    """
+    added = 0
+    for stageIndex, stage in enumerate(stages):
+      stageParameters = parameters
+      if parameters and stage in parameters and isinstance(parameters[stage], dict):
+        stageParameters = parameters[stage]
+      added += self.addJob(subject, stage, stageParameters, stageIndex)
+    return added
+
+  #
+  # Workers
+  #
+
+  def _runnableQuery(self, now, stages=None):
+    query = ("SELECT * FROM jobs AS j WHERE (j.status = ? OR (j.status = ? AND j.leaseExpires < ?)) "
+             "AND NOT EXISTS (SELECT 1 FROM jobs AS p WHERE p.subject = j.subject "
+             "AND p.stageIndex < j.stageIndex AND p.status != ?)")
+    arguments = [PENDING, RUNNING, now, DONE]
+    if stages:
+      query += " AND j.stage IN (%s)" % ",".join("?" * len(stages))
+      arguments += list(stages)
+    return query, arguments
+
+  def hasRunnableJobs(self, stages=None):
+    """True when a job could be claimed now, regardless of the memory budget
+    """
+    query, arguments = self._runnableQuery(time.time(), stages)
+    return self.connection.execute(query + " LIMIT 1", arguments).fetchone() is not None
+
+  def claimJob(self, worker=None, leaseDuration=3600.0, stages=None, memoryBudgetMB=None):
+    """Claims the next runnable job, or returns None when nothing can run now.
+    A running job whose lease expired (its worker died) is claimed again. With a memory
+    budget (MB) of this machine, only a job whose estimate fits the budget left by the jobs
+    running on this machine is claimed, the largest one first; a job larger than the budget
+    runs when nothing else does on this machine.
+    """
+    worker = worker or defaultWorkerName()
+    host = socket.gethostname()
+    now = time.time()
+    query, arguments = self._runnableQuery(now, stages)
+    with self._transaction() as cursor:
+      if memoryBudgetMB:
+        running = cursor.execute("SELECT COUNT(*) AS n, COALESCE(SUM(memoryMB), 0) AS memory FROM jobs "
+                                 "WHERE status = ? AND leaseExpires >= ? AND host = ?", (RUNNING, now, host)).fetchone()
+        query += " AND (? = 0 OR COALESCE(j.memoryMB, 0) <= ?) ORDER BY COALESCE(j.memoryMB, 0) DESC, j.stageIndex, j.id LIMIT 1"
+        arguments += [running["n"], memoryBudgetMB - running["memory"]]
+      else:
+        query += " ORDER BY j.stageIndex, j.id LIMIT 1"
+      row = cursor.execute(query, arguments).fetchone()
+      if row is None:
+        return None
+      cursor.execute("UPDATE jobs SET status = ?, worker = ?, host = ?, attempts = attempts + 1, started = ?, "
+                     "finished = NULL, error = NULL, leaseExpires = ? WHERE id = ?",
+                     (RUNNING, worker, host, now, now + leaseDuration, row["id"]))
+      row = cursor.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+    return Job(row)
+
+  def renewLease(self, job, leaseDuration=3600.0):
+    """Extends the lease of a long running job
+    """
+    with self._transaction() as cursor:
+      cursor.execute("UPDATE jobs SET leaseExpires = ? WHERE id = ? AND status = ? AND worker = ?",
+                     (time.time() + leaseDuration, job.id, RUNNING, job.worker))
+      return cursor.rowcount == 1
+
+  def completeJob(self, job, outputs=None, peakMemoryMB=None):
+    """Records the outputs and the measured peak memory of a job (ignored if its lease expired
+    and another worker claimed it)
+    """
+    with self._transaction() as cursor:
+      cursor.execute("UPDATE jobs SET status = ?, outputs = ?, finished = ?, leaseExpires = NULL, peakMemoryMB = ? "
+                     "WHERE id = ? AND worker = ?",
+                     (DONE, json.dumps(outputs or {}, sort_keys=True), time.time(), peakMemoryMB, job.id, job.worker))
+      return cursor.rowcount == 1
+
+  def failJob(self, job, error):
+    """Records the error text of a job (ignored if its lease expired and another worker claimed it)
+    """
+    with self._transaction() as cursor:
+      cursor.execute("UPDATE jobs SET status = ?, error = ?, finished = ?, leaseExpires = NULL WHERE id = ? AND worker = ?",
+                     (FAILED, str(error), time.time(), job.id, job.worker))
+      return cursor.rowcount == 1
+
+  def retryFailed(self, maximumAttempts=None):
+    """Puts the failed jobs back in the queue (only those tried less than maximumAttempts times)
+    """
+    query = "UPDATE jobs SET status = ?, worker = NULL, leaseExpires = NULL WHERE status = ?"
+    arguments = [PENDING, FAILED]
+    if maximumAttempts is not None:
+      query += " AND attempts < ?"
+      arguments.append(maximumAttempts)
+    with self._transaction() as cursor:
+      cursor.execute(query, arguments)
+      return cursor.rowcount
+
+  def runWorker(self, handlers, worker=None, leaseDuration=3600.0, maximumJobs=None, memoryBudgetMB=None,
+                pollInterval=30.0):
+    """Claims and runs jobs until the queue has nothing runnable left. handlers maps a
+    stage name to a function(subject, parameters) returning a dict of outputs. With a
+    memory budget (MB) shared by the workers of this machine, the worker waits while
+    no runnable job fits the budget. Returns the number of jobs run.
+    """
+    from LesionSpotlightLib import MemoryModel
+    worker = worker or defaultWorkerName()
+    stages = list(handlers.keys())
+    numberOfJobs = 0
+    with LeaseHeartbeat(self.path, leaseDuration) as heartbeat:
+      while maximumJobs is None or numberOfJobs < maximumJobs:
+        if memoryBudgetMB:
+          self.estimateMemory()
+        job = self.claimJob(worker, leaseDuration, stages, memoryBudgetMB)
+        if job is None:
+          if memoryBudgetMB and self.hasRunnableJobs(stages):
+            time.sleep(pollInterval)
+            continue
+          break
+        numberOfJobs += 1
+        peakBefore = MemoryModel.processPeakMemoryMB()
+        heartbeat.add(job)
+        try:
+          outputs = handlers[job.stage](job.subject, job.parameters)
+        except Exception:
+          heartbeat.remove(job)
+          self._finish(job, self.failJob(job, traceback.format_exc()))
+          continue
+        heartbeat.remove(job)
+        # The process peak only tells the peak of this job when this job raised it
+        peakAfter = MemoryModel.processPeakMemoryMB()
+        self._finish(job, self.completeJob(job, outputs, peakAfter if peakAfter is not None and peakAfter > peakBefore else None))
+    return numberOfJobs
+
+  def runPipeline(self, stage, executor, worker=None, leaseDuration=3600.0, maximumJobs=None):
+    """Runs the jobs of one stage through a Pipeline.PipelineExecutor, whose items are
+    (subject, parameters) and whose last stage returns the job outputs. A job is only claimed
+    when the first pipeline stage has room for it (one claimed job may wait for that room).
+    Returns the number of jobs run.
+    """
+    worker = worker or defaultWorkerName()
+
+    with LeaseHeartbeat(self.path, leaseDuration) as heartbeat:
+
+      def claimedJobs():
+        numberOfJobs = 0
+        while maximumJobs is None or numberOfJobs < maximumJobs:
+          job = self.claimJob(worker, leaseDuration, [stage])
+          if job is None:
+            return
+          numberOfJobs += 1
+          heartbeat.add(job)
+          yield job, (job.subject, job.parameters)
+
+      def onResult(job, outputs):
+        heartbeat.remove(job)
+        self._finish(job, self.completeJob(job, outputs))
+
+      def onError(job, error):
+        heartbeat.remove(job)
+        self._finish(job, self.failJob(job, error))
+
+      return executor.run(claimedJobs(), onResult, onError)
+
+  def _finish(self, job, recorded):
+    if not recorded:
+      logging.error("%s lost its lease to another worker, its result was not recorded and it may have run twice" % job)
+
+  #
+  # Memory model
+  #
+
+  def estimateMemory(self, model=None, reestimate=False):
+    """Sets the peak memory estimate of the pending jobs that have none (every pending job
+    with reestimate). Returns the number of jobs estimated.
+    """
+    from LesionSpotlightLib import MemoryModel
+    model = model or self.memoryModel()
+    query = "SELECT * FROM jobs WHERE status = ?"
+    if not reestimate:
+      query += " AND memoryMB IS NULL"
+    updates = []
+    for row in self.connection.execute(query, (PENDING,)).fetchall():
+      features = (row["megavoxels"], row["inputMB"]) if row["megavoxels"] is not None else None
+      if features is None:
+        features = MemoryModel.jobFeatures(row["stage"], json.loads(row["parameters"]) if row["parameters"] else {})
+      if features is None:
+        # Unknown input size: the size of a 1 mm brain volume
+        features = (7.0, 28.0)
+      updates.append(features + (model.estimateFeatures(row["stage"], *features), row["id"]))
+    with self._transaction() as cursor:
+      cursor.executemany("UPDATE jobs SET megavoxels = ?, inputMB = ?, memoryMB = ? WHERE id = ?", updates)
+    return len(updates)
+
+  def memoryModel(self):
+    """Memory model calibrated on the peaks recorded by the workers
+    """
+    from LesionSpotlightLib import MemoryModel
+    model = MemoryModel.MemoryModel()
+    model.calibrate([(row["stage"], row["megavoxels"], row["inputMB"], row["peakMemoryMB"]) for row in
+                     self.connection.execute("SELECT stage, megavoxels, inputMB, peakMemoryMB FROM jobs "
+                                             "WHERE status = ? AND peakMemoryMB IS NOT NULL", (DONE,))])
+    return model
+
+  def calibrate(self):
+    """Fits the memory model on the recorded peaks and estimates the pending jobs again.
+    Returns the model.
+    """
+    model = self.memoryModel()
+    self.estimateMemory(model, reestimate=True)
+    return model
+
+  #
+  # Reports
+  #
+
+  def jobs(self, status=None):
+    query = "SELECT * FROM jobs"
+    arguments = []
+    if status:
+      query += " WHERE status = ?"
+      arguments.append(status)
+    query += " ORDER BY subject, stageIndex"
+    return [Job(row) for row in self.connection.execute(query, arguments).fetchall()]
+
+  def summary(self):
+    """Counts by status, duration per stage, throughput and failures
+    """
+    counts = dict((status, 0) for status in (PENDING, RUNNING, DONE, FAILED))
+    for row in self.connection.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status"):
+      counts[row["status"]] = row["n"]
+
+    stages = []
+    for row in self.connection.execute(
+        "SELECT stage, COUNT(*) AS n, AVG(finished - started) AS mean, MAX(finished - started) AS maximum "
+        "FROM jobs WHERE status = ? GROUP BY stage ORDER BY MIN(stageIndex)", (DONE,)):
+      stages.append({"stage": row["stage"], "done": row["n"], "meanSeconds": row["mean"], "maximumSeconds": row["maximum"]})
+    for stage in stages:
+      row = self.connection.execute("SELECT MAX(peakMemoryMB) AS peak, MAX(memoryMB) AS estimate FROM jobs "
+                                    "WHERE stage = ? AND status = ?", (stage["stage"], DONE)).fetchone()
+      stage["maximumPeakMemoryMB"] = row["peak"]
+      stage["maximumEstimateMB"] = row["estimate"]
+
+    row = self.connection.execute("SELECT MIN(started) AS first, MAX(finished) AS last, COUNT(*) AS n, "
+                                  "COUNT(DISTINCT worker) AS workers FROM jobs WHERE status = ?", (DONE,)).fetchone()
+    elapsed = (row["last"] - row["first"]) if row["n"] else 0.0
+    throughput = (3600.0 * row["n"] / elapsed) if elapsed > 0 else None
+
+    failures = [{"subject": job.subject, "stage": job.stage, "attempts": job.attempts, "error": _lastLine(job.error)}
+                for job in self.jobs(FAILED)]
+    return {"counts": counts, "stages": stages, "elapsedSeconds": elapsed,
+            "jobsPerHour": throughput, "workers": row["workers"], "failures": failures}
+
+  def printSummary(self, stream=None):
+    stream = stream or sys.stdout
+    summary = self.summary()
+    counts = summary["counts"]
+    stream.write("Jobs: %d done, %d running, %d pending, %d failed\n"
+                 % (counts[DONE], counts[RUNNING], counts[PENDING], counts[FAILED]))
+    if summary["jobsPerHour"] is not None:
+      stream.write("Throughput: %.1f jobs/hour over %.1f hours with %d workers\n"
+                   % (summary["jobsPerHour"], summary["elapsedSeconds"] / 3600.0, summary["workers"]))
+    for stage in summary["stages"]:
+      stream.write("  %s: %d done, mean %.1f s, max %.1f s"
+                   % (stage["stage"], stage["done"], stage["meanSeconds"], stage["maximumSeconds"]))
+      if stage["maximumPeakMemoryMB"] is not None:
+        stream.write(", peak memory %.0f MB" % stage["maximumPeakMemoryMB"])
+      if stage["maximumEstimateMB"] is not None:
+        stream.write(" (largest estimate %.0f MB)" % stage["maximumEstimateMB"])
+      stream.write("\n")
+    for failure in summary["failures"]:
+      stream.write("FAILED %s/%s (%d attempts): %s\n"
+                   % (failure["subject"], failure["stage"], failure["attempts"], failure["error"]))
+
+class LeaseHeartbeat(object):
+  """Renews the leases of the jobs being run from a thread, with its own connection to the queue
+  """
+
+  def __init__(self, path, leaseDuration=3600.0, interval=None):
+    self.path = path
+    self.leaseDuration = leaseDuration
+    self.interval = interval or LEASE_RENEWAL * leaseDuration
+    self._jobs = {}
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread = None
+
+  def add(self, job):
+    with self._lock:
+      self._jobs[job.id] = job
+
+  def remove(self, job):
+    with self._lock:
+      self._jobs.pop(job.id, None)
+
+  def __enter__(self):
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run, name="leaseHeartbeat")
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self._stop.set()
+    self._thread.join()
+
+  def _run(self):
+    with JobQueue(self.path) as queue:
+      while not self._stop.wait(self.interval):
+        with self._lock:
+          jobs = list(self._jobs.values())
+        for job in jobs:
+          try:
+            renewed = queue.renewLease(job, self.leaseDuration)
+          except sqlite3.Error as e:
+            # Busy queue file, the next beat tries again
+            logging.warning("Could not renew the lease of %s: %s" % (job, e))
+            continue
+          if not renewed:
+            logging.error("Could not renew the lease of %s, another worker claimed it" % job)
+            self.remove(job)
+
+def _lastLine(text):
+  """Last line of an error text (the exception message of a traceback)
+  """
+  lines = (text or "").strip().splitlines()
+  return lines[-1] if lines else ""
+
+class _ImmediateTransaction(object):
+
+  def __init__(self, connection):
+    self.connection = connection
+
+  def __enter__(self):
+    self.cursor = self.connection.cursor()
+    self.cursor.execute("BEGIN IMMEDIATE")
+    return self.cursor
+
+  def __exit__(self, excType, excValue, tb):
+    if excType is None:
+      self.cursor.execute("COMMIT")
+    else:
+      self.cursor.execute("ROLLBACK")
+    self.cursor.close()
+    return False
+
+def main(argv):
+  import argparse
+  parser = argparse.ArgumentParser(prog="python -m LesionSpotlightLib.JobQueue",
+                                   description="Lesion Spotlight cohort job queue")
+  parser.add_argument("command", choices=["summary", "retry", "calibrate"])
+  parser.add_argument("queue", help="SQLite queue file")
+  parser.add_argument("--maximumAttempts", type=int, default=None,
+                      help="retry: only retry the jobs tried less than this number of times")
+  args = parser.parse_args(argv)
+  if not os.path.exists(args.queue):
+    parser.error("queue file not found: %s" % args.queue)
+  with JobQueue(args.queue) as queue:
+    if args.command == "summary":
+      queue.printSummary()
+    elif args.command == "retry":
+      print("%d failed jobs put back in the queue" % queue.retryFailed(args.maximumAttempts))
+    elif args.command == "calibrate":
+      model = queue.calibrate()
+      for stage in sorted(model.coefficients):
+        intercept, slope = model.coefficients[stage]
+        print("%s: %.0f MB + %.1f MB per megavoxel" % (stage, intercept, slope))
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,245 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Lesion maps as segmentations with lazily built 3D surfaces.
+
+exportLesions() writes a lesion label map (e.g. the outputLabel of
+LSSegmenterLogic or AFTSegmenterLogic) into a segmentation node, with one
+segment per connected lesion or a single segment. Only the binary labelmap is
+imported, so the export costs one connected component labelling and one
+labelmap import, whatever the number of lesions.
+
+The closed surfaces are built when the 3D view shows the segmentation: an
+observer of its display node calls createLesionSurfaces() once the 3D
+visibility is turned on. Each lesion is meshed on its own bounding box, its
+smoothing grows and its triangles are decimated with its size, and the lesions
+smaller than the minimum display volume get an empty surface and are hidden in
+3D, so a brain with hundreds of small lesions stays responsive.
+"""
+import logging
+
+# Lesions smaller than this volume (mm3) are not shown in 3D
+MINIMUM_DISPLAY_VOLUME = 10.0
+
+# Smoothing factor (0 to 1, as the Slicer closed surface conversion) of the lesions of
+# LARGE_LESION_VOXELS voxels or more, smaller lesions are smoothed proportionally less
+MAXIMUM_SMOOTHING = 0.5
+LARGE_LESION_VOXELS = 1000
+
+# Surfaces with more triangles are decimated down to MINIMUM_TRIANGLES, but by at most
+# MAXIMUM_DECIMATION of their triangles
+MINIMUM_TRIANGLES = 200
+MAXIMUM_DECIMATION = 0.9
+
+SMOOTHING_ITERATIONS = 20
+
+# Segmentation node attribute holding the minimum display volume
+MINIMUM_DISPLAY_VOLUME_ATTRIBUTE = "LesionSpotlight.MinimumDisplayVolume"
+
+# Display node observer tags, by segmentation node ID
+_observers = {}
+
+def _boundingBoxes(array):
+  """KJI slices of the bounding box of each label of an integer array, by label
+  """
+  from LesionSpotlightLib import Engine
+  sitk = Engine.simpleITK()
+  shapes = sitk.LabelShapeStatisticsImageFilter()
+  shapes.Execute(sitk.Cast(sitk.GetImageFromArray(array), sitk.sitkUInt32))
+  boxes = {}
+  for label in shapes.GetLabels():
+    i, j, k, width, height, depth = shapes.GetBoundingBox(label)
+    boxes[label] = (slice(k, k + depth), slice(j, j + height), slice(i, i + width))
+  return boxes
+
+def exportLesions(labelNode, segmentationNode, perLesion=True, connectivity=6,
+                  minimumDisplayVolume=MINIMUM_DISPLAY_VOLUME):
+  """Replaces the segments of segmentationNode by the lesions of labelNode (nonzero voxels),
+  one segment per connected lesion or a single one. The closed surfaces are left to the 3D view.
+  Returns the number of segments.
+  """
+  import numpy as np
+  import slicer
+  from LesionSpotlightLib import Engine
+  sitk = Engine.simpleITK()
+  lesions = slicer.util.arrayFromVolume(labelNode) != 0
+  if perLesion:
+    labels = Engine.labelLesions(sitk.GetImageFromArray(lesions.astype(np.uint8)), connectivity)
+    numberOfLesions = int(labels.max()) if labels.size else 0
+  else:
+    labels = lesions.astype(np.uint8)
+    numberOfLesions = int(labels.any())
+
+  segmentationNode.GetSegmentation().RemoveAllSegments()
+  segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(labelNode)
+  segmentationNode.SetAttribute(MINIMUM_DISPLAY_VOLUME_ATTRIBUTE, str(minimumDisplayVolume))
+  segmentationNode.CreateDefaultDisplayNodes()
+  displayNode = segmentationNode.GetDisplayNode()
+  displayNode.SetVisibility3D(False)
+  if numberOfLesions:
+    lesionLabel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+    try:
+      lesionLabel.CopyOrientation(labelNode)
+      slicer.util.updateVolumeFromArray(lesionLabel, labels.astype(np.uint16 if numberOfLesions < 65536 else np.uint32))
+      slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(lesionLabel, segmentationNode)
+    finally:
+      slicer.mrmlScene.RemoveNode(lesionLabel)
+    segmentation = segmentationNode.GetSegmentation()
+    for index in range(segmentation.GetNumberOfSegments()):
+      segmentation.GetNthSegment(index).SetName("Lesion %d" % (index + 1) if perLesion else "Lesions")
+  observeSegmentation(segmentationNode)
+  logging.info("%d lesion segments in %s" % (numberOfLesions, segmentationNode.GetName()))
+  return numberOfLesions
+
+def lesionSurface(mask, start, imageToWorld):
+  """Closed surface, in world coordinates, of a boolean lesion array (KJI) whose first voxel is
+  at the IJK index start. Its smoothing and decimation are scaled to the lesion size.
+  """
+  import numpy as np
+  import vtk
+  from vtk.util import numpy_support
+  numberOfVoxels = int(np.count_nonzero(mask))
+  # The lesion is padded with background so that its surface is closed
+  mask = np.pad(mask.astype(np.uint8), 1, mode="constant")
+  image = vtk.vtkImageData()
+  image.SetDimensions(mask.shape[2], mask.shape[1], mask.shape[0])
+  image.SetOrigin(start[0] - 1, start[1] - 1, start[2] - 1)
+  image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(mask.ravel(), deep=True,
+                                                             array_type=vtk.VTK_UNSIGNED_CHAR))
+
+  surface = vtk.vtkDiscreteFlyingEdges3D() if hasattr(vtk, "vtkDiscreteFlyingEdges3D") else vtk.vtkDiscreteMarchingCubes()
+  surface.SetInputData(image)
+  surface.SetValue(0, 1)
+  surface.Update()
+  polyData = surface.GetOutput()
+
+  numberOfTriangles = polyData.GetNumberOfPolys()
+  if numberOfTriangles > MINIMUM_TRIANGLES:
+    decimation = vtk.vtkDecimatePro()
+    decimation.SetInputData(polyData)
+    decimation.SetTargetReduction(min(MAXIMUM_DECIMATION, 1.0 - float(MINIMUM_TRIANGLES) / numberOfTriangles))
+    decimation.PreserveTopologyOn()
+    decimation.Update()
+    polyData = decimation.GetOutput()
+
+  smoothing = MAXIMUM_SMOOTHING * min(1.0, float(numberOfVoxels) / LARGE_LESION_VOXELS)
+  if smoothing > 0:
+    smoother = vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputData(polyData)
+    smoother.SetNumberOfIterations(SMOOTHING_ITERATIONS)
+    smoother.SetPassBand(pow(10.0, -4.0 * smoothing))
+    smoother.BoundarySmoothingOff()
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+    smoother.Update()
+    polyData = smoother.GetOutput()
+
+  transform = vtk.vtkTransform()
+  transform.SetMatrix(imageToWorld)
+  transformFilter = vtk.vtkTransformPolyDataFilter()
+  transformFilter.SetInputData(polyData)
+  transformFilter.SetTransform(transform)
+  normals = vtk.vtkPolyDataNormals()
+  normals.SetInputConnection(transformFilter.GetOutputPort())
+  normals.ConsistencyOn()
+  normals.SplittingOff()
+  normals.Update()
+  result = vtk.vtkPolyData()
+  result.DeepCopy(normals.GetOutput())
+  return result
+
+def hasLesionSurfaces(segmentationNode):
+  import slicer
+  segmentation = segmentationNode.GetSegmentation()
+  return (segmentation.GetNumberOfSegments() == 0 or
+          segmentation.ContainsRepresentation(slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()))
+
+def createLesionSurfaces(segmentationNode, minimumDisplayVolume=None):
+  """Adds the closed surface of every segment from its binary labelmap. The segments smaller than
+  minimumDisplayVolume (mm3, the one given to exportLesions by default) get an empty surface and
+  are hidden in 3D. Returns the number of surfaces built.
+  """
+  import numpy as np
+  import vtk
+  import slicer
+  from vtk.util import numpy_support
+  if minimumDisplayVolume is None:
+    minimumDisplayVolume = float(segmentationNode.GetAttribute(MINIMUM_DISPLAY_VOLUME_ATTRIBUTE) or MINIMUM_DISPLAY_VOLUME)
+  labelmapName = slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()
+  closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+  segmentation = segmentationNode.GetSegmentation()
+
+  # Segments sharing a labelmap (one label value each) are located by one pass over it
+  layers = {}
+  for index in range(segmentation.GetNumberOfSegments()):
+    segmentId = segmentation.GetNthSegmentID(index)
+    segment = segmentation.GetSegment(segmentId)
+    labelmap = segment.GetRepresentation(labelmapName)
+    if labelmap is None:
+      continue
+    labelValue = segment.GetLabelValue() if hasattr(segment, "GetLabelValue") else 1
+    layers.setdefault(labelmap, []).append((segmentId, segment, labelValue))
+
+  numberOfSurfaces = 0
+  hiddenSegments = []
+  for labelmap, segments in layers.items():
+    dimensions = labelmap.GetDimensions()
+    extent = labelmap.GetExtent()
+    scalars = labelmap.GetPointData().GetScalars()
+    if scalars is None or 0 in dimensions:
+      array = np.zeros((0, 0, 0), dtype=np.uint8)
+    else:
+      array = numpy_support.vtk_to_numpy(scalars).reshape(dimensions[2], dimensions[1], dimensions[0])
+    imageToWorld = vtk.vtkMatrix4x4()
+    labelmap.GetImageToWorldMatrix(imageToWorld)
+    voxelVolume = abs(imageToWorld.Determinant())
+    boxes = _boundingBoxes(array) if array.size else {}
+    for segmentId, segment, labelValue in segments:
+      box = boxes.get(labelValue)
+      mask = array[box] == labelValue if box else None
+      if mask is None or np.count_nonzero(mask) * voxelVolume < minimumDisplayVolume:
+        segment.AddRepresentation(closedSurfaceName, vtk.vtkPolyData())
+        hiddenSegments.append(segmentId)
+        continue
+      start = (extent[0] + box[2].start, extent[2] + box[1].start, extent[4] + box[0].start)
+      segment.AddRepresentation(closedSurfaceName, lesionSurface(mask, start, imageToWorld))
+      numberOfSurfaces += 1
+
+  # Once every segment has its surface, so that the display node observer finds them built
+  displayNode = segmentationNode.GetDisplayNode()
+  if displayNode:
+    for segmentId in hiddenSegments:
+      displayNode.SetSegmentVisibility3D(segmentId, False)
+  logging.info("%d lesion surfaces in %s, %d lesions below %g mm3 not shown in 3D"
+               % (numberOfSurfaces, segmentationNode.GetName(), len(hiddenSegments), minimumDisplayVolume))
+  return numberOfSurfaces
+
+def _onDisplayModified(displayNode, event):
+  segmentationNode = displayNode.GetDisplayableNode()
+  if (segmentationNode and displayNode.GetVisibility() and displayNode.GetVisibility3D()
+      and not hasLesionSurfaces(segmentationNode)):
+    createLesionSurfaces(segmentationNode)
+
+def observeSegmentation(segmentationNode):
+  """Builds the lesion surfaces of segmentationNode when its 3D visibility is turned on
+  """
+  import vtk
+  displayNode = segmentationNode.GetDisplayNode()
+  observer = _observers.get(segmentationNode.GetID())
+  if observer:
+    if observer[0] is displayNode:
+      return
+    observer[0].RemoveObserver(observer[1])
+  # Above the default priority, so the surfaces exist before the 3D displayable manager asks for them
+  tag = displayNode.AddObserver(vtk.vtkCommand.ModifiedEvent, _onDisplayModified, 1.0)
+  _observers[segmentationNode.GetID()] = (displayNode, tag)
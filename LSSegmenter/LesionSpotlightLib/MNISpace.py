@@ -0,0 +1,122 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Detection of the volumes already in the MNI152 space.
+
+A volume is in the MNI152 space when it lies on the grid of the bundled MNI152
+1 mm template (size, spacing, origin and direction) and its intensities in the
+template brain correlate with the template ones. The size is compared first
+with the template header, so the template is only read for volumes of the
+template size. Such volumes need neither the atlas registration nor the atlas
+resampling.
+
+isMNISpaceVolume() works on Slicer volume nodes, isMNISpaceImage() on
+SimpleITK images. Both return the decision and its reason.
+"""
+from LesionSpotlightLib import Engine, MemoryModel
+
+TEMPLATE = "MNI152_T1_1mm_brain.nii.gz"
+
+# Largest relative spacing difference
+SPACING_TOLERANCE = 1e-3
+
+# Largest difference of the direction cosines
+DIRECTION_TOLERANCE = 1e-3
+
+# Largest origin difference, in voxels
+ORIGIN_TOLERANCE = 0.5
+
+# Smallest correlation with the template in its brain. The T2-FLAIR and T1 contrasts differ
+# between gray and white matter, but both have a dark CSF, so a volume in the MNI152 space
+# correlates well above this and a misaligned one does not
+MINIMUM_CORRELATION = 0.2
+
+# Only every CORRELATION_STEP voxel along each axis is used by the correlation
+CORRELATION_STEP = 2
+
+def templateSize():
+  """Size (IJK) of the MNI152 template, read from its header
+  """
+  return MemoryModel.readHeader(Engine.atlasPath(TEMPLATE))[0]
+
+def gridDifference(spacing, origin, direction, templateSpacing, templateOrigin, templateDirection):
+  """Reason why a grid differs from the template one, None when they agree. direction holds the
+  nine direction cosines and must be given in the same space (RAS or LPS) as templateDirection.
+  """
+  for s, t in zip(spacing, templateSpacing):
+    if abs(s - t) > SPACING_TOLERANCE * t:
+      return "spacing %s mm instead of %s mm" % (", ".join("%g" % s for s in spacing),
+                                                 ", ".join("%g" % t for t in templateSpacing))
+  if max(abs(d - t) for d, t in zip(direction, templateDirection)) > DIRECTION_TOLERANCE:
+    return "direction differs from the template one"
+  if max(abs(o - t) for o, t in zip(origin, templateOrigin)) > ORIGIN_TOLERANCE * min(templateSpacing):
+    return "origin %s instead of %s" % (", ".join("%.1f" % o for o in origin),
+                                        ", ".join("%.1f" % t for t in templateOrigin))
+  return None
+
+def intensityCorrelation(array, templateArray, step=CORRELATION_STEP):
+  """Pearson correlation of two arrays of the same shape in the template brain (nonzero voxels)
+  """
+  import numpy as np
+  region = (slice(None, None, step),) * 3
+  templateValues = templateArray[region]
+  brain = templateValues != 0
+  values = array[region][brain].astype(np.float64)
+  templateValues = templateValues[brain].astype(np.float64)
+  if values.size < 2 or values.std() == 0 or templateValues.std() == 0:
+    return 0.0
+  return float(np.corrcoef(values, templateValues)[0, 1])
+
+def _decision(correlation):
+  if correlation < MINIMUM_CORRELATION:
+    return False, "template grid, but correlation %.2f with the template below %.2f" % (correlation, MINIMUM_CORRELATION)
+  return True, "template grid and correlation %.2f with the template" % correlation
+
+def isMNISpaceVolume(volumeNode):
+  """(in MNI152 space, reason) of a Slicer volume node
+  """
+  import vtk
+  import slicer
+  size = volumeNode.GetImageData().GetDimensions()
+  if tuple(size) != tuple(templateSize()):
+    return False, "size %s instead of the template %s" % ("x".join(str(d) for d in size),
+                                                        "x".join(str(d) for d in templateSize()))
+  templateNode = slicer.util.loadVolume(Engine.atlasPath(TEMPLATE))
+  try:
+    directions = []
+    for node in (volumeNode, templateNode):
+      directionMatrix = vtk.vtkMatrix4x4()
+      node.GetIJKToRASDirectionMatrix(directionMatrix)
+      directions.append([directionMatrix.GetElement(i, j) for i in range(3) for j in range(3)])
+    difference = gridDifference(volumeNode.GetSpacing(), volumeNode.GetOrigin(), directions[0],
+                                templateNode.GetSpacing(), templateNode.GetOrigin(), directions[1])
+    if difference:
+      return False, difference
+    correlation = intensityCorrelation(slicer.util.arrayFromVolume(volumeNode),
+                                       slicer.util.arrayFromVolume(templateNode))
+  finally:
+    slicer.mrmlScene.RemoveNode(templateNode)
+  return _decision(correlation)
+
+def isMNISpaceImage(image):
+  """(in MNI152 space, reason) of a SimpleITK image
+  """
+  sitk = Engine.simpleITK()
+  if tuple(image.GetSize()) != tuple(templateSize()):
+    return False, "size %s instead of the template %s" % ("x".join(str(d) for d in image.GetSize()),
+                                                        "x".join(str(d) for d in templateSize()))
+  template = Engine.readImage(Engine.atlasPath(TEMPLATE))
+  difference = gridDifference(image.GetSpacing(), image.GetOrigin(), image.GetDirection(),
+                              template.GetSpacing(), template.GetOrigin(), template.GetDirection())
+  if difference:
+    return False, difference
+  return _decision(intensityCorrelation(sitk.GetArrayViewFromImage(image), sitk.GetArrayViewFromImage(template)))
@@ -0,0 +1,230 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Peak memory model of the segmentation jobs, used by the job queue admission.
+
+The peak memory of a job grows with the number of voxels its pipeline works
+on: every step (N4, AAD, BRAINSFit, the enhancement CLIs) keeps a few float
+copies of the volume. A job is described by the megavoxels it processes, read
+from the image headers of its inputs (NIfTI, NRRD and MetaImage, without
+loading them) and reduced by the preview spacing, and by the megabytes of its
+inputs, which depend on the pixel type. The model of each stage is
+
+  peak (MB) = intercept + slope * megavoxels + input megabytes
+
+The default coefficients are rough figures, calibrate() fits them on the
+peaks recorded by the job queue workers.
+"""
+import sys
+import gzip
+import struct
+
+# (intercept MB, MB per processed megavoxel) of each job queue stage
+DEFAULT_COEFFICIENTS = {
+  "LSSegmenter": (700.0, 90.0),
+  "AFTSegmenter": (800.0, 110.0),
+  "LSContrastEnhancer": (600.0, 70.0),
+  # The Engine stages, without the preprocessing and registration CLIs
+  "LSEngine": (300.0, 60.0),
+  "AFTEngine": (400.0, 80.0),
+}
+FALLBACK_COEFFICIENTS = (800.0, 110.0)
+
+# Job parameters holding the input volumes of each stage
+INPUT_PARAMETERS = {
+  "LSSegmenter": ("inputFLAIRVolume",),
+  "AFTSegmenter": ("inputT1Volume", "inputFLAIRVolume"),
+  "LSContrastEnhancer": ("inputVolume",),
+  "LSEngine": ("inputFLAIRVolume",),
+  "AFTEngine": ("inputT1Volume", "inputFLAIRVolume"),
+}
+
+# Estimates are raised by this factor, since an underestimate may start the OOM killer
+SAFETY_MARGIN = 1.2
+
+# Fewest recorded peaks needed to fit the coefficients of a stage
+MINIMUM_SAMPLES = 3
+
+NIFTI_BYTES = {2: 1, 4: 2, 8: 4, 16: 4, 64: 8, 256: 1, 512: 2, 768: 4, 1024: 8, 1280: 8}
+
+NRRD_BYTES = {"uchar": 1, "unsigned char": 1, "uint8": 1, "uint8_t": 1, "signed char": 1, "char": 1, "int8": 1,
+              "int8_t": 1, "short": 2, "short int": 2, "signed short": 2, "int16": 2, "int16_t": 2, "ushort": 2,
+              "unsigned short": 2, "uint16": 2, "uint16_t": 2, "int": 4, "signed int": 4, "int32": 4, "int32_t": 4,
+              "uint": 4, "unsigned int": 4, "uint32": 4, "uint32_t": 4, "longlong": 8, "long long": 8, "int64": 8,
+              "int64_t": 8, "ulonglong": 8, "unsigned long long": 8, "uint64": 8, "uint64_t": 8, "float": 4,
+              "double": 8}
+
+METAIMAGE_BYTES = {"MET_UCHAR": 1, "MET_CHAR": 1, "MET_USHORT": 2, "MET_SHORT": 2, "MET_UINT": 4, "MET_INT": 4,
+                   "MET_ULONG": 8, "MET_LONG": 8, "MET_ULONG_LONG": 8, "MET_LONG_LONG": 8, "MET_FLOAT": 4,
+                   "MET_DOUBLE": 8}
+
+def _readNIfTIHeader(path):
+  opener = gzip.open if path.endswith(".gz") else open
+  with opener(path, "rb") as niftiFile:
+    header = niftiFile.read(540)
+  for endian in ("<", ">"):
+    headerSize = struct.unpack(endian + "i", header[:4])[0]
+    if headerSize == 348:
+      dims = struct.unpack(endian + "8h", header[40:56])
+      datatype = struct.unpack(endian + "h", header[70:72])[0]
+      spacing = struct.unpack(endian + "8f", header[76:108])
+      break
+    if headerSize == 540:
+      datatype = struct.unpack(endian + "h", header[12:14])[0]
+      dims = struct.unpack(endian + "8q", header[16:80])
+      spacing = struct.unpack(endian + "8d", header[104:168])
+      break
+  else:
+    raise ValueError("%s is not a NIfTI file" % path)
+  size = tuple(int(d) for d in dims[1:1 + dims[0]])
+  components = 1
+  for d in size[3:]:
+    components *= max(d, 1)
+  return size[:3], tuple(abs(float(s)) or 1.0 for s in spacing[1:4]), NIFTI_BYTES.get(datatype, 4) * components
+
+def _readNRRDHeader(path):
+  fields = {}
+  with open(path, "rb") as nrrdFile:
+    if not nrrdFile.readline().startswith(b"NRRD"):
+      raise ValueError("%s is not a NRRD file" % path)
+    for line in nrrdFile:
+      line = line.decode("latin-1").strip()
+      if not line:
+        break
+      if line.startswith("#") or ":" not in line:
+        continue
+      key, value = line.split(":", 1)
+      fields[key.strip().lower()] = value.lstrip("=").strip()
+  sizes = [int(s) for s in fields["sizes"].split()]
+  kinds = fields.get("kinds", "").split()
+  # Drop the component axis of vector images
+  components = 1
+  if len(sizes) > 3 or (kinds and len(kinds) == len(sizes) and kinds[0] not in ("domain", "space")):
+    components = sizes[0]
+    sizes = sizes[1:]
+  spacing = (1.0, 1.0, 1.0)
+  if "space directions" in fields:
+    vectors = [v for v in fields["space directions"].replace("none", "").split(")") if "(" in v]
+    spacing = tuple(sum(float(c) ** 2 for c in v.split("(")[1].split(",")) ** 0.5 for v in vectors[-3:])
+  elif "spacings" in fields:
+    spacing = tuple(float(s) for s in fields["spacings"].split() if s.lower() != "nan")[-3:]
+  return tuple(sizes[:3]), spacing, NRRD_BYTES.get(fields.get("type", "float").lower(), 4) * components
+
+def _readMetaImageHeader(path):
+  fields = {}
+  with open(path, "rb") as metaFile:
+    for line in metaFile:
+      line = line.decode("latin-1")
+      if "=" not in line:
+        break
+      key, value = line.split("=", 1)
+      fields[key.strip()] = value.strip()
+      if key.strip() == "ElementDataFile":
+        break
+  sizes = tuple(int(s) for s in fields["DimSize"].split())
+  spacing = tuple(float(s) for s in fields.get("ElementSpacing", "1 1 1").split())
+  bytesPerVoxel = METAIMAGE_BYTES.get(fields.get("ElementType", "MET_FLOAT"), 4)
+  return sizes[:3], spacing[:3], bytesPerVoxel * int(fields.get("ElementNumberOfChannels", 1))
+
+def readHeader(path):
+  """(size, spacing, bytes per voxel) of a NIfTI, NRRD or MetaImage volume, read from its header only
+  """
+  lowerPath = path.lower()
+  if lowerPath.endswith((".nii", ".nii.gz", ".hdr")):
+    size, spacing, bytesPerVoxel = _readNIfTIHeader(path)
+  elif lowerPath.endswith((".nrrd", ".nhdr")):
+    size, spacing, bytesPerVoxel = _readNRRDHeader(path)
+  elif lowerPath.endswith((".mha", ".mhd")):
+    size, spacing, bytesPerVoxel = _readMetaImageHeader(path)
+  else:
+    raise ValueError("cannot read the header of %s, only NIfTI, NRRD and MetaImage files are supported" % path)
+  # Single slice volumes
+  return tuple(size) + (1,) * (3 - len(size)), tuple(spacing) + (1.0,) * (3 - len(spacing)), bytesPerVoxel
+
+def jobFeatures(stage, parameters):
+  """(processed megavoxels, input megabytes) of a job, None when an input header cannot be read
+  """
+  megavoxels = 0.0
+  inputMB = 0.0
+  previewSpacing = float(parameters.get("previewSpacing") or 0)
+  for key in INPUT_PARAMETERS.get(stage, ()):
+    if not parameters.get(key):
+      continue
+    try:
+      size, spacing, bytesPerVoxel = readHeader(parameters[key])
+    except (IOError, OSError, ValueError, KeyError, struct.error):
+      return None
+    voxels = float(size[0]) * size[1] * size[2]
+    inputMB += voxels * bytesPerVoxel / 1048576.0
+    if previewSpacing:
+      for s in spacing:
+        voxels *= min(1.0, s / previewSpacing)
+    megavoxels += voxels / 1e6
+  return megavoxels, inputMB
+
+def processPeakMemoryMB():
+  """Largest resident memory (MB) of this process and of its finished child processes (the CLIs),
+  None where the resource module is not available (Windows)
+  """
+  try:
+    import resource
+  except ImportError:
+    return None
+  peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  # Linux reports kilobytes, macOS bytes
+  return peak / 1048576.0 if sys.platform == "darwin" else peak / 1024.0
+
+class MemoryModel(object):
+  """Linear peak memory model of each stage
+  """
+
+  def __init__(self, coefficients=None):
+    self.coefficients = dict(DEFAULT_COEFFICIENTS)
+    self.coefficients.update(coefficients or {})
+
+  def estimate(self, stage, parameters):
+    """Peak memory estimate (MB) of a job, None when its inputs cannot be read
+    """
+    features = jobFeatures(stage, parameters)
+    if features is None:
+      return None
+    return self.estimateFeatures(stage, *features)
+
+  def estimateFeatures(self, stage, megavoxels, inputMB):
+    intercept, slope = self.coefficients.get(stage, FALLBACK_COEFFICIENTS)
+    return SAFETY_MARGIN * (intercept + slope * megavoxels + inputMB)
+
+  def calibrate(self, samples):
+    """Least squares fit of the coefficients of each stage on (stage, megavoxels, input MB, peak MB)
+    samples. The stages with too few samples, or a single volume size, keep their coefficients.
+    Returns the stages that were fitted.
+    """
+    byStage = {}
+    for stage, megavoxels, inputMB, peakMB in samples:
+      if megavoxels is not None and peakMB is not None:
+        byStage.setdefault(stage, []).append((megavoxels, peakMB - (inputMB or 0.0)))
+    fitted = []
+    for stage, points in byStage.items():
+      if len(points) < MINIMUM_SAMPLES:
+        continue
+      n = float(len(points))
+      meanX = sum(x for x, y in points) / n
+      meanY = sum(y for x, y in points) / n
+      varianceX = sum((x - meanX) ** 2 for x, y in points)
+      if varianceX <= 1e-12:
+        continue
+      slope = sum((x - meanX) * (y - meanY) for x, y in points) / varianceX
+      if slope <= 0:
+        continue
+      self.coefficients[stage] = (max(0.0, meanY - slope * meanX), slope)
+      fitted.append(stage)
+    return fitted
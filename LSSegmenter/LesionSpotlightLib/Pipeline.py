@@ -0,0 +1,195 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Stage pipelined executor of cohort runs.
+
+The steps of a segmentation have different resource profiles: reading and
+writing are I/O bound, the bias field correction is CPU bound and the lesion
+enhancement loop is memory bandwidth bound. Running the subjects one after
+another leaves most of them idle, so the executor splits the pipeline in
+stages, each with its own bounded input queue and pool of worker threads: the
+bias field correction of a subject overlaps the atlas resampling of the
+previous one and the enhancement of the one before. The bounded queues keep
+at most a few subjects in memory between two stages.
+
+The per-stage utilization (busy time over the time of its workers) and queue
+depth of a run tell how to size the pools: a stage near 100% with a deep
+input queue needs more workers, one with an empty queue has too many.
+
+Every stage function takes the value given by the former stage (the item for
+the first one) and returns the value of the next one. The items and the
+callbacks are handled by the thread calling run(), so items may come from a
+generator claiming jobs of a JobQueue.
+"""
+import sys
+import time
+import threading
+import traceback
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+# Seconds between two samples of the queue depths
+SAMPLE_INTERVAL = 0.1
+
+_STOP = object()
+
+class Stage(object):
+  """A pipeline stage: name, function, number of worker threads and size of its input queue
+  """
+
+  def __init__(self, name, function, workers=1, queueSize=2):
+    self.name = name
+    self.function = function
+    self.workers = max(1, int(workers))
+    self.queueSize = max(1, int(queueSize))
+
+  def __repr__(self):
+    return "Stage(%s, workers=%d, queueSize=%d)" % (self.name, self.workers, self.queueSize)
+
+class StageStatistics(object):
+  """Items, failures, busy seconds and queue depth samples of a stage
+  """
+
+  def __init__(self, stage):
+    self.stage = stage
+    self.items = 0
+    self.failures = 0
+    self.busySeconds = 0.0
+    self.queueDepthSum = 0
+    self.queueDepthSamples = 0
+    self.maximumQueueDepth = 0
+
+  def utilization(self, wallSeconds):
+    if wallSeconds <= 0:
+      return 0.0
+    return self.busySeconds / (self.stage.workers * wallSeconds)
+
+  def meanQueueDepth(self):
+    return float(self.queueDepthSum) / self.queueDepthSamples if self.queueDepthSamples else 0.0
+
+class PipelineExecutor(object):
+  """Runs items through a sequence of stages, each with its own worker pool
+  """
+
+  def __init__(self, stages):
+    if not stages:
+      raise ValueError("a pipeline needs at least one stage")
+    self.stages = list(stages)
+    self.statistics = [StageStatistics(stage) for stage in self.stages]
+    self.wallSeconds = 0.0
+    self._lock = threading.Lock()
+
+  def _work(self, index, queues, results):
+    stage = self.stages[index]
+    statistics = self.statistics[index]
+    while True:
+      item = queues[index].get()
+      if item is _STOP:
+        return
+      key, value = item
+      start = time.time()
+      try:
+        value = stage.function(value)
+        error = None
+      except Exception:
+        error = "%s: %s" % (stage.name, traceback.format_exc())
+      with self._lock:
+        statistics.busySeconds += time.time() - start
+        statistics.items += 1
+        if error:
+          statistics.failures += 1
+      if error:
+        results.put((key, None, error))
+      elif index + 1 < len(self.stages):
+        # Blocks while the next stage is behind, the time waiting is not busy time
+        queues[index + 1].put((key, value))
+      else:
+        results.put((key, value, None))
+
+  def _sample(self, queues):
+    for statistics, stageQueue in zip(self.statistics, queues):
+      depth = stageQueue.qsize()
+      statistics.queueDepthSum += depth
+      statistics.queueDepthSamples += 1
+      statistics.maximumQueueDepth = max(statistics.maximumQueueDepth, depth)
+
+  def run(self, items, onResult=None, onError=None):
+    """Runs the (key, value) items through the stages. onResult(key, value) receives the value
+    returned by the last stage, onError(key, error) the traceback of an item failing a stage, the
+    item then skips the next stages. Both are called by this thread. Returns the number of items.
+    """
+    self.statistics = [StageStatistics(stage) for stage in self.stages]
+    queues = [queue.Queue(stage.queueSize) for stage in self.stages]
+    results = queue.Queue()
+    threads = []
+    for index, stage in enumerate(self.stages):
+      for number in range(stage.workers):
+        thread = threading.Thread(target=self._work, args=(index, queues, results),
+                                  name="%s-%d" % (stage.name, number))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    start = time.time()
+    items = iter(items)
+    nextItem = next(items, None)
+    fed = 0
+    finished = 0
+    while nextItem is not None or finished < fed:
+      if nextItem is not None:
+        try:
+          queues[0].put_nowait(nextItem)
+          fed += 1
+          nextItem = next(items, None)
+          continue
+        except queue.Full:
+          pass
+      try:
+        key, value, error = results.get(timeout=SAMPLE_INTERVAL)
+      except queue.Empty:
+        self._sample(queues)
+        continue
+      finished += 1
+      if error is None:
+        if onResult:
+          onResult(key, value)
+      elif onError:
+        onError(key, error)
+    self.wallSeconds = time.time() - start
+    # The stages are empty once every item is finished, the workers only get the stop marks
+    for index, stage in enumerate(self.stages):
+      for number in range(stage.workers):
+        queues[index].put(_STOP)
+    for thread in threads:
+      thread.join()
+    return fed
+
+  def report(self):
+    """Per-stage dictionaries: workers, items, failures, busy seconds, utilization and queue depths
+    """
+    return [{"stage": statistics.stage.name, "workers": statistics.stage.workers, "items": statistics.items,
+             "failures": statistics.failures, "busySeconds": statistics.busySeconds,
+             "utilization": statistics.utilization(self.wallSeconds),
+             "meanQueueDepth": statistics.meanQueueDepth(), "maximumQueueDepth": statistics.maximumQueueDepth}
+            for statistics in self.statistics]
+
+  def printReport(self, stream=None):
+    stream = stream or sys.stdout
+    stream.write("%.1f s\n" % self.wallSeconds)
+    stream.write("%-14s %7s %6s %8s %10s %11s %11s\n"
+                 % ("stage", "workers", "items", "failures", "busy (s)", "utilization", "queue depth"))
+    for row in self.report():
+      stream.write("%-14s %7d %6d %8d %10.1f %10.0f%% %5.1f (max %d)\n"
+                   % (row["stage"], row["workers"], row["items"], row["failures"], row["busySeconds"],
+                      100.0 * row["utilization"], row["meanQueueDepth"], row["maximumQueueDepth"]))
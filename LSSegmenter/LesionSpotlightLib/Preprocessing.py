@@ -0,0 +1,150 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Preprocessing profiles for the N4 bias field correction and the anisotropic
+anomalous diffusion (AAD) steps.
+
+"accurate" keeps the CLI defaults used so far. "balanced" and "fast" work on a
+coarser N4 grid with fewer iterations and a looser convergence threshold. They
+also run 60% and 40% of the AAD iterations, both with the largest stable time
+step of the 3D explicit scheme (1/16). The time step cannot grow past that
+limit to make up for the missing iterations, so the total diffusion time is
+not kept: unless the CLI default step is well below 1/16, "balanced" and
+"fast" smooth the FLAIR less than "accurate".
+
+The profile settings are uncalibrated guesses until benchmarkProfiles() has been
+run on a cohort. It times the LSSegmenter pipeline with each profile and
+reports the Dice coefficient of its lesion map against the "accurate" one. Run
+it inside Slicer:
+
+  Slicer --no-main-window --python-code "from LesionSpotlightLib import Preprocessing;
+         Preprocessing.benchmarkProfiles(['case1_flair.nii.gz', 'case2_flair.nii.gz'], 'profiles.csv'); exit()"
+"""
+import os
+import sys
+import time
+import logging
+
+ACCURATE = "accurate"
+BALANCED = "balanced"
+FAST = "fast"
+
+# aadIterationScale multiplies the AAD iterations requested by the module, aadTimeStep is the
+# 3D stability limit and None keeps the CLI default. Uncalibrated, see benchmarkProfiles()
+PROFILES = {
+  ACCURATE: {"shrinkFactor": 4, "numberOfIterations": "50,40,30", "convergenceThreshold": 0.0001,
+             "aadIterationScale": 1.0, "aadTimeStep": None},
+  BALANCED: {"shrinkFactor": 4, "numberOfIterations": "40,20", "convergenceThreshold": 0.001,
+             "aadIterationScale": 0.6, "aadTimeStep": 0.0625},
+  FAST: {"shrinkFactor": 6, "numberOfIterations": "20,10", "convergenceThreshold": 0.005,
+         "aadIterationScale": 0.4, "aadTimeStep": 0.0625},
+}
+
+PROFILE_NAMES = (ACCURATE, BALANCED, FAST)
+
+# LSSegmenterLogic.run() settings of the benchmarks, the module defaults
+BENCHMARK_PARAMETERS = {"isBET": True, "isMNISpace": False, "sampling": 0.02, "initiation": "useMomentsAlign",
+                        "interpolation": "Linear", "wmMatch": 0.6, "minimumSize": 50, "lUpdate": 3,
+                        "thrMethod": "MaximumEntropy", "numBins": 128, "lThr": 0.95}
+
+def profile(name):
+  try:
+    return PROFILES[name.lower()]
+  except KeyError:
+    raise ValueError("unknown preprocessing profile %s, choose one of %s" % (name, ", ".join(PROFILE_NAMES)))
+
+def n4Parameters(inputVolume, outputVolume, profileName=ACCURATE, maskVolume=None):
+  """Parameters of the n4itkbiasfieldcorrection CLI for a profile
+  """
+  settings = profile(profileName)
+  params = {}
+  params["inputImageName"] = inputVolume.GetID()
+  params["outputImageName"] = outputVolume.GetID()
+  if maskVolume:
+    params["maskImageName"] = maskVolume.GetID()
+  params["shrinkFactor"] = settings["shrinkFactor"]
+  params["numberOfIterations"] = settings["numberOfIterations"]
+  params["convergenceThreshold"] = settings["convergenceThreshold"]
+  return params
+
+def aadParameters(inputVolume, outputVolume, iterations, profileName=ACCURATE):
+  """Parameters of the aadimagefilter CLI for a profile. The iterations asked by the module
+  are scaled by the profile, the conductance and q settings are left to the caller.
+  """
+  settings = profile(profileName)
+  params = {}
+  params["inputVolume"] = inputVolume.GetID()
+  params["outputVolume"] = outputVolume.GetID()
+  params["iterations"] = max(1, int(round(iterations * settings["aadIterationScale"])))
+  if settings["aadTimeStep"] is not None:
+    params["timeStep"] = settings["aadTimeStep"]
+  return params
+
+def dice(labelA, labelB):
+  """Dice coefficient of the non-zero voxels of two label map nodes
+  """
+  import numpy as np
+  import slicer
+  a = slicer.util.arrayFromVolume(labelA) != 0
+  b = slicer.util.arrayFromVolume(labelB) != 0
+  total = int(a.sum()) + int(b.sum())
+  return 1.0 if total == 0 else 2.0 * float(np.logical_and(a, b).sum()) / total
+
+def benchmarkProfiles(inputFLAIRPaths, outputCSV=None, profileNames=PROFILE_NAMES, segmentationParameters=None, stream=None):
+  """Runs LSSegmenterLogic on every FLAIR file with each profile. Returns a list of
+  (case, profile, seconds, speedup, dice) rows, where speedup and Dice are relative to the
+  "accurate" profile, and writes them to outputCSV when it is given.
+  """
+  import slicer
+  from LSSegmenter import LSSegmenterLogic
+  parameters = dict(BENCHMARK_PARAMETERS)
+  parameters.update(segmentationParameters or {})
+  profileNames = [ACCURATE] + [name for name in profileNames if name != ACCURATE]
+  logic = LSSegmenterLogic()
+  rows = []
+  for path in inputFLAIRPaths:
+    case = os.path.basename(path)
+    inputFLAIRVolume = slicer.util.loadVolume(path)
+    reference = None
+    referenceSeconds = None
+    for name in profileNames:
+      outputLabel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", "%s_%s" % (case, name))
+      start = time.time()
+      logic.run(inputFLAIRVolume, outputLabel, preprocessingProfile=name, **parameters)
+      seconds = time.time() - start
+      if reference is None:
+        reference = outputLabel
+        referenceSeconds = seconds
+      rows.append((case, name, seconds, referenceSeconds / seconds, dice(reference, outputLabel)))
+      logging.info("%s %s: %.1f s, Dice %.3f" % (case, name, seconds, rows[-1][4]))
+      if outputLabel is not reference:
+        slicer.mrmlScene.RemoveNode(outputLabel)
+    slicer.mrmlScene.RemoveNode(reference)
+    slicer.mrmlScene.RemoveNode(inputFLAIRVolume)
+  reportBenchmark(rows, stream)
+  if outputCSV:
+    with open(outputCSV, "w") as csvFile:
+      csvFile.write("case,profile,seconds,speedup,dice\n")
+      for row in rows:
+        csvFile.write("%s,%s,%.3f,%.3f,%.4f\n" % row)
+  return rows
+
+def reportBenchmark(rows, stream=None):
+  """Writes the mean time, speedup and Dice of each profile
+  """
+  stream = stream or sys.stdout
+  for name in [profileName for profileName in PROFILE_NAMES if any(row[1] == profileName for row in rows)]:
+    profileRows = [row for row in rows if row[1] == name]
+    count = float(len(profileRows))
+    stream.write("%s: %.1f s, %.2fx faster, Dice %.4f (min %.4f) over %d cases\n"
+                 % (name, sum(row[2] for row in profileRows) / count, sum(row[3] for row in profileRows) / count,
+                    sum(row[4] for row in profileRows) / count, min(row[4] for row in profileRows), len(profileRows)))
@@ -0,0 +1,123 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Low resolution preview runs of the Lesion Spotlight logics.
+
+The inputs are resampled to a coarse spacing (e.g. 2 or 3 mm), the whole
+pipeline runs on them, with the atlases registered and resampled to the
+coarse grid, and the result is resampled back to the input grid for display.
+
+benchmarkPreview() compares the lesion count and volume of preview and full
+resolution LSSegmenter runs:
+
+  Slicer --no-main-window --python-code "from LesionSpotlightLib import Preview;
+         Preview.benchmarkPreview(['phantom1.nii.gz', 'phantom2.nii.gz'], 2.0, 'preview.csv'); exit()"
+"""
+import os
+import sys
+import time
+import logging
+
+from LesionSpotlightLib import CLIUtils
+
+def previewSpacing(volumeNode, spacing):
+  """Spacing of the preview grid, never finer than the volume spacing
+  """
+  return [max(float(spacing), s) for s in volumeNode.GetSpacing()]
+
+def previewVolume(volumeNode, spacing, numberOfThreads=0):
+  """Linear resampling of a scalar volume to the preview spacing, in a new node
+  """
+  import slicer
+  preview = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", volumeNode.GetName() + "_preview")
+  params = {}
+  params["InputVolume"] = volumeNode.GetID()
+  params["OutputVolume"] = preview.GetID()
+  params["outputPixelSpacing"] = ",".join("%g" % s for s in previewSpacing(volumeNode, spacing))
+  params["interpolationType"] = "linear"
+
+  CLIUtils.runCLI(slicer.modules.resamplescalarvolume, params, numberOfThreads)
+  return preview
+
+def restoreResolution(previewNode, referenceVolume, outputNode, isLabel=True, numberOfThreads=0):
+  """Resamples the preview result back on the grid of the reference volume
+  """
+  import slicer
+  params = {}
+  params["inputVolume"] = previewNode.GetID()
+  params["referenceVolume"] = referenceVolume.GetID()
+  params["outputVolume"] = outputNode.GetID()
+  params["interpolationMode"] = "NearestNeighbor" if isLabel else "Linear"
+  if isLabel:
+    params["pixelType"] = "uchar"
+
+  CLIUtils.runCLI(slicer.modules.brainsresample, params, numberOfThreads)
+
+def previewMinimumSize(minimumSize, volumeNode, previewNode):
+  """Minimum lesion size, in voxels, of the preview grid for the same physical volume
+  """
+  voxelVolume = 1.0
+  previewVoxelVolume = 1.0
+  for s, p in zip(volumeNode.GetSpacing(), previewNode.GetSpacing()):
+    voxelVolume *= s
+    previewVoxelVolume *= p
+  return max(1, int(round(minimumSize * voxelVolume / previewVoxelVolume)))
+
+def lesionSummary(lesionStatisticsTable):
+  """Number of lesions and total lesion volume (mm3) of a lesion statistics table
+  """
+  table = lesionStatisticsTable.GetTable()
+  column = lesionStatisticsTable.GetColumnIndex("volume_mm3")
+  count = table.GetNumberOfRows()
+  volume = sum(float(lesionStatisticsTable.GetCellText(row, column)) for row in range(count)) if column >= 0 else 0.0
+  return count, volume
+
+def benchmarkPreview(inputFLAIRPaths, spacing=2.0, outputCSV=None, segmentationParameters=None, stream=None):
+  """Runs LSSegmenterLogic at full and preview resolution on every FLAIR file. Returns a list of
+  (case, full count, preview count, full volume, preview volume, speedup) rows and writes them to
+  outputCSV when it is given.
+  """
+  import slicer
+  from LSSegmenter import LSSegmenterLogic
+  from LesionSpotlightLib import Preprocessing
+  parameters = dict(Preprocessing.BENCHMARK_PARAMETERS)
+  parameters.update(segmentationParameters or {})
+  logic = LSSegmenterLogic()
+  rows = []
+  for path in inputFLAIRPaths:
+    case = os.path.basename(path)
+    inputFLAIRVolume = slicer.util.loadVolume(path)
+    results = []
+    for runSpacing in (None, spacing):
+      outputLabel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+      lesionStatisticsTable = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+      start = time.time()
+      logic.run(inputFLAIRVolume, outputLabel, lesionStatisticsTable=lesionStatisticsTable,
+                previewSpacing=runSpacing, **parameters)
+      results.append(lesionSummary(lesionStatisticsTable) + (time.time() - start,))
+      slicer.mrmlScene.RemoveNode(outputLabel)
+      slicer.mrmlScene.RemoveNode(lesionStatisticsTable)
+    slicer.mrmlScene.RemoveNode(inputFLAIRVolume)
+    (fullCount, fullVolume, fullSeconds), (previewCount, previewVolumeMM3, previewSeconds) = results
+    rows.append((case, fullCount, previewCount, fullVolume, previewVolumeMM3, fullSeconds / previewSeconds))
+    logging.info("%s: %d/%d lesions, %.1f/%.1f mm3, %.1fx faster" % rows[-1])
+
+  stream = stream or sys.stdout
+  for row in rows:
+    stream.write("%s: lesions %d (full) / %d (preview), volume %.1f / %.1f mm3 (ratio %.2f), %.1fx faster\n"
+                 % (row[:5] + ((row[4] / row[3]) if row[3] else 0.0, row[5])))
+  if outputCSV:
+    with open(outputCSV, "w") as csvFile:
+      csvFile.write("case,fullCount,previewCount,fullVolume_mm3,previewVolume_mm3,speedup\n")
+      for row in rows:
+        csvFile.write("%s,%d,%d,%.3f,%.3f,%.3f\n" % row)
+  return rows
@@ -0,0 +1,166 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+"""Quality gates run by the logics before their expensive stages.
+
+checkInput() is run on every input before the bias field correction: header
+sanity (enough slices, plausible spacing and orientation) and intensity
+histogram plausibility (not constant, not a label map, enough foreground).
+
+checkRegistration() is run once the atlas is registered: most of the warped
+white matter (or brain) atlas must fall inside the foreground found by an Otsu
+threshold of the volume, otherwise the registration failed or the volume is
+badly oriented. checkContrast() then compares the white matter and gray matter
+intensities, which are reversed between T1 and T2-FLAIR volumes, so a T1 given
+as FLAIR (or the opposite) is found before the segmentation.
+
+A failed gate raises QualityGateError with the reason.
+"""
+import logging
+
+# Fewest voxels along each axis of a volume
+MINIMUM_SLICES = 20
+
+# Largest voxel spacing (mm)
+MAXIMUM_SPACING = 8.0
+
+# Fewest distinct intensities, fewer means a label map or a saturated volume
+MINIMUM_INTENSITY_LEVELS = 16
+
+# Smallest fraction of the volume above the Otsu threshold
+MINIMUM_FOREGROUND = 0.01
+
+# Smallest fraction of the warped atlas inside the foreground of the volume
+MINIMUM_ATLAS_OVERLAP = 0.6
+
+# White matter to gray matter median ratio limits: T1 above, T2-FLAIR below. The T2-FLAIR limit
+# leaves room for the CSF partial volume of the registered gray matter
+T1_MINIMUM_CONTRAST = 1.0
+FLAIR_MAXIMUM_CONTRAST = 1.2
+
+T1 = "T1"
+FLAIR = "T2-FLAIR"
+
+class QualityGateError(ValueError):
+  """A volume failed a quality gate
+  """
+
+def _fail(message, nodesToRemove=()):
+  import slicer
+  for node in nodesToRemove:
+    if node:
+      slicer.mrmlScene.RemoveNode(node)
+  logging.error("Quality gate failed: %s" % message)
+  raise QualityGateError(message)
+
+def otsuThreshold(values, numberOfBins=256):
+  """Otsu threshold of an array of intensities
+  """
+  import numpy as np
+  frequencies, edges = np.histogram(values, bins=numberOfBins)
+  centers = (edges[:-1] + edges[1:]) / 2.0
+  weights = np.cumsum(frequencies).astype(np.float64)
+  sums = np.cumsum(frequencies * centers)
+  total = weights[-1]
+  backgroundMean = sums / np.maximum(weights, 1)
+  foregroundMean = (sums[-1] - sums) / np.maximum(total - weights, 1)
+  betweenVariance = weights * (total - weights) * (backgroundMean - foregroundMean) ** 2
+  return float(edges[int(np.argmax(betweenVariance[:-1])) + 1])
+
+def foregroundMask(array):
+  """Voxels above the Otsu threshold of the nonzero intensities
+  """
+  import numpy as np
+  nonzero = array[array != 0]
+  if not nonzero.size:
+    return np.zeros(array.shape, dtype=bool)
+  return array > otsuThreshold(nonzero)
+
+def checkInput(volumeNode, modality, nodesToRemove=()):
+  """Header and intensity histogram gates of an input volume
+  """
+  import numpy as np
+  import vtk
+  name = "%s volume %s" % (modality, volumeNode.GetName())
+  imageData = volumeNode.GetImageData()
+  if imageData is None:
+    _fail("the %s has no image data" % name, nodesToRemove)
+  if imageData.GetNumberOfScalarComponents() != 1:
+    _fail("the %s has %d components, a scalar volume is needed" % (name, imageData.GetNumberOfScalarComponents()),
+          nodesToRemove)
+  dimensions = imageData.GetDimensions()
+  if min(dimensions) < MINIMUM_SLICES:
+    _fail("the %s has only %d slices along one axis (%s), at least %d are needed"
+          % (name, min(dimensions), "x".join(str(d) for d in dimensions), MINIMUM_SLICES), nodesToRemove)
+  spacing = volumeNode.GetSpacing()
+  if not all(0 < s <= MAXIMUM_SPACING for s in spacing):
+    _fail("the %s has an implausible spacing of %s mm" % (name, ", ".join("%g" % s for s in spacing)), nodesToRemove)
+  ijkToRAS = vtk.vtkMatrix4x4()
+  volumeNode.GetIJKToRASMatrix(ijkToRAS)
+  if abs(ijkToRAS.Determinant()) < 1e-6:
+    _fail("the %s has a degenerate orientation matrix" % name, nodesToRemove)
+
+  import slicer
+  array = slicer.util.arrayFromVolume(volumeNode)
+  if np.issubdtype(array.dtype, np.floating) and not np.isfinite(array).all():
+    _fail("the %s has NaN or infinite intensities" % name, nodesToRemove)
+  if array.min() == array.max():
+    _fail("the %s is constant" % name, nodesToRemove)
+  if len(np.unique(array[::4, ::4, ::4])) < MINIMUM_INTENSITY_LEVELS:
+    _fail("the %s has fewer than %d intensity levels, it looks like a label map" % (name, MINIMUM_INTENSITY_LEVELS),
+          nodesToRemove)
+  foreground = foregroundMask(array).mean()
+  if foreground < MINIMUM_FOREGROUND:
+    _fail("only %.2f%% of the %s is foreground" % (100.0 * foreground, name), nodesToRemove)
+  logging.info("Quality gate passed: %s (%s voxels, %s mm)"
+               % (name, "x".join(str(d) for d in dimensions), ", ".join("%g" % s for s in spacing)))
+
+def checkRegistration(volumeNode, atlasMask, modality, atlasName="white matter atlas", nodesToRemove=()):
+  """Fraction of the warped atlas mask (array on the volume grid) inside the volume foreground
+  """
+  import slicer
+  name = "%s volume %s" % (modality, volumeNode.GetName())
+  atlasMask = atlasMask != 0
+  if not atlasMask.any():
+    _fail("the %s registered to the %s is empty, the registration failed" % (atlasName, name), nodesToRemove)
+  overlap = float(foregroundMask(slicer.util.arrayFromVolume(volumeNode))[atlasMask].mean())
+  if overlap < MINIMUM_ATLAS_OVERLAP:
+    _fail("only %.0f%% of the %s registered to the %s falls inside its foreground, the registration failed or "
+          "the volume is badly oriented" % (100.0 * overlap, atlasName, name), nodesToRemove)
+  logging.info("Quality gate passed: %.0f%% of the %s inside the %s" % (100.0 * overlap, atlasName, name))
+
+def checkContrast(volumeNode, wmMask, gmMask, modality, nodesToRemove=()):
+  """White matter to gray matter median ratio of the volume, given the warped masks (arrays on
+  the volume grid). Without gmMask, the foreground out of the white matter is used.
+  """
+  import numpy as np
+  import slicer
+  name = "%s volume %s" % (modality, volumeNode.GetName())
+  array = slicer.util.arrayFromVolume(volumeNode)
+  wmMask = wmMask != 0
+  if gmMask is None:
+    gmMask = foregroundMask(array) & ~wmMask
+  else:
+    gmMask = gmMask != 0
+  wmValues = array[wmMask & (array != 0)]
+  gmValues = array[gmMask & (array != 0)]
+  if not wmValues.size or not gmValues.size:
+    _fail("the white or gray matter of the %s is empty" % name, nodesToRemove)
+  gmMedian = float(np.median(gmValues))
+  contrast = float(np.median(wmValues)) / gmMedian if gmMedian else float("inf")
+  if modality == T1 and contrast < T1_MINIMUM_CONTRAST:
+    _fail("the white matter of the %s is darker than the gray matter (ratio %.2f), it does not look like a T1"
+          % (name, contrast), nodesToRemove)
+  if modality == FLAIR and contrast > FLAIR_MAXIMUM_CONTRAST:
+    _fail("the white matter of the %s is brighter than the gray matter (ratio %.2f), it looks like a T1"
+          % (name, contrast), nodesToRemove)
+  logging.info("Quality gate passed: white to gray matter ratio %.2f of the %s" % (contrast, name))
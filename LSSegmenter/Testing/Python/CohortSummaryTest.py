@@ -0,0 +1,88 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+import os
+import sys
+import csv
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from LesionSpotlightLib import CohortSummary
+
+class CohortSummaryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.path = os.path.join(self.folder, "cohort_summary.sqlite")
+    self.summary = CohortSummary.CohortSummary(self.path)
+
+  def tearDown(self):
+    self.summary.close()
+    shutil.rmtree(self.folder)
+
+  def test_SizeHistogram(self):
+    self.assertEqual(CohortSummary.sizeHistogram([0.5, 9.9, 10.0, 75.0, 499.0, 6000.0]), [2, 1, 1, 1, 0, 0, 1])
+    self.assertEqual(CohortSummary.SIZE_BIN_COLUMNS[1], "lesions10to50mm3")
+    self.assertEqual(CohortSummary.SIZE_BIN_COLUMNS[-1], "lesionsOver5000mm3")
+
+  def test_LesionRecord(self):
+    record = CohortSummary.lesionRecord("subject1", "LSSegmenter", [4.0, 20.0, 36.0], parameters={"lThr": 0.95})
+    self.assertEqual(record["lesionCount"], 3)
+    self.assertEqual(record["totalVolume_mm3"], 60.0)
+    self.assertEqual(record["meanVolume_mm3"], 20.0)
+    self.assertEqual(record["maximumVolume_mm3"], 36.0)
+    self.assertEqual(record["lesions0to10mm3"], 1)
+    self.assertEqual(record["lesions10to50mm3"], 2)
+    empty = CohortSummary.lesionRecord("subject2", "LSSegmenter", [])
+    self.assertEqual((empty["lesionCount"], empty["meanVolume_mm3"], empty["maximumVolume_mm3"]), (0, 0.0, 0.0))
+
+  def test_AppendReplacesTheSubjectRecord(self):
+    self.summary.appendLesions("subject1", "LSSegmenter", [4.0, 20.0], parameters={"lThr": 0.95})
+    self.summary.appendLesions("subject1", "LSSegmenter", [8.0], parameters={"lThr": 0.9})
+    self.summary.appendLesions("subject1", "AFTSegmenter", [8.0, 8.0])
+    records = self.summary.records("LSSegmenter")
+    self.assertEqual(len(records), 1)
+    self.assertEqual(records[0]["lesionCount"], 1)
+    self.assertEqual(records[0]["parameters"], {"lThr": 0.9})
+    self.assertEqual(self.summary.methods(), ["AFTSegmenter", "LSSegmenter"])
+
+  def test_Aggregate(self):
+    for subject, volumes in (("subject1", [10.0]), ("subject2", [10.0, 20.0]), ("subject3", [10.0, 20.0, 30.0])):
+      self.summary.appendLesions(subject, "LSSegmenter", volumes)
+    statistics = self.summary.aggregate(("lesionCount", "totalVolume_mm3"), "LSSegmenter")
+    self.assertEqual(statistics["lesionCount"]["count"], 3)
+    self.assertAlmostEqual(statistics["lesionCount"]["mean"], 2.0)
+    self.assertAlmostEqual(statistics["lesionCount"]["std"], 1.0)
+    self.assertEqual((statistics["totalVolume_mm3"]["minimum"], statistics["totalVolume_mm3"]["maximum"]), (10.0, 60.0))
+    self.assertEqual(self.summary.column("lesionCount", subjects=["subject1", "subject3"]), [1, 3])
+    self.assertRaises(ValueError, self.summary.column, "subject")
+
+  def test_ExportCSV(self):
+    self.summary.appendLesions("subject1", "LSSegmenter", [4.0, 20.0])
+    self.summary.appendLesions("subject2", "LSSegmenter", [])
+    csvPath = os.path.join(self.folder, "study.csv")
+    self.summary.exportCSV(csvPath)
+    with open(csvPath) as csvFile:
+      rows = list(csv.DictReader(csvFile))
+    self.assertEqual([row["subject"] for row in rows], ["subject1", "subject2"])
+    self.assertEqual(rows[0]["lesionCount"], "2")
+    self.assertEqual(float(rows[0]["totalVolume_mm3"]), 24.0)
+
+  def test_SharedFile(self):
+    self.summary.appendLesions("subject1", "LSSegmenter", [4.0])
+    CohortSummary.appendToSummary(self.path, "subject2", "LSSegmenter", [5.0, 6.0])
+    self.assertEqual(self.summary.column("lesionCount"), [1, 2])
+
+if __name__ == "__main__":
+  unittest.main()
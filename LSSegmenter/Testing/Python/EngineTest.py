@@ -0,0 +1,180 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+import os
+import sys
+import itertools
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from LesionSpotlightLib import Engine, MemoryModel
+
+try:
+  import numpy as np
+  import SimpleITK as sitk
+except ImportError:
+  np = None
+
+#
+# Voxel by voxel transcriptions of the ITK filters of the CLIs
+#
+
+def _neighbourOffsets(connectivity):
+  """Offsets of the LesionSizeFilterImageFilter neighbours: at most 1, 2 or 3 nonzero components
+  """
+  maximumNonZero = {6: 1, 18: 2, 26: 3}[connectivity]
+  return [offset for offset in itertools.product((-1, 0, 1), repeat=3)
+          if 0 < sum(1 for o in offset if o) <= maximumNonZero]
+
+def referenceLesions(mask, minimumSize, connectivity):
+  """Lesions of at least minimumSize voxels, in raster order of their first voxel, as lists of KJI indices
+  """
+  offsets = _neighbourOffsets(connectivity)
+  seen = np.zeros(mask.shape, dtype=bool)
+  lesions = []
+  for start in zip(*np.nonzero(mask)):
+    if seen[start]:
+      continue
+    seen[start] = True
+    lesion = [start]
+    for voxel in lesion:
+      for offset in offsets:
+        neighbour = tuple(v + o for v, o in zip(voxel, offset))
+        if (all(0 <= n < s for n, s in zip(neighbour, mask.shape)) and mask[neighbour]
+            and not seen[neighbour]):
+          seen[neighbour] = True
+          lesion.append(neighbour)
+    if len(lesion) >= minimumSize:
+      lesions.append(lesion)
+  return lesions
+
+def referenceWhiteMatterMatch(lesions, whiteMatter, wmMatch, radius=1):
+  """WhiteMatterMatchImageFilter with the zero flux Neumann boundary of the neighbourhood iterators
+  """
+  output = np.zeros(lesions.shape, dtype=np.uint8)
+  width = 2 * radius + 1
+  for voxel in zip(*np.nonzero(lesions)):
+    match = 0
+    for offset in itertools.product(range(-radius, radius + 1), repeat=3):
+      neighbour = tuple(min(max(v + o, 0), s - 1) for v, o, s in zip(voxel, offset, lesions.shape))
+      if lesions[neighbour] and whiteMatter[neighbour]:
+        match += 1
+    if np.float32(match) / np.float32(width ** 3) >= np.float32(wmMatch):
+      output[voxel] = 1
+  return output
+
+def referencePercentileBins(values, fractions, isInteger, maximumNumberOfBins):
+  """MaskedIntensityHistogramCalculator: histogram of the masked values and GetPercentileBin()
+  """
+  minimum = float(min(values))
+  maximum = float(max(values))
+  if isInteger and maximum - minimum + 1.0 <= maximumNumberOfBins:
+    frequencies = [0] * int(maximum - minimum + 1.0)
+    binWidth = 1.0
+  else:
+    frequencies = [0] * max(1, maximumNumberOfBins)
+    binWidth = (maximum - minimum) / len(frequencies)
+  scale = 1.0 / binWidth if binWidth > 0.0 else 0.0
+  bins = []
+  for value in values:
+    bins.append(min(int((float(value) - minimum) * scale), len(frequencies) - 1))
+    frequencies[bins[-1]] += 1
+  percentileBins = []
+  for fraction in fractions:
+    target = fraction * len(values)
+    cumulative = 0
+    for index, frequency in enumerate(frequencies):
+      cumulative += frequency
+      if cumulative > 0 and cumulative >= target:
+        break
+    percentileBins.append(index)
+  return bins, percentileBins
+
+@unittest.skipUnless(np is not None, "NumPy and SimpleITK are not available")
+class EngineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.random = np.random.RandomState(42)
+
+  def image(self, array):
+    return sitk.GetImageFromArray(array)
+
+  def test_WhiteMatterMatch(self):
+    for wmMatch in (0.3, 0.6):
+      lesions = (self.random.rand(7, 8, 9) > 0.4).astype(np.uint8)
+      whiteMatter = (self.random.rand(7, 8, 9) > 0.3).astype(np.uint8)
+      result = Engine.whiteMatterMatch(self.image(lesions), self.image(whiteMatter), wmMatch)
+      np.testing.assert_array_equal(sitk.GetArrayFromImage(result),
+                                    referenceWhiteMatterMatch(lesions, whiteMatter, wmMatch))
+
+  def test_LesionSizeFilter(self):
+    mask = (self.random.rand(6, 9, 10) > 0.65).astype(np.uint8)
+    intensity = self.random.rand(6, 9, 10).astype(np.float32)
+    for connectivity in (6, 18, 26):
+      expected = referenceLesions(mask != 0, 3, connectivity)
+      result, statistics = Engine.lesionSizeFilter(self.image(mask), 3, connectivity, intensity=self.image(intensity))
+      expectedMask = np.zeros(mask.shape, dtype=np.uint8)
+      for lesion in expected:
+        expectedMask[tuple(np.array(lesion).T)] = 1
+      np.testing.assert_array_equal(sitk.GetArrayFromImage(result), expectedMask)
+      self.assertEqual(len(statistics), len(expected))
+      for lesion, reference in zip(statistics, expected):
+        indices = np.array(reference)
+        self.assertEqual(lesion["voxelCount"], len(reference))
+        # The statistics are in IJK order, the arrays in KJI order
+        self.assertEqual([lesion["bbox_min_i"], lesion["bbox_min_j"], lesion["bbox_min_k"]], list(indices.min(axis=0)[::-1]))
+        self.assertEqual([lesion["bbox_max_i"], lesion["bbox_max_j"], lesion["bbox_max_k"]], list(indices.max(axis=0)[::-1]))
+        np.testing.assert_allclose([lesion["centroid_x"], lesion["centroid_y"], lesion["centroid_z"]],
+                                   indices.mean(axis=0)[::-1])
+        self.assertAlmostEqual(lesion["meanIntensity"], float(intensity[tuple(indices.T)].mean()), places=5)
+
+  def test_LabelLesions(self):
+    mask = (self.random.rand(8, 8, 8) > 0.6).astype(np.uint8)
+    for connectivity in (6, 18, 26):
+      labels = Engine.labelLesions(self.image(mask), connectivity)
+      expected = referenceLesions(mask != 0, 1, connectivity)
+      self.assertEqual(int(labels.max()), len(expected))
+      for label, lesion in enumerate(expected, 1):
+        self.assertTrue((labels[tuple(np.array(lesion).T)] == label).all())
+    self.assertRaises(ValueError, Engine.labelLesions, self.image(mask), 8)
+
+  def test_MaskedClipping(self):
+    integers = self.random.randint(-50, 400, size=500).astype(np.int16)
+    reals = (self.random.rand(500) * 1000.0).astype(np.float32)
+    for values, isInteger, maximumNumberOfBins in ((integers, True, 1 << 16), (integers, True, 64),
+                                                   (reals, False, 1 << 16), (reals, False, 100)):
+      bins, percentileBins = Engine.maskedHistogramBins(values, Engine.CLIPPING_FRACTIONS, maximumNumberOfBins)
+      expectedBins, expectedPercentileBins = referencePercentileBins(values, Engine.CLIPPING_FRACTIONS, isInteger,
+                                                                     maximumNumberOfBins)
+      self.assertEqual(list(bins), expectedBins)
+      self.assertEqual(percentileBins, expectedPercentileBins)
+
+  def test_GammaLevelLesions(self):
+    levels = (self.random.rand(7, 9, 8) * 4.0).astype(np.float32)
+    for connectivity in (6, 18, 26):
+      for gamma, minimumSize in ((2.0, 1), (2.5, 3)):
+        expected = np.zeros(levels.shape, dtype=np.uint8)
+        for lesion in referenceLesions(levels >= gamma, minimumSize, connectivity):
+          expected[tuple(np.array(lesion).T)] = 1
+        np.testing.assert_array_equal(Engine.gammaLevelLesions(levels, gamma, minimumSize, connectivity), expected)
+
+class EngineStageTest(unittest.TestCase):
+
+  def test_EngineStages(self):
+    # The engine parameters are not those of the Slicer logics, their jobs must not share a stage
+    for stage in (Engine.LS_STAGE, Engine.AFT_STAGE):
+      self.assertNotIn(stage, ("LSSegmenter", "AFTSegmenter", "LSContrastEnhancer"))
+      self.assertIn(stage, MemoryModel.DEFAULT_COEFFICIENTS)
+      self.assertIn(stage, MemoryModel.INPUT_PARAMETERS)
+
+if __name__ == "__main__":
+  unittest.main()
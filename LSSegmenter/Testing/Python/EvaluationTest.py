@@ -0,0 +1,85 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+import os
+import sys
+import math
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from LesionSpotlightLib import Evaluation
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+@unittest.skipUnless(np is not None, "NumPy is not available")
+class EvaluationTest(unittest.TestCase):
+
+  def test_VoxelMetrics(self):
+    predicted = np.zeros((2, 3, 4), dtype=bool)
+    reference = np.zeros((2, 3, 4), dtype=bool)
+    predicted[0, 0, :3] = True
+    reference[0, 0, 1:] = True
+    reference[1, 2, 3] = True
+    metrics = Evaluation.voxelMetrics(predicted, reference, voxelVolume=2.0)
+    # 2 true positives, 1 false positive, 2 false negatives, 19 true negatives
+    self.assertAlmostEqual(metrics["dice"], 4.0 / 7.0)
+    self.assertAlmostEqual(metrics["tpr"], 0.5)
+    self.assertAlmostEqual(metrics["fpr"], 1.0 / 20.0)
+    self.assertAlmostEqual(metrics["precision"], 2.0 / 3.0)
+    self.assertEqual(metrics["predictedVolume_mm3"], 6.0)
+    self.assertEqual(metrics["referenceVolume_mm3"], 8.0)
+    self.assertAlmostEqual(metrics["volumeDifference"], -0.25)
+
+  def test_VoxelMetricsOfEmptyMasks(self):
+    empty = np.zeros((2, 2, 2), dtype=bool)
+    metrics = Evaluation.voxelMetrics(empty, empty)
+    self.assertEqual(metrics["dice"], 1.0)
+    self.assertEqual(metrics["fpr"], 0.0)
+    self.assertTrue(math.isnan(metrics["tpr"]))
+    self.assertTrue(math.isnan(metrics["precision"]))
+
+  def test_LesionMetrics(self):
+    predicted = np.zeros((1, 1, 10), dtype=np.int32)
+    reference = np.zeros((1, 1, 10), dtype=np.int32)
+    # Predicted lesions 1 and 2 overlap reference lesions 1 and 2, predicted lesion 3 is false,
+    # reference lesion 3 is missed
+    predicted[0, 0, 0:2] = 1
+    predicted[0, 0, 3] = 2
+    predicted[0, 0, 6] = 3
+    reference[0, 0, 1:3] = 1
+    reference[0, 0, 3:5] = 2
+    reference[0, 0, 8:10] = 3
+    metrics = Evaluation.lesionMetrics(predicted, reference)
+    self.assertEqual((metrics["predictedLesions"], metrics["referenceLesions"]), (3, 3))
+    self.assertEqual((metrics["detectedLesions"], metrics["falsePositiveLesions"]), (2, 1))
+    self.assertAlmostEqual(metrics["lesionTPR"], 2.0 / 3.0)
+    self.assertAlmostEqual(metrics["lesionFDR"], 1.0 / 3.0)
+    self.assertAlmostEqual(metrics["lesionF1"], 2.0 / 3.0)
+
+  def test_MinimumOverlap(self):
+    predicted = np.array([[[1, 1, 0, 2]]], dtype=np.int32)
+    reference = np.array([[[0, 1, 1, 1]]], dtype=np.int32)
+    metrics = Evaluation.lesionMetrics(predicted, reference, minimumOverlap=2)
+    # Each predicted lesion shares a single voxel with the reference lesion
+    self.assertEqual(metrics["detectedLesions"], 1)
+    self.assertEqual(metrics["falsePositiveLesions"], 2)
+    self.assertAlmostEqual(metrics["lesionFDR"], 1.0)
+
+  def test_Columns(self):
+    self.assertIn("lesionFDR", Evaluation.COLUMNS)
+    self.assertNotIn("lesionFPR", Evaluation.COLUMNS)
+
+if __name__ == "__main__":
+  unittest.main()
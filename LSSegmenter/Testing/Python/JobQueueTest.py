@@ -0,0 +1,124 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from LesionSpotlightLib import JobQueue
+
+class JobQueueTest(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.path = os.path.join(self.folder, "cohort.sqlite")
+    self.queue = JobQueue.JobQueue(self.path)
+
+  def tearDown(self):
+    self.queue.close()
+    shutil.rmtree(self.folder)
+
+  def test_StagesRunInOrder(self):
+    self.queue.addSubject("subject1", ["first", "second"])
+    self.assertEqual(self.queue.addSubject("subject1", ["first", "second"]), 0)
+    first = self.queue.claimJob("worker1")
+    self.assertEqual(first.stage, "first")
+    self.assertIsNone(self.queue.claimJob("worker2"))
+    self.assertTrue(self.queue.completeJob(first, {"output": "a.nii.gz"}))
+    second = self.queue.claimJob("worker2")
+    self.assertEqual(second.stage, "second")
+
+  def test_ExpiredLeaseReclaim(self):
+    self.queue.addJob("subject1", "LSSegmenter")
+    lost = self.queue.claimJob("worker1", leaseDuration=0.05)
+    self.assertIsNone(self.queue.claimJob("worker2", leaseDuration=0.05))
+    time.sleep(0.1)
+    reclaimed = self.queue.claimJob("worker2", leaseDuration=60.0)
+    self.assertEqual(reclaimed.id, lost.id)
+    self.assertEqual(reclaimed.attempts, 2)
+    # The worker that lost its lease can neither renew it nor record its result
+    self.assertFalse(self.queue.renewLease(lost))
+    self.assertFalse(self.queue.completeJob(lost))
+    self.assertTrue(self.queue.completeJob(reclaimed))
+    self.assertEqual(self.queue.jobs(JobQueue.DONE)[0].worker, "worker2")
+
+  def test_HeartbeatKeepsTheLease(self):
+    self.queue.addJob("subject1", "LSSegmenter")
+    claims = []
+
+    def handler(subject, parameters):
+      # Several lease durations long, the heartbeat must keep other workers away
+      with JobQueue.JobQueue(self.path) as other:
+        for beat in range(4):
+          time.sleep(0.2)
+          claims.append(other.claimJob("thief", leaseDuration=60.0))
+      return {"subject": subject}
+
+    self.assertEqual(self.queue.runWorker({"LSSegmenter": handler}, "worker1", leaseDuration=0.3), 1)
+    self.assertEqual(claims, [None] * 4)
+    job = self.queue.jobs(JobQueue.DONE)[0]
+    self.assertEqual(job.attempts, 1)
+    self.assertEqual(job.outputs, {"subject": "subject1"})
+
+  def test_FailedJobs(self):
+    self.queue.addJob("subject1", "LSSegmenter")
+
+    def handler(subject, parameters):
+      raise RuntimeError("no FLAIR volume")
+
+    self.queue.runWorker({"LSSegmenter": handler}, "worker1")
+    failures = self.queue.summary()["failures"]
+    self.assertEqual(len(failures), 1)
+    self.assertEqual(failures[0]["error"], "RuntimeError: no FLAIR volume")
+    self.assertEqual(self.queue.retryFailed(maximumAttempts=1), 0)
+    self.assertEqual(self.queue.retryFailed(), 1)
+    self.assertEqual(len(self.queue.jobs(JobQueue.PENDING)), 1)
+
+  def addEstimatedJob(self, subject, memoryMB):
+    self.queue.addJob(subject, "LSSegmenter")
+    self.queue.connection.execute("UPDATE jobs SET megavoxels = 7.0, inputMB = 28.0, memoryMB = ? WHERE subject = ?",
+                                  (memoryMB, subject))
+
+  def test_MemoryBudgetRefusesAnOversizedJob(self):
+    self.addEstimatedJob("subject1", 500.0)
+    self.addEstimatedJob("subject2", 700.0)
+    first = self.queue.claimJob("worker1", memoryBudgetMB=1000.0)
+    self.assertEqual(first.subject, "subject2")
+    # 500 MB does not fit the 300 MB left by the running job
+    self.assertIsNone(self.queue.claimJob("worker2", memoryBudgetMB=1000.0))
+    self.assertTrue(self.queue.hasRunnableJobs())
+    self.queue.completeJob(first)
+    self.assertEqual(self.queue.claimJob("worker2", memoryBudgetMB=1000.0).subject, "subject1")
+
+  def test_JobLargerThanTheBudgetRunsAlone(self):
+    self.addEstimatedJob("subject1", 1500.0)
+    self.addEstimatedJob("subject2", 100.0)
+    first = self.queue.claimJob("worker1", memoryBudgetMB=1000.0)
+    self.assertEqual(first.subject, "subject1")
+    # Nothing else runs beside it, even a job that would fit on its own
+    self.assertIsNone(self.queue.claimJob("worker2", memoryBudgetMB=1000.0))
+    self.queue.completeJob(first)
+    self.assertEqual(self.queue.claimJob("worker2", memoryBudgetMB=1000.0).subject, "subject2")
+
+  def test_MemoryBudgetOnlyCountsThisHost(self):
+    self.addEstimatedJob("subject1", 900.0)
+    self.addEstimatedJob("subject2", 600.0)
+    self.queue.connection.execute("UPDATE jobs SET status = ?, worker = 'other:1', host = 'otherHost', leaseExpires = ? "
+                                  "WHERE subject = 'subject1'", (JobQueue.RUNNING, time.time() + 60.0))
+    self.assertEqual(self.queue.claimJob("worker1", memoryBudgetMB=1000.0).subject, "subject2")
+
+if __name__ == "__main__":
+  unittest.main()
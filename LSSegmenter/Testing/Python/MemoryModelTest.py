@@ -0,0 +1,91 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+import os
+import sys
+import gzip
+import shutil
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from LesionSpotlightLib import MemoryModel
+
+class MemoryModelTest(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def writeNIfTIHeader(self, fileName, size, spacing, datatype):
+    header = bytearray(348)
+    struct.pack_into("<i", header, 0, 348)
+    struct.pack_into("<8h", header, 40, *((3,) + size + (1,) * 4))
+    struct.pack_into("<h", header, 70, datatype)
+    struct.pack_into("<8f", header, 76, *((1.0,) + spacing + (1.0,) * 4))
+    path = os.path.join(self.folder, fileName)
+    with gzip.open(path, "wb") as niftiFile:
+      niftiFile.write(bytes(header) + b"\0" * 4)
+    return path
+
+  def writeText(self, fileName, text):
+    path = os.path.join(self.folder, fileName)
+    with open(path, "w") as textFile:
+      textFile.write(text)
+    return path
+
+  def test_ReadHeaders(self):
+    nifti = self.writeNIfTIHeader("flair.nii.gz", (256, 256, 40), (1.0, 1.0, 3.0), 4)
+    self.assertEqual(MemoryModel.readHeader(nifti), ((256, 256, 40), (1.0, 1.0, 3.0), 2))
+    nrrd = self.writeText("flair.nhdr", "NRRD0004\ntype: float\ndimension: 3\nsizes: 100 120 80\n"
+                                        "space directions: (0.5,0,0) (0,0.5,0) (0,0,2)\n"
+                                        "data file: flair.raw\n\n")
+    self.assertEqual(MemoryModel.readHeader(nrrd), ((100, 120, 80), (0.5, 0.5, 2.0), 4))
+    meta = self.writeText("t1.mhd", "NDims = 3\nDimSize = 64 64 32\nElementSpacing = 2 2 4\n"
+                                    "ElementType = MET_SHORT\nElementDataFile = t1.raw\n")
+    self.assertEqual(MemoryModel.readHeader(meta), ((64, 64, 32), (2.0, 2.0, 4.0), 2))
+    self.assertRaises(ValueError, MemoryModel.readHeader, os.path.join(self.folder, "flair.dcm"))
+
+  def test_JobFeatures(self):
+    flair = self.writeText("flair.nhdr", "NRRD0004\ntype: short\ndimension: 3\nsizes: 100 100 100\n"
+                                         "spacings: 1 1 1\ndata file: flair.raw\n\n")
+    megavoxels, inputMB = MemoryModel.jobFeatures("LSSegmenter", {"inputFLAIRVolume": flair})
+    self.assertAlmostEqual(megavoxels, 1.0)
+    self.assertAlmostEqual(inputMB, 2e6 / 1048576.0)
+    # The preview runs on a 2 mm grid, an eighth of the voxels
+    megavoxels, inputMB = MemoryModel.jobFeatures("LSSegmenter", {"inputFLAIRVolume": flair, "previewSpacing": 2})
+    self.assertAlmostEqual(megavoxels, 0.125)
+    self.assertAlmostEqual(inputMB, 2e6 / 1048576.0)
+    self.assertIsNone(MemoryModel.jobFeatures("LSSegmenter", {"inputFLAIRVolume": os.path.join(self.folder, "none.nrrd")}))
+
+  def test_Estimate(self):
+    model = MemoryModel.MemoryModel({"LSSegmenter": (100.0, 10.0)})
+    self.assertAlmostEqual(model.estimateFeatures("LSSegmenter", 5.0, 20.0), MemoryModel.SAFETY_MARGIN * 170.0)
+    intercept, slope = MemoryModel.FALLBACK_COEFFICIENTS
+    self.assertAlmostEqual(model.estimateFeatures("Unknown", 1.0, 0.0), MemoryModel.SAFETY_MARGIN * (intercept + slope))
+
+  def test_Calibrate(self):
+    model = MemoryModel.MemoryModel()
+    samples = [("LSSegmenter", megavoxels, 10.0, 10.0 + 300.0 + 50.0 * megavoxels) for megavoxels in (2.0, 4.0, 8.0)]
+    samples.append(("AFTSegmenter", 7.0, 10.0, 2000.0))
+    self.assertEqual(model.calibrate(samples), ["LSSegmenter"])
+    intercept, slope = model.coefficients["LSSegmenter"]
+    self.assertAlmostEqual(intercept, 300.0)
+    self.assertAlmostEqual(slope, 50.0)
+    # Too few samples keep the defaults
+    self.assertEqual(model.coefficients["AFTSegmenter"], MemoryModel.DEFAULT_COEFFICIENTS["AFTSegmenter"])
+
+if __name__ == "__main__":
+  unittest.main()
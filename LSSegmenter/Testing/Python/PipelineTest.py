@@ -0,0 +1,83 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from LesionSpotlightLib import JobQueue, Pipeline
+
+def _read(value):
+  return value + 1
+
+def _enhance(value):
+  if value == 3:
+    raise ValueError("empty brain mask")
+  return value * 10
+
+def _write(value):
+  return {"value": value}
+
+class PipelineTest(unittest.TestCase):
+
+  def executor(self):
+    return Pipeline.PipelineExecutor([Pipeline.Stage("read", _read, workers=2), Pipeline.Stage("enhance", _enhance),
+                                      Pipeline.Stage("write", _write, workers=2, queueSize=1)])
+
+  def test_Results(self):
+    executor = self.executor()
+    results = {}
+    self.assertEqual(executor.run(((key, key) for key in (0, 1, 4, 5)), lambda key, value: results.update({key: value})), 4)
+    self.assertEqual(results, {0: {"value": 10}, 1: {"value": 20}, 4: {"value": 50}, 5: {"value": 60}})
+    report = executor.report()
+    self.assertEqual([row["stage"] for row in report], ["read", "enhance", "write"])
+    self.assertEqual([row["items"] for row in report], [4, 4, 4])
+    self.assertEqual([row["failures"] for row in report], [0, 0, 0])
+
+  def test_ErrorPath(self):
+    executor = self.executor()
+    results = {}
+    errors = {}
+    numberOfItems = executor.run(((key, key) for key in range(5)), lambda key, value: results.update({key: value}),
+                                 lambda key, error: errors.update({key: error}))
+    self.assertEqual(numberOfItems, 5)
+    # The failing item skips the next stages, the others go on
+    self.assertEqual(sorted(results), [0, 1, 3, 4])
+    self.assertEqual(list(errors), [2])
+    self.assertTrue(errors[2].startswith("enhance: "))
+    self.assertIn("ValueError: empty brain mask", errors[2])
+    self.assertEqual([row["items"] for row in executor.report()], [5, 5, 4])
+    self.assertEqual([row["failures"] for row in executor.report()], [0, 1, 0])
+
+  def test_NoStages(self):
+    self.assertRaises(ValueError, Pipeline.PipelineExecutor, [])
+
+  def test_JobQueuePipeline(self):
+    folder = tempfile.mkdtemp()
+    try:
+      with JobQueue.JobQueue(os.path.join(folder, "cohort.sqlite")) as queue:
+        for subject in range(4):
+          queue.addJob("subject%d" % subject, "enhancement", {"value": subject})
+        executor = Pipeline.PipelineExecutor([Pipeline.Stage("enhance", lambda item: _enhance(item[1]["value"] + 1)),
+                                              Pipeline.Stage("write", _write)])
+        self.assertEqual(queue.runPipeline("enhancement", executor), 4)
+        self.assertEqual([job.subject for job in queue.jobs(JobQueue.FAILED)], ["subject2"])
+        self.assertEqual([job.outputs for job in queue.jobs(JobQueue.DONE)],
+                         [{"value": 10}, {"value": 20}, {"value": 40}])
+    finally:
+      shutil.rmtree(folder)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,10 +1,15 @@
 #include "itkImageFileWriter.h"
 
-#include "itkThresholdImageFilter.h"
-#include "itkConnectedComponentImageFilter.h"
-#include "itkRelabelComponentImageFilter.h"
 #include "itkBinaryThresholdImageFilter.h"
+#include "itkStreamingImageFilter.h"
+#include "itkWhiteMatterMatchImageFilter.h"
+#include "itkLesionSizeFilterImageFilter.h"
+#include "itkFilterProfiler.h"
+#include "itkThreadBudget.h"
 
+#include <fstream>
+
+#include "itkMultiThreaderBase.h"
 #include "itkPluginUtilities.h"
 
 #include "LesionMapRefinementCLP.h"
@@ -37,83 +42,73 @@ int DoIt( int argc, char * argv[], T )
 
   readerProbMap->SetFileName( lesionProbMap.c_str() );
   readerWMMask->SetFileName( wmMask.c_str() );
-  readerProbMap->Update();
-  readerWMMask->Update();
+  readerWMMask->ReleaseDataFlagOn();
+
+  //Wall time and buffer size of each step, written to profileOutput
+  itk::FilterProfiler profiler;
+  profiler.Observe(readerProbMap, "readerProbMap");
+  profiler.Observe(readerWMMask, "readerWMMask");
 
   typedef itk::BinaryThresholdImageFilter<InputImageType,MaskImageType>         BinaryImageType;
   typename BinaryImageType::Pointer flairLesions = BinaryImageType::New();
   flairLesions->SetInput(readerProbMap->GetOutput());
   flairLesions->SetLowerThreshold(lesionThr);
   flairLesions->SetInsideValue(1);
-  flairLesions->Update();
+  flairLesions->ReleaseDataFlagOn();
 
   //Apply global lesion constraints
-  MaskImageType::Pointer finalLesionMap = MaskImageType::New();
-  finalLesionMap->CopyInformation(flairLesions->GetOutput());
-  finalLesionMap->SetRegions(flairLesions->GetOutput()->GetBufferedRegion());
-  finalLesionMap->Allocate();
-  finalLesionMap->FillBuffer(0);
-  typedef itk::NeighborhoodIterator<MaskImageType>                        NeighborhoodIterator;
-  typedef itk::ImageRegionIterator<MaskImageType>                         MaskRegionIterator;
-  NeighborhoodIterator::RadiusType radius = {1,1,1};
-  NeighborhoodIterator        lesionMaskIt(radius,flairLesions->GetOutput(),flairLesions->GetOutput()->GetBufferedRegion());
-  NeighborhoodIterator        wmMaskIt(radius,readerWMMask->GetOutput(),readerWMMask->GetOutput()->GetBufferedRegion());
-  MaskRegionIterator          finalLesionIt(finalLesionMap,flairLesions->GetOutput()->GetBufferedRegion());
-
-  int match=0;
-  lesionMaskIt.GoToBegin();
-  wmMaskIt.GoToBegin();
-  finalLesionIt.GoToBegin();
-  while (!lesionMaskIt.IsAtEnd()) {
-      if (lesionMaskIt.GetCenterPixel()!=static_cast<MaskLabelPixelType>(0)) {
-          match=0;
-          for (int idx = 0; idx < 27; ++idx) {
-              if (lesionMaskIt.GetPixel(idx)*wmMaskIt.GetPixel(idx)!=static_cast<MaskLabelPixelType>(0)) {
-                  match++;
-              }
-          }
-          if ((float)match/(float)27 >= wmMatch) {
-              finalLesionIt.Set(1);
-          }else{
-              finalLesionIt.Set(0);
-          }
-          ++lesionMaskIt;
-          ++wmMaskIt;
-          ++finalLesionIt;
-      }else{
-          ++lesionMaskIt;
-          ++wmMaskIt;
-          ++finalLesionIt;
-      }
-  }
+  //1: Lesions must be mostly surrounded by white matter
+  typedef itk::WhiteMatterMatchImageFilter<MaskImageType>                      WhiteMatterMatchType;
+  typename WhiteMatterMatchType::Pointer finalLesionMap = WhiteMatterMatchType::New();
+  finalLesionMap->SetInput(flairLesions->GetOutput());
+  finalLesionMap->SetWhiteMatterMask(readerWMMask->GetOutput());
+  finalLesionMap->SetWhiteMatterMatch(wmMatch);
+  finalLesionMap->SetInsideValue(1);
+  finalLesionMap->ReleaseDataFlagOn();
+
+  //The voxelwise and neighbourhood stages are streamed in tiles, only the lesion mask is kept whole.
+  typedef itk::StreamingImageFilter<MaskImageType, MaskImageType>              StreamingType;
+  typename StreamingType::Pointer lesionMapTiles = StreamingType::New();
+  lesionMapTiles->SetInput(finalLesionMap->GetOutput());
+  lesionMapTiles->SetNumberOfStreamDivisions(numberOfTiles);
+  lesionMapTiles->ReleaseDataFlagOn();
+  profiler.Observe(lesionMapTiles, "lesionMapTiles");
 
   //2: Apply a minimum lesion size
-  typedef unsigned int ConnectedVoxelType;
-  typedef itk::Image<ConnectedVoxelType, 3>   ConnectedVoxelImageType;
-  typedef itk::ConnectedComponentImageFilter<MaskImageType, ConnectedVoxelImageType> ConnectedLabelType;
-  typename ConnectedLabelType::Pointer connLesionLabel = ConnectedLabelType::New();
-  connLesionLabel->SetInput(finalLesionMap);
-  connLesionLabel->Update();
-
-  typedef itk::RelabelComponentImageFilter<ConnectedVoxelImageType, MaskImageType>      RelabelerType;
-  typename RelabelerType::Pointer relabelLesionLabel = RelabelerType::New();
-  relabelLesionLabel->SetInput(connLesionLabel->GetOutput());
-  relabelLesionLabel->SetSortByObjectSize(true);
-  relabelLesionLabel->SetMinimumObjectSize(minimumSize);
-  relabelLesionLabel->Update();
-
-  typedef itk::BinaryThresholdImageFilter<MaskImageType,MaskImageType>                BinaryLabelMap;
-  typename BinaryLabelMap::Pointer hyperintenseLesions = BinaryLabelMap::New();
-  hyperintenseLesions->SetInput(relabelLesionLabel->GetOutput());
-  hyperintenseLesions->SetLowerThreshold(1);
+  typedef itk::LesionSizeFilterImageFilter<MaskImageType, InputImageType>      LesionSizeFilterType;
+  typename LesionSizeFilterType::Pointer hyperintenseLesions = LesionSizeFilterType::New();
+  hyperintenseLesions->SetInput(lesionMapTiles->GetOutput());
+  hyperintenseLesions->SetIntensityImage(readerProbMap->GetOutput());
+  hyperintenseLesions->SetNumberOfStreamDivisions(numberOfTiles);
+  hyperintenseLesions->SetMinimumSize(minimumSize);
+  hyperintenseLesions->SetConnectivity(connectivity);
   hyperintenseLesions->SetInsideValue(1);
+  profiler.Observe(hyperintenseLesions, "lesionSizeFilter");
+  hyperintenseLesions->Update();
+  //Only the lesion mask is left to write
+  readerProbMap->GetOutput()->ReleaseData();
+
+  if (!lesionStatistics.empty()) {
+      std::ofstream statisticsFile(lesionStatistics.c_str());
+      hyperintenseLesions->WriteLesionStatistics(statisticsFile);
+  }
 
   typename WriterType::Pointer writer = WriterType::New();
   writer->SetFileName( outputLesionMap.c_str() );
   writer->SetInput( hyperintenseLesions->GetOutput() );
   writer->SetUseCompression(1);
+  profiler.Observe(writer, "writer");
   writer->Update();
 
+  if (!returnParameterFile.empty()) {
+      std::ofstream returnFile(returnParameterFile.c_str());
+      returnFile<<"numberOfLesions = "<<hyperintenseLesions->GetNumberOfLesions()<<std::endl;
+  }
+  if (!profileOutput.empty()) {
+      std::ofstream profileFile(profileOutput.c_str());
+      profiler.Write(profileFile);
+  }
+
   return EXIT_SUCCESS;
 }
 
@@ -123,6 +118,10 @@ int main( int argc, char * argv[] )
 {
   PARSE_ARGS;
 
+  //Thread budget given by the caller, 0 keeps the ITK default (every core). The former
+  //default is restored on return, since an in-process CLI shares it with Slicer
+  itk::ThreadBudget threadBudget(numberOfThreads);
+
   itk::ImageIOBase::IOPixelType     pixelType;
   itk::ImageIOBase::IOComponentType componentType;
 
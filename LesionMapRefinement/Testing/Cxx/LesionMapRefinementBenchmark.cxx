@@ -0,0 +1,34 @@
+#include "CLIBenchmark.h"
+
+#ifdef WIN32
+# define MODULE_IMPORT __declspec(dllimport)
+#else
+# define MODULE_IMPORT
+#endif
+
+extern "C" MODULE_IMPORT int ModuleEntryPoint(int, char* []);
+
+//Arguments: size temporaryDirectory referenceCSV tolerance
+int LesionMapRefinementBenchmark(int argc, char* argv[])
+{
+  unsigned int size;
+  std::string directory, referenceFile;
+  double tolerance;
+  if (!CLIBenchmark::ParseArguments(argc, argv, size, directory, referenceFile, tolerance))
+    {
+    return EXIT_FAILURE;
+    }
+
+  std::ostringstream prefix;
+  prefix<<directory<<"/LesionMapRefinementBenchmark"<<size<<"_";
+  CLIBenchmark::WriteSyntheticVolumes(prefix.str(), size);
+
+  std::vector<std::string> arguments;
+  arguments.push_back("--lesionThr");
+  arguments.push_back("0.5");
+  arguments.push_back(prefix.str()+"lesionProbability.nrrd");
+  arguments.push_back(prefix.str()+"wmMask.nrrd");
+  arguments.push_back(prefix.str()+"output.nrrd");
+  return CLIBenchmark::RunBenchmark("LesionMapRefinement", ModuleEntryPoint, arguments, size, referenceFile, tolerance,
+                                    directory+"/LesionMapRefinementBenchmark.csv");
+}
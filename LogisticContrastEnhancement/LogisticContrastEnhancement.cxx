@@ -16,13 +16,17 @@
 #include "itkImageFileWriter.h"
 
 #include "itkLogisticContrastEnhancementImageFilter.h"
-#include "itkSigmoidImageFilter.h"
-#include "itkMaskImageFilter.h"
-#include "itkThresholdImageFilter.h"
+#include "itkSigmoidLookupTableImageFilter.h"
+#include "itkMaskedIntensityHistogramCalculator.h"
 #include "itkImageRegionIterator.h"
 #include "itkImageRegionConstIterator.h"
 
+#include "itkFilterProfiler.h"
+#include "itkThreadBudget.h"
+#include "itkMultiThreaderBase.h"
 #include "itkPluginUtilities.h"
+#include <algorithm>
+#include <fstream>
 
 #include "LogisticContrastEnhancementCLP.h"
 
@@ -54,10 +58,8 @@ int DoIt( int argc, char * argv[], T )
     typedef itk::LogisticContrastEnhancementImageFilter<InputImageType, InputImageType> LogisticEnhancementType;
     typename LogisticEnhancementType::Pointer enhParameters = LogisticEnhancementType::New();
 
-    typedef itk::MaskImageFilter<InputImageType, LabelImageType>      MaskType;
-    typename MaskType::Pointer mask = MaskType::New();
-
-    typedef itk::SigmoidImageFilter<InputImageType, OutputImageType>  SigmoidType;
+    //Integer inputs map the voxels through a sigmoid lookup table
+    typedef itk::SigmoidLookupTableImageFilter<InputImageType, OutputImageType>  SigmoidType;
     typename SigmoidType::Pointer sigmoid = SigmoidType::New();
 
     typename ReaderType::Pointer reader = ReaderType::New();
@@ -66,63 +68,30 @@ int DoIt( int argc, char * argv[], T )
     reader->SetFileName( inputVolume.c_str() );
     labelReader->SetFileName( maskVolume.c_str() );
 
-    mask->SetInput(reader->GetOutput());
-    mask->SetMaskImage(labelReader->GetOutput());
+    //Wall time and buffer size of each step, written to profileOutput
+    itk::FilterProfiler profiler;
+    profiler.Observe(reader, "inputReader");
+    profiler.Observe(labelReader, "maskReader");
 
     //Removing signal outliers using a similar strategy applied at BET brain extraction algorithm.
-    typedef itk::Statistics::ImageToHistogramFilter< InputImageType >   HistogramFilterType;
-    typename  HistogramFilterType::Pointer histogramFilter =  HistogramFilterType::New();
-
-    typedef typename HistogramFilterType::HistogramSizeType   SizeType;
-    SizeType size( 1 );
-    size[0] = 255;
-    histogramFilter->SetHistogramSize( size );
-
-    typename HistogramFilterType::HistogramMeasurementVectorType lowerBound( 1 );
-    typename HistogramFilterType::HistogramMeasurementVectorType upperBound( 1 );
-    lowerBound[0] = 0;
-    upperBound[0] = 256;
-    histogramFilter->SetHistogramBinMinimum( lowerBound );
-    histogramFilter->SetHistogramBinMaximum( upperBound );
-
-    histogramFilter->SetInput(  mask->GetOutput()  );
-    histogramFilter->Update();
-
-    typedef typename HistogramFilterType::HistogramType  HistogramType;
-    const HistogramType * histogram = histogramFilter->GetOutput();
-
-    vector<double> cdf;
-    double sum=0,cdf_sum=0;
-    for (int p = 0; p < histogram->Size(); ++p) {
-        sum += histogram->GetFrequency(p, 0);
-    }
-
-    for (int i = 0; i < histogram->Size(); ++i) {
-        cdf_sum+=(double)histogram->GetFrequency(i, 0)/(double)sum;
-        cdf.push_back(cdf_sum);
-    }
-
-    InputPixelType lowThr, highThr;
-    for (int i = 0; i < cdf.size(); ++i) {
-        //Correcting data set to remove CDF lower than 2% and higher than 98%.
-        //Finding the threshold values to cut each part of the image histogram.
-        if (cdf[i]>0.005 && cdf[i]<0.01) {
-            lowThr=histogram->GetBinMax(0, i);
-        }
-        if (cdf[i]>0.98 && cdf[i]<0.99) {
-            highThr= histogram->GetBinMax(0, i);
-        }
-    }
-
-    typedef itk::ThresholdImageFilter< InputImageType >   ThresholdType;
-    typename ThresholdType::Pointer cleanMask = ThresholdType::New();
-    cleanMask->SetInput(mask->GetOutput());
-    cleanMask->ThresholdOutside(lowThr, highThr);
-    cleanMask->SetOutsideValue(0);
-
+    //The histogram bins follow the masked intensity range, so the cut points hold for any bit depth.
+    typedef itk::MaskedIntensityHistogramCalculator<InputImageType, LabelImageType>  HistogramCalculatorType;
+    typename HistogramCalculatorType::Pointer clipHistogram = HistogramCalculatorType::New();
+    clipHistogram->SetImage(reader->GetOutput());
+    clipHistogram->SetMaskImage(labelReader->GetOutput());
+    clipHistogram->SetNumberOfStreamDivisions(numberOfTiles);
+    profiler.Begin("clipHistogram");
+    clipHistogram->Compute();
+    profiler.End("clipHistogram");
+    //The brain mask is not needed anymore
+    labelReader->GetOutput()->ReleaseData();
+
+    //Masked voxels below the 1% and above the 99% of the CDF are clipped.
+    const itk::SizeValueType lowBin = clipHistogram->GetPercentileBin(0.01);
+    const itk::SizeValueType highBin = clipHistogram->GetPercentileBin(0.99);
+    std::cout<<"Clipping: "<<clipHistogram->GetBinValue(lowBin)<<" - "<<clipHistogram->GetBinValue(highBin)<<std::endl;
 
     //Inserting data in the Logistic Enhancemente algorithm.
-    enhParameters->SetInput(cleanMask->GetOutput());
     enhParameters->SetMaximumOutput(1.0);
     enhParameters->SetMinimumOutput(0.0);
     enhParameters->SetNumberOfBins(numberOfBins);
@@ -144,7 +113,41 @@ int DoIt( int argc, char * argv[], T )
         enhParameters->SetThresholdMethod(LogisticEnhancementType::INTERMODES);
     }
 
-    enhParameters->Update();
+    //The clipped image keeps the masked voxels within the cut points, the other ones are zero. Its threshold
+    //histogram is filled from the clipping histogram, so the volume is not read again.
+    profiler.Begin("estimateParameters");
+    itk::SizeValueType zeros = clipHistogram->GetNumberOfVoxels();
+    double cleanMinimum = itk::NumericTraits<double>::max();
+    double cleanMaximum = itk::NumericTraits<double>::NonpositiveMin();
+    for (itk::SizeValueType bin = lowBin; bin <= highBin; ++bin) {
+        if (clipHistogram->GetFrequency(bin)>0 && clipHistogram->GetBinValue(bin)!=0.0) {
+            zeros-=clipHistogram->GetFrequency(bin);
+            cleanMinimum=std::min(cleanMinimum, clipHistogram->GetBinValue(bin));
+            cleanMaximum=std::max(cleanMaximum, clipHistogram->GetBinValue(bin));
+        }
+    }
+    if (zeros>0) {
+        cleanMinimum=std::min(cleanMinimum, 0.0);
+        cleanMaximum=std::max(cleanMaximum, 0.0);
+    }
+    typedef typename LogisticEnhancementType::HistogramType HistogramType;
+    typename HistogramType::Pointer thresholdHistogram = enhParameters->MakeThresholdHistogram(cleanMinimum, cleanMaximum);
+    typename HistogramType::MeasurementVectorType measurement(1);
+    typename HistogramType::IndexType index(1);
+    for (itk::SizeValueType bin = lowBin; bin <= highBin; ++bin) {
+        if (clipHistogram->GetFrequency(bin)>0 && clipHistogram->GetBinValue(bin)!=0.0) {
+            measurement[0]=clipHistogram->GetBinValue(bin);
+            if (thresholdHistogram->GetIndex(measurement, index)) {
+                thresholdHistogram->IncreaseFrequencyOfIndex(index, clipHistogram->GetFrequency(bin));
+            }
+        }
+    }
+    measurement[0]=0.0;
+    if (zeros>0 && thresholdHistogram->GetIndex(measurement, index)) {
+        thresholdHistogram->IncreaseFrequencyOfIndex(index, zeros);
+    }
+    enhParameters->EstimateParameters(thresholdHistogram, cleanMaximum);
+    profiler.End("estimateParameters");
     std::cout<<"Beta: "<<enhParameters->GetBeta()<<" - Alpha: "<<enhParameters->GetAlpha()<<std::endl;
 
     sigmoid->SetInput(reader->GetOutput());
@@ -152,13 +155,29 @@ int DoIt( int argc, char * argv[], T )
     sigmoid->SetAlpha(enhParameters->GetAlpha());
     sigmoid->SetOutputMinimum(0.0);
     sigmoid->SetOutputMaximum(1.0);
+    //The input volume has no other consumer, the output reuses its buffer
+    sigmoid->InPlaceOn();
+    profiler.Observe(sigmoid, "sigmoid");
 
     typename WriterType::Pointer writer = WriterType::New();
     writer->SetFileName( outputVolume.c_str() );
     writer->SetInput( sigmoid->GetOutput() );
-    writer->SetUseCompression(1);
+    //Compressed files can not be written tile by tile.
+    writer->SetUseCompression(numberOfTiles<=1);
+    writer->SetNumberOfStreamDivisions(numberOfTiles);
+    profiler.Observe(writer, "writer");
     writer->Update();
 
+    if (!returnParameterFile.empty()) {
+        std::ofstream returnFile(returnParameterFile.c_str());
+        returnFile<<"alpha = "<<enhParameters->GetAlpha()<<std::endl;
+        returnFile<<"beta = "<<enhParameters->GetBeta()<<std::endl;
+    }
+    if (!profileOutput.empty()) {
+        std::ofstream profileFile(profileOutput.c_str());
+        profiler.Write(profileFile);
+    }
+
     return EXIT_SUCCESS;
 }
 
@@ -169,6 +188,10 @@ int main( int argc, char * argv[] )
 {
     PARSE_ARGS;
 
+    //Thread budget given by the caller, 0 keeps the ITK default (every core). The former
+    //default is restored on return, since an in-process CLI shares it with Slicer
+    itk::ThreadBudget threadBudget(numberOfThreads);
+
     itk::ImageIOBase::IOPixelType     pixelType;
     itk::ImageIOBase::IOComponentType componentType;
 
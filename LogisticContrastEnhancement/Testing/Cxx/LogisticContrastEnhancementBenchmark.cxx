@@ -0,0 +1,32 @@
+#include "CLIBenchmark.h"
+
+#ifdef WIN32
+# define MODULE_IMPORT __declspec(dllimport)
+#else
+# define MODULE_IMPORT
+#endif
+
+extern "C" MODULE_IMPORT int ModuleEntryPoint(int, char* []);
+
+//Arguments: size temporaryDirectory referenceCSV tolerance
+int LogisticContrastEnhancementBenchmark(int argc, char* argv[])
+{
+  unsigned int size;
+  std::string directory, referenceFile;
+  double tolerance;
+  if (!CLIBenchmark::ParseArguments(argc, argv, size, directory, referenceFile, tolerance))
+    {
+    return EXIT_FAILURE;
+    }
+
+  std::ostringstream prefix;
+  prefix<<directory<<"/LogisticContrastEnhancementBenchmark"<<size<<"_";
+  CLIBenchmark::WriteSyntheticVolumes(prefix.str(), size);
+
+  std::vector<std::string> arguments;
+  arguments.push_back(prefix.str()+"flair.nrrd");
+  arguments.push_back(prefix.str()+"brainMask.nrrd");
+  arguments.push_back(prefix.str()+"output.nrrd");
+  return CLIBenchmark::RunBenchmark("LogisticContrastEnhancement", ModuleEntryPoint, arguments, size, referenceFile, tolerance,
+                                    directory+"/LogisticContrastEnhancementBenchmark.csv");
+}
@@ -18,8 +18,10 @@
 #endif
 
 extern "C" MODULE_IMPORT int ModuleEntryPoint(int, char* []);
+int LogisticContrastEnhancementBenchmark(int, char* []);
 
 void RegisterTests()
 {
   StringToTestFunctionMap["ModuleEntryPoint"] = ModuleEntryPoint;
+  StringToTestFunctionMap["LogisticContrastEnhancementBenchmark"] = LogisticContrastEnhancementBenchmark;
 }
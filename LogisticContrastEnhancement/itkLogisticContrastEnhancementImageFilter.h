@@ -18,6 +18,7 @@
 #include "itkImageToImageFilter.h"
 #include "itkImage.h"
 #include "itkNumericTraits.h"
+#include "itkImageToHistogramFilter.h"
 
 namespace itk
 {
@@ -53,6 +54,9 @@ public:
     typedef typename InputImageType::PixelType                 InputPixelType;
     typedef typename OutputImageType::PixelType                OutputPixelType;
 
+    typedef Statistics::ImageToHistogramFilter<InputImageType>  HistogramFilterType;
+    typedef typename HistogramFilterType::HistogramType         HistogramType;
+
     /** Set the maximum output. */
     itkSetMacro(MaximumOutput, double)
 
@@ -72,6 +76,9 @@ public:
     /** Set threshold method. */
     itkSetMacro(ThresholdMethod, unsigned char)
 
+    /** Set the number of tiles used to stream the input in EstimateParameters(). */
+    itkSetMacro(NumberOfStreamDivisions, unsigned int)
+
     itkGetMacro(FlipObjectArea, bool)
     itkGetMacro(Alpha, double)
     itkGetMacro(Beta, double)
@@ -80,6 +87,22 @@ public:
     itkGetMacro(NumberOfBins, unsigned int)
     itkGetMacro(Tolerance, char)
     itkGetMacro(ThresholdMethod, unsigned char)
+    itkGetMacro(NumberOfStreamDivisions, unsigned int)
+
+    /** Compute the (alpha,beta) parameters without generating the output image.
+     * The input is streamed in NumberOfStreamDivisions tiles, the threshold
+     * histogram and the maximum being accumulated over all the tiles. */
+    void EstimateParameters();
+
+    /** Compute the (alpha,beta) parameters from the threshold histogram of the
+     * input and its maximum, without reading the input. The histogram is made by
+     * MakeThresholdHistogram() from the input minimum and maximum, and filled by
+     * the caller (e.g. from a histogram of the input it already has). */
+    void EstimateParameters(const HistogramType * histogram, double maximum);
+
+    /** Empty threshold histogram with the bins EstimateParameters() uses for an
+     * input in [minimum, maximum]. */
+    typename HistogramType::Pointer MakeThresholdHistogram(double minimum, double maximum) const;
 
 #ifdef ITK_USE_CONCEPT_CHECKING
     // Begin concept checking
@@ -110,6 +133,7 @@ protected:
     double m_MinimumOutput;
     unsigned int m_NumberOfBins;
     unsigned char m_ThresholdMethod;
+    unsigned int m_NumberOfStreamDivisions;
 
     void GenerateData();
 private:
@@ -117,6 +141,8 @@ private:
     LogisticContrastEnhancementImageFilter(const Self &); //purposely not implemented
     void operator=(const Self &);  //purposely not implemented
     double sigmoid(double x, double alpha, double beta);
+    void computeParameters(const InputImageType * image, unsigned int numberOfStreamDivisions);
+    void computeParameters(const HistogramType * histogram, double maximum);
     void checkTolerance(char tolerance);
 };
 
@@ -19,18 +19,19 @@
 
 
 //Threshold methods
-#include <itkMaximumEntropyThresholdImageFilter.h>
-#include <itkOtsuThresholdImageFilter.h>
-#include <itkIsoDataThresholdImageFilter.h>
-#include <itkRenyiEntropyThresholdImageFilter.h>
-#include <itkMomentsThresholdImageFilter.h>
-#include <itkYenThresholdImageFilter.h>
-#include <itkIntermodesThresholdImageFilter.h>
-
+#include <itkMaximumEntropyThresholdCalculator.h>
+#include <itkOtsuThresholdCalculator.h>
+#include <itkIsoDataThresholdCalculator.h>
+#include <itkRenyiEntropyThresholdCalculator.h>
+#include <itkMomentsThresholdCalculator.h>
+#include <itkYenThresholdCalculator.h>
+#include <itkIntermodesThresholdCalculator.h>
+
+#include <itkImageToHistogramFilter.h>
 #include <itkImageRegionConstIterator.h>
 #include <itkImageRegionIterator.h>
 #include <itkStatisticsImageFilter.h>
-#include <itkSigmoidImageFilter.h>
+#include "itkSigmoidLookupTableImageFilter.h"
 
 #include <math.h>
 
@@ -50,142 +51,159 @@ LogisticContrastEnhancementImageFilter< TInput, TOutput >
     this->m_Tolerance=1;
     this->m_NumberOfBins=128;
     this->m_ThresholdMethod=1;
+    this->m_NumberOfStreamDivisions=1;
 }
 
 template< typename TInput, typename TOutput >
 void
 LogisticContrastEnhancementImageFilter< TInput, TOutput >
-::GenerateData()
+::EstimateParameters()
 {
-    checkTolerance(m_Tolerance);
+    computeParameters(this->GetInput(), m_NumberOfStreamDivisions);
+}
+
+template< typename TInput, typename TOutput >
+void
+LogisticContrastEnhancementImageFilter< TInput, TOutput >
+::EstimateParameters(const HistogramType * histogram, double maximum)
+{
+    computeParameters(histogram, maximum);
+}
+
+template< typename TInput, typename TOutput >
+typename LogisticContrastEnhancementImageFilter< TInput, TOutput >::HistogramType::Pointer
+LogisticContrastEnhancementImageFilter< TInput, TOutput >
+::MakeThresholdHistogram(double minimum, double maximum) const
+{
+    //Same range as an automatic minimum-maximum histogram of ImageToHistogramFilter
+    typename HistogramType::SizeType size(1);
+    size[0]=m_NumberOfBins;
+    typename HistogramType::MeasurementVectorType lowerBound(1);
+    typename HistogramType::MeasurementVectorType upperBound(1);
+    lowerBound[0]=minimum;
+    upperBound[0]=maximum+((maximum-minimum)/static_cast<double>(m_NumberOfBins))/HistogramFilterType::New()->GetMarginalScale();
+    typename HistogramType::Pointer histogram = HistogramType::New();
+    histogram->SetMeasurementVectorSize(1);
+    histogram->Initialize(size, lowerBound, upperBound);
+    return histogram;
+}
 
+template< typename TInput, typename TOutput >
+void
+LogisticContrastEnhancementImageFilter< TInput, TOutput >
+::GenerateData()
+{
     //Input image
     typename InputImageType::ConstPointer input = this->GetInput();
-    //Output image
-    typename OutputImageType::Pointer output = this->GetOutput();
-    output->SetRegions(input->GetBufferedRegion());
-    output->Allocate();
+
+    //The input is already buffered, a graft keeps the parameter passes from updating it again.
+    typename InputImageType::Pointer bufferedInput = InputImageType::New();
+    bufferedInput->Graft(input);
+    computeParameters(bufferedInput, 1);
+    const double alpha=m_Alpha;
+    const double beta=m_Beta;
+
+    //Apply sigmoid on input image, written straight into the output buffer
+    typedef itk::SigmoidLookupTableImageFilter<InputImageType, OutputImageType> SigmoidFilterType;
+    typename SigmoidFilterType::Pointer sigmoid = SigmoidFilterType::New();
+    sigmoid->SetInput(bufferedInput);
+    sigmoid->SetOutputMinimum(m_MinimumOutput);
+    sigmoid->SetOutputMaximum(m_MaximumOutput);
+    sigmoid->SetAlpha(alpha);
+    sigmoid->SetBeta(beta);
+    sigmoid->GraftOutput(this->GetOutput());
+    sigmoid->Update();
+    this->GraftOutput(sigmoid->GetOutput());
+}
+
+template< typename TInput, typename TOutput >
+void
+LogisticContrastEnhancementImageFilter< TInput, TOutput >
+::computeParameters(const InputImageType * image, unsigned int numberOfStreamDivisions)
+{
+    checkTolerance(m_Tolerance);
+
+    //First pass: image maximum and range of the threshold histogram
+    typedef itk::StatisticsImageFilter<InputImageType> StatisticsType;
+    typename StatisticsType::Pointer imageStatistics = StatisticsType::New();
+    imageStatistics->SetInput(image);
+    imageStatistics->SetNumberOfStreamDivisions(numberOfStreamDivisions);
+    imageStatistics->Update();
+
+    //Second pass: threshold histogram, with the same range as an automatic minimum-maximum histogram
+    typename HistogramType::Pointer bins = MakeThresholdHistogram(static_cast<double>(imageStatistics->GetMinimum()),
+                                                                  static_cast<double>(imageStatistics->GetMaximum()));
+    typename HistogramFilterType::Pointer histogramFilter = HistogramFilterType::New();
+    typename HistogramFilterType::HistogramSizeType size(1);
+    size[0]=m_NumberOfBins;
+    typename HistogramFilterType::HistogramMeasurementVectorType lowerBound(1);
+    typename HistogramFilterType::HistogramMeasurementVectorType upperBound(1);
+    lowerBound[0]=bins->GetBinMin(0, 0);
+    upperBound[0]=bins->GetBinMax(0, m_NumberOfBins-1);
+    histogramFilter->SetInput(image);
+    histogramFilter->SetHistogramSize(size);
+    histogramFilter->SetAutoMinimumMaximum(false);
+    histogramFilter->SetHistogramBinMinimum(lowerBound);
+    histogramFilter->SetHistogramBinMaximum(upperBound);
+    histogramFilter->SetNumberOfStreamDivisions(numberOfStreamDivisions);
+    histogramFilter->Update();
+
+    computeParameters(histogramFilter->GetOutput(), static_cast<double>(imageStatistics->GetMaximum()));
+}
+
+template< typename TInput, typename TOutput >
+void
+LogisticContrastEnhancementImageFilter< TInput, TOutput >
+::computeParameters(const HistogramType * histogram, double maximum)
+{
+    checkTolerance(m_Tolerance);
 
     //Image threshold
-    typedef itk::MaximumEntropyThresholdImageFilter<InputImageType, InputImageType>  MaxEntropyThresholdType;
-    typedef itk::OtsuThresholdImageFilter<InputImageType, InputImageType>  OstuThresholdType;
-    typedef itk::RenyiEntropyThresholdImageFilter<InputImageType, InputImageType>  RenyiThresholdType;
-    typedef itk::IsoDataThresholdImageFilter<InputImageType, InputImageType>  IsoDataThresholdType;
-    typedef itk::MomentsThresholdImageFilter<InputImageType, InputImageType>  MomentsThresholdType;
-    typedef itk::YenThresholdImageFilter<InputImageType, InputImageType>  YenThresholdType;
-    typedef itk::IntermodesThresholdImageFilter<InputImageType, InputImageType>  IntermodesThresholdType;
-
-    typename MaxEntropyThresholdType::Pointer maxEnThreshold = MaxEntropyThresholdType::New();
-    typename OstuThresholdType::Pointer otsuThreshold = OstuThresholdType::New();
-
-    typename RenyiThresholdType::Pointer renyiThreshold = RenyiThresholdType::New();
-    typename IsoDataThresholdType::Pointer isoDataThreshold = IsoDataThresholdType::New();
-    typename MomentsThresholdType::Pointer momentsThreshold = MomentsThresholdType::New();
-    typename YenThresholdType::Pointer yenThreshold = YenThresholdType::New();
-    typename IntermodesThresholdType::Pointer intermodesThreshold = IntermodesThresholdType::New();
-
-    double thr=0.0;
+    typedef itk::HistogramThresholdCalculator<HistogramType, InputPixelType>          CalculatorType;
+    typename CalculatorType::Pointer calculator;
     switch (m_ThresholdMethod) {
     case MAXENTROPY:
-        maxEnThreshold->SetInput(input);
-        maxEnThreshold->SetInsideValue(0);
-        maxEnThreshold->SetOutsideValue(1);
-        maxEnThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        maxEnThreshold->Update();
-        thr=maxEnThreshold->GetThreshold();
+        calculator = itk::MaximumEntropyThresholdCalculator<HistogramType, InputPixelType>::New();
         break;
     case OTSU:
-        otsuThreshold->SetInput(input);
-        otsuThreshold->SetInsideValue(0);
-        otsuThreshold->SetOutsideValue(1);
-        otsuThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        otsuThreshold->Update();
-        thr=otsuThreshold->GetThreshold();
+        calculator = itk::OtsuThresholdCalculator<HistogramType, InputPixelType>::New();
         break;
     case RENYI:
-        renyiThreshold->SetInput(input);
-        renyiThreshold->SetInsideValue(0);
-        renyiThreshold->SetOutsideValue(1);
-        renyiThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        renyiThreshold->Update();
-        thr=renyiThreshold->GetThreshold();
+        calculator = itk::RenyiEntropyThresholdCalculator<HistogramType, InputPixelType>::New();
         break;
     case MOMENTS:
-        momentsThreshold->SetInput(input);
-        momentsThreshold->SetInsideValue(0);
-        momentsThreshold->SetOutsideValue(1);
-        momentsThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        momentsThreshold->Update();
-        thr=momentsThreshold->GetThreshold();
+        calculator = itk::MomentsThresholdCalculator<HistogramType, InputPixelType>::New();
         break;
     case ISODATA:
-        isoDataThreshold->SetInput(input);
-        isoDataThreshold->SetInsideValue(0);
-        isoDataThreshold->SetOutsideValue(1);
-        isoDataThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        isoDataThreshold->Update();
-        thr=isoDataThreshold->GetThreshold();
+        calculator = itk::IsoDataThresholdCalculator<HistogramType, InputPixelType>::New();
         break;
     case YEN:
-        yenThreshold->SetInput(input);
-        yenThreshold->SetInsideValue(0);
-        yenThreshold->SetOutsideValue(1);
-        yenThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        yenThreshold->Update();
-        thr=yenThreshold->GetThreshold();
+        calculator = itk::YenThresholdCalculator<HistogramType, InputPixelType>::New();
         break;
     case INTERMODES:
-        intermodesThreshold->SetInput(input);
-        intermodesThreshold->SetInsideValue(0);
-        intermodesThreshold->SetOutsideValue(1);
-        intermodesThreshold->SetNumberOfHistogramBins(m_NumberOfBins);
-        intermodesThreshold->Update();
-        thr=intermodesThreshold->GetThreshold();
+        calculator = itk::IntermodesThresholdCalculator<HistogramType, InputPixelType>::New();
         break;
     default:
         std::cout<<"ERROR: The threshold method is not valid! Choose the options available in the ThresholdMethod enumeration."<<std::endl;
         exit(EXIT_FAILURE);
         break;
     }
+    calculator->SetInput(histogram);
+    calculator->Update();
+    double thr=static_cast<double>(calculator->GetThreshold());
 
     //Set Beta
-    typedef itk::StatisticsImageFilter<InputImageType> StatisticsType;
-    typename StatisticsType::Pointer imageStatistics = StatisticsType::New();
-    imageStatistics->SetInput(input);
-    imageStatistics->Update();
-
     double beta=0.0;
     if (m_FlipObjectArea) {
         beta = thr/2.0;
     }else{
-        beta = ((imageStatistics->GetMaximum()-thr)/2.0)+thr;
+        beta = ((maximum-thr)/2.0)+thr;
     }
 
     //Set Alpha
     double alpha=0.0;
     alpha=((-1)*(thr)+beta)/(log((100.0-static_cast<double>(m_Tolerance))/static_cast<double>(m_Tolerance)));
 
-    //Apply sigmoid on input image
-    typedef itk::SigmoidImageFilter<InputImageType, OutputImageType> SigmoidFilterType;
-    typename SigmoidFilterType::Pointer sigmoid = SigmoidFilterType::New();
-    sigmoid->SetInput(input);
-    sigmoid->SetOutputMinimum(m_MinimumOutput);
-    sigmoid->SetOutputMaximum(m_MaximumOutput);
-    sigmoid->SetAlpha(alpha);
-    sigmoid->SetBeta(beta);
-    sigmoid->Update();
-
-    itk::ImageRegionConstIterator<TInput> sigmoidIterator(sigmoid->GetOutput(), sigmoid->GetOutput()->GetBufferedRegion());
-    itk::ImageRegionIterator<TOutput> outputIterator(output, output->GetBufferedRegion());
-
-    sigmoidIterator.IsAtBegin();
-    outputIterator.IsAtBegin();
-    while (!sigmoidIterator.IsAtEnd()) {
-        outputIterator.Set(sigmoidIterator.Get());
-        ++sigmoidIterator;
-        ++outputIterator;
-    }
-
     //Output the (alpha,beta) parameters
     m_Alpha=alpha;
     m_Beta=beta;
@@ -0,0 +1,131 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef __itkMaskedIntensityHistogramCalculator_h
+#define __itkMaskedIntensityHistogramCalculator_h
+#include "itkObject.h"
+#include "itkObjectFactory.h"
+#include "itkImage.h"
+#include "itkNumericTraits.h"
+
+#include <vector>
+
+namespace itk
+{
+
+/** \class MaskedIntensityHistogramCalculator
+ *
+ * Histogram of the image intensities inside a mask (nonzero mask voxels), with
+ * bins adapted to the masked intensity range. A first pass finds the masked
+ * range, a second one fills the histogram, both split over the threads and,
+ * when NumberOfStreamDivisions is above one, streamed tile by tile from the
+ * image and mask sources.
+ *
+ * Integer images whose masked range has at most MaximumNumberOfBins values get
+ * one bin per value, so the histogram and its percentiles are exact. Wider
+ * ranges and float images get MaximumNumberOfBins bins of the same width over
+ * the masked range, each represented by its center.
+ *
+ * GetPercentileBin() gives the first bin where the cumulative fraction of the
+ * masked voxels reaches a given fraction, so the percentiles are always within
+ * the masked range, whatever the input intensity range.
+ */
+template< typename TInputImage, typename TMaskImage >
+class ITK_EXPORT MaskedIntensityHistogramCalculator:
+        public Object
+{
+public:
+    /** Standard class typedefs. */
+    typedef MaskedIntensityHistogramCalculator  Self;
+    typedef Object                              Superclass;
+    typedef SmartPointer< Self >                Pointer;
+    typedef SmartPointer< const Self >          ConstPointer;
+
+    /** Method for creation through the object factory. */
+    itkNewMacro(Self)
+
+    /** Run-time type information (and related methods). */
+    itkTypeMacro(MaskedIntensityHistogramCalculator, Object)
+
+    typedef TInputImage                           InputImageType;
+    typedef TMaskImage                            MaskImageType;
+    typedef typename InputImageType::PixelType    InputPixelType;
+    typedef typename InputImageType::RegionType   RegionType;
+
+    itkSetConstObjectMacro(Image, InputImageType)
+    itkSetConstObjectMacro(MaskImage, MaskImageType)
+
+    /** Set the largest number of histogram bins. */
+    itkSetMacro(MaximumNumberOfBins, SizeValueType)
+
+    /** Set the number of tiles the image and mask are streamed in. */
+    itkSetMacro(NumberOfStreamDivisions, unsigned int)
+
+    itkGetConstMacro(MaximumNumberOfBins, SizeValueType)
+    itkGetConstMacro(NumberOfStreamDivisions, unsigned int)
+
+    /** Range and number of the masked voxels, and number of voxels of the image. */
+    itkGetConstMacro(Minimum, double)
+    itkGetConstMacro(Maximum, double)
+    itkGetConstMacro(NumberOfMaskedVoxels, SizeValueType)
+    itkGetConstMacro(NumberOfVoxels, SizeValueType)
+
+    /** Whether each bin holds a single integer value. */
+    itkGetConstMacro(Exact, bool)
+
+    /** Compute the masked range and histogram. */
+    void Compute();
+
+    SizeValueType GetNumberOfBins() const { return m_Frequencies.size(); }
+    SizeValueType GetFrequency(SizeValueType bin) const { return m_Frequencies[bin]; }
+
+    /** Intensity of a bin: its value for exact histograms, its center otherwise. */
+    double GetBinValue(SizeValueType bin) const;
+
+    /** First bin where the cumulative fraction of the masked voxels reaches fraction. */
+    SizeValueType GetPercentileBin(double fraction) const;
+
+protected:
+    MaskedIntensityHistogramCalculator();
+    virtual ~MaskedIntensityHistogramCalculator() {}
+    void PrintSelf(std::ostream & os, Indent indent) const;
+
+    typename InputImageType::ConstPointer m_Image;
+    typename MaskImageType::ConstPointer m_MaskImage;
+    SizeValueType m_MaximumNumberOfBins;
+    unsigned int m_NumberOfStreamDivisions;
+    double m_Minimum;
+    double m_Maximum;
+    SizeValueType m_NumberOfMaskedVoxels;
+    SizeValueType m_NumberOfVoxels;
+    bool m_Exact;
+private:
+    MaskedIntensityHistogramCalculator(const Self &); //purposely not implemented
+    void operator=(const Self &);  //purposely not implemented
+    void computeRange(const RegionType & region);
+    void computeHistogram(const RegionType & region);
+    void updateTile(const RegionType & region);
+
+    std::vector<SizeValueType> m_Frequencies;
+    double m_BinWidth;
+};
+
+} // end namespace itk
+
+#ifndef ITK_MANUAL_INSTANTIATION
+#include "itkMaskedIntensityHistogramCalculator.hxx"
+#endif
+
+#endif
@@ -0,0 +1,219 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef __itkMaskedIntensityHistogramCalculator_hxx
+#define __itkMaskedIntensityHistogramCalculator_hxx
+#include "itkMaskedIntensityHistogramCalculator.h"
+
+#include <itkImageRegionConstIterator.h>
+#include <itkImageRegionSplitterSlowDimension.h>
+#include <itkMultiThreaderBase.h>
+
+#include <algorithm>
+#include <cmath>
+#include <mutex>
+
+namespace itk
+{
+template< typename TInputImage, typename TMaskImage >
+MaskedIntensityHistogramCalculator< TInputImage, TMaskImage >
+::MaskedIntensityHistogramCalculator()
+{
+    this->m_MaximumNumberOfBins=1<<16;
+    this->m_NumberOfStreamDivisions=1;
+    this->m_Minimum=0.0;
+    this->m_Maximum=0.0;
+    this->m_NumberOfMaskedVoxels=0;
+    this->m_NumberOfVoxels=0;
+    this->m_Exact=false;
+    this->m_BinWidth=1.0;
+}
+
+template< typename TInputImage, typename TMaskImage >
+void
+MaskedIntensityHistogramCalculator< TInputImage, TMaskImage >
+::Compute()
+{
+    if (m_Image.IsNull() || m_MaskImage.IsNull()) {
+        itkExceptionMacro("The image and the mask image must be set");
+    }
+    InputImageType * image = const_cast<InputImageType *>(m_Image.GetPointer());
+    MaskImageType * maskImage = const_cast<MaskImageType *>(m_MaskImage.GetPointer());
+    image->UpdateOutputInformation();
+    maskImage->UpdateOutputInformation();
+    const RegionType largestRegion = image->GetLargestPossibleRegion();
+    if (maskImage->GetLargestPossibleRegion()!=largestRegion) {
+        itkExceptionMacro("The mask image does not have the size of the image");
+    }
+    m_NumberOfVoxels=largestRegion.GetNumberOfPixels();
+
+    ImageRegionSplitterSlowDimension::Pointer splitter = ImageRegionSplitterSlowDimension::New();
+    const unsigned int numberOfTiles = splitter->GetNumberOfSplits(largestRegion, std::max(1u, m_NumberOfStreamDivisions));
+
+    //First pass: masked intensity range
+    m_NumberOfMaskedVoxels=0;
+    m_Minimum=NumericTraits<double>::max();
+    m_Maximum=NumericTraits<double>::NonpositiveMin();
+    for (unsigned int tile = 0; tile < numberOfTiles; ++tile) {
+        RegionType region = largestRegion;
+        splitter->GetSplit(tile, numberOfTiles, region);
+        updateTile(region);
+        computeRange(region);
+    }
+    if (m_NumberOfMaskedVoxels==0) {
+        itkExceptionMacro("The mask image is empty");
+    }
+
+    //Bins of the masked range: one per value when it fits, equal width ones otherwise
+    const double numberOfValues = m_Maximum-m_Minimum+1.0;
+    m_Exact=NumericTraits<InputPixelType>::is_integer && numberOfValues<=static_cast<double>(m_MaximumNumberOfBins);
+    if (m_Exact) {
+        m_Frequencies.assign(static_cast<size_t>(numberOfValues), 0);
+        m_BinWidth=1.0;
+    }else{
+        m_Frequencies.assign(std::max<SizeValueType>(1, m_MaximumNumberOfBins), 0);
+        m_BinWidth=(m_Maximum-m_Minimum)/static_cast<double>(m_Frequencies.size());
+    }
+
+    //Second pass: histogram, a tile still buffered by the first pass is not read again
+    for (unsigned int tile = numberOfTiles; tile > 0; --tile) {
+        RegionType region = largestRegion;
+        splitter->GetSplit(tile-1, numberOfTiles, region);
+        updateTile(region);
+        computeHistogram(region);
+    }
+}
+
+template< typename TInputImage, typename TMaskImage >
+void
+MaskedIntensityHistogramCalculator< TInputImage, TMaskImage >
+::updateTile(const RegionType & region)
+{
+    InputImageType * image = const_cast<InputImageType *>(m_Image.GetPointer());
+    MaskImageType * maskImage = const_cast<MaskImageType *>(m_MaskImage.GetPointer());
+    image->SetRequestedRegion(region);
+    image->PropagateRequestedRegion();
+    image->UpdateOutputData();
+    maskImage->SetRequestedRegion(region);
+    maskImage->PropagateRequestedRegion();
+    maskImage->UpdateOutputData();
+}
+
+template< typename TInputImage, typename TMaskImage >
+void
+MaskedIntensityHistogramCalculator< TInputImage, TMaskImage >
+::computeRange(const RegionType & region)
+{
+    const InputImageType * image = m_Image;
+    const MaskImageType * maskImage = m_MaskImage;
+    std::mutex rangeMutex;
+    MultiThreaderBase::Pointer threader = MultiThreaderBase::New();
+    threader->template ParallelizeImageRegion<InputImageType::ImageDimension>(
+                region,
+                [this, image, maskImage, &rangeMutex](const RegionType & threadRegion) {
+        double threadMinimum=NumericTraits<double>::max();
+        double threadMaximum=NumericTraits<double>::NonpositiveMin();
+        SizeValueType threadCount=0;
+        ImageRegionConstIterator<MaskImageType> maskIt(maskImage, threadRegion);
+        for (ImageRegionConstIterator<InputImageType> it(image, threadRegion); !it.IsAtEnd(); ++it, ++maskIt) {
+            if (maskIt.Get()!=NumericTraits<typename MaskImageType::PixelType>::ZeroValue()) {
+                const double value=static_cast<double>(it.Get());
+                threadMinimum=std::min(threadMinimum, value);
+                threadMaximum=std::max(threadMaximum, value);
+                ++threadCount;
+            }
+        }
+        std::lock_guard<std::mutex> lock(rangeMutex);
+        m_Minimum=std::min(m_Minimum, threadMinimum);
+        m_Maximum=std::max(m_Maximum, threadMaximum);
+        m_NumberOfMaskedVoxels+=threadCount;
+    }, nullptr);
+}
+
+template< typename TInputImage, typename TMaskImage >
+void
+MaskedIntensityHistogramCalculator< TInputImage, TMaskImage >
+::computeHistogram(const RegionType & region)
+{
+    const InputImageType * image = m_Image;
+    const MaskImageType * maskImage = m_MaskImage;
+    const double minimum = m_Minimum;
+    const double scale = m_BinWidth>0.0 ? 1.0/m_BinWidth : 0.0;
+    const size_t lastBin = m_Frequencies.size()-1;
+    std::mutex histogramMutex;
+    MultiThreaderBase::Pointer threader = MultiThreaderBase::New();
+    threader->template ParallelizeImageRegion<InputImageType::ImageDimension>(
+                region,
+                [this, image, maskImage, minimum, scale, lastBin, &histogramMutex](const RegionType & threadRegion) {
+        std::vector<SizeValueType> threadFrequencies(lastBin+1, 0);
+        ImageRegionConstIterator<MaskImageType> maskIt(maskImage, threadRegion);
+        for (ImageRegionConstIterator<InputImageType> it(image, threadRegion); !it.IsAtEnd(); ++it, ++maskIt) {
+            if (maskIt.Get()!=NumericTraits<typename MaskImageType::PixelType>::ZeroValue()) {
+                const size_t bin=static_cast<size_t>((static_cast<double>(it.Get())-minimum)*scale);
+                ++threadFrequencies[std::min(bin, lastBin)];
+            }
+        }
+        std::lock_guard<std::mutex> lock(histogramMutex);
+        for (size_t bin = 0; bin <= lastBin; ++bin) {
+            m_Frequencies[bin]+=threadFrequencies[bin];
+        }
+    }, nullptr);
+}
+
+template< typename TInputImage, typename TMaskImage >
+double
+MaskedIntensityHistogramCalculator< TInputImage, TMaskImage >
+::GetBinValue(SizeValueType bin) const
+{
+    if (m_Exact) {
+        return m_Minimum+static_cast<double>(bin);
+    }
+    return m_Minimum+(static_cast<double>(bin)+0.5)*m_BinWidth;
+}
+
+template< typename TInputImage, typename TMaskImage >
+SizeValueType
+MaskedIntensityHistogramCalculator< TInputImage, TMaskImage >
+::GetPercentileBin(double fraction) const
+{
+    const double target = fraction*static_cast<double>(m_NumberOfMaskedVoxels);
+    SizeValueType cumulative = 0;
+    for (SizeValueType bin = 0; bin < m_Frequencies.size(); ++bin) {
+        cumulative+=m_Frequencies[bin];
+        if (cumulative>0 && static_cast<double>(cumulative)>=target) {
+            return bin;
+        }
+    }
+    return m_Frequencies.empty() ? 0 : m_Frequencies.size()-1;
+}
+
+template< typename TInputImage, typename TMaskImage >
+void
+MaskedIntensityHistogramCalculator< TInputImage, TMaskImage >
+::PrintSelf(std::ostream & os, Indent indent) const
+{
+    Superclass::PrintSelf(os, indent);
+    os << indent << "MaximumNumberOfBins: " << m_MaximumNumberOfBins << std::endl;
+    os << indent << "NumberOfStreamDivisions: " << m_NumberOfStreamDivisions << std::endl;
+    os << indent << "Minimum: " << m_Minimum << std::endl;
+    os << indent << "Maximum: " << m_Maximum << std::endl;
+    os << indent << "NumberOfMaskedVoxels: " << m_NumberOfMaskedVoxels << std::endl;
+    os << indent << "NumberOfBins: " << m_Frequencies.size() << std::endl;
+    os << indent << "Exact: " << m_Exact << std::endl;
+}
+
+} // end namespace itk
+
+#endif
@@ -0,0 +1,113 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef __itkSigmoidLookupTableImageFilter_h
+#define __itkSigmoidLookupTableImageFilter_h
+#include "itkInPlaceImageFilter.h"
+#include "itkImage.h"
+#include "itkNumericTraits.h"
+
+#include <vector>
+
+namespace itk
+{
+
+/** \class SigmoidLookupTableImageFilter
+ *
+ * Same output as SigmoidImageFilter:
+ *
+ *   f(x) = (Max-Min) / (1 + exp(-(x-Beta)/Alpha)) + Min
+ *
+ * For integer inputs the sigmoid is evaluated once per input value into a
+ * lookup table, then the voxels are mapped through the table. The table spans
+ * the whole pixel type range for 8 and 16 bit types, and the range of the
+ * requested region for larger integer types, unless it is wider than
+ * MaximumTableSize. Float inputs, and the integer ranges too wide for the
+ * table, evaluate the sigmoid on each voxel.
+ *
+ * With InPlaceOn() and the same input and output types, the output reuses
+ * the input buffer.
+ */
+template< typename TInputImage, typename TOutputImage >
+class ITK_EXPORT SigmoidLookupTableImageFilter:
+        public InPlaceImageFilter< TInputImage, TOutputImage >
+{
+public:
+    /** Convenient typedefs for simplifying declarations. */
+    typedef TInputImage  InputImageType;
+    typedef TOutputImage OutputImageType;
+
+    /** Standard class typedefs. */
+    typedef SigmoidLookupTableImageFilter                       Self;
+    typedef InPlaceImageFilter< TInputImage, TOutputImage >     Superclass;
+    typedef SmartPointer< Self >                                Pointer;
+    typedef SmartPointer< const Self >                          ConstPointer;
+
+    /** Method for creation through the object factory. */
+    itkNewMacro(Self)
+
+    /** Run-time type information (and related methods). */
+    itkTypeMacro(SigmoidLookupTableImageFilter, InPlaceImageFilter)
+
+    typedef typename InputImageType::PixelType          InputPixelType;
+    typedef typename OutputImageType::PixelType         OutputPixelType;
+    typedef typename Superclass::OutputImageRegionType  OutputImageRegionType;
+
+    itkSetMacro(Alpha, double)
+    itkSetMacro(Beta, double)
+    itkSetMacro(OutputMinimum, double)
+    itkSetMacro(OutputMaximum, double)
+
+    /** Set the largest number of lookup table entries. */
+    itkSetMacro(MaximumTableSize, SizeValueType)
+
+    itkGetConstMacro(Alpha, double)
+    itkGetConstMacro(Beta, double)
+    itkGetConstMacro(OutputMinimum, double)
+    itkGetConstMacro(OutputMaximum, double)
+    itkGetConstMacro(MaximumTableSize, SizeValueType)
+
+    /** Whether the last update mapped the voxels through the lookup table. */
+    itkGetConstMacro(UsedLookupTable, bool)
+
+protected:
+    SigmoidLookupTableImageFilter();
+    virtual ~SigmoidLookupTableImageFilter() {}
+    double m_Alpha;
+    double m_Beta;
+    double m_OutputMinimum;
+    double m_OutputMaximum;
+    SizeValueType m_MaximumTableSize;
+    bool m_UsedLookupTable;
+
+    void BeforeThreadedGenerateData();
+    void DynamicThreadedGenerateData(const OutputImageRegionType & outputRegionForThread);
+    void PrintSelf(std::ostream & os, Indent indent) const;
+private:
+    SigmoidLookupTableImageFilter(const Self &); //purposely not implemented
+    void operator=(const Self &);  //purposely not implemented
+    OutputPixelType sigmoid(double x) const;
+
+    std::vector<OutputPixelType> m_Table;
+    double m_TableMinimum;
+};
+
+} // end namespace itk
+
+#ifndef ITK_MANUAL_INSTANTIATION
+#include "itkSigmoidLookupTableImageFilter.hxx"
+#endif
+
+#endif
@@ -0,0 +1,141 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef __itkSigmoidLookupTableImageFilter_hxx
+#define __itkSigmoidLookupTableImageFilter_hxx
+#include "itkSigmoidLookupTableImageFilter.h"
+
+#include <itkImageRegionConstIterator.h>
+#include <itkImageRegionIterator.h>
+
+#include <algorithm>
+#include <cmath>
+#include <mutex>
+
+namespace itk
+{
+template< typename TInputImage, typename TOutputImage >
+SigmoidLookupTableImageFilter< TInputImage, TOutputImage >
+::SigmoidLookupTableImageFilter()
+{
+    this->m_Alpha=1.0;
+    this->m_Beta=0.0;
+    this->m_OutputMinimum=NumericTraits<OutputPixelType>::NonpositiveMin();
+    this->m_OutputMaximum=NumericTraits<OutputPixelType>::max();
+    this->m_MaximumTableSize=1<<20;
+    this->m_UsedLookupTable=false;
+    this->m_TableMinimum=0.0;
+    this->DynamicMultiThreadingOn();
+}
+
+template< typename TInputImage, typename TOutputImage >
+typename SigmoidLookupTableImageFilter< TInputImage, TOutputImage >::OutputPixelType
+SigmoidLookupTableImageFilter< TInputImage, TOutputImage >
+::sigmoid(double x) const
+{
+    //Same operations as itk::Functor::Sigmoid, so both paths give the same output
+    const double e = 1.0/(1.0+std::exp(-(x-m_Beta)/m_Alpha));
+    return static_cast<OutputPixelType>((m_OutputMaximum-m_OutputMinimum)*e+m_OutputMinimum);
+}
+
+template< typename TInputImage, typename TOutputImage >
+void
+SigmoidLookupTableImageFilter< TInputImage, TOutputImage >
+::BeforeThreadedGenerateData()
+{
+    m_Table.clear();
+    m_UsedLookupTable=false;
+    if (!NumericTraits<InputPixelType>::is_integer) {
+        return;
+    }
+
+    double minimum=static_cast<double>(NumericTraits<InputPixelType>::NonpositiveMin());
+    double maximum=static_cast<double>(NumericTraits<InputPixelType>::max());
+    if (sizeof(InputPixelType)>2) {
+        //Range of the requested region, found by the threads in one pass
+        const InputImageType * input = this->GetInput();
+        InputPixelType regionMinimum=NumericTraits<InputPixelType>::max();
+        InputPixelType regionMaximum=NumericTraits<InputPixelType>::NonpositiveMin();
+        std::mutex rangeMutex;
+        this->GetMultiThreader()->template ParallelizeImageRegion<InputImageType::ImageDimension>(
+                    this->GetOutput()->GetRequestedRegion(),
+                    [input, &regionMinimum, &regionMaximum, &rangeMutex](const typename InputImageType::RegionType & region) {
+            InputPixelType threadMinimum=NumericTraits<InputPixelType>::max();
+            InputPixelType threadMaximum=NumericTraits<InputPixelType>::NonpositiveMin();
+            for (ImageRegionConstIterator<InputImageType> it(input, region); !it.IsAtEnd(); ++it) {
+                threadMinimum=std::min(threadMinimum, it.Get());
+                threadMaximum=std::max(threadMaximum, it.Get());
+            }
+            std::lock_guard<std::mutex> lock(rangeMutex);
+            regionMinimum=std::min(regionMinimum, threadMinimum);
+            regionMaximum=std::max(regionMaximum, threadMaximum);
+        }, nullptr);
+        minimum=static_cast<double>(regionMinimum);
+        maximum=static_cast<double>(regionMaximum);
+    }
+    if (maximum<minimum || maximum-minimum+1.0>static_cast<double>(m_MaximumTableSize)) {
+        return;
+    }
+
+    m_TableMinimum=minimum;
+    m_Table.resize(static_cast<size_t>(maximum-minimum)+1);
+    for (size_t i = 0; i < m_Table.size(); ++i) {
+        m_Table[i]=sigmoid(minimum+static_cast<double>(i));
+    }
+    m_UsedLookupTable=true;
+}
+
+template< typename TInputImage, typename TOutputImage >
+void
+SigmoidLookupTableImageFilter< TInputImage, TOutputImage >
+::DynamicThreadedGenerateData(const OutputImageRegionType & outputRegionForThread)
+{
+    ImageRegionConstIterator<InputImageType> inputIt(this->GetInput(), outputRegionForThread);
+    ImageRegionIterator<OutputImageType> outputIt(this->GetOutput(), outputRegionForThread);
+
+    if (m_UsedLookupTable) {
+        const OutputPixelType * table = &m_Table[0];
+        const double tableMinimum = m_TableMinimum;
+        while (!outputIt.IsAtEnd()) {
+            outputIt.Set(table[static_cast<size_t>(static_cast<double>(inputIt.Get())-tableMinimum)]);
+            ++inputIt;
+            ++outputIt;
+        }
+    }else{
+        while (!outputIt.IsAtEnd()) {
+            outputIt.Set(sigmoid(static_cast<double>(inputIt.Get())));
+            ++inputIt;
+            ++outputIt;
+        }
+    }
+}
+
+template< typename TInputImage, typename TOutputImage >
+void
+SigmoidLookupTableImageFilter< TInputImage, TOutputImage >
+::PrintSelf(std::ostream & os, Indent indent) const
+{
+    Superclass::PrintSelf(os, indent);
+    os << indent << "Alpha: " << m_Alpha << std::endl;
+    os << indent << "Beta: " << m_Beta << std::endl;
+    os << indent << "OutputMinimum: " << m_OutputMinimum << std::endl;
+    os << indent << "OutputMaximum: " << m_OutputMaximum << std::endl;
+    os << indent << "MaximumTableSize: " << m_MaximumTableSize << std::endl;
+    os << indent << "UsedLookupTable: " << m_UsedLookupTable << std::endl;
+}
+
+} // end namespace itk
+
+#endif
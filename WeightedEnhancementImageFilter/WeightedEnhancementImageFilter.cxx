@@ -19,14 +19,20 @@
 
 #include "itkMaskImageFilter.h"
 #include "itkThresholdImageFilter.h"
+#include "itkBinaryThresholdImageFilter.h"
 #include "itkSubtractImageFilter.h"
 #include "itkMultiplyImageFilter.h"
 #include "itkAddImageFilter.h"
+#include "itkAndImageFilter.h"
 #include "itkStatisticsImageFilter.h"
-#include "itkRescaleIntensityImageFilter.h"
-#include "itkImageRegionIterator.h"
+#include "itkLabelStatisticsImageFilter.h"
+#include "itkIntensityWindowingImageFilter.h"
 
+#include "itkFilterProfiler.h"
+#include "itkThreadBudget.h"
+#include "itkMultiThreaderBase.h"
 #include "itkPluginUtilities.h"
+#include <fstream>
 
 #include "WeightedEnhancementImageFilterCLP.h"
 
@@ -38,6 +44,39 @@
 namespace
 {
 
+template <class TImage>
+void ComputeRange(const TImage * image, unsigned int numberOfTiles,
+                  typename TImage::PixelType & minimum, typename TImage::PixelType & maximum)
+{
+    //Streamed minimum and maximum, used in place of the whole volume rescaling.
+    typedef itk::StatisticsImageFilter<TImage>            StatisticsType;
+    typename StatisticsType::Pointer statistics = StatisticsType::New();
+    statistics->SetInput(image);
+    statistics->SetNumberOfStreamDivisions(numberOfTiles);
+    statistics->Update();
+    minimum=statistics->GetMinimum();
+    maximum=statistics->GetMaximum();
+    if (!(maximum > minimum)) {
+        maximum=minimum+itk::NumericTraits<typename TImage::PixelType>::OneValue();
+    }
+}
+
+template <class TImage, class TLabelImage>
+double ComputeLabelMean(const TImage * image, const TLabelImage * label, unsigned int numberOfTiles)
+{
+    //Streamed mean of the image where the label is 1.
+    typedef itk::LabelStatisticsImageFilter<TImage, TLabelImage>    LabelStatisticsType;
+    typename LabelStatisticsType::Pointer statistics = LabelStatisticsType::New();
+    statistics->SetInput(image);
+    statistics->SetLabelInput(label);
+    statistics->SetNumberOfStreamDivisions(numberOfTiles);
+    statistics->Update();
+    if (!statistics->HasLabel(1)) {
+        return 0.0;
+    }
+    return statistics->GetMean(1);
+}
+
 template <class T>
 int DoIt( int argc, char * argv[], T )
 {
@@ -54,7 +93,6 @@ int DoIt( int argc, char * argv[], T )
     typedef itk::ImageFileReader<InputImageType>      ReaderType;
     typedef itk::ImageFileReader<LabelImageType>      LabelReaderType;
     typedef itk::ImageFileWriter<OutputImageType>     WriterType;
-    //    typedef itk::ImageFileWriter<InputImageType>      WeightedWriterType;
 
     typename ReaderType::Pointer inputReader = ReaderType::New();
     typename ReaderType::Pointer contrastMapReader = ReaderType::New();
@@ -62,98 +100,105 @@ int DoIt( int argc, char * argv[], T )
 
     inputReader->SetFileName( inputVolume.c_str() );
     contrastMapReader->SetFileName( contrastMap.c_str() );
-    regionMaskReader->SetFileName( regionMask.c_str() );
+
+    //Wall time and buffer size of each step, written to profileOutput
+    itk::FilterProfiler profiler;
+    profiler.Observe(inputReader, "inputReader");
+    profiler.Observe(contrastMapReader, "contrastMapReader");
+    profiler.Observe(regionMaskReader, "regionMaskReader");
+
+    //Every global statistic is computed in a streamed pass, the images are then processed tile by tile.
+    typedef itk::IntensityWindowingImageFilter<InputImageType,InputImageType>  RescalerType;
+    typedef itk::BinaryThresholdImageFilter<InputImageType,LabelImageType>     NonZeroType;
+    typedef itk::MultiplyImageFilter< InputImageType >                        MultiplyType;
+
+    //Voxels different from zero in the input volume
+    typename NonZeroType::Pointer inputNonZero = NonZeroType::New();
+    inputNonZero->SetInput(inputReader->GetOutput());
+    inputNonZero->SetLowerThreshold(0);
+    inputNonZero->SetUpperThreshold(0);
+    inputNonZero->SetInsideValue(0);
+    inputNonZero->SetOutsideValue(1);
+    inputNonZero->ReleaseDataFlagOn();
+
+    InputPixelType contrastMinimum, contrastMaximum;
+    profiler.Begin("contrastMapRange");
+    ComputeRange<InputImageType>(contrastMapReader->GetOutput(), numberOfTiles, contrastMinimum, contrastMaximum);
+    profiler.End("contrastMapRange");
+
+    //Values returned to the caller
+    double regionMeanContrast=0.0, meanEnhancement=0.0;
+
+    typename MultiplyType::Pointer inputEnhanced = MultiplyType::New();
+    profiler.Observe(inputEnhanced, "weighting");
+    typename RescalerType::Pointer rescaledContrastMap = RescalerType::New();
+    rescaledContrastMap->SetInput(contrastMapReader->GetOutput());
+    rescaledContrastMap->SetWindowMinimum(contrastMinimum);
+    rescaledContrastMap->SetWindowMaximum(contrastMaximum);
+    //The range pass is done, the contrast map has no other consumer
+    rescaledContrastMap->InPlaceOn();
 
     if (maintainGaussianity) {
         //Rescale the contrast map to a range that facilitates the signal enhancement.
         //In practice, the lesion probability are realocated to a range between 1 < l < max(weighting), where the weight is provided by the user.
-        typedef itk::RescaleIntensityImageFilter<InputImageType,InputImageType> RescalerType;
-        typename RescalerType::Pointer rescaledContrastMap = RescalerType::New();
-        rescaledContrastMap->SetInput(contrastMapReader->GetOutput());
         rescaledContrastMap->SetOutputMaximum(2.0 + (2.0 * weight));
         rescaledContrastMap->SetOutputMinimum(1.0);
 
         //Apply the weighting map over the input image. The resulted image has an improved signal contrast.
-        typedef itk::MultiplyImageFilter< InputImageType >      MultiplyType;
-        typename MultiplyType::Pointer inputEnhanced = MultiplyType::New();
         inputEnhanced->SetInput1(inputReader->GetOutput());
         inputEnhanced->SetInput2(rescaledContrastMap->GetOutput());
-        inputEnhanced->Update();
 
         //Info: Mean lesion contrast enhancement achieved in this iteration
-        typedef itk::ImageRegionIterator< InputImageType >              IteratorType;
-        IteratorType enhancedIt(inputEnhanced->GetOutput(), inputEnhanced->GetOutput()->GetBufferedRegion());
-        IteratorType origIt(inputReader->GetOutput(),inputReader->GetOutput()->GetBufferedRegion());
-
-        enhancedIt.GoToBegin();
-        origIt.GoToBegin();
-        InputPixelType meanBoost=0;
-        int M=0;
-        while (!enhancedIt.IsAtEnd()) {
-            if (enhancedIt.Get()!=static_cast<InputPixelType>(0)) {
-                meanBoost+=(enhancedIt.Get()/origIt.Get())-static_cast<InputPixelType>(1);
-                M++;
-                ++origIt;
-                ++enhancedIt;
-            }
-            ++origIt;
-            ++enhancedIt;
-        }
-        meanBoost/=static_cast<InputPixelType>(M);
-        std::cout<<"Mean image contrast enhancement estimated in "<<(meanBoost)*static_cast<InputPixelType>(100)<<"% in comparison with the original image."<<std::endl;
-
-        typename WriterType::Pointer writer = WriterType::New();
-        writer->SetFileName( outputVolume.c_str() );
-        writer->SetInput( inputEnhanced->GetOutput() );
-        writer->SetUseCompression(1);
-        writer->Update();
-
-        return EXIT_SUCCESS;
+        profiler.Begin("meanEnhancement");
+        double meanBoost=ComputeLabelMean<InputImageType, LabelImageType>(rescaledContrastMap->GetOutput(), inputNonZero->GetOutput(), numberOfTiles)-1.0;
+        profiler.End("meanEnhancement");
+        meanEnhancement=(meanBoost)*100.0;
+        std::cout<<"Mean image contrast enhancement estimated in "<<meanEnhancement<<"% in comparison with the original image."<<std::endl;
     }else{
         //Split background and lesion regions
         //Lesion image:
-
-        typedef itk::RescaleIntensityImageFilter<InputImageType,InputImageType> RescalerType;
-        typename RescalerType::Pointer rescaledContrastMap = RescalerType::New();
-        rescaledContrastMap->SetInput(contrastMapReader->GetOutput());
         rescaledContrastMap->SetOutputMaximum(1.0);
         rescaledContrastMap->SetOutputMinimum(0.0);
 
-
         typedef itk::ThresholdImageFilter<InputImageType>  ThresholderType;
         typename ThresholderType::Pointer lesionImage = ThresholderType::New();
         lesionImage->SetInput(rescaledContrastMap->GetOutput());
         lesionImage->ThresholdBelow(static_cast<InputPixelType>(lesionThr));
+        lesionImage->ReleaseDataFlagOn();
         //Background image:
         typedef itk::SubtractImageFilter<InputImageType>  SubtractType;
         typename SubtractType::Pointer backgroundImage = SubtractType::New();
         backgroundImage->SetInput1(rescaledContrastMap->GetOutput());
         backgroundImage->SetInput2(lesionImage->GetOutput());
 
-        //Apply region mask over the contrast map
+        //Apply region mask over the contrast map (the whole volume is used when no mask is given)
         typedef itk::MaskImageFilter<InputImageType, LabelImageType>  MaskFilterType;
         typename MaskFilterType::Pointer maskedImage = MaskFilterType::New();
-        maskedImage->SetInput(backgroundImage->GetOutput());
-        maskedImage->SetMaskImage(regionMaskReader->GetOutput());
-        maskedImage->Update();
+        const InputImageType * regionImage = backgroundImage->GetOutput();
+        if (!regionMask.empty()) {
+            regionMaskReader->SetFileName( regionMask.c_str() );
+            maskedImage->SetInput(backgroundImage->GetOutput());
+            maskedImage->SetMaskImage(regionMaskReader->GetOutput());
+            maskedImage->InPlaceOn();
+            regionMaskReader->ReleaseDataFlagOn();
+            regionImage = maskedImage->GetOutput();
+        }
 
         //Calculating baseline contrast
-        InputPixelType baselineValue = 0;
-        typedef itk::ImageRegionIterator< InputImageType >              IteratorType;
-        IteratorType contrastIt(maskedImage->GetOutput(), maskedImage->GetOutput()->GetBufferedRegion());
-
-        contrastIt.GoToBegin();
-        int N=0;
-        while (!contrastIt.IsAtEnd()) {
-            //        std::cout<<contrastIt.Get()<<std::endl;
-            if (contrastIt.Get()!=static_cast<InputPixelType>(0)) {
-                baselineValue=baselineValue+contrastIt.Get();
-                ++contrastIt;
-                N++;
-            }
-            ++contrastIt;
-        }
-        baselineValue/=static_cast<InputPixelType>(N);
+        typename NonZeroType::Pointer regionNonZero = NonZeroType::New();
+        regionNonZero->SetInput(regionImage);
+        regionNonZero->SetLowerThreshold(0);
+        regionNonZero->SetUpperThreshold(0);
+        regionNonZero->SetInsideValue(0);
+        regionNonZero->SetOutsideValue(1);
+        regionNonZero->ReleaseDataFlagOn();
+        profiler.Begin("regionMeanContrast");
+        InputPixelType baselineValue = static_cast<InputPixelType>(ComputeLabelMean<InputImageType, LabelImageType>(regionImage, regionNonZero->GetOutput(), numberOfTiles));
+        profiler.End("regionMeanContrast");
+        //The region image is only used by the baseline contrast
+        backgroundImage->GetOutput()->ReleaseData();
+        maskedImage->GetOutput()->ReleaseData();
+        regionMeanContrast=static_cast<double>(baselineValue);
         std::cout<<"Region mean contrast: "<<baselineValue<<std::endl;
 
         typename SubtractType::Pointer baselineContrast = SubtractType::New();
@@ -163,68 +208,82 @@ int DoIt( int argc, char * argv[], T )
         typename ThresholderType::Pointer finalContrasMap = ThresholderType::New();
         finalContrasMap->SetInput(baselineContrast->GetOutput());
         finalContrasMap->ThresholdBelow(0.0);
-        finalContrasMap->Update();
-
-        rescaledContrastMap->SetInput(finalContrasMap->GetOutput());
-        rescaledContrastMap->SetOutputMaximum(1.0);
-        rescaledContrastMap->SetOutputMinimum(0.0);
+        finalContrasMap->InPlaceOn();
+
+        InputPixelType finalMinimum, finalMaximum;
+        profiler.Begin("finalContrastMapRange");
+        ComputeRange<InputImageType>(finalContrasMap->GetOutput(), numberOfTiles, finalMinimum, finalMaximum);
+        profiler.End("finalContrastMapRange");
+        //Every consumer of the rescaled contrast map has run
+        rescaledContrastMap->GetOutput()->ReleaseData();
+        typename RescalerType::Pointer rescaledFinalContrastMap = RescalerType::New();
+        rescaledFinalContrastMap->SetInput(finalContrasMap->GetOutput());
+        rescaledFinalContrastMap->SetWindowMinimum(finalMinimum);
+        rescaledFinalContrastMap->SetWindowMaximum(finalMaximum);
+        rescaledFinalContrastMap->SetOutputMaximum(1.0);
+        rescaledFinalContrastMap->SetOutputMinimum(0.0);
 
         //Applying contrast weighting on the input image
         InputPixelType contrastPercentage = static_cast<InputPixelType>(weight)+static_cast<InputPixelType>(1);
-        typedef itk::MultiplyImageFilter< InputImageType >      MultiplyType;
         typename MultiplyType::Pointer rescaledBoost = MultiplyType::New();
-        rescaledBoost->SetInput1(rescaledContrastMap->GetOutput());
+        rescaledBoost->SetInput1(rescaledFinalContrastMap->GetOutput());
         rescaledBoost->SetConstant2(contrastPercentage);
+        rescaledBoost->InPlaceOn();
 
         typedef itk::AddImageFilter<InputImageType>             AddType;
         typename AddType::Pointer boostWeight = AddType::New();
         boostWeight->SetInput1(rescaledBoost->GetOutput());
         boostWeight->SetConstant2(static_cast<InputPixelType>(1));
-        boostWeight->Update();
+        boostWeight->InPlaceOn();
 
-        typename MultiplyType::Pointer inputEnhanced = MultiplyType::New();
         inputEnhanced->SetInput1(inputReader->GetOutput());
         inputEnhanced->SetInput2(boostWeight->GetOutput());
-        inputEnhanced->Update();
 
         //Info: Mean lesion contrast enhancement
-        IteratorType enhancedIt(inputEnhanced->GetOutput(), inputEnhanced->GetOutput()->GetBufferedRegion());
-        IteratorType origIt(inputReader->GetOutput(),inputReader->GetOutput()->GetBufferedRegion());
-        IteratorType maskIt(finalContrasMap->GetOutput(), finalContrasMap->GetOutput()->GetBufferedRegion());
-
-        enhancedIt.GoToBegin();
-        origIt.GoToBegin();
-        maskIt.GoToBegin();
-        InputPixelType meanBoost=0;
-        int M=0;
-        while (!enhancedIt.IsAtEnd()) {
-            if (maskIt.Get()!=0) {
-                if (enhancedIt.Get()!=static_cast<InputPixelType>(0)) {
-                    meanBoost+=(enhancedIt.Get()/origIt.Get())-static_cast<InputPixelType>(1);
-                    M++;
-                    ++origIt;
-                    ++enhancedIt;
-                    ++maskIt;
-                }
-            }
-            ++origIt;
-            ++enhancedIt;
-            ++maskIt;
-        }
-
-        meanBoost/=static_cast<InputPixelType>(M);
-        std::cout<<"Mean image contrast enhancement estimated in "<<(meanBoost)*static_cast<InputPixelType>(100)<<"% in comparison with the original image."<<std::endl;
-
-        typename WriterType::Pointer writer = WriterType::New();
-        writer->SetFileName( outputVolume.c_str() );
-        writer->SetInput( inputEnhanced->GetOutput() );
-        writer->SetUseCompression(1);
-        writer->Update();
-
-        return EXIT_SUCCESS;
+        typename NonZeroType::Pointer contrastNonZero = NonZeroType::New();
+        contrastNonZero->SetInput(finalContrasMap->GetOutput());
+        contrastNonZero->SetLowerThreshold(0);
+        contrastNonZero->SetUpperThreshold(0);
+        contrastNonZero->SetInsideValue(0);
+        contrastNonZero->SetOutsideValue(1);
+        typedef itk::AndImageFilter<LabelImageType>             AndType;
+        typename AndType::Pointer boostedVoxels = AndType::New();
+        boostedVoxels->SetInput1(contrastNonZero->GetOutput());
+        boostedVoxels->SetInput2(inputNonZero->GetOutput());
+        boostedVoxels->InPlaceOn();
+
+        profiler.Begin("meanEnhancement");
+        double meanBoost=ComputeLabelMean<InputImageType, LabelImageType>(boostWeight->GetOutput(), boostedVoxels->GetOutput(), numberOfTiles)-1.0;
+        profiler.End("meanEnhancement");
+        meanEnhancement=(meanBoost)*100.0;
+        std::cout<<"Mean image contrast enhancement estimated in "<<meanEnhancement<<"% in comparison with the original image."<<std::endl;
+        //Only the boost weights are left for the weighting
+        finalContrasMap->GetOutput()->ReleaseData();
     }
 
+    //The input volume has no other consumer left, the weighted volume reuses its buffer
+    inputEnhanced->InPlaceOn();
+
+    typename WriterType::Pointer writer = WriterType::New();
+    writer->SetFileName( outputVolume.c_str() );
+    writer->SetInput( inputEnhanced->GetOutput() );
+    //Compressed files can not be written tile by tile.
+    writer->SetUseCompression(numberOfTiles<=1);
+    writer->SetNumberOfStreamDivisions(numberOfTiles);
+    profiler.Observe(writer, "writer");
+    writer->Update();
+
+    if (!returnParameterFile.empty()) {
+        std::ofstream returnFile(returnParameterFile.c_str());
+        returnFile<<"regionMeanContrast = "<<regionMeanContrast<<std::endl;
+        returnFile<<"meanEnhancement = "<<meanEnhancement<<std::endl;
+    }
+    if (!profileOutput.empty()) {
+        std::ofstream profileFile(profileOutput.c_str());
+        profiler.Write(profileFile);
+    }
 
+    return EXIT_SUCCESS;
 }
 
 } // end of anonymous namespace
@@ -233,6 +292,10 @@ int main( int argc, char * argv[] )
 {
     PARSE_ARGS;
 
+    //Thread budget given by the caller, 0 keeps the ITK default (every core). The former
+    //default is restored on return, since an in-process CLI shares it with Slicer
+    itk::ThreadBudget threadBudget(numberOfThreads);
+
     itk::ImageIOBase::IOPixelType     pixelType;
     itk::ImageIOBase::IOComponentType componentType;
 